@@ -0,0 +1,91 @@
+"""
+Per-document cost of office conversion: one request per file versus
+/convert/batch-to-pdf.
+
+Generates small DOCX files and converts them through the app in-process,
+first one /convert/word-to-pdf request at a time (the concurrency a client
+would typically use), then with one batch request. The result cache is
+disabled so every run really converts. Needs LibreOffice on PATH.
+
+    cd server
+    python benchmarks/convert_batch.py --documents 10 40 --concurrency 4
+"""
+import argparse
+import io
+import json
+import os
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+SERVER_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def make_documents(count: int):
+    import docx
+
+    documents = []
+    for i in range(count):
+        document = docx.Document()
+        document.add_heading(f"Document {i}", level=1)
+        for n in range(20):
+            document.add_paragraph(f"Paragraph {n} of document {i}. " * 8)
+        buffer = io.BytesIO()
+        document.save(buffer)
+        documents.append((f"document_{i:03d}.docx", buffer.getvalue()))
+    return documents
+
+
+def run_single(client, documents, concurrency: int) -> float:
+    def convert(document):
+        name, data = document
+        response = client.post("/convert/word-to-pdf", files={"file": (name, data)})
+        response.raise_for_status()
+
+    started = time.perf_counter()
+    with ThreadPoolExecutor(concurrency) as executor:
+        list(executor.map(convert, documents))
+    return time.perf_counter() - started
+
+
+def run_batch(client, documents) -> float:
+    started = time.perf_counter()
+    response = client.post("/convert/batch-to-pdf", files=[("file", document) for document in documents])
+    response.raise_for_status()
+    return time.perf_counter() - started
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--documents", type=int, nargs="+", default=[10, 40])
+    parser.add_argument("--concurrency", type=int, default=4, help="parallel single-file requests")
+    parser.add_argument("--json", help="also write the results to this file")
+    args = parser.parse_args()
+
+    os.environ["TOOLKIT_CACHE_ENABLED"] = "0"
+    os.chdir(SERVER_DIR)
+    sys.path.insert(0, SERVER_DIR)
+    from fastapi.testclient import TestClient
+    import main as app_main
+
+    results = []
+    with TestClient(app_main.app) as client:
+        # Wait for the pool so cold starts don't count against either mode
+        from utils import get_libreoffice_pool
+        get_libreoffice_pool()
+        print(f"{'mode':<8} {'documents':>9} {'seconds':>8} {'ms/doc':>8}")
+        for count in args.documents:
+            documents = make_documents(count)
+            for mode, run in (("single", lambda: run_single(client, documents, args.concurrency)),
+                              ("batch", lambda: run_batch(client, documents))):
+                seconds = run()
+                results.append({"mode": mode, "documents": count, "seconds": seconds})
+                print(f"{mode:<8} {count:>9} {seconds:>8.2f} {seconds / count * 1000:>8.1f}")
+
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
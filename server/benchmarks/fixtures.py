@@ -0,0 +1,175 @@
+"""
+Synthetic inputs for the benchmarks, generated locally so runs don't depend
+on sample files. Everything is deterministic for a given scale, so two runs
+on the same machine convert the same bytes.
+
+    cd server
+    python benchmarks/fixtures.py /tmp/bench_fixtures --scale 2
+"""
+import argparse
+import io
+import os
+import random
+import zlib
+from typing import Dict
+
+WORDS = ("lorem ipsum dolor sit amet consectetur adipiscing elit sed do eiusmod tempor incididunt ut labore "
+         "et dolore magna aliqua enim ad minim veniam quis nostrud exercitation ullamco laboris nisi").split()
+
+
+def _sentence(rng: random.Random, words: int = 12) -> str:
+    return " ".join(rng.choice(WORDS) for _ in range(words)).capitalize() + "."
+
+
+def write_text_pdf(path: str, pages: int, lines_per_page: int = 50, seed: int = 0):
+    """Text only PDF with one shared font, written directly (no renderer needed)."""
+    rng = random.Random(seed)
+    objects = {1: b"<< /Type /Catalog /Pages 2 0 R >>", 3: b"<< /Type /Font /Subtype /Type1 /BaseFont /Helvetica >>"}
+    kids = []
+    number = 4
+    for page in range(pages):
+        lines = [f"BT /F1 10 Tf 12 TL 50 790 Td (Page {page + 1}) Tj"]
+        for _ in range(lines_per_page):
+            lines.append(f"T* ({_sentence(rng)}) Tj")
+        lines.append("ET")
+        content = zlib.compress("\n".join(lines).encode("latin-1"))
+        objects[number] = b"<< /Length %d /Filter /FlateDecode >>\nstream\n" % len(content) + content + b"\nendstream"
+        objects[number + 1] = (b"<< /Type /Page /Parent 2 0 R /MediaBox [0 0 595 842] "
+                               b"/Resources << /Font << /F1 3 0 R >> >> /Contents %d 0 R >>" % number)
+        kids.append(number + 1)
+        number += 2
+    objects[2] = b"<< /Type /Pages /Count %d /Kids [%s] >>" % (len(kids), b" ".join(b"%d 0 R" % k for k in kids))
+
+    with open(path, "wb") as f:
+        f.write(b"%PDF-1.4\n%\xe2\xe3\xcf\xd3\n")
+        offsets = {}
+        for n in sorted(objects):
+            offsets[n] = f.tell()
+            f.write(b"%d 0 obj\n" % n + objects[n] + b"\nendobj\n")
+        xref = f.tell()
+        f.write(b"xref\n0 %d\n0000000000 65535 f \n" % (number,))
+        for n in range(1, number):
+            f.write(b"%010d 00000 n \n" % offsets[n])
+        f.write(b"trailer\n<< /Size %d /Root 1 0 R >>\nstartxref\n%d\n%%%%EOF\n" % (number, xref))
+
+
+def write_image_pdf(path: str, pages: int, size=(1600, 1200), seed: int = 0):
+    from PIL import Image
+
+    images = [Image.effect_noise(size, 30 + (seed + n) % 50).convert("RGB") for n in range(pages)]
+    images[0].save(path, save_all=True, append_images=images[1:], resolution=150, quality=90)
+
+
+def write_image(path: str, size, seed: int = 0):
+    from PIL import Image, ImageDraw
+
+    # Noise plus shapes, so encoders see both texture and flat areas
+    image = Image.effect_noise(size, 20 + seed % 40).convert("RGB")
+    draw = ImageDraw.Draw(image)
+    rng = random.Random(seed)
+    for _ in range(20):
+        x, y = rng.randrange(size[0]), rng.randrange(size[1])
+        draw.rectangle([x, y, x + size[0] // 8, y + size[1] // 8], fill=tuple(rng.randrange(256) for _ in range(3)))
+    image.save(path, **({"quality": 90} if path.endswith(".jpg") else {}))
+
+
+def write_text(path: str, lines: int, seed: int = 0):
+    rng = random.Random(seed)
+    with open(path, "w") as f:
+        for _ in range(lines):
+            f.write(_sentence(rng) + "\n")
+
+
+def write_docx(path: str, paragraphs: int, seed: int = 0):
+    import docx
+
+    rng = random.Random(seed)
+    document = docx.Document()
+    document.add_heading("Benchmark document", level=1)
+    for i in range(paragraphs):
+        if i % 20 == 0:
+            document.add_heading(f"Section {i // 20 + 1}", level=2)
+        document.add_paragraph(" ".join(_sentence(rng) for _ in range(5)))
+    table = document.add_table(rows=10, cols=4)
+    for row in table.rows:
+        for cell in row.cells:
+            cell.text = str(rng.randrange(10000))
+    document.save(path)
+
+
+def write_xlsx(path: str, rows: int, columns: int = 10, seed: int = 0):
+    import openpyxl
+
+    rng = random.Random(seed)
+    workbook = openpyxl.Workbook(write_only=True)
+    sheet = workbook.create_sheet("Data")
+    sheet.append([f"Column {c + 1}" for c in range(columns)])
+    for _ in range(rows):
+        sheet.append([rng.randrange(100000) if c % 2 else rng.choice(WORDS) for c in range(columns)])
+    workbook.save(path)
+
+
+def write_pptx(path: str, slides: int, seed: int = 0):
+    from PIL import Image
+    from pptx import Presentation
+    from pptx.util import Inches
+
+    rng = random.Random(seed)
+    presentation = Presentation()
+    image = io.BytesIO()
+    Image.effect_noise((800, 600), 40).convert("RGB").save(image, "JPEG", quality=85)
+    for i in range(slides):
+        slide = presentation.slides.add_slide(presentation.slide_layouts[1])
+        slide.shapes.title.text = f"Slide {i + 1}"
+        slide.placeholders[1].text = "\n".join(_sentence(rng, 6) for _ in range(4))
+        if i % 3 == 0:
+            image.seek(0)
+            slide.shapes.add_picture(image, Inches(5), Inches(4), width=Inches(4))
+    presentation.save(path)
+
+
+def make_fixtures(directory: str, scale: int = 1) -> Dict[str, str]:
+    """
+    Writes the fixtures into directory (reusing files already there) and
+    returns {name: path}. scale multiplies page, row and slide counts.
+    Office fixtures are left out when their library is not installed.
+    """
+    os.makedirs(directory, exist_ok=True)
+    writers = {
+        "text.pdf": lambda p: write_text_pdf(p, 20 * scale),
+        "images.pdf": lambda p: write_image_pdf(p, 5 * scale),
+        "many-pages.pdf": lambda p: write_text_pdf(p, 500 * scale, lines_per_page=10, seed=1),
+        "small.png": lambda p: write_image(p, (640, 480)),
+        "large.jpg": lambda p: write_image(p, (4000, 3000), seed=1),
+        "document.docx": lambda p: write_docx(p, 60 * scale),
+        "spreadsheet.xlsx": lambda p: write_xlsx(p, 2000 * scale),
+        "slides.pptx": lambda p: write_pptx(p, 10 * scale),
+        "notes.txt": lambda p: write_text(p, 500 * scale),
+    }
+    fixtures = {}
+    for name, write in writers.items():
+        path = os.path.join(directory, f"{os.path.splitext(name)[0]}-x{scale}{os.path.splitext(name)[1]}")
+        if not os.path.exists(path):
+            # Written under a temporary name, an interrupted run leaves no
+            # truncated fixture behind to be reused
+            partial = os.path.join(directory, "partial-" + os.path.basename(path))
+            try:
+                write(partial)
+            except ImportError:
+                continue
+            os.replace(partial, path)
+        fixtures[name] = path
+    return fixtures
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("directory")
+    parser.add_argument("--scale", type=int, default=1)
+    args = parser.parse_args()
+    for name, path in make_fixtures(args.directory, args.scale).items():
+        print(f"{name:<18} {os.path.getsize(path) / 1024:>10.1f} KB  {path}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,115 @@
+"""
+Peak memory and wall time of turning a batch of photos into one PDF.
+
+Generates phone-sized JPEGs (12 MP by default), then converts the first N
+of them for several N, each run in a fresh process. Compares img2pdf (the
+previous implementation, whole PDF built in memory) with the streaming
+writer used by /image/to-pdf for each preset. Peak RSS is that of the
+converting process; with the streaming writer images are decoded in the
+process pool workers, each of which holds one image at a time.
+
+    cd server
+    python benchmarks/image_pdf_memory.py --images 10 50 100 --presets original compact
+"""
+import argparse
+import json
+import os
+import subprocess
+import sys
+import tempfile
+
+SERVER_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from merge_memory import peak_rss_kb  # noqa: E402
+
+
+def make_images(directory: str, count: int, width: int, height: int):
+    from PIL import Image
+
+    # One noise image saved under many names keeps generation quick; the
+    # converters don't know they are identical
+    image = Image.effect_noise((width, height), 40).convert("RGB")
+    paths = []
+    for i in range(count):
+        path = os.path.join(directory, f"photo_{i:03d}.jpg")
+        image.save(path, quality=90, dpi=(72, 72))
+        paths.append(path)
+    return paths
+
+
+def run_convert(engine: str, paths, output_path: str):
+    sys.path.insert(0, SERVER_DIR)
+    if engine == "img2pdf":
+        import img2pdf
+        with open(output_path, "wb") as f:
+            f.write(img2pdf.convert(paths))
+    else:
+        import shutil
+        import storage
+        import utils
+        storage.ensure_dirs()
+        result = utils.image_to_pdf(paths, engine)
+        shutil.move(result, output_path)
+        utils.shutdown_executors()
+
+
+def measure(engine: str, paths, directory: str) -> dict:
+    output_path = os.path.join(directory, f"images_{engine}_{len(paths)}.pdf")
+    code = (
+        "import json, sys, time\n"
+        f"sys.path.insert(0, {os.path.dirname(os.path.abspath(__file__))!r})\n"
+        "from image_pdf_memory import run_convert, peak_rss_kb\n"
+        f"sys.path.insert(0, {SERVER_DIR!r})\n"
+        "import utils\n"
+        "utils.import_modules()\n"
+        "if __name__ == '__main__':\n"
+        "    started = time.perf_counter()\n"
+        f"    run_convert({engine!r}, {list(paths)!r}, {output_path!r})\n"
+        "    print(json.dumps({'seconds': time.perf_counter() - started, 'peak_rss_kb': peak_rss_kb()}))\n"
+    )
+    script = os.path.join(directory, "run.py")
+    with open(script, "w") as f:
+        f.write(code)
+    result = subprocess.run([sys.executable, script], capture_output=True, text=True, cwd=SERVER_DIR)
+    if result.returncode != 0:
+        raise RuntimeError(result.stderr)
+    stats = json.loads(result.stdout.strip().splitlines()[-1])
+    stats.update({
+        "engine": engine,
+        "images": len(paths),
+        "input_bytes": sum(os.path.getsize(p) for p in paths),
+        "output_bytes": os.path.getsize(output_path),
+    })
+    os.remove(output_path)
+    return stats
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--images", type=int, nargs="+", default=[10, 50, 100])
+    parser.add_argument("--size", type=int, nargs=2, default=[4000, 3000], metavar=("WIDTH", "HEIGHT"))
+    parser.add_argument("--presets", nargs="+", default=["original", "compact"],
+                        help="streaming writer presets to run next to img2pdf")
+    parser.add_argument("--json", help="also write the results to this file")
+    args = parser.parse_args()
+
+    results = []
+    with tempfile.TemporaryDirectory(prefix="image_pdf_bench_") as directory:
+        paths = make_images(directory, max(args.images), *args.size)
+        print(f"{'engine':<10} {'images':>6} {'input MB':>9} {'output MB':>10} {'peak RSS MB':>12} {'seconds':>8}")
+        for count in args.images:
+            for engine in ["img2pdf"] + args.presets:
+                stats = measure(engine, paths[:count], directory)
+                results.append(stats)
+                print(f"{engine:<10} {count:>6} {stats['input_bytes'] / 2**20:>9.1f} "
+                      f"{stats['output_bytes'] / 2**20:>10.1f} {stats['peak_rss_kb'] / 1024:>12.1f} "
+                      f"{stats['seconds']:>8.2f}")
+
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
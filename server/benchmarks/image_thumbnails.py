@@ -0,0 +1,108 @@
+"""
+Decode time and peak memory of making thumbnails from large JPEGs.
+
+Generates camera-sized JPEGs, then turns each into a thumbnail in a fresh
+process per engine: "full" decodes the whole image and resizes it (the
+previous /image/convert path), "draft" is convert_image with draft()
+decoding and reduce(). The last engine runs the same batch through
+iter_convert_images on the process pool.
+
+    cd server
+    python benchmarks/image_thumbnails.py --images 20 --size 320
+"""
+import argparse
+import json
+import os
+import subprocess
+import sys
+import tempfile
+
+SERVER_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from merge_memory import peak_rss_kb  # noqa: E402
+
+
+def make_images(directory: str, count: int, width: int, height: int):
+    from PIL import Image
+
+    image = Image.effect_noise((width, height), 40).convert("RGB")
+    paths = []
+    for i in range(count):
+        path = os.path.join(directory, f"photo_{i:03d}.jpg")
+        image.save(path, quality=90)
+        paths.append(path)
+    return paths
+
+
+def run_thumbnails(engine: str, paths, size: int, output_dir: str):
+    sys.path.insert(0, SERVER_DIR)
+    from PIL import Image
+    import utils
+
+    if engine == "full":
+        for i, path in enumerate(paths):
+            img = Image.open(path).convert("RGB")
+            scale = size / float(max(img.size))
+            img = img.resize((round(img.width * scale), round(img.height * scale)), Image.LANCZOS)
+            img.save(os.path.join(output_dir, f"{i}.jpg"), "JPEG")
+    elif engine == "draft":
+        from imaging import convert_image
+        for i, path in enumerate(paths):
+            convert_image(path, os.path.join(output_dir, f"{i}.jpg"), "JPEG", size, size)
+    else:
+        items = [utils.BatchItem(i, os.path.basename(p), p) for i, p in enumerate(paths)]
+        options = utils.validate_image_convert_options("JPEG", size, size)
+        for _arcname, _path in utils.iter_convert_images(items, output_dir, options):
+            pass
+        utils.shutdown_executors()
+
+
+def measure(engine: str, paths, size: int, directory: str) -> dict:
+    output_dir = tempfile.mkdtemp(prefix=f"{engine}_", dir=directory)
+    script = os.path.join(directory, "run.py")
+    with open(script, "w") as f:
+        f.write(
+            "import json, sys, time\n"
+            f"sys.path.insert(0, {os.path.dirname(os.path.abspath(__file__))!r})\n"
+            "from image_thumbnails import run_thumbnails, peak_rss_kb\n"
+            f"sys.path.insert(0, {SERVER_DIR!r})\n"
+            "import utils\n"
+            "if __name__ == '__main__':\n"
+            "    started = time.perf_counter()\n"
+            f"    run_thumbnails({engine!r}, {list(paths)!r}, {size}, {output_dir!r})\n"
+            "    print(json.dumps({'seconds': time.perf_counter() - started, 'peak_rss_kb': peak_rss_kb()}))\n"
+        )
+    result = subprocess.run([sys.executable, script], capture_output=True, text=True, cwd=SERVER_DIR)
+    if result.returncode != 0:
+        raise RuntimeError(result.stderr)
+    stats = json.loads(result.stdout.strip().splitlines()[-1])
+    stats.update({"engine": engine, "images": len(paths), "size": size})
+    return stats
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--images", type=int, default=20)
+    parser.add_argument("--source", type=int, nargs=2, default=[4000, 3000], metavar=("WIDTH", "HEIGHT"))
+    parser.add_argument("--size", type=int, default=320, help="longest side of the thumbnails")
+    parser.add_argument("--json", help="also write the results to this file")
+    args = parser.parse_args()
+
+    results = []
+    with tempfile.TemporaryDirectory(prefix="thumbnail_bench_") as directory:
+        paths = make_images(directory, args.images, *args.source)
+        print(f"{'engine':<8} {'images':>6} {'ms/image':>9} {'peak RSS MB':>12}")
+        for engine in ("full", "draft", "pool"):
+            stats = measure(engine, paths, args.size, directory)
+            results.append(stats)
+            print(f"{engine:<8} {args.images:>6} {stats['seconds'] / args.images * 1000:>9.1f} "
+                  f"{stats['peak_rss_kb'] / 1024:>12.1f}")
+
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
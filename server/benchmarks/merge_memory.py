@@ -0,0 +1,122 @@
+"""
+Peak memory of merging a growing number of PDFs.
+
+Generates image heavy synthetic inputs, then merges the first N of them for
+several N, each run in a fresh process so ru_maxrss is the peak of that
+merge alone. Compares PyPDF2's PdfMerger (the previous implementation) with
+the incremental merger used by /pdf/merge.
+
+    cd server
+    python benchmarks/merge_memory.py --inputs 5 10 20 40 --pages 10
+"""
+import argparse
+import json
+import os
+import subprocess
+import sys
+import tempfile
+
+SERVER_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def make_inputs(directory: str, count: int, pages: int):
+    from PIL import Image
+
+    paths = []
+    for i in range(count):
+        images = [
+            Image.effect_noise((1200, 900), 30 + (i * pages + n) % 50).convert("RGB")
+            for n in range(pages)
+        ]
+        path = os.path.join(directory, f"input_{i:03d}.pdf")
+        images[0].save(path, save_all=True, append_images=images[1:], resolution=150, quality=85)
+        paths.append(path)
+    return paths
+
+
+def run_merge(engine: str, paths, output_path: str):
+    sys.path.insert(0, SERVER_DIR)
+    if engine == "pdfmerger":
+        import PyPDF2
+        merger = PyPDF2.PdfMerger()
+        for path in paths:
+            merger.append(path)
+        merger.write(output_path)
+        merger.close()
+    else:
+        from merging import IncrementalMerger
+        merger = IncrementalMerger(output_path)
+        for path in paths:
+            merger.add(path)
+        merger.finish()
+
+
+def peak_rss_kb() -> int:
+    # VmHWM starts fresh at exec; ru_maxrss can carry over the parent's
+    # peak on Linux (and is in bytes on macOS)
+    try:
+        with open("/proc/self/status") as f:
+            for line in f:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1])
+    except OSError:
+        pass
+    import resource
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak // 1024 if sys.platform == "darwin" else peak
+
+
+def measure(engine: str, paths, directory: str) -> dict:
+    output_path = os.path.join(directory, f"merged_{engine}_{len(paths)}.pdf")
+    code = (
+        "import json, sys, time\n"
+        f"sys.path.insert(0, {os.path.dirname(os.path.abspath(__file__))!r})\n"
+        "from merge_memory import run_merge, peak_rss_kb\n"
+        # Same imports for both engines, like in a server worker
+        f"sys.path.insert(0, {SERVER_DIR!r})\n"
+        "import utils\n"
+        "utils.import_modules()\n"
+        "started = time.perf_counter()\n"
+        f"run_merge({engine!r}, {list(paths)!r}, {output_path!r})\n"
+        "print(json.dumps({'seconds': time.perf_counter() - started, 'peak_rss_kb': peak_rss_kb()}))\n"
+    )
+    result = subprocess.run([sys.executable, "-c", code], capture_output=True, text=True, cwd=SERVER_DIR)
+    if result.returncode != 0:
+        raise RuntimeError(result.stderr)
+    stats = json.loads(result.stdout.strip().splitlines()[-1])
+    stats.update({
+        "engine": engine,
+        "inputs": len(paths),
+        "input_bytes": sum(os.path.getsize(p) for p in paths),
+        "output_bytes": os.path.getsize(output_path),
+    })
+    os.remove(output_path)
+    return stats
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--inputs", type=int, nargs="+", default=[5, 10, 20, 40])
+    parser.add_argument("--pages", type=int, default=10, help="pages per input")
+    parser.add_argument("--engines", nargs="+", default=["pdfmerger", "incremental"])
+    parser.add_argument("--json", help="also write the results to this file")
+    args = parser.parse_args()
+
+    results = []
+    with tempfile.TemporaryDirectory(prefix="merge_bench_") as directory:
+        paths = make_inputs(directory, max(args.inputs), args.pages)
+        print(f"{'engine':<12} {'inputs':>6} {'input MB':>9} {'peak RSS MB':>12} {'seconds':>8}")
+        for count in args.inputs:
+            for engine in args.engines:
+                stats = measure(engine, paths[:count], directory)
+                results.append(stats)
+                print(f"{engine:<12} {count:>6} {stats['input_bytes'] / 2**20:>9.1f} "
+                      f"{stats['peak_rss_kb'] / 1024:>12.1f} {stats['seconds']:>8.2f}")
+
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
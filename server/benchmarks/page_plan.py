@@ -0,0 +1,84 @@
+"""
+Time of page removal and reordering as documents grow.
+
+Generates text PDFs with the given page counts and applies the same plans
+to each: remove every third page, reverse all pages and rotate them, and
+duplicate every page. The previous remove_pdf_pages (a PdfWriter and a list
+membership test per page) is measured alongside for the removal. The time
+per page should stay flat for the page plan engine.
+
+    cd server
+    python benchmarks/page_plan.py --pages 1000 2000 5000
+"""
+import argparse
+import json
+import os
+import sys
+import tempfile
+import time
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+SERVER_DIR = os.path.dirname(BENCH_DIR)
+sys.path.insert(0, BENCH_DIR)
+sys.path.insert(0, SERVER_DIR)
+
+from fixtures import write_text_pdf  # noqa: E402
+
+
+def list_remove(file_path: str, pages_to_remove, output_path: str):
+    # The implementation before the page plan engine
+    import PyPDF2
+
+    reader = PyPDF2.PdfReader(file_path)
+    writer = PyPDF2.PdfWriter()
+    for i, page in enumerate(reader.pages):
+        if (i + 1) not in pages_to_remove:
+            writer.add_page(page)
+    with open(output_path, "wb") as f:
+        writer.write(f)
+
+
+def cases(pages: int):
+    every_third = list(range(3, pages + 1, 3))
+    return {
+        "remove (list)": lambda u, path, d: list_remove(path, every_third, os.path.join(d, "list.pdf")),
+        "remove": lambda u, path, d: u.organize_pdf(path, remove=every_third, output_dir=d),
+        "reverse+rotate": lambda u, path, d: u.organize_pdf(path, "end-1", rotate=90, output_dir=d),
+        "duplicate": lambda u, path, d: u.organize_pdf(path, ",".join(f"{n},{n}" for n in range(1, pages + 1)),
+                                                       output_dir=d),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--pages", type=int, nargs="+", default=[1000, 2000, 5000])
+    parser.add_argument("--repeat", type=int, default=3, help="best of N runs")
+    parser.add_argument("--json", help="also write the results to this file")
+    args = parser.parse_args()
+
+    import utils
+
+    results = []
+    with tempfile.TemporaryDirectory(prefix="page_plan_bench_") as directory:
+        print(f"{'case':<16} {'pages':>6} {'seconds':>8} {'us/page':>8}")
+        for pages in args.pages:
+            path = os.path.join(directory, f"input_{pages}.pdf")
+            write_text_pdf(path, pages, lines_per_page=5)
+            for name, run in cases(pages).items():
+                best = None
+                for _ in range(args.repeat):
+                    out_dir = tempfile.mkdtemp(dir=directory)
+                    started = time.perf_counter()
+                    run(utils, path, out_dir)
+                    elapsed = time.perf_counter() - started
+                    best = elapsed if best is None else min(best, elapsed)
+                results.append({"case": name, "pages": pages, "seconds": best})
+                print(f"{name:<16} {pages:>6} {best:>8.3f} {best / pages * 1e6:>8.1f}")
+
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,140 @@
+"""
+Latency of small requests while another client keeps heavy ones running.
+
+One client sends /text/to-pdf requests for a large log from several
+threads at once while another sends small /pdf/remove-pages requests one
+after the other; the small requests' latency is reported. Scenarios, each
+in a fresh server process:
+
+- idle: small requests only
+- lanes: the default light and heavy lanes
+- one lane: TOOLKIT_HEAVY_COST so high that everything shares a lane
+
+With lanes the small requests' p99 should stay close to idle.
+
+    cd server
+    python benchmarks/scheduling.py --heavy-mb 20 --heavy-clients 8 --requests 50
+"""
+import argparse
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+SERVER_DIR = os.path.dirname(BENCH_DIR)
+sys.path.insert(0, BENCH_DIR)
+
+from fixtures import write_text_pdf  # noqa: E402
+from suite import percentile  # noqa: E402
+from text_to_pdf import write_log  # noqa: E402
+
+SCENARIOS = {
+    "idle": {},
+    "lanes": {},
+    "one lane": {"TOOLKIT_HEAVY_COST": "1e12"},
+}
+
+
+def worker(scenario: str, small_path: str, heavy_path: str, args) -> dict:
+    from fastapi.testclient import TestClient
+    import main
+
+    with open(small_path, "rb") as f:
+        small = [("file", ("small.pdf", f.read(), "application/pdf"))]
+    with open(heavy_path, "rb") as f:
+        heavy = [("file", ("log.txt", f.read(), "text/plain"))]
+    stop = threading.Event()
+    heavy_done = []
+
+    def load():
+        while not stop.is_set():
+            response = client.post("/text/to-pdf", files=heavy, headers={"X-Client": "heavy"})
+            heavy_done.append(response.status_code)
+
+    def post_small():
+        return client.post("/pdf/remove-pages", files=small, data={"pages": "[1]"}, headers={"X-Client": "light"})
+
+    with TestClient(main.app) as client:
+        # Starts every process pool worker
+        warmup = [threading.Thread(target=post_small) for _ in range(args.workers)]
+        for thread in warmup:
+            thread.start()
+        for thread in warmup:
+            thread.join()
+        threads = []
+        if scenario != "idle":
+            threads = [threading.Thread(target=load) for _ in range(args.heavy_clients)]
+            for thread in threads:
+                thread.start()
+            # Let the heavy requests take their slots first
+            time.sleep(args.head_start)
+        latencies, errors = [], 0
+        for _ in range(args.requests):
+            started = time.perf_counter()
+            response = post_small()
+            latencies.append(time.perf_counter() - started)
+            errors += response.status_code >= 400
+        stop.set()
+        for thread in threads:
+            thread.join()
+    return {
+        "scenario": scenario,
+        "p50_ms": percentile(latencies, 50) * 1000,
+        "p99_ms": percentile(latencies, 99) * 1000,
+        "max_ms": max(latencies) * 1000,
+        "errors": errors,
+        "heavy_done": sum(1 for status in heavy_done if status == 200),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--heavy-mb", type=float, default=20, help="size of the log the heavy client converts")
+    parser.add_argument("--heavy-clients", type=int, default=8, help="concurrent heavy requests")
+    parser.add_argument("--requests", type=int, default=50, help="small requests measured")
+    parser.add_argument("--head-start", type=float, default=2.0, help="seconds the heavy client starts earlier")
+    parser.add_argument("--workers", type=int, default=4, help="TOOLKIT_CPU_WORKERS of the server")
+    parser.add_argument("--scenarios", nargs="+", default=list(SCENARIOS), choices=list(SCENARIOS))
+    parser.add_argument("--json", help="also write the results to this file")
+    parser.add_argument("--worker", help=argparse.SUPPRESS)
+    parser.add_argument("--inputs", nargs=2, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.worker:
+        os.chdir(SERVER_DIR)
+        sys.path.insert(0, SERVER_DIR)
+        print(json.dumps(worker(args.worker, *args.inputs, args)))
+        return
+
+    results = []
+    with tempfile.TemporaryDirectory(prefix="scheduling_bench_") as directory:
+        small_path = os.path.join(directory, "small.pdf")
+        heavy_path = os.path.join(directory, "log.txt")
+        write_text_pdf(small_path, 5)
+        write_log(heavy_path, args.heavy_mb)
+        print(f"{'scenario':<10} {'p50 ms':>8} {'p99 ms':>8} {'max ms':>8} {'errors':>7} {'heavy done':>11}")
+        for scenario in args.scenarios:
+            env = dict(os.environ, TOOLKIT_CACHE_ENABLED="0", TOOLKIT_ACCESS_LOG="0", TOOLKIT_LOG_LEVEL="WARNING",
+                       TOOLKIT_CLIENT_HEADER="X-Client", TOOLKIT_CPU_WORKERS=str(args.workers),
+                       **SCENARIOS[scenario])
+            command = [sys.executable, os.path.abspath(__file__), "--worker", scenario,
+                       "--inputs", small_path, heavy_path] + sys.argv[1:]
+            result = subprocess.run(command, capture_output=True, text=True, cwd=SERVER_DIR, env=env)
+            if result.returncode != 0:
+                raise RuntimeError(result.stderr)
+            stats = json.loads(result.stdout.strip().splitlines()[-1])
+            results.append(stats)
+            print(f"{scenario:<10} {stats['p50_ms']:>8.1f} {stats['p99_ms']:>8.1f} {stats['max_ms']:>8.1f} "
+                  f"{stats['errors']:>7} {stats['heavy_done']:>11}")
+
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,132 @@
+"""
+Cold start: import time and time to first response.
+
+- import: `import main` in a fresh interpreter, with the heavy libraries
+  loaded on first use, and "eager" with them imported right away (what
+  every worker paid before they were deferred)
+- serve: starts serve.py for each TOOLKIT_PREWARM setting, measures the
+  time until GET / answers, then the first and second /pdf/remove-pages
+  request
+
+    cd server
+    python benchmarks/startup.py --repeat 5 --workers 2 --prewarm none imports,pool
+"""
+import argparse
+import json
+import os
+import socket
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+SERVER_DIR = os.path.dirname(BENCH_DIR)
+sys.path.insert(0, BENCH_DIR)
+
+from fixtures import write_text_pdf  # noqa: E402
+
+IMPORT_CASES = {
+    "lazy": "import main",
+    "eager": "import main, lazy; lazy.import_modules()",
+}
+
+
+def time_import(statement: str) -> float:
+    code = (
+        "import time\n"
+        "started = time.perf_counter()\n"
+        f"{statement}\n"
+        "print(time.perf_counter() - started)\n"
+    )
+    result = subprocess.run([sys.executable, "-c", code], capture_output=True, text=True, cwd=SERVER_DIR,
+                            env=dict(os.environ, TOOLKIT_LOG_LEVEL="WARNING"))
+    if result.returncode != 0:
+        raise RuntimeError(result.stderr)
+    return float(result.stdout.strip().splitlines()[-1])
+
+
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def time_serve(prewarm: str, pdf_path: str, args) -> dict:
+    import httpx
+
+    port = free_port()
+    env = dict(os.environ, TOOLKIT_PREWARM=prewarm, TOOLKIT_CACHE_ENABLED="0", TOOLKIT_ACCESS_LOG="0",
+               TOOLKIT_LOG_LEVEL="WARNING")
+    started = time.perf_counter()
+    server = subprocess.Popen([sys.executable, "serve.py", "--host", "127.0.0.1", "--port", str(port),
+                               "--workers", str(args.workers)],
+                              cwd=SERVER_DIR, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    base = f"http://127.0.0.1:{port}"
+    try:
+        with httpx.Client(timeout=60) as client:
+            while True:
+                if server.poll() is not None:
+                    raise RuntimeError(f"serve.py exited with {server.returncode}")
+                try:
+                    if client.get(base + "/").status_code == 200:
+                        break
+                except httpx.TransportError:
+                    pass
+                if time.perf_counter() - started > args.timeout:
+                    raise RuntimeError("serve.py didn't answer in time")
+                time.sleep(0.01)
+            ready = time.perf_counter() - started
+            time.sleep(args.settle)
+
+            with open(pdf_path, "rb") as f:
+                files = [("file", ("input.pdf", f.read(), "application/pdf"))]
+            latencies = []
+            for _ in range(2):
+                request_started = time.perf_counter()
+                response = client.post(base + "/pdf/remove-pages", files=files, data={"pages": "[1]"})
+                response.raise_for_status()
+                latencies.append(time.perf_counter() - request_started)
+    finally:
+        server.terminate()
+        server.wait()
+    return {"prewarm": prewarm, "ready_ms": ready * 1000,
+            "first_ms": latencies[0] * 1000, "second_ms": latencies[1] * 1000}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--repeat", type=int, default=5, help="fresh interpreters per import case (median)")
+    parser.add_argument("--workers", type=int, default=1, help="server processes started by serve.py")
+    parser.add_argument("--prewarm", nargs="+", default=["none", "imports,pool"], help="TOOLKIT_PREWARM settings")
+    parser.add_argument("--settle", type=float, default=0.0,
+                        help="seconds between the first GET / and the first operation")
+    parser.add_argument("--timeout", type=float, default=60.0)
+    parser.add_argument("--json", help="also write the results to this file")
+    args = parser.parse_args()
+
+    results = {"import": [], "serve": []}
+    print(f"{'import':<8} {'median ms':>10} {'min ms':>8}")
+    for name, statement in IMPORT_CASES.items():
+        times = [time_import(statement) for _ in range(args.repeat)]
+        results["import"].append({"case": name, "median_ms": statistics.median(times) * 1000,
+                                  "min_ms": min(times) * 1000})
+        print(f"{name:<8} {statistics.median(times) * 1000:>10.1f} {min(times) * 1000:>8.1f}")
+
+    print(f"\n{'prewarm':<14} {'ready ms':>9} {'first ms':>9} {'second ms':>10}")
+    with tempfile.TemporaryDirectory(prefix="startup_bench_") as directory:
+        pdf_path = os.path.join(directory, "input.pdf")
+        write_text_pdf(pdf_path, 5)
+        for prewarm in args.prewarm:
+            stats = time_serve(prewarm, pdf_path, args)
+            results["serve"].append(stats)
+            print(f"{prewarm:<14} {stats['ready_ms']:>9.1f} {stats['first_ms']:>9.1f} {stats['second_ms']:>10.1f}")
+
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,370 @@
+"""
+Latency, throughput and peak memory of every toolkit operation.
+
+Generates synthetic fixtures (see fixtures.py), then benchmarks each
+processing function in utils.py directly and each HTTP endpoint through an
+in-process client at several concurrency levels. Every case runs in a
+fresh process, so its peak RSS is its own. The result cache is disabled.
+Cases needing LibreOffice or pdftoppm are skipped when those are missing.
+
+    cd server
+    python benchmarks/suite.py --json results.json
+    python benchmarks/suite.py --only merge split --concurrency 1 8
+    python benchmarks/suite.py --baseline results.json   # exits 1 on regressions
+
+Results are JSON: one entry per case and concurrency with p50/p99/mean
+latency in ms, throughput in operations per second, peak RSS of the
+benchmark process and of its largest child (process pool worker, pdftoppm,
+LibreOffice). Compare only runs from the same machine.
+"""
+import argparse
+import json
+import os
+import platform
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Dict, List, NamedTuple, Tuple
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+SERVER_DIR = os.path.dirname(BENCH_DIR)
+sys.path.insert(0, BENCH_DIR)
+
+from fixtures import make_fixtures  # noqa: E402
+from merge_memory import peak_rss_kb  # noqa: E402
+
+
+class FunctionCase(NamedTuple):
+    fixtures: Tuple[str, ...]
+    run: Callable  # (utils module, fixture paths, scratch dir) -> output path(s)
+    requires: Tuple[str, ...] = ()
+
+
+class EndpointCase(NamedTuple):
+    path: str
+    files: Tuple[Tuple[str, str, str], ...]  # (field, fixture, content type)
+    data: Dict[str, str]
+    requires: Tuple[str, ...] = ()
+
+
+PDF = "application/pdf"
+DOCX = "application/vnd.openxmlformats-officedocument.wordprocessingml.document"
+XLSX = "application/vnd.openxmlformats-officedocument.spreadsheetml.sheet"
+PPTX = "application/vnd.openxmlformats-officedocument.presentationml.presentation"
+
+FUNCTION_CASES = {
+    "merge_pdfs": FunctionCase(
+        ("text.pdf", "images.pdf", "many-pages.pdf"), lambda u, f, d: u.merge_pdfs(list(f))),
+    "split_pdf": FunctionCase(
+        ("many-pages.pdf",), lambda u, f, d: u.split_pdf(f[0], output_dir=d, every=10)),
+    "compress_pdf": FunctionCase(
+        ("images.pdf",), lambda u, f, d: u.compress_pdf(f[0], "ebook")),
+    "remove_pdf_pages": FunctionCase(
+        ("many-pages.pdf",), lambda u, f, d: u.remove_pdf_pages(f[0], list(range(1, 100)))),
+    "organize_pdf": FunctionCase(
+        ("many-pages.pdf",), lambda u, f, d: u.organize_pdf(f[0], "end-1", remove=list(range(1, 100)), rotate=90,
+                                                            output_dir=d)),
+    "pdf_to_images": FunctionCase(
+        ("text.pdf",), lambda u, f, d: u.pdf_to_images(f[0], dpi=100), ("pdftoppm",)),
+    "image_to_pdf": FunctionCase(
+        ("small.png", "large.jpg"), lambda u, f, d: u.image_to_pdf(list(f), "original")),
+    "image_to_pdf_compact": FunctionCase(
+        ("small.png", "large.jpg"), lambda u, f, d: u.image_to_pdf(list(f), "compact")),
+    "convert_image_format": FunctionCase(
+        ("large.jpg",), lambda u, f, d: u.convert_image_format(f[0], "WEBP", width=1600)),
+    "convert_docx_to_pdf": FunctionCase(
+        ("document.docx",), lambda u, f, d: u.convert_to_pdf_libreoffice(f[0], d), ("libreoffice",)),
+    "convert_xlsx_to_pdf": FunctionCase(
+        ("spreadsheet.xlsx",), lambda u, f, d: u.convert_to_pdf_libreoffice(f[0], d), ("libreoffice",)),
+    "prepare_workbook": FunctionCase(
+        ("spreadsheet.xlsx",), lambda u, f, d: u.prepare_workbook(f[0], d, **u.excel_preflight_options())),
+    "convert_pptx_to_pdf": FunctionCase(
+        ("slides.pptx",), lambda u, f, d: u.convert_to_pdf_libreoffice(f[0], d), ("libreoffice",)),
+    "text_to_pdf": FunctionCase(
+        ("notes.txt",), lambda u, f, d: u.text_to_pdf(f[0], d, **u.validate_text_pdf_options())),
+}
+
+ENDPOINT_CASES = {
+    "POST /pdf/merge": EndpointCase(
+        "/pdf/merge", (("file", "text.pdf", PDF), ("file", "images.pdf", PDF)), {}),
+    "POST /pdf/split": EndpointCase(
+        "/pdf/split", (("file", "many-pages.pdf", PDF),), {"every": "10"}),
+    "POST /pdf/compress": EndpointCase(
+        "/pdf/compress", (("file", "images.pdf", PDF),), {"preset": "ebook"}),
+    "POST /pdf/remove-pages": EndpointCase(
+        "/pdf/remove-pages", (("file", "text.pdf", PDF),), {"pages": "[1, 2, 3]"}),
+    "POST /pdf/organize": EndpointCase(
+        "/pdf/organize", (("file", "many-pages.pdf", PDF),), {"pages": "end-1", "remove": "1-99", "rotate": "90"}),
+    "POST /pdf/to-images": EndpointCase(
+        "/pdf/to-images", (("file", "text.pdf", PDF),), {"dpi": "100"}, ("pdftoppm",)),
+    "POST /image/to-pdf": EndpointCase(
+        "/image/to-pdf", (("file", "small.png", "image/png"), ("file", "large.jpg", "image/jpeg")), {}),
+    "POST /image/convert": EndpointCase(
+        "/image/convert", (("file", "large.jpg", "image/jpeg"),), {"format": "WEBP", "width": "1600"}),
+    "POST /convert/word-to-pdf": EndpointCase(
+        "/convert/word-to-pdf", (("file", "document.docx", DOCX),), {}, ("libreoffice",)),
+    "POST /convert/excel-to-pdf": EndpointCase(
+        "/convert/excel-to-pdf", (("file", "spreadsheet.xlsx", XLSX),), {}, ("libreoffice",)),
+    "POST /convert/ppt-to-pdf": EndpointCase(
+        "/convert/ppt-to-pdf", (("file", "slides.pptx", PPTX),), {}, ("libreoffice",)),
+    "POST /text/to-pdf": EndpointCase(
+        "/text/to-pdf", (("file", "notes.txt", "text/plain"),), {}),
+    "POST /convert/batch-to-pdf": EndpointCase(
+        "/convert/batch-to-pdf",
+        (("file", "document.docx", DOCX), ("file", "spreadsheet.xlsx", XLSX),
+         ("file", "slides.pptx", PPTX), ("file", "notes.txt", "text/plain")),
+        {}, ("libreoffice",)),
+}
+
+# Compared against the baseline; True if higher is better
+COMPARED = {"p50_ms": False, "p99_ms": False, "throughput": True, "peak_rss_kb": False}
+
+
+def missing_tools(requires) -> List[str]:
+    missing = []
+    for tool in requires:
+        if tool == "libreoffice":
+            if not (shutil.which("soffice") or shutil.which("libreoffice")):
+                missing.append(tool)
+        elif not shutil.which(tool):
+            missing.append(tool)
+    return missing
+
+
+def percentile(values: List[float], q: float) -> float:
+    # Nearest rank, so p99 of few samples is the slowest one
+    ordered = sorted(values)
+    rank = max(1, -(-len(ordered) * q // 100))
+    return ordered[int(rank) - 1]
+
+
+def summarize(latencies: List[float], wall: float) -> dict:
+    return {
+        "iterations": len(latencies),
+        "p50_ms": percentile(latencies, 50) * 1000,
+        "p99_ms": percentile(latencies, 99) * 1000,
+        "mean_ms": sum(latencies) / len(latencies) * 1000,
+        "max_ms": max(latencies) * 1000,
+        "throughput": len(latencies) / wall,
+    }
+
+
+def discard(result):
+    paths = result if isinstance(result, list) else [result]
+    for path in paths:
+        if isinstance(path, str) and os.path.isfile(path):
+            os.remove(path)
+
+
+def run_function_case(name: str, fixtures: Dict[str, str], iterations: int, warmup: int) -> dict:
+    import storage
+    import utils
+
+    # The server creates its directories at startup
+    storage.ensure_dirs()
+    case = FUNCTION_CASES[name]
+    paths = [fixtures[f] for f in case.fixtures]
+    scratch = tempfile.mkdtemp(prefix="bench_")
+    latencies = []
+    try:
+        for i in range(warmup + iterations):
+            started = time.perf_counter()
+            result = case.run(utils, paths, scratch)
+            elapsed = time.perf_counter() - started
+            discard(result)
+            if i >= warmup:
+                latencies.append(elapsed)
+    finally:
+        shutil.rmtree(scratch, ignore_errors=True)
+    wall = sum(latencies)
+    return summarize(latencies, wall)
+
+
+def run_endpoint_case(name: str, fixtures: Dict[str, str], iterations: int, warmup: int, concurrency: int) -> dict:
+    from fastapi.testclient import TestClient
+    import main
+
+    case = ENDPOINT_CASES[name]
+    # Read once, so fixture I/O isn't part of the measurement
+    files = []
+    for field, fixture, content_type in case.files:
+        with open(fixtures[fixture], "rb") as f:
+            files.append((field, (os.path.basename(fixtures[fixture]), f.read(), content_type)))
+    errors = []
+
+    def call(_):
+        started = time.perf_counter()
+        response = client.post(case.path, files=files, data=case.data)
+        response.read()
+        elapsed = time.perf_counter() - started
+        if response.status_code >= 400:
+            errors.append(f"{response.status_code} {response.text[:200]}")
+        return elapsed
+
+    with TestClient(main.app) as client:
+        for i in range(warmup):
+            call(i)
+        requests = max(iterations, concurrency)
+        started = time.perf_counter()
+        with ThreadPoolExecutor(concurrency) as executor:
+            latencies = list(executor.map(call, range(requests)))
+        wall = time.perf_counter() - started
+    stats = summarize(latencies, wall)
+    stats["errors"] = len(errors)
+    if errors:
+        stats["first_error"] = errors[0]
+    return stats
+
+
+def worker(args):
+    # Runs one case in this (fresh) process and prints its stats as JSON
+    os.environ.setdefault("TOOLKIT_CACHE_ENABLED", "0")
+    os.environ.setdefault("TOOLKIT_ACCESS_LOG", "0")
+    os.environ.setdefault("TOOLKIT_LOG_LEVEL", "WARNING")
+    os.chdir(SERVER_DIR)
+    sys.path.insert(0, SERVER_DIR)
+    fixtures = json.loads(args.fixture_paths)
+    if args.worker in FUNCTION_CASES:
+        stats = run_function_case(args.worker, fixtures, args.iterations, args.warmup)
+    else:
+        stats = run_endpoint_case(args.worker, fixtures, args.iterations, args.warmup, args.concurrency[0])
+
+    import utils
+    # Reap the pool workers so their peak shows up in RUSAGE_CHILDREN
+    utils.shutdown_executors(wait=True)
+    children = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss
+    stats["peak_rss_kb"] = peak_rss_kb()
+    stats["peak_child_rss_kb"] = children // 1024 if sys.platform == "darwin" else children
+    print(json.dumps(stats))
+
+
+def run_case(name: str, kind: str, concurrency: int, fixtures: Dict[str, str], args) -> dict:
+    command = [sys.executable, os.path.abspath(__file__), "--worker", name,
+               "--fixture-paths", json.dumps(fixtures), "--iterations", str(args.iterations),
+               "--warmup", str(args.warmup), "--concurrency", str(concurrency)]
+    entry = {"case": name, "kind": kind, "concurrency": concurrency}
+    result = subprocess.run(command, capture_output=True, text=True, cwd=SERVER_DIR)
+    if result.returncode != 0:
+        entry.update({"status": "failed", "error": result.stderr.strip().splitlines()[-1:]})
+        return entry
+    entry.update(json.loads(result.stdout.strip().splitlines()[-1]))
+    entry["status"] = "failed" if entry.get("errors") else "ok"
+    return entry
+
+
+def environment(scale: int) -> dict:
+    from importlib.metadata import PackageNotFoundError, version
+
+    packages = {}
+    for package in ("PyPDF2", "Pillow", "pikepdf", "fastapi", "starlette", "pdf2image", "openpyxl"):
+        try:
+            packages[package] = version(package)
+        except PackageNotFoundError:
+            continue
+    return {
+        "created": time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime()),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "cpu_count": os.cpu_count(),
+        "scale": scale,
+        "packages": packages,
+        "tools": {tool: not missing_tools([tool]) for tool in ("libreoffice", "pdftoppm")},
+    }
+
+
+def compare(results: List[dict], baseline: dict, threshold: float) -> List[str]:
+    """Prints the change against baseline and returns the regressions."""
+    previous = {(r["case"], r["concurrency"]): r for r in baseline.get("results", []) if r.get("status") == "ok"}
+    regressions = []
+    print(f"\n{'case':<34} {'conc':>4} " + " ".join(f"{metric:>12}" for metric in COMPARED))
+    for result in results:
+        before = previous.get((result["case"], result["concurrency"]))
+        if result.get("status") != "ok" or before is None:
+            continue
+        cells = []
+        for metric, higher_is_better in COMPARED.items():
+            if not before.get(metric):
+                cells.append(f"{'-':>12}")
+                continue
+            change = result[metric] / before[metric] - 1
+            worse = -change if higher_is_better else change
+            flag = "!" if worse > threshold else " "
+            if worse > threshold:
+                regressions.append(f"{result['case']} (concurrency {result['concurrency']}): "
+                                   f"{metric} {before[metric]:.1f} -> {result[metric]:.1f}")
+            cells.append(f"{change * 100:>+10.1f}%{flag}")
+        print(f"{result['case']:<34} {result['concurrency']:>4} " + " ".join(cells))
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--only", nargs="+", default=[], help="run cases whose name contains any of these")
+    parser.add_argument("--functions-only", action="store_true")
+    parser.add_argument("--endpoints-only", action="store_true")
+    parser.add_argument("--concurrency", type=int, nargs="+", default=[1, 4, 16],
+                        help="client concurrency levels for the endpoint cases")
+    parser.add_argument("--iterations", type=int, default=20, help="measured calls per case and concurrency")
+    parser.add_argument("--warmup", type=int, default=1, help="unmeasured calls first (pool start-up)")
+    parser.add_argument("--scale", type=int, default=1, help="multiplies fixture page/row counts")
+    parser.add_argument("--fixtures-dir", default=os.path.join(tempfile.gettempdir(), "toolkit_bench_fixtures"))
+    parser.add_argument("--json", help="write the results to this file")
+    parser.add_argument("--baseline", help="compare with the results in this file")
+    parser.add_argument("--threshold", type=float, default=0.25,
+                        help="relative change that counts as a regression (default 0.25)")
+    parser.add_argument("--worker", help=argparse.SUPPRESS)
+    parser.add_argument("--fixture-paths", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.worker:
+        worker(args)
+        return
+
+    fixtures = make_fixtures(args.fixtures_dir, args.scale)
+    cases = []
+    if not args.endpoints_only:
+        cases += [(name, "function", 1, case) for name, case in FUNCTION_CASES.items()]
+    if not args.functions_only:
+        cases += [(name, "endpoint", c, case) for name, case in ENDPOINT_CASES.items() for c in args.concurrency]
+    if args.only:
+        cases = [c for c in cases if any(word in c[0] for word in args.only)]
+
+    results = []
+    print(f"{'case':<34} {'conc':>4} {'p50 ms':>9} {'p99 ms':>9} {'ops/s':>8} {'RSS MB':>8} {'child MB':>9}")
+    for name, kind, concurrency, case in cases:
+        needs = [f for f in (case.fixtures if kind == "function" else [f[1] for f in case.files]) if f not in fixtures]
+        missing = missing_tools(case.requires) + needs
+        if missing:
+            results.append({"case": name, "kind": kind, "concurrency": concurrency,
+                            "status": "skipped", "missing": missing})
+            print(f"{name:<34} {concurrency:>4} skipped, missing {', '.join(missing)}")
+            continue
+        result = run_case(name, kind, concurrency, fixtures, args)
+        results.append(result)
+        if result["status"] == "ok":
+            print(f"{name:<34} {concurrency:>4} {result['p50_ms']:>9.1f} {result['p99_ms']:>9.1f} "
+                  f"{result['throughput']:>8.2f} {result['peak_rss_kb'] / 1024:>8.1f} "
+                  f"{result['peak_child_rss_kb'] / 1024:>9.1f}")
+        else:
+            print(f"{name:<34} {concurrency:>4} failed: {result.get('first_error') or result.get('error')}")
+
+    report = {"environment": environment(args.scale), "results": results}
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(report, f, indent=2)
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        regressions = compare(results, baseline, args.threshold)
+        if regressions:
+            print("\nRegressions:\n  " + "\n  ".join(regressions))
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,119 @@
+"""
+Throughput and peak memory of /text/to-pdf's engines on log-sized files.
+
+Generates log-like text files of the given sizes and lays each out with
+the native renderer (every font) and with LibreOffice, the previous and
+fallback engine, each run in a fresh process. Peak RSS is that of the
+converting process; for LibreOffice the soffice process isn't included,
+and it is skipped when not installed. The native renderer's peak RSS
+should stay flat as the files grow.
+
+    cd server
+    python benchmarks/text_to_pdf.py --mb 1 10 100 --engines courier helvetica libreoffice
+"""
+import argparse
+import json
+import os
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+SERVER_DIR = os.path.dirname(BENCH_DIR)
+sys.path.insert(0, BENCH_DIR)
+
+from fixtures import WORDS  # noqa: E402
+from merge_memory import peak_rss_kb  # noqa: E402
+
+LEVELS = ("DEBUG", "INFO", "INFO", "INFO", "WARN", "ERROR")
+
+
+def write_log(path: str, megabytes: float, seed: int = 0):
+    rng = random.Random(seed)
+    target = int(megabytes * 2**20)
+    written = 0
+    with open(path, "w") as f:
+        while written < target:
+            line = (f"2024-05-{rng.randrange(1, 29):02d}T{rng.randrange(24):02d}:{rng.randrange(60):02d}:"
+                    f"{rng.randrange(60):02d}.{rng.randrange(1000):03d}Z {rng.choice(LEVELS):<5} "
+                    f"[worker-{rng.randrange(16)}] "
+                    + " ".join(rng.choice(WORDS) for _ in range(rng.randrange(4, 30))) + "\n")
+            f.write(line)
+            written += len(line)
+
+
+def run_convert(engine: str, input_path: str, output_path: str):
+    sys.path.insert(0, SERVER_DIR)
+    import utils
+    if engine == "libreoffice":
+        result = utils.convert_to_pdf_libreoffice(input_path, os.path.dirname(output_path))
+    else:
+        result = utils.text_to_pdf(input_path, os.path.dirname(output_path),
+                                   **utils.validate_text_pdf_options(font=engine))
+    shutil.move(result, output_path)
+
+
+def measure(engine: str, input_path: str, directory: str) -> dict:
+    output_path = os.path.join(directory, f"out_{engine}.pdf")
+    code = (
+        "import json, sys, time\n"
+        f"sys.path.insert(0, {BENCH_DIR!r})\n"
+        "from text_to_pdf import run_convert, peak_rss_kb\n"
+        "if __name__ == '__main__':\n"
+        "    started = time.perf_counter()\n"
+        f"    run_convert({engine!r}, {input_path!r}, {output_path!r})\n"
+        "    print(json.dumps({'seconds': time.perf_counter() - started, 'peak_rss_kb': peak_rss_kb()}))\n"
+    )
+    script = os.path.join(directory, "run.py")
+    with open(script, "w") as f:
+        f.write(code)
+    result = subprocess.run([sys.executable, script], capture_output=True, text=True, cwd=SERVER_DIR)
+    if result.returncode != 0:
+        raise RuntimeError(result.stderr)
+    stats = json.loads(result.stdout.strip().splitlines()[-1])
+    stats.update({
+        "engine": engine,
+        "input_bytes": os.path.getsize(input_path),
+        "output_bytes": os.path.getsize(output_path),
+    })
+    os.remove(output_path)
+    return stats
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--mb", type=float, nargs="+", default=[1, 10, 100], help="input sizes in MB")
+    parser.add_argument("--engines", nargs="+", default=["courier", "helvetica", "libreoffice"],
+                        help="native renderer fonts and/or libreoffice")
+    parser.add_argument("--json", help="also write the results to this file")
+    args = parser.parse_args()
+
+    engines = list(args.engines)
+    if "libreoffice" in engines and not (shutil.which("soffice") or shutil.which("libreoffice")):
+        print("LibreOffice not installed, skipping it")
+        engines.remove("libreoffice")
+
+    results = []
+    with tempfile.TemporaryDirectory(prefix="text_pdf_bench_") as directory:
+        print(f"{'engine':<12} {'input MB':>9} {'output MB':>10} {'peak RSS MB':>12} {'seconds':>8} {'MB/s':>7}")
+        for megabytes in args.mb:
+            input_path = os.path.join(directory, f"log_{megabytes:g}mb.txt")
+            write_log(input_path, megabytes)
+            for engine in engines:
+                stats = measure(engine, input_path, directory)
+                results.append(stats)
+                input_mb = stats["input_bytes"] / 2**20
+                print(f"{engine:<12} {input_mb:>9.1f} {stats['output_bytes'] / 2**20:>10.1f} "
+                      f"{stats['peak_rss_kb'] / 1024:>12.1f} {stats['seconds']:>8.2f} "
+                      f"{input_mb / stats['seconds']:>7.1f}")
+            os.remove(input_path)
+
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,128 @@
+"""
+Cost and effect of the XLSX preflight behind /convert/excel-to-pdf.
+
+Writes two kinds of workbooks: a small table with one formatted cell at
+row 1,048,576 ("stray"), and tables of the given numbers of rows. For each
+it reports how long the preflight takes and its peak RSS (in a fresh
+process, without budgets), the used range and estimated pages. With
+LibreOffice installed each workbook is also converted as it is and after
+the preflight, with the seconds and pages of both PDFs.
+
+    cd server
+    python benchmarks/xlsx_preflight.py --rows 10000 100000 --libreoffice
+"""
+import argparse
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+SERVER_DIR = os.path.dirname(BENCH_DIR)
+sys.path.insert(0, BENCH_DIR)
+
+from fixtures import write_xlsx  # noqa: E402
+
+
+def write_stray(path: str, rows: int = 50):
+    import openpyxl
+    from openpyxl.styles import PatternFill
+
+    workbook = openpyxl.Workbook()
+    sheet = workbook.active
+    for row in range(rows):
+        sheet.append([f"Item {row}", row, row * 1.5, "note"])
+    sheet.cell(row=1048576, column=1).fill = PatternFill("solid", fgColor="FFFF00")
+    workbook.save(path)
+
+
+def run_preflight(input_path: str, output_path: str) -> dict:
+    sys.path.insert(0, SERVER_DIR)
+    import xlsxprep
+    from merge_memory import peak_rss_kb
+
+    started = time.perf_counter()
+    plans = xlsxprep.plan_workbook(input_path)
+    xlsxprep.write_workbook(input_path, output_path, plans)
+    return {
+        "seconds": time.perf_counter() - started,
+        "peak_rss_kb": peak_rss_kb(),
+        "rows": sum(plan.rows for plan in plans),
+        "columns": max((plan.columns for plan in plans), default=0),
+        "estimated_pages": sum(plan.pages for plan in plans),
+    }
+
+
+def measure_preflight(input_path: str, output_path: str) -> dict:
+    code = (
+        "import json, sys\n"
+        f"sys.path.insert(0, {BENCH_DIR!r})\n"
+        "from xlsx_preflight import run_preflight\n"
+        f"print(json.dumps(run_preflight({input_path!r}, {output_path!r})))\n"
+    )
+    result = subprocess.run([sys.executable, "-c", code], capture_output=True, text=True, cwd=SERVER_DIR)
+    if result.returncode != 0:
+        raise RuntimeError(result.stderr)
+    return json.loads(result.stdout.strip().splitlines()[-1])
+
+
+def convert(path: str, directory: str) -> dict:
+    sys.path.insert(0, SERVER_DIR)
+    import PyPDF2
+    import utils
+
+    started = time.perf_counter()
+    pdf_path = utils.convert_to_pdf_libreoffice(path, directory)
+    seconds = time.perf_counter() - started
+    stats = {"seconds": seconds, "pages": len(PyPDF2.PdfReader(pdf_path).pages),
+             "bytes": os.path.getsize(pdf_path)}
+    os.remove(pdf_path)
+    return stats
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--rows", type=int, nargs="+", default=[10000, 100000], help="rows of the tables")
+    parser.add_argument("--columns", type=int, default=10)
+    parser.add_argument("--libreoffice", action="store_true", help="also convert with LibreOffice")
+    parser.add_argument("--json", help="also write the results to this file")
+    args = parser.parse_args()
+
+    libreoffice = args.libreoffice
+    if libreoffice and not (shutil.which("soffice") or shutil.which("libreoffice")):
+        print("LibreOffice not installed, skipping the conversions")
+        libreoffice = False
+
+    results = []
+    with tempfile.TemporaryDirectory(prefix="xlsx_preflight_bench_") as directory:
+        cases = [("stray", lambda p: write_stray(p))]
+        cases += [(f"{rows} rows", lambda p, rows=rows: write_xlsx(p, rows, args.columns)) for rows in args.rows]
+        print(f"{'workbook':<12} {'MB':>6} {'seconds':>8} {'RSS MB':>7} {'used range':>14} {'est. pages':>10}"
+              + (f" {'LO s':>7} {'pages':>6} {'LO s prep':>9} {'pages':>6}" if libreoffice else ""))
+        for name, write in cases:
+            input_path = os.path.join(directory, "input.xlsx")
+            output_path = os.path.join(directory, "prepared.xlsx")
+            write(input_path)
+            stats = measure_preflight(input_path, output_path)
+            stats.update({"workbook": name, "input_bytes": os.path.getsize(input_path)})
+            line = (f"{name:<12} {stats['input_bytes'] / 2**20:>6.1f} {stats['seconds']:>8.2f} "
+                    f"{stats['peak_rss_kb'] / 1024:>7.1f} {stats['rows']:>7} x {stats['columns']:<4} "
+                    f"{stats['estimated_pages']:>10}")
+            if libreoffice:
+                stats["original"] = convert(input_path, directory)
+                stats["prepared"] = convert(output_path, directory)
+                line += (f" {stats['original']['seconds']:>7.1f} {stats['original']['pages']:>6}"
+                         f" {stats['prepared']['seconds']:>9.1f} {stats['prepared']['pages']:>6}")
+            results.append(stats)
+            print(line)
+
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,264 @@
+import asyncio
+import hashlib
+import json
+import logging
+import os
+import shutil
+import threading
+import time
+import uuid
+from typing import Optional, Tuple
+
+from config import CACHE_ENABLED, CACHE_DIR, CACHE_MAX_BYTES, CACHE_TTL_SECONDS
+
+logger = logging.getLogger(__name__)
+
+# Disk-backed, content-addressed cache of operation results.
+#
+# The key is the SHA-256 of the input(s) plus the operation and its
+# parameters, so re-submitting the same document skips the LibreOffice or
+# PyPDF2 work entirely. Entries are written to a temp file and renamed into
+# place, which is atomic across uvicorn workers sharing the directory.
+# Reads hand out a hard link to the entry, so a concurrent eviction can't
+# pull the file out from under a response that is still being sent. The
+# last use is recorded in the entry's atime, its mtime stays the time it
+# was written.
+
+
+class ResultCache:
+    def __init__(self, directory: str = CACHE_DIR, max_bytes: int = CACHE_MAX_BYTES,
+                 ttl: float = CACHE_TTL_SECONDS):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._approx_bytes = None
+        self._last_sweep = 0.0
+        self._lock = threading.Lock()
+        os.makedirs(directory, exist_ok=True)
+
+    @staticmethod
+    def key(digest: str, operation: str, params: Optional[dict] = None) -> str:
+        material = json.dumps({"digest": digest, "operation": operation, "params": params or {}}, sort_keys=True)
+        return hashlib.sha256(material.encode()).hexdigest()
+
+    def _entry_path(self, key: str) -> str:
+        return os.path.join(self.directory, key[:2], key)
+
+    def get(self, key: str, dest_dir: str) -> Optional[str]:
+        """
+        Returns a private path (in `dest_dir`) to the cached result, or None
+        on a miss. The caller owns the returned path and removes it when done.
+        """
+        path = self._entry_path(key)
+        try:
+            st = os.stat(path)
+        except FileNotFoundError:
+            self.misses += 1
+            return None
+        if time.time() - st.st_atime > self.ttl:
+            self._remove(path)
+            self.misses += 1
+            return None
+
+        dest = os.path.join(dest_dir, f"cached_{uuid.uuid4()}")
+        try:
+            link_or_copy(path, dest)
+            # atime doubles as "last used" for LRU eviction
+            os.utime(path, ns=(time.time_ns(), st.st_mtime_ns))
+        except FileNotFoundError:
+            # Evicted between stat and link
+            self.misses += 1
+            return None
+        self.hits += 1
+        return dest
+
+    def put(self, key: str, src_path: str):
+        path = self._entry_path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp = os.path.join(os.path.dirname(path), f".{key}.{uuid.uuid4().hex}.tmp")
+        try:
+            link_or_copy(src_path, tmp)
+            os.replace(tmp, path)
+        except OSError as e:
+            logger.warning("Error writing cache entry", extra={"key": key, "error": str(e)})
+            self._remove(tmp)
+            return
+        self._added(path)
+
+    def writer(self, key: str) -> "CacheWriter":
+        return CacheWriter(self, key)
+
+    def _added(self, path: str):
+        with self._lock:
+            if self._approx_bytes is not None:
+                self._approx_bytes += os.path.getsize(path)
+        self.maybe_evict()
+
+    def maybe_evict(self):
+        with self._lock:
+            due = time.monotonic() - self._last_sweep > 60
+            over = self._approx_bytes is None or self._approx_bytes > self.max_bytes
+            if not (due or over):
+                return
+            self._last_sweep = time.monotonic()
+        self.evict()
+
+    def evict(self):
+        """
+        Removes expired entries, then the least recently used ones until the
+        cache is below 90% of its size budget.
+        """
+        now = time.time()
+        entries = []
+        total = 0
+        for root, _dirs, files in os.walk(self.directory):
+            for name in files:
+                path = os.path.join(root, name)
+                try:
+                    st = os.stat(path)
+                except FileNotFoundError:
+                    continue
+                if name.endswith(".tmp"):
+                    # Leftover from a crashed writer
+                    if now - st.st_mtime > 3600:
+                        self._remove(path)
+                    continue
+                if now - st.st_atime > self.ttl:
+                    self._remove(path)
+                    continue
+                entries.append((st.st_atime, st.st_size, path))
+                total += st.st_size
+
+        if total > self.max_bytes:
+            entries.sort()
+            target = int(self.max_bytes * 0.9)
+            for _atime, size, path in entries:
+                if total <= target:
+                    break
+                self._remove(path)
+                total -= size
+
+        with self._lock:
+            self._approx_bytes = total
+
+    def stats(self) -> dict:
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "bytes": self._approx_bytes,
+            "max_bytes": self.max_bytes,
+        }
+
+    @staticmethod
+    def _remove(path: str):
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+        except OSError as e:
+            logger.warning("Error removing cache entry", extra={"path": path, "error": str(e)})
+
+
+class CacheWriter:
+    """
+    Builds a cache entry from streamed chunks; it only becomes visible to
+    readers once commit() renames it into place.
+    """
+    def __init__(self, cache: ResultCache, key: str):
+        self.cache = cache
+        self.path = cache._entry_path(key)
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        self.tmp = os.path.join(os.path.dirname(self.path), f".{key}.{uuid.uuid4().hex}.tmp")
+        self.file = open(self.tmp, "wb")
+
+    def write(self, data: bytes):
+        self.file.write(data)
+
+    def commit(self):
+        self.file.close()
+        os.replace(self.tmp, self.path)
+        self.cache._added(self.path)
+
+    def abort(self):
+        self.file.close()
+        self.cache._remove(self.tmp)
+
+
+def link_or_copy(src: str, dest: str):
+    try:
+        os.link(src, dest)
+    except OSError:
+        # Different filesystem or no hard link support
+        shutil.copyfile(src, dest)
+
+
+_cache: Optional[ResultCache] = None
+
+
+def get_cache() -> Optional[ResultCache]:
+    global _cache
+    if not CACHE_ENABLED:
+        return None
+    if _cache is None:
+        _cache = ResultCache()
+    return _cache
+
+
+def result_key(operation: str, digest, params: Optional[dict] = None) -> str:
+    """
+    Names the result of `operation` with `params` on the input with SHA-256
+    `digest` (a list of them for several inputs), whether or not caching is
+    enabled: the cache key, and the ETag of the download.
+    """
+    return ResultCache.key(digest, operation, params)
+
+
+async def cache_lookup(operation: str, digest: str, params: Optional[dict],
+                       dest_dir: str) -> Tuple[Optional[str], Optional[str]]:
+    """
+    Returns (key, path). path is None on a miss, key is None when caching
+    is disabled.
+    """
+    cache = get_cache()
+    if cache is None:
+        return None, None
+    key = cache.key(digest, operation, params)
+    return key, await asyncio.to_thread(cache.get, key, dest_dir)
+
+
+def tee_to_cache(chunks, key: Optional[str]):
+    """
+    Passes streamed chunks through while writing them to the cache entry
+    for `key`. The entry is only committed if the stream completes.
+    """
+    cache = get_cache()
+    if cache is None or key is None:
+        yield from chunks
+        return
+    writer = cache.writer(key)
+    try:
+        for chunk in chunks:
+            writer.write(chunk)
+            yield chunk
+    except BaseException:
+        writer.abort()
+        raise
+    writer.commit()
+
+
+async def cached_call(operation: str, digest: str, params: Optional[dict], produce,
+                      dest_dir: str) -> Tuple[str, bool]:
+    """
+    Returns (path, hit). On a miss `produce` (an async callable returning the
+    output path) is awaited and its result stored in the cache.
+    """
+    key, path = await cache_lookup(operation, digest, params, dest_dir)
+    if path is not None:
+        return path, True
+
+    path = await produce()
+    if key is not None:
+        await asyncio.to_thread(get_cache().put, key, path)
+    return path, False
@@ -0,0 +1,506 @@
+import hashlib
+import importlib.util
+import io
+import logging
+import math
+import os
+import shutil
+import struct
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, List, NamedTuple, Optional, Tuple
+
+import PyPDF2
+from PyPDF2.filters import FlateDecode
+from PyPDF2.generic import (
+    ArrayObject,
+    ContentStream,
+    DictionaryObject,
+    IndirectObject,
+    NameObject,
+    NumberObject,
+    StreamObject,
+)
+from PIL import Image
+
+from config import COMPRESS_THREADS
+from presets import CompressionPreset, COMPRESSION_PRESETS, DEFAULT_COMPRESSION_PRESET
+
+logger = logging.getLogger(__name__)
+
+# PDF compression engine behind /pdf/compress.
+#
+# One pass over the document:
+#   1. copy the page tree into a fresh writer (only objects reachable from
+#      the pages are carried over)
+#   2. point identical image/form XObjects and embedded font programs at a
+#      single copy
+#   3. work out how large every image is actually drawn by following the
+#      transformation matrix through the content streams, drop XObject
+#      resources that are never drawn, and re-encode images above the
+#      preset's DPI in a thread pool (Pillow releases the GIL)
+#   4. flate the content streams and write the result
+# When pikepdf is installed the output is rewritten once more with object
+# streams and a cross-reference stream, which PyPDF2 can't produce. It is
+# only imported then, being by far the slowest import here.
+
+HAS_PIKEPDF = importlib.util.find_spec("pikepdf") is not None
+
+
+# Presets are defined in presets.py
+PRESETS = COMPRESSION_PRESETS
+DEFAULT_PRESET = DEFAULT_COMPRESSION_PRESET
+
+# Images are only resampled when that shrinks them noticeably, and a
+# re-encoded image is only kept when it is clearly smaller than the original.
+MIN_SCALE = 0.9
+MIN_SAVING = 0.9
+
+FONT_FILE_KEYS = ("/FontFile", "/FontFile2", "/FontFile3")
+MAX_FORM_DEPTH = 8
+
+
+def _multiply(m, ctm):
+    a, b, c, d, e, f = m
+    A, B, C, D, E, F = ctm
+    return [
+        a * A + b * C, a * B + b * D,
+        c * A + d * C, c * B + d * D,
+        e * A + f * C + E, e * B + f * D + F,
+    ]
+
+
+def _walk(root, visit):
+    """
+    Visits every dictionary and array reachable from root, following
+    indirect references once. Page tree back links (/Parent) are skipped.
+    """
+    seen = set()
+    stack = [root]
+    while stack:
+        obj = stack.pop()
+        if isinstance(obj, IndirectObject):
+            if obj.idnum in seen:
+                continue
+            seen.add(obj.idnum)
+            obj = obj.get_object()
+        if isinstance(obj, DictionaryObject):
+            visit(obj)
+            stack.extend(v for k, v in obj.items() if k != "/Parent")
+        elif isinstance(obj, ArrayObject):
+            visit(obj)
+            stack.extend(obj)
+
+
+class StreamDeduplicator:
+    """
+    Finds streams with identical dictionaries and data. References inside
+    the dictionaries (e.g. /SMask, an ICC colour space) are compared by what
+    they point to, so equal images stored as separate objects still match,
+    also across documents.
+    """
+
+    def __init__(self):
+        self._keys: Dict[Tuple[int, int], str] = {}
+        self.canonical: Dict[str, IndirectObject] = {}
+        self.replace: Dict[int, IndirectObject] = {}
+
+    def _describe(self, obj, depth=0) -> str:
+        if isinstance(obj, IndirectObject):
+            if depth > 16:
+                # Too deep to compare, only the object itself is equal to it
+                return f"R{id(obj.pdf)}:{obj.idnum}"
+            target = obj.get_object()
+            if isinstance(target, StreamObject):
+                return self.key(obj)
+            return self._describe(target, depth + 1)
+        if isinstance(obj, DictionaryObject):
+            items = sorted((k, self._describe(v, depth + 1)) for k, v in obj.items() if k != "/Length")
+            return "<<" + " ".join(f"{k} {v}" for k, v in items) + ">>"
+        if isinstance(obj, ArrayObject):
+            return "[" + " ".join(self._describe(v, depth + 1) for v in obj) + "]"
+        return repr(obj)
+
+    def key(self, ref: IndirectObject) -> str:
+        source = (ref.idnum, ref.generation)
+        if source not in self._keys:
+            stream = ref.get_object()
+            digest = hashlib.sha256(stream._data)
+            digest.update(self._describe(DictionaryObject(stream)).encode("utf-8", "replace"))
+            self._keys[source] = digest.hexdigest()
+        return self._keys[source]
+
+    def add(self, ref: IndirectObject):
+        if ref.idnum in self.replace:
+            return
+        key = self.key(ref)
+        first = self.canonical.setdefault(key, ref)
+        if first.idnum != ref.idnum:
+            self.replace[ref.idnum] = first
+
+
+def _collect_candidates(writer: PyPDF2.PdfWriter):
+    """Image/form XObjects and embedded font programs reachable from the pages."""
+    refs = {}
+
+    def visit(obj):
+        if not isinstance(obj, DictionaryObject):
+            return
+        xobjects = obj.get("/XObject")
+        if isinstance(obj.get("/Type"), NameObject) and obj["/Type"] == "/FontDescriptor":
+            for key in FONT_FILE_KEYS:
+                value = obj.get(key)
+                if isinstance(value, IndirectObject):
+                    refs[value.idnum] = value
+        if xobjects is not None:
+            for value in xobjects.get_object().values():
+                if isinstance(value, IndirectObject):
+                    refs[value.idnum] = value
+        smask = obj.get("/SMask")
+        if isinstance(smask, IndirectObject) and obj.get("/Subtype") == "/Image":
+            refs[smask.idnum] = smask
+
+    _walk(writer._pages, visit)
+    return refs
+
+
+def _deduplicate(writer: PyPDF2.PdfWriter) -> int:
+    dedup = StreamDeduplicator()
+    for ref in _collect_candidates(writer).values():
+        if isinstance(ref.get_object(), StreamObject):
+            dedup.add(ref)
+    if not dedup.replace:
+        return 0
+
+    def visit(obj):
+        entries = obj.items() if isinstance(obj, DictionaryObject) else enumerate(obj)
+        for k, v in list(entries):
+            if isinstance(v, IndirectObject) and v.idnum in dedup.replace:
+                obj[k] = dedup.replace[v.idnum]
+
+    _walk(writer._pages, visit)
+    return len(dedup.replace)
+
+
+class _Placements:
+    """Largest size (in points) each image is drawn at, keyed by object number."""
+
+    def __init__(self):
+        self.size: Dict[int, list] = {}
+        self.refs: Dict[int, IndirectObject] = {}
+        # images drawn somewhere we couldn't follow; left untouched
+        self.unknown = set()
+        self.smasks = set()
+        # XObject dicts -> names drawn from them, None if a content stream
+        # using them couldn't be parsed
+        self.used: Dict[int, Optional[set]] = {}
+        self.xobject_dicts: Dict[int, DictionaryObject] = {}
+
+    def record(self, ref: IndirectObject, ctm):
+        width = math.hypot(ctm[0], ctm[1])
+        height = math.hypot(ctm[2], ctm[3])
+        self.refs[ref.idnum] = ref
+        current = self.size.setdefault(ref.idnum, [0.0, 0.0])
+        current[0] = max(current[0], width)
+        current[1] = max(current[1], height)
+
+    def scan(self, content, resources, pdf, ctm, depth=0):
+        resources = resources.get_object() if resources is not None else DictionaryObject()
+        xobjects = resources.get("/XObject")
+        xobjects = xobjects.get_object() if xobjects is not None else None
+        if not xobjects:
+            return
+        key = id(xobjects)
+        self.xobject_dicts[key] = xobjects
+        used = self.used.setdefault(key, set())
+        try:
+            operations = ContentStream(content, pdf).operations
+        except Exception:
+            self.used[key] = None
+            for ref in xobjects.values():
+                if isinstance(ref, IndirectObject):
+                    self.unknown.add(ref.idnum)
+            return
+
+        stack = []
+        for operands, operator in operations:
+            if operator == b"q":
+                stack.append(ctm)
+            elif operator == b"Q":
+                ctm = stack.pop() if stack else ctm
+            elif operator == b"cm" and len(operands) == 6:
+                ctm = _multiply([float(x) for x in operands], ctm)
+            elif operator == b"Do" and operands:
+                name = operands[0]
+                if used is not None:
+                    used.add(name)
+                ref = xobjects.get(name)
+                if not isinstance(ref, IndirectObject):
+                    continue
+                xobject = ref.get_object()
+                subtype = xobject.get("/Subtype")
+                if subtype == "/Image":
+                    self.record(ref, ctm)
+                    smask = xobject.get("/SMask")
+                    if isinstance(smask, IndirectObject):
+                        self.smasks.add(smask.idnum)
+                        self.record(smask, ctm)
+                elif subtype == "/Form":
+                    # A form without resources of its own uses the ones of
+                    # the page (or form) drawing it
+                    form_resources = xobject.get("/Resources", resources)
+                    if depth >= MAX_FORM_DEPTH:
+                        self.unknown.update(self._images_below(form_resources))
+                        if "/Resources" not in xobject:
+                            self.used[key] = used = None
+                        continue
+                    matrix = xobject.get("/Matrix")
+                    form_ctm = _multiply([float(x) for x in matrix], ctm) if matrix else ctm
+                    self.scan(xobject, form_resources, pdf, form_ctm, depth + 1)
+
+    def _images_below(self, resources):
+        found = []
+
+        def visit(obj):
+            if isinstance(obj, DictionaryObject) and "/XObject" in obj:
+                found.extend(v.idnum for v in obj["/XObject"].get_object().values()
+                             if isinstance(v, IndirectObject))
+
+        _walk(resources, visit)
+        return found
+
+    def strip_unused(self) -> int:
+        removed = 0
+        for key, used in self.used.items():
+            if used is None:
+                continue
+            xobjects = self.xobject_dicts[key]
+            for name in [n for n in xobjects if n not in used]:
+                del xobjects[name]
+                removed += 1
+        return removed
+
+
+def _find_placements(writer: PyPDF2.PdfWriter) -> _Placements:
+    placements = _Placements()
+    for page in writer.pages:
+        content = page.get_contents()
+        if content is None:
+            continue
+        placements.scan(content, page.get("/Resources"), writer, [1.0, 0.0, 0.0, 1.0, 0.0, 0.0])
+    return placements
+
+
+class _ImageJob(NamedTuple):
+    idnum: int
+    data: bytes
+    filter: str
+    decode_parms: Optional[DictionaryObject]
+    width: int
+    height: int
+    mode: str
+    scale: float
+
+
+def _image_job(ref: IndirectObject, placed, preset: CompressionPreset, is_smask: bool) -> Optional[_ImageJob]:
+    image = ref.get_object()
+    if image.get("/ImageMask") or "/Decode" in image:
+        return None
+    filters = image.get("/Filter")
+    if isinstance(filters, ArrayObject):
+        if len(filters) != 1:
+            return None
+        filters = filters[0]
+    if filters not in ("/DCTDecode", "/FlateDecode"):
+        return None
+    if filters == "/FlateDecode" and image.get("/BitsPerComponent") != 8:
+        return None
+
+    color_space = image.get("/ColorSpace")
+    if isinstance(color_space, IndirectObject):
+        color_space = color_space.get_object()
+    if isinstance(color_space, ArrayObject) and color_space and color_space[0] == "/ICCBased":
+        components = color_space[1].get_object().get("/N")
+        color_space = {1: "/DeviceGray", 3: "/DeviceRGB"}.get(components)
+    if color_space is None and is_smask:
+        # Soft masks have no colour space and are always grey
+        color_space = "/DeviceGray"
+    mode = {"/DeviceGray": "L", "/DeviceRGB": "RGB"}.get(color_space)
+    if mode is None:
+        return None
+
+    width, height = int(image.get("/Width", 0)), int(image.get("/Height", 0))
+    if width <= 0 or height <= 0:
+        return None
+    placed_width, placed_height = placed
+    if placed_width <= 0 or placed_height <= 0:
+        return None
+    # effective resolution of the sharper axis decides
+    dpi = max(width / (placed_width / 72.0), height / (placed_height / 72.0))
+    scale = min(1.0, preset.dpi / dpi)
+
+    decode_parms = image.get("/DecodeParms")
+    if isinstance(decode_parms, ArrayObject):
+        decode_parms = decode_parms[0] if decode_parms else None
+    if decode_parms and decode_parms.get("/Predictor", 1) >= 10:
+        if (decode_parms.get("/Columns", 1) != width or decode_parms.get("/Colors", 1) != len(mode)
+                or decode_parms.get("/BitsPerComponent", 8) != 8):
+            return None
+    return _ImageJob(ref.idnum, image._data, filters, decode_parms, width, height, mode,
+                     scale if scale < MIN_SCALE else 1.0)
+
+
+def _png_chunk(kind: bytes, data: bytes) -> bytes:
+    return struct.pack(">I", len(data)) + kind + data + struct.pack(">I", zlib.crc32(kind + data))
+
+
+def _png_container(job: _ImageJob) -> bytes:
+    """
+    Flate data with PNG predictors is exactly the IDAT payload of a PNG, so
+    it is wrapped into one and decoded by Pillow instead of unfiltering the
+    rows in Python.
+    """
+    color_type = 2 if job.mode == "RGB" else 0
+    header = struct.pack(">IIBBBBB", job.width, job.height, 8, color_type, 0, 0, 0)
+    return (
+        b"\x89PNG\r\n\x1a\n"
+        + _png_chunk(b"IHDR", header)
+        + _png_chunk(b"IDAT", job.data)
+        + _png_chunk(b"IEND", b"")
+    )
+
+
+def _reencode(job: _ImageJob, quality: int):
+    """Returns (data, width, height) of the JPEG re-encoding, None to keep the original."""
+    try:
+        if job.filter == "/DCTDecode":
+            image = Image.open(io.BytesIO(job.data))
+            if job.scale < 1.0:
+                # Let libjpeg decode at a reduced scale where possible
+                image.draft(job.mode, (int(job.width * job.scale), int(job.height * job.scale)))
+            image = image.convert(job.mode)
+        elif job.decode_parms and job.decode_parms.get("/Predictor", 1) >= 10:
+            image = Image.open(io.BytesIO(_png_container(job)))
+            image.load()
+        else:
+            raw = FlateDecode.decode(job.data, job.decode_parms)
+            image = Image.frombytes(job.mode, (job.width, job.height), raw)
+
+        if job.scale < 1.0:
+            size = (max(1, round(job.width * job.scale)), max(1, round(job.height * job.scale)))
+            image = image.resize(size, Image.LANCZOS)
+        elif job.filter == "/DCTDecode" and image.size != (job.width, job.height):
+            return None
+
+        buffer = io.BytesIO()
+        image.save(buffer, format="JPEG", quality=quality, optimize=True)
+        data = buffer.getvalue()
+    except Exception as e:
+        logger.warning("Skipping image during compression", extra={"object": job.idnum, "error": str(e)})
+        return None
+
+    if len(data) >= len(job.data) * MIN_SAVING:
+        return None
+    return data, image.size[0], image.size[1]
+
+
+def _recompress_images(writer: PyPDF2.PdfWriter, placements: _Placements, preset: CompressionPreset) -> int:
+    jobs = []
+    for idnum, placed in placements.size.items():
+        if idnum in placements.unknown:
+            continue
+        job = _image_job(placements.refs[idnum], placed, preset, idnum in placements.smasks)
+        if job is not None:
+            jobs.append(job)
+    if not jobs:
+        return 0
+
+    changed = 0
+    with ThreadPoolExecutor(max_workers=max(1, COMPRESS_THREADS)) as executor:
+        results = executor.map(lambda job: _reencode(job, preset.quality), jobs)
+        for job, result in zip(jobs, results):
+            if result is None:
+                continue
+            data, width, height = result
+            image = placements.refs[job.idnum].get_object()
+            image._data = data
+            if hasattr(image, "decoded_self"):
+                image.decoded_self = None
+            image[NameObject("/Filter")] = NameObject("/DCTDecode")
+            image[NameObject("/Width")] = NumberObject(width)
+            image[NameObject("/Height")] = NumberObject(height)
+            image[NameObject("/BitsPerComponent")] = NumberObject(8)
+            if "/DecodeParms" in image:
+                del image["/DecodeParms"]
+            changed += 1
+    return changed
+
+
+def _copy_pages(source: str, pages: Optional[List[int]] = None) -> PyPDF2.PdfWriter:
+    reader = PyPDF2.PdfReader(source)
+    writer = PyPDF2.PdfWriter()
+    for n in pages if pages is not None else range(1, len(reader.pages) + 1):
+        writer.add_page(reader.pages[n - 1])
+    if reader.metadata:
+        writer.add_metadata(reader.metadata)
+    return writer
+
+
+def _write(writer: PyPDF2.PdfWriter, path: str):
+    with open(path, "wb") as f:
+        writer.write(f)
+
+
+def compress_document(input_path: str, output_path: str, preset: str = DEFAULT_PRESET,
+                      pages: Optional[List[int]] = None) -> dict:
+    """
+    Compresses input_path into output_path with one of PRESETS. Never
+    produces a file larger than the input; if nothing could be gained the
+    input is copied as is. With `pages` (1-based) only those pages are
+    kept, and the size check is skipped. Returns counters describing what
+    was done.
+    """
+    settings = PRESETS[preset]
+    writer = _copy_pages(input_path, pages)
+    stats = {"preset": preset, "deduplicated": _deduplicate(writer)}
+
+    placements = _find_placements(writer)
+    stats["unused_removed"] = placements.strip_unused()
+    stats["images_recompressed"] = (
+        _recompress_images(writer, placements, settings) if settings.dpi else 0
+    )
+
+    for page in writer.pages:
+        page.compress_content_streams()
+        # PyPDF2 stores the flated stream inline, which other readers reject
+        if "/Contents" in page and not isinstance(page.raw_get("/Contents"), IndirectObject):
+            page[NameObject("/Contents")] = writer._add_object(page["/Contents"])
+
+    staging = output_path + ".part"
+    try:
+        _write(writer, staging)
+        del writer
+        if HAS_PIKEPDF:
+            import pikepdf
+            # qpdf only writes objects reachable from the trailer, so the
+            # copies replaced above are dropped here
+            with pikepdf.open(staging) as pdf:
+                pdf.remove_unreferenced_resources()
+                pdf.save(
+                    output_path,
+                    object_stream_mode=pikepdf.ObjectStreamMode.generate,
+                    compress_streams=True,
+                    recompress_flate=True,
+                )
+        else:
+            # PyPDF2 writes every object it holds, copy once more to leave
+            # the orphaned duplicates behind
+            _write(_copy_pages(staging), output_path)
+    finally:
+        if os.path.exists(staging):
+            os.remove(staging)
+
+    if pages is None and os.path.getsize(output_path) >= os.path.getsize(input_path):
+        shutil.copyfile(input_path, output_path)
+        stats["kept_original"] = True
+    return stats
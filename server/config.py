@@ -0,0 +1,181 @@
+import logging
+import os
+import tempfile
+
+# Runtime configuration. Everything can be overridden with environment
+# variables so the same image can be tuned per deployment.
+
+
+def env_int(name: str, default: int) -> int:
+    value = os.environ.get(name)
+    if value is None or value.strip() == "":
+        return default
+    try:
+        return int(value)
+    except ValueError:
+        logging.getLogger(__name__).warning("Ignoring invalid value for %s: %r", name, value)
+        return default
+
+
+def env_float(name: str, default: float) -> float:
+    value = os.environ.get(name)
+    if value is None or value.strip() == "":
+        return default
+    try:
+        return float(value)
+    except ValueError:
+        logging.getLogger(__name__).warning("Ignoring invalid value for %s: %r", name, value)
+        return default
+
+
+def env_bool(name: str, default: bool) -> bool:
+    value = os.environ.get(name)
+    if value is None or value.strip() == "":
+        return default
+    return value.strip().lower() in ("1", "true", "yes", "on")
+
+
+BASE_TMP = tempfile.gettempdir()
+
+# LibreOffice worker pool (0 disables the pool and falls back to one
+# `libreoffice --headless` process per document)
+LIBREOFFICE_POOL_SIZE = env_int("LIBREOFFICE_POOL_SIZE", 2)
+LIBREOFFICE_MAX_CONVERSIONS = env_int("LIBREOFFICE_MAX_CONVERSIONS", 200)
+LIBREOFFICE_TIMEOUT = env_float("LIBREOFFICE_TIMEOUT", 120.0)
+LIBREOFFICE_STARTUP_TIMEOUT = env_float("LIBREOFFICE_STARTUP_TIMEOUT", 60.0)
+LIBREOFFICE_HEALTH_INTERVAL = env_float("LIBREOFFICE_HEALTH_INTERVAL", 30.0)
+LIBREOFFICE_PROFILE_DIR = os.environ.get(
+    "LIBREOFFICE_PROFILE_DIR", os.path.join(BASE_TMP, "lo_profiles")
+)
+# /convert/batch: documents per LibreOffice invocation and the timeout for
+# one such group (a group that times out is retried one document at a time)
+LIBREOFFICE_BATCH_SIZE = env_int("LIBREOFFICE_BATCH_SIZE", 20)
+LIBREOFFICE_BATCH_TIMEOUT = env_float("LIBREOFFICE_BATCH_TIMEOUT", 600.0)
+# /text/to-pdf: "native" (in-process renderer) or "libreoffice", requests
+# can pick the other one with the engine field
+TEXT_PDF_ENGINE = os.environ.get("TOOLKIT_TEXT_PDF_ENGINE", "native").strip().lower()
+# /convert/excel-to-pdf: XLSX workbooks are printed from their used range
+# only (see xlsxprep.py). Above the cell or estimated page budget (0 for
+# none) they are rejected with 413, or with TOOLKIT_XLSX_OVER_BUDGET=truncate
+# printed up to the budget.
+XLSX_PREFLIGHT = env_bool("TOOLKIT_XLSX_PREFLIGHT", True)
+XLSX_FIT_TO_WIDTH = env_bool("TOOLKIT_XLSX_FIT_TO_WIDTH", True)
+XLSX_MAX_CELLS = env_int("TOOLKIT_XLSX_MAX_CELLS", 2_000_000)
+XLSX_MAX_PAGES = env_int("TOOLKIT_XLSX_MAX_PAGES", 1000)
+XLSX_OVER_BUDGET = os.environ.get("TOOLKIT_XLSX_OVER_BUDGET", "reject").strip().lower()
+
+# Execution layer: CPU-bound PyPDF2/Pillow work runs in process pools (one
+# per scheduling lane, CPU_WORKERS processes between them), subprocess-bound
+# work (LibreOffice, pdftoppm) in a thread pool.
+CPU_WORKERS = env_int("TOOLKIT_CPU_WORKERS", os.cpu_count() or 2)
+IO_WORKERS = env_int("TOOLKIT_IO_WORKERS", 16)
+# Loaded in the background at startup instead of on first use, comma
+# separated: "libreoffice" (the LibreOffice pool), "imports" (PyPDF2,
+# Pillow, pikepdf, ... in the server process) and "pool" (the process pool
+# workers, with the same imports), or "none".
+PREWARM = [part.strip().lower() for part in os.environ.get("TOOLKIT_PREWARM", "libreoffice").split(",")
+           if part.strip() and part.strip().lower() != "none"]
+# Concurrent jobs per operation and how many more may wait for a slot
+# before new requests are rejected with 429.
+OPERATION_CONCURRENCY = env_int("TOOLKIT_OPERATION_CONCURRENCY", CPU_WORKERS)
+OPERATION_QUEUE_SIZE = env_int("TOOLKIT_OPERATION_QUEUE_SIZE", 32)
+# Hard cap on queued + running jobs across all operations (503 when full)
+MAX_PENDING_JOBS = env_int("TOOLKIT_MAX_PENDING_JOBS", 256)
+RETRY_AFTER_SECONDS = env_int("TOOLKIT_RETRY_AFTER", 5)
+# Scheduling: work estimated at more than HEAVY_COST (roughly seconds, from
+# the operation, input size, page count and image dimensions) runs in the
+# heavy lane, the rest in the light lane, each with its own concurrency
+# budget and process pool; by default the two split CPU_WORKERS. LibreOffice
+# conversions run on the thread pool and have a lane of their own. A client
+# may have CLIENT_QUEUE_SIZE requests waiting per lane. Clients are told
+# apart by address, or by CLIENT_HEADER (e.g. X-Forwarded-For) when a
+# trusted proxy in front sets it.
+HEAVY_COST = env_float("TOOLKIT_HEAVY_COST", 2.0)
+HEAVY_LANE_CONCURRENCY = max(1, env_int("TOOLKIT_HEAVY_LANE_CONCURRENCY", CPU_WORKERS // 2))
+LIGHT_LANE_CONCURRENCY = max(1, env_int("TOOLKIT_LIGHT_LANE_CONCURRENCY", CPU_WORKERS - HEAVY_LANE_CONCURRENCY))
+OFFICE_LANE_CONCURRENCY = max(1, env_int("TOOLKIT_OFFICE_LANE_CONCURRENCY", LIBREOFFICE_POOL_SIZE))
+CLIENT_QUEUE_SIZE = env_int("TOOLKIT_CLIENT_QUEUE_SIZE", 8)
+CLIENT_HEADER = os.environ.get("TOOLKIT_CLIENT_HEADER", "").strip().lower()
+
+
+def operation_concurrency(operation: str, default: int) -> int:
+    # e.g. TOOLKIT_LIMIT_PDF_TO_IMAGES=2
+    name = "TOOLKIT_LIMIT_" + operation.upper().replace("-", "_")
+    return max(1, env_int(name, default))
+
+# serve.py, the production entry point: uvicorn with WORKERS server
+# processes. Unless TOOLKIT_CPU_WORKERS is set the CPUs are divided among
+# them for their process pools.
+HOST = os.environ.get("TOOLKIT_HOST", "0.0.0.0")
+PORT = env_int("TOOLKIT_PORT", 8000)
+WORKERS = max(1, env_int("TOOLKIT_WORKERS", 1))
+
+# Async job queue
+JOBS_DIR = os.environ.get("TOOLKIT_JOBS_DIR", os.path.join(BASE_TMP, "jobs"))
+JOB_CONCURRENCY = env_int("TOOLKIT_JOB_CONCURRENCY", 2)
+JOB_POLL_INTERVAL = env_float("TOOLKIT_JOB_POLL_INTERVAL", 1.0)
+# A running job whose worker hasn't sent a heartbeat for this long is
+# considered orphaned (worker crashed/restarted) and is queued again.
+JOB_STALE_SECONDS = env_float("TOOLKIT_JOB_STALE_SECONDS", 120.0)
+JOB_TTL_SECONDS = env_float("TOOLKIT_JOB_TTL_SECONDS", 24 * 3600.0)
+
+# Temporary files. Every request works in its own scratch directory that
+# is removed with the response; the sweeper removes what a crash or a
+# dropped connection leaves behind and enforces the disk quota.
+UPLOAD_DIR = os.path.join(BASE_TMP, "uploads")
+OUTPUT_DIR = os.path.join(BASE_TMP, "outputs")
+SCRATCH_DIR = os.environ.get("TOOLKIT_SCRATCH_DIR", os.path.join(BASE_TMP, "scratch"))
+TEMP_MAX_AGE_SECONDS = env_float("TOOLKIT_TEMP_MAX_AGE_SECONDS", 3600.0)
+TEMP_SWEEP_INTERVAL = env_float("TOOLKIT_TEMP_SWEEP_INTERVAL", 60.0)
+# New requests get 503 while the temp dirs hold more than this (0 = no
+# quota) or the disk has less than TEMP_MIN_FREE_BYTES free
+TEMP_MAX_BYTES = env_int("TOOLKIT_TEMP_MAX_BYTES", 10 * 1024 * 1024 * 1024)
+TEMP_MIN_FREE_BYTES = env_int("TOOLKIT_TEMP_MIN_FREE_BYTES", 512 * 1024 * 1024)
+# Optional RAM backed scratch space (e.g. /dev/shm/toolkit) for requests
+# up to TMPFS_MAX_REQUEST_BYTES, TMPFS_MAX_BYTES reserved in total
+TMPFS_DIR = os.environ.get("TOOLKIT_TMPFS_DIR", "").strip()
+TMPFS_MAX_BYTES = env_int("TOOLKIT_TMPFS_MAX_BYTES", 256 * 1024 * 1024)
+TMPFS_MAX_REQUEST_BYTES = env_int("TOOLKIT_TMPFS_MAX_REQUEST_BYTES", 8 * 1024 * 1024)
+
+# Document handles (/documents): uploaded once, used by id in later
+# requests. Removed by the sweeper when unused for DOCUMENT_TTL_SECONDS.
+DOCUMENTS_DIR = os.environ.get("TOOLKIT_DOCUMENTS_DIR", os.path.join(BASE_TMP, "documents"))
+DOCUMENT_TTL_SECONDS = env_float("TOOLKIT_DOCUMENT_TTL_SECONDS", 3600.0)
+# Steps in one /pipeline request
+MAX_PIPELINE_STEPS = env_int("TOOLKIT_MAX_PIPELINE_STEPS", 10)
+
+# Uploads
+UPLOAD_CHUNK_SIZE = env_int("TOOLKIT_UPLOAD_CHUNK_SIZE", 1024 * 1024)
+# Per file, can be overridden per endpoint with TOOLKIT_MAX_UPLOAD_<OPERATION>,
+# e.g. TOOLKIT_MAX_UPLOAD_MERGE=52428800
+MAX_UPLOAD_BYTES = env_int("TOOLKIT_MAX_UPLOAD_BYTES", 200 * 1024 * 1024)
+# All files of one request together
+MAX_REQUEST_BYTES = env_int("TOOLKIT_MAX_REQUEST_BYTES", 500 * 1024 * 1024)
+
+
+def max_upload_bytes(operation: str) -> int:
+    if not operation:
+        return MAX_UPLOAD_BYTES
+    name = "TOOLKIT_MAX_UPLOAD_" + operation.upper().replace("-", "_")
+    return env_int(name, MAX_UPLOAD_BYTES)
+
+# Result cache (content addressed, shared by all workers on the host)
+CACHE_ENABLED = env_bool("TOOLKIT_CACHE_ENABLED", True)
+CACHE_DIR = os.environ.get("TOOLKIT_CACHE_DIR", os.path.join(BASE_TMP, "result_cache"))
+CACHE_MAX_BYTES = env_int("TOOLKIT_CACHE_MAX_BYTES", 2 * 1024 * 1024 * 1024)
+CACHE_TTL_SECONDS = env_float("TOOLKIT_CACHE_TTL_SECONDS", 7 * 24 * 3600.0)
+
+# PDF rasterization (/pdf/to-images)
+PDF_RENDER_THREADS = env_int("TOOLKIT_PDF_RENDER_THREADS", min(4, CPU_WORKERS))
+# Pages rendered per pdftoppm batch; bounds temp disk use per request
+PDF_RENDER_CHUNK_PAGES = env_int("TOOLKIT_PDF_RENDER_CHUNK_PAGES", 16)
+
+# PDF compression (/pdf/compress): threads re-encoding images per document
+COMPRESS_THREADS = env_int("TOOLKIT_COMPRESS_THREADS", min(4, CPU_WORKERS))
+
+# Observability: /metrics endpoint and structured logs ("json" or "text")
+METRICS_ENABLED = env_bool("TOOLKIT_METRICS_ENABLED", True)
+LOG_LEVEL = os.environ.get("TOOLKIT_LOG_LEVEL", "INFO").strip().upper() or "INFO"
+LOG_FORMAT = os.environ.get("TOOLKIT_LOG_FORMAT", "json").strip().lower()
+# One log line per request with its status, duration and stage timings
+ACCESS_LOG = env_bool("TOOLKIT_ACCESS_LOG", True)
@@ -0,0 +1,117 @@
+import json
+import os
+import re
+import shutil
+import time
+import uuid
+from typing import NamedTuple, Optional
+
+from fastapi import HTTPException
+
+from cache import link_or_copy
+from config import DOCUMENTS_DIR, DOCUMENT_TTL_SECONDS
+
+# Document handles.
+#
+# A file uploaded to /documents is kept under DOCUMENTS_DIR/<id> and can be
+# passed by id to any operation instead of being uploaded again. Every use
+# hard links the content into the request's scratch directory, so the
+# handle stays valid for later requests and a concurrent expiry can't pull
+# the file out from under a running one. Using a handle also refreshes its
+# directory's mtime, which the temp file sweeper (storage.py) compares
+# against DOCUMENT_TTL_SECONDS; handles count towards the temp disk quota
+# like any other temporary file.
+
+CONTENT_NAME = "content"
+META_NAME = "meta.json"
+_ID_RE = re.compile(r"^[0-9a-f]{32}$")
+
+
+class StoredDocument(NamedTuple):
+    id: str
+    filename: str
+    content_type: Optional[str]
+    size: int
+    sha256: str
+    kind: Optional[str]
+    created_at: float
+
+    @property
+    def path(self) -> str:
+        return os.path.join(DOCUMENTS_DIR, self.id, CONTENT_NAME)
+
+    def describe(self) -> dict:
+        info = self._asdict()
+        info["expires_at"] = _last_used(self.id) + DOCUMENT_TTL_SECONDS
+        return info
+
+
+def _document_dir(doc_id: str) -> str:
+    return os.path.join(DOCUMENTS_DIR, doc_id)
+
+
+def _last_used(doc_id: str) -> float:
+    try:
+        return os.stat(_document_dir(doc_id)).st_mtime
+    except FileNotFoundError:
+        return time.time()
+
+
+def create_document(path: str, filename: str, content_type: Optional[str], size: int, sha256: str,
+                    kind: Optional[str]) -> StoredDocument:
+    """Moves the file at path into the store and returns its handle."""
+    doc = StoredDocument(uuid.uuid4().hex, filename, content_type, size, sha256, kind, time.time())
+    directory = _document_dir(doc.id)
+    os.makedirs(directory)
+    try:
+        shutil.move(path, doc.path)
+        # Written last, a handle without metadata doesn't resolve
+        tmp = os.path.join(directory, META_NAME + ".tmp")
+        with open(tmp, "w") as f:
+            json.dump(doc._asdict(), f)
+        os.replace(tmp, os.path.join(directory, META_NAME))
+    except BaseException:
+        shutil.rmtree(directory, ignore_errors=True)
+        raise
+    return doc
+
+
+def get_document(doc_id: str, touch: bool = True) -> Optional[StoredDocument]:
+    if not _ID_RE.match(doc_id or ""):
+        return None
+    directory = _document_dir(doc_id)
+    try:
+        with open(os.path.join(directory, META_NAME)) as f:
+            doc = StoredDocument(**json.load(f))
+        if time.time() - os.stat(directory).st_mtime > DOCUMENT_TTL_SECONDS:
+            # Expired, the sweeper just hasn't got to it yet
+            return None
+        if touch:
+            os.utime(directory)
+    except (OSError, ValueError, TypeError):
+        return None
+    return doc
+
+
+def require_document(doc_id: str) -> StoredDocument:
+    doc = get_document(doc_id)
+    if doc is None:
+        raise HTTPException(status_code=404, detail=f"Document {doc_id} not found or expired.")
+    return doc
+
+
+def delete_document(doc_id: str) -> bool:
+    if get_document(doc_id, touch=False) is None:
+        return False
+    shutil.rmtree(_document_dir(doc_id), ignore_errors=True)
+    return True
+
+
+def link_document(doc: StoredDocument, directory: str) -> str:
+    """Private path to the document's content in directory."""
+    dest = os.path.join(directory, f"doc_{uuid.uuid4().hex}{os.path.splitext(doc.filename)[1].lower()}")
+    try:
+        link_or_copy(doc.path, dest)
+    except FileNotFoundError:
+        raise HTTPException(status_code=404, detail=f"Document {doc.id} not found or expired.")
+    return dest
@@ -0,0 +1,122 @@
+import asyncio
+import hashlib
+import os
+import unicodedata
+from typing import Mapping, Optional
+from urllib.parse import quote
+
+from fastapi.responses import FileResponse, Response, StreamingResponse
+from starlette.datastructures import Headers
+
+# Result downloads.
+#
+# Every file result goes out through DownloadResponse, a FileResponse with
+# an ETag, Range/If-Range support so an interrupted download can be
+# resumed, If-None-Match for the GET endpoints and a Content-Disposition
+# header that survives non-ASCII filenames. The body is handed to the
+# server as a path (ASGI pathsend, which lets servers that support it
+# sendfile() the file) and read in large chunks otherwise.
+#
+# The ETag never needs the file to be read. Callers pass a digest naming
+# the content: the SHA-256 of a stored document, or for results the key of
+# the operation, its parameters and the SHA-256s of its inputs
+# (cache.result_key), so the same request resumes the same download even
+# when the result was produced again. A file served without one only gets
+# a weak ETag from its inode, size and mtime, which a later file can
+# reuse, so it never satisfies If-Range.
+
+CHUNK_SIZE = 1024 * 1024
+
+
+def file_tag(path: str) -> str:
+    st = os.stat(path)
+    identity = (st.st_dev, st.st_ino, st.st_size, st.st_mtime_ns)
+    return f'W/"{hashlib.sha256(repr(identity).encode()).hexdigest()}"'
+
+
+def strong_etag(digest: str) -> str:
+    return f'"{digest}"'
+
+
+def content_disposition(filename: str, disposition: str = "attachment") -> str:
+    """
+    RFC 6266 header value: an ASCII fallback in filename= and, when that
+    had to change anything, the exact name RFC 5987-encoded in filename*=.
+    """
+    filename = "".join(c for c in filename if unicodedata.category(c)[0] != "C") or "download"
+    base, ext = (unicodedata.normalize("NFKD", part).encode("ascii", "ignore").decode("ascii")
+                 for part in os.path.splitext(filename))
+    fallback = (base.strip() or "download") + ext
+    fallback = fallback.replace("\\", "_").replace('"', "_")
+    value = f'{disposition}; filename="{fallback}"'
+    if fallback != filename:
+        value += f"; filename*=UTF-8''{quote(filename, safe='')}"
+    return value
+
+
+def _opaque(tag: str) -> str:
+    return tag[2:] if tag.startswith("W/") else tag
+
+
+def _etag_matches(header: str, etag: str) -> bool:
+    # Weak comparison, as If-None-Match asks for
+    tags = [tag.strip() for tag in header.split(",")]
+    return "*" in tags or _opaque(etag) in map(_opaque, tags)
+
+
+class _ReleasingResponse:
+    # Starlette skips the background tasks when sending fails, e.g. because
+    # the client went away; they release the request's scratch directory,
+    # which the sweeper leaves alone while it is active
+    async def __call__(self, scope, receive, send):
+        background, self.background = self.background, None
+        try:
+            await self.respond(scope, receive, send)
+        finally:
+            if background is not None:
+                await background()
+
+    async def respond(self, scope, receive, send):
+        await super().__call__(scope, receive, send)
+
+
+class ZipStreamingResponse(_ReleasingResponse, StreamingResponse):
+    pass
+
+
+class DownloadResponse(_ReleasingResponse, FileResponse):
+    chunk_size = CHUNK_SIZE
+
+    def __init__(self, path: str, filename: str, media_type: Optional[str] = None,
+                 digest: Optional[str] = None, headers: Optional[Mapping[str, str]] = None, **kwargs):
+        """
+        digest identifies the content for the strong ETag; without it the
+        ETag is a weak one (see file_tag).
+        """
+        super().__init__(path, filename=filename, media_type=media_type, headers=headers, **kwargs)
+        self.headers["content-disposition"] = content_disposition(filename)
+        self.digest = digest
+
+    async def respond(self, scope, receive, send):
+        if self.digest is not None:
+            etag = strong_etag(self.digest)
+        else:
+            etag = await asyncio.to_thread(file_tag, self.path)
+        # Set before FileResponse fills in its own (mtime based) one
+        self.headers["etag"] = etag
+
+        headers = Headers(scope=scope)
+        if_none_match = headers.get("if-none-match")
+        if if_none_match and scope["method"] in ("GET", "HEAD") and _etag_matches(if_none_match, etag):
+            response = Response(status_code=304, headers={"ETag": etag})
+            await response(scope, receive, send)
+            return
+        if_range = headers.get("if-range")
+        if if_range is not None and "range" in headers:
+            # Only an unchanged strong ETag guarantees the client's partial
+            # copy and the rest of this one fit together, otherwise the whole
+            # file is sent. FileResponse only gets to see a Range to honour.
+            strong_match = if_range == etag and not etag.startswith("W/")
+            dropped = (b"if-range",) if strong_match else (b"if-range", b"range")
+            scope = dict(scope, headers=[(k, v) for k, v in scope["headers"] if k not in dropped])
+        await super().respond(scope, receive, send)
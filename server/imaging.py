@@ -0,0 +1,340 @@
+import os
+import uuid
+import zlib
+from typing import List, NamedTuple, Optional, Tuple
+
+from PIL import Image, ImageOps, ImageSequence, UnidentifiedImageError
+from PyPDF2.generic import (
+    ArrayObject,
+    DictionaryObject,
+    FloatObject,
+    IndirectObject,
+    NameObject,
+    NumberObject,
+    StreamObject,
+)
+
+from merging import PdfFileWriter
+from presets import (
+    ImagePreset,
+    IMAGE_PDF_PRESETS,
+    DEFAULT_IMAGE_PDF_PRESET,
+    ENCODER_PRESETS,
+    DEFAULT_ENCODER_PRESET,
+)
+
+# Streaming image to PDF behind /image/to-pdf.
+#
+# img2pdf builds the whole PDF as one bytes object. Here every image is
+# prepared on its own (in a process pool task) into a file holding the
+# final stream data, and the writer copies that file into the output in
+# chunks, so memory use is bounded by one decoded image per worker.
+#
+# With the "original" preset JPEGs are embedded as they are, the EXIF
+# orientation is applied by the page's transformation matrix instead of
+# re-encoding. The other presets decode, rotate, downscale and re-encode.
+
+
+# Used when an image has no resolution, same as img2pdf
+DEFAULT_DPI = 96.0
+
+# EXIF orientation -> matrix taking the image as stored (w x h points,
+# origin bottom left) to the displayed orientation on the page
+ORIENTATION_MATRICES = {
+    2: lambda w, h: (-1, 0, 0, 1, w, 0),
+    3: lambda w, h: (-1, 0, 0, -1, w, h),
+    4: lambda w, h: (1, 0, 0, -1, 0, h),
+    5: lambda w, h: (0, -1, -1, 0, h, w),
+    6: lambda w, h: (0, -1, 1, 0, 0, w),
+    7: lambda w, h: (0, 1, 1, 0, 0, 0),
+    8: lambda w, h: (0, 1, -1, 0, h, 0),
+}
+
+
+class PreparedImage(NamedTuple):
+    """One page: the image stream data sits in data_path."""
+    data_path: str
+    temporary: bool        # data_path was written for this page
+    width: int
+    height: int
+    color_space: str
+    bits: int
+    filter: str
+    decode: Optional[Tuple[int, ...]]
+    # Page size in points (before orientation) and EXIF orientation
+    page_width: float
+    page_height: float
+    orientation: int
+
+
+def _resolution(img: Image.Image) -> Tuple[float, float]:
+    dpi = img.info.get("dpi")
+    try:
+        x, y = float(dpi[0]), float(dpi[1])
+    except (TypeError, ValueError, IndexError):
+        return DEFAULT_DPI, DEFAULT_DPI
+    # Some files carry a zero or absurdly small resolution
+    return (x if x >= 1 else DEFAULT_DPI), (y if y >= 1 else DEFAULT_DPI)
+
+
+def _orientation(img: Image.Image) -> int:
+    try:
+        orientation = int(img.getexif().get(0x0112, 1))
+    except Exception:
+        return 1
+    return orientation if 1 <= orientation <= 8 else 1
+
+
+def _scaled_size(width: int, height: int, max_pixels: Optional[int]) -> Tuple[int, int]:
+    if not max_pixels or width * height <= max_pixels:
+        return width, height
+    scale = (max_pixels / float(width * height)) ** 0.5
+    return max(1, int(width * scale)), max(1, int(height * scale))
+
+
+def _flatten(img: Image.Image) -> Image.Image:
+    # PDF images have no alpha here, transparent areas become white
+    if img.mode in ("RGBA", "LA", "PA") or (img.mode == "P" and "transparency" in img.info):
+        img = img.convert("RGBA")
+        background = Image.new("RGB", img.size, (255, 255, 255))
+        background.paste(img, mask=img.getchannel("A"))
+        return background
+    if img.mode in ("1", "L", "RGB", "CMYK"):
+        return img
+    if img.mode in ("I;16", "I;16B", "I;16L", "I"):
+        return img.convert("I").point(lambda v: v * (1 / 256)).convert("L")
+    return img.convert("RGB")
+
+
+def _raw_page(img: Image.Image, work_dir: str, page_size: Tuple[float, float], orientation: int) -> PreparedImage:
+    # Lossless: pixels go in Flate compressed, rows as PIL stores them
+    img = _flatten(img)
+    color_space = {"1": "/DeviceGray", "L": "/DeviceGray", "CMYK": "/DeviceCMYK"}.get(img.mode, "/DeviceRGB")
+    data_path = os.path.join(work_dir, f"{uuid.uuid4()}.bin")
+    compressor = zlib.compressobj(6)
+    with open(data_path, "wb") as f:
+        rows = 256
+        for top in range(0, img.height, rows):
+            box = (0, top, img.width, min(img.height, top + rows))
+            f.write(compressor.compress(img.crop(box).tobytes()))
+        f.write(compressor.flush())
+    return PreparedImage(
+        data_path, True, img.width, img.height, color_space, 1 if img.mode == "1" else 8,
+        "/FlateDecode", None, page_size[0], page_size[1], orientation,
+    )
+
+
+def _jpeg_page(img: Image.Image, data_path: str, temporary: bool,
+               page_size: Tuple[float, float], orientation: int) -> PreparedImage:
+    color_space = {"L": "/DeviceGray", "CMYK": "/DeviceCMYK"}.get(img.mode, "/DeviceRGB")
+    decode = None
+    if img.mode == "CMYK" and "adobe" in img.info:
+        # Adobe CMYK JPEGs are stored inverted
+        decode = (1, 0) * 4
+    return PreparedImage(
+        data_path, temporary, img.width, img.height, color_space, 8,
+        "/DCTDecode", decode, page_size[0], page_size[1], orientation,
+    )
+
+
+def _reencode(img: Image.Image, preset: ImagePreset, work_dir: str, page_size) -> PreparedImage:
+    width, height = _scaled_size(img.width, img.height, preset.max_pixels)
+    if img.format in ("JPEG", "MPO") and (width, height) != img.size:
+        # Let the JPEG decoder do most of the downscaling (DCT scaling)
+        img.draft("L" if preset.grayscale else img.mode, (width, height))
+    img = ImageOps.exif_transpose(img)
+    img = _flatten(img)
+    if preset.grayscale:
+        img = img.convert("L")
+    elif img.mode not in ("L", "RGB"):
+        img = img.convert("RGB")
+    # Sizes swap if the transpose rotated the image
+    target = _scaled_size(img.width, img.height, preset.max_pixels)
+    if target != img.size:
+        img = img.resize(target, Image.LANCZOS, reducing_gap=3.0)
+    data_path = os.path.join(work_dir, f"{uuid.uuid4()}.jpg")
+    img.save(data_path, "JPEG", quality=preset.quality, optimize=True)
+    return _jpeg_page(img, data_path, True, page_size, 1)
+
+
+def prepare_image(path: str, preset: str = DEFAULT_IMAGE_PDF_PRESET, work_dir: str = None) -> List[PreparedImage]:
+    """
+    Turns one image file into the pages it should produce (one per frame
+    for multi-frame GIF/TIFF). Runs in a process pool worker.
+    """
+    preset_values = IMAGE_PDF_PRESETS[preset]
+    work_dir = work_dir or os.path.dirname(path)
+    pages = []
+    with Image.open(path) as img:
+        orientation = _orientation(img)
+        dpi_x, dpi_y = _resolution(img)
+        # MPO (phone cameras) is a JPEG followed by previews, only the
+        # first image is a page
+        is_jpeg = img.format in ("JPEG", "MPO")
+        frames = [img] if is_jpeg else ImageSequence.Iterator(img)
+        multi_frame = getattr(img, "n_frames", 1) > 1
+        for frame in frames:
+            # The page keeps the physical size of the original image,
+            # only the resolution of the embedded image changes
+            page_size = (frame.width * 72.0 / dpi_x, frame.height * 72.0 / dpi_y)
+            if orientation in (5, 6, 7, 8) and preset_values.max_pixels is not None:
+                page_size = page_size[::-1]
+            if preset_values.max_pixels is not None:
+                pages.append(_reencode(frame.copy() if multi_frame else frame, preset_values,
+                                       work_dir, page_size))
+            elif is_jpeg and img.mode in ("L", "RGB", "CMYK"):
+                # Embedded as is, the viewer decodes it
+                pages.append(_jpeg_page(img, path, False, page_size, orientation))
+            else:
+                pages.append(_raw_page(frame, work_dir, page_size, orientation))
+    return pages
+
+
+def _number(value: float):
+    return NumberObject(value) if float(value).is_integer() else FloatObject(round(value, 4))
+
+
+class ImagePdfWriter(PdfFileWriter):
+    """Writes one page per prepared image, in the order they are added."""
+
+    def add(self, image: PreparedImage):
+        with self.open() as out:
+            image_number = self.allocate()
+            header = DictionaryObject({
+                NameObject("/Type"): NameObject("/XObject"),
+                NameObject("/Subtype"): NameObject("/Image"),
+                NameObject("/Width"): NumberObject(image.width),
+                NameObject("/Height"): NumberObject(image.height),
+                NameObject("/ColorSpace"): NameObject(image.color_space),
+                NameObject("/BitsPerComponent"): NumberObject(image.bits),
+                NameObject("/Filter"): NameObject(image.filter),
+            })
+            if image.decode:
+                header[NameObject("/Decode")] = ArrayObject(NumberObject(v) for v in image.decode)
+            self.write_stream_file(out, image_number, header, image.data_path)
+
+            w, h = image.page_width, image.page_height
+            media_w, media_h = (h, w) if image.orientation in (5, 6, 7, 8) else (w, h)
+            operators = []
+            if image.orientation in ORIENTATION_MATRICES:
+                matrix = ORIENTATION_MATRICES[image.orientation](w, h)
+                operators.append(" ".join(f"{v:.4f}" for v in matrix) + " cm")
+            operators.append(f"{w:.4f} 0 0 {h:.4f} 0 0 cm /Im0 Do")
+            content = StreamObject()
+            content._data = f"q {' '.join(operators)} Q".encode()
+            content_number = self.allocate()
+            self.write_object(out, content_number, content)
+
+            page_number = self.allocate()
+            page = DictionaryObject({
+                NameObject("/Type"): NameObject("/Page"),
+                NameObject("/Parent"): IndirectObject(self.pages_number, 0, None),
+                NameObject("/MediaBox"): ArrayObject([
+                    NumberObject(0), NumberObject(0), _number(media_w), _number(media_h)
+                ]),
+                NameObject("/Resources"): DictionaryObject({
+                    NameObject("/XObject"): DictionaryObject({
+                        NameObject("/Im0"): IndirectObject(image_number, 0, None),
+                    }),
+                }),
+                NameObject("/Contents"): IndirectObject(content_number, 0, None),
+            })
+            self.write_object(out, page_number, page)
+            self.kids.append(page_number)
+
+    def finish(self) -> str:
+        if not self.kids:
+            raise ValueError("No images to convert.")
+        return super().finish()
+
+
+# Image format conversion behind /image/convert.
+#
+# Downscaling starts in the decoder: draft() makes the JPEG decoder skip
+# DCT coefficients (1/2, 1/4 or 1/8 of the size for a fraction of the
+# work and memory), reduce() then takes the image down by an integer
+# factor with a cheap box filter, and only the last step uses LANCZOS.
+
+# Formats with a quality setting, and the default when none is given
+QUALITY_FORMATS = {"JPEG": 75, "WEBP": 80}
+
+
+def _fit_size(width: int, height: int, max_width: Optional[int], max_height: Optional[int]) -> Tuple[int, int]:
+    # Fits inside the box keeping the aspect ratio, never enlarges
+    scale = 1.0
+    if max_width:
+        scale = min(scale, max_width / float(width))
+    if max_height:
+        scale = min(scale, max_height / float(height))
+    if scale >= 1.0:
+        return width, height
+    return max(1, round(width * scale)), max(1, round(height * scale))
+
+
+def encoder_options(format: str, encoder: str = DEFAULT_ENCODER_PRESET, quality: Optional[int] = None) -> dict:
+    options = dict(ENCODER_PRESETS[encoder].get(format, {}))
+    if format in QUALITY_FORMATS:
+        options["quality"] = quality or QUALITY_FORMATS[format]
+    return options
+
+
+def _target_mode(img: Image.Image, format: str) -> Image.Image:
+    if format == "JPEG":
+        img = _flatten(img)
+        return img if img.mode in ("L", "RGB") else img.convert("RGB")
+    if img.mode in ("CMYK", "I;16", "I;16B", "I;16L", "I", "F", "YCbCr", "LAB", "HSV"):
+        return _flatten(img) if img.mode != "CMYK" else img.convert("RGB")
+    if format == "BMP" and img.mode in ("LA", "PA"):
+        return img.convert("RGBA")
+    return img
+
+
+def convert_image(input_path: str, output_path: str, format: str, max_width: int = None, max_height: int = None,
+                  quality: int = None, encoder: str = DEFAULT_ENCODER_PRESET) -> str:
+    """
+    Converts one image to `format`, downscaled to fit max_width x
+    max_height when given. The EXIF orientation is applied, so the output
+    shows upright without it.
+    """
+    with Image.open(input_path) as img:
+        orientation = _orientation(img)
+        # Box in stored orientation, the transpose below may swap the sides
+        box = (max_width, max_height) if orientation < 5 else (max_height, max_width)
+        target = _fit_size(img.width, img.height, *box)
+        if target != img.size and img.format in ("JPEG", "MPO"):
+            img.draft(img.mode, target)
+        out = img
+        if target != out.size:
+            factor = min(out.width // target[0], out.height // target[1])
+            if factor >= 2:
+                out = out.reduce(factor)
+            if out.size != target:
+                out = out.resize(target, Image.LANCZOS)
+        out = ImageOps.exif_transpose(out)
+        out = _target_mode(out, format)
+        out.save(output_path, format=format, **encoder_options(format, encoder, quality))
+    return output_path
+
+
+class ImageJob(NamedTuple):
+    input_path: str
+    output_path: str
+
+
+def convert_images(jobs: List[ImageJob], format: str, max_width: int = None, max_height: int = None,
+                   quality: int = None, encoder: str = DEFAULT_ENCODER_PRESET) -> List[Optional[str]]:
+    """
+    Process pool entry point for a batch: converts every job and returns
+    the error for each one, None where it worked.
+    """
+    errors = []
+    for job in jobs:
+        try:
+            convert_image(job.input_path, job.output_path, format, max_width, max_height, quality, encoder)
+            errors.append(None)
+        except UnidentifiedImageError:
+            # Pillow's message names the temporary path
+            errors.append("Not a readable image.")
+        except Exception as e:
+            errors.append(str(e) or e.__class__.__name__)
+    return errors
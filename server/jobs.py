@@ -0,0 +1,555 @@
+import asyncio
+import json
+import logging
+import os
+import shutil
+import socket
+import sqlite3
+import time
+import uuid
+from typing import List, Optional
+
+from fastapi import HTTPException
+
+import metrics
+import scheduler
+import utils
+
+logger = logging.getLogger(__name__)
+from config import (
+    JOBS_DIR,
+    JOB_CONCURRENCY,
+    JOB_POLL_INTERVAL,
+    JOB_STALE_SECONDS,
+    JOB_TTL_SECONDS,
+    RETRY_AFTER_SECONDS,
+)
+
+# Persistent job queue for the async API (/jobs/...).
+#
+# Jobs, their inputs and their results live under JOBS_DIR with the job
+# table in SQLite, so any uvicorn worker can pick up a queued job or serve
+# a finished result, and jobs survive a worker restart: a job left in the
+# "running" state by a dead worker stops sending heartbeats and is queued
+# again.
+
+STATUS_QUEUED = "queued"
+STATUS_RUNNING = "running"
+STATUS_DONE = "done"
+STATUS_FAILED = "failed"
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS jobs (
+    id TEXT PRIMARY KEY,
+    operation TEXT NOT NULL,
+    status TEXT NOT NULL,
+    params TEXT NOT NULL,
+    inputs TEXT NOT NULL,
+    result_filename TEXT NOT NULL,
+    media_type TEXT NOT NULL,
+    result_path TEXT,
+    error TEXT,
+    progress_done INTEGER NOT NULL DEFAULT 0,
+    progress_total INTEGER NOT NULL DEFAULT 0,
+    worker TEXT,
+    attempts INTEGER NOT NULL DEFAULT 0,
+    created_at REAL NOT NULL,
+    updated_at REAL NOT NULL,
+    heartbeat_at REAL,
+    result_key TEXT
+)
+"""
+
+MAX_ATTEMPTS = 3
+# The scheduler's client for all jobs: together they get one fair share
+JOBS_CLIENT = "jobs"
+
+
+def _connect() -> sqlite3.Connection:
+    os.makedirs(JOBS_DIR, exist_ok=True)
+    conn = sqlite3.connect(os.path.join(JOBS_DIR, "jobs.db"), timeout=30, isolation_level=None)
+    conn.row_factory = sqlite3.Row
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute(SCHEMA)
+    if "result_key" not in {row["name"] for row in conn.execute("PRAGMA table_info(jobs)")}:
+        # Stores created before results had a key (their ETag)
+        try:
+            conn.execute("ALTER TABLE jobs ADD COLUMN result_key TEXT")
+        except sqlite3.OperationalError:
+            pass  # added by another process in the meantime
+    return conn
+
+
+def job_dir(job_id: str) -> str:
+    return os.path.join(JOBS_DIR, job_id)
+
+
+def new_job_id() -> str:
+    return uuid.uuid4().hex
+
+
+# Store
+def create_job(job_id: str, operation: str, params: dict, inputs: List[str],
+               result_filename: str, media_type: str, result_key: Optional[str] = None):
+    now = time.time()
+    conn = _connect()
+    try:
+        conn.execute(
+            "INSERT INTO jobs (id, operation, status, params, inputs, result_filename, media_type, result_key, "
+            "created_at, updated_at) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+            (job_id, operation, STATUS_QUEUED, json.dumps(params), json.dumps(inputs),
+             result_filename, media_type, result_key, now, now),
+        )
+    finally:
+        conn.close()
+
+
+def get_job(job_id: str) -> Optional[dict]:
+    conn = _connect()
+    try:
+        row = conn.execute("SELECT * FROM jobs WHERE id = ?", (job_id,)).fetchone()
+        return dict(row) if row else None
+    finally:
+        conn.close()
+
+
+def claim_next_job(worker: str) -> Optional[dict]:
+    conn = _connect()
+    try:
+        # BEGIN IMMEDIATE takes the write lock so two workers can't claim
+        # the same job.
+        conn.execute("BEGIN IMMEDIATE")
+        row = conn.execute(
+            "SELECT * FROM jobs WHERE status = ? ORDER BY created_at LIMIT 1", (STATUS_QUEUED,)
+        ).fetchone()
+        if row is None:
+            conn.execute("COMMIT")
+            return None
+        now = time.time()
+        conn.execute(
+            "UPDATE jobs SET status = ?, worker = ?, attempts = attempts + 1, updated_at = ?, heartbeat_at = ? WHERE id = ?",
+            (STATUS_RUNNING, worker, now, now, row["id"]),
+        )
+        conn.execute("COMMIT")
+        job = dict(row)
+        job["attempts"] += 1
+        return job
+    except Exception:
+        conn.execute("ROLLBACK")
+        raise
+    finally:
+        conn.close()
+
+
+def _update(job_id: str, **fields):
+    fields["updated_at"] = time.time()
+    columns = ", ".join(f"{name} = ?" for name in fields)
+    conn = _connect()
+    try:
+        conn.execute(f"UPDATE jobs SET {columns} WHERE id = ?", (*fields.values(), job_id))
+    finally:
+        conn.close()
+
+
+def set_progress(job_id: str, done: int, total: int):
+    _update(job_id, progress_done=done, progress_total=total)
+
+
+def finish_job(job_id: str, result_path: str):
+    _update(job_id, status=STATUS_DONE, result_path=result_path, error=None)
+
+
+def fail_job(job_id: str, error: str):
+    _update(job_id, status=STATUS_FAILED, error=error)
+
+
+def requeue_job(job_id: str):
+    _update(job_id, status=STATUS_QUEUED, worker=None)
+
+
+def heartbeat(job_ids: List[str]):
+    if not job_ids:
+        return
+    conn = _connect()
+    try:
+        placeholders = ", ".join("?" for _ in job_ids)
+        conn.execute(f"UPDATE jobs SET heartbeat_at = ? WHERE id IN ({placeholders})", (time.time(), *job_ids))
+    finally:
+        conn.close()
+
+
+def requeue_stale_jobs():
+    cutoff = time.time() - JOB_STALE_SECONDS
+    conn = _connect()
+    try:
+        conn.execute(
+            "UPDATE jobs SET status = ?, error = 'Worker stopped responding' WHERE status = ? AND heartbeat_at < ? AND attempts >= ?",
+            (STATUS_FAILED, STATUS_RUNNING, cutoff, MAX_ATTEMPTS),
+        )
+        conn.execute(
+            "UPDATE jobs SET status = ?, worker = NULL WHERE status = ? AND heartbeat_at < ?",
+            (STATUS_QUEUED, STATUS_RUNNING, cutoff),
+        )
+    finally:
+        conn.close()
+
+
+def purge_expired_jobs():
+    cutoff = time.time() - JOB_TTL_SECONDS
+    conn = _connect()
+    try:
+        rows = conn.execute(
+            "SELECT id FROM jobs WHERE status IN (?, ?) AND updated_at < ?", (STATUS_DONE, STATUS_FAILED, cutoff)
+        ).fetchall()
+        for row in rows:
+            shutil.rmtree(job_dir(row["id"]), ignore_errors=True)
+            conn.execute("DELETE FROM jobs WHERE id = ?", (row["id"],))
+    finally:
+        conn.close()
+
+
+def count_jobs() -> dict:
+    conn = _connect()
+    try:
+        rows = conn.execute("SELECT status, COUNT(*) AS n FROM jobs GROUP BY status").fetchall()
+        return {row["status"]: row["n"] for row in rows}
+    finally:
+        conn.close()
+
+
+metrics.Gauge(
+    "toolkit_async_jobs", "Async jobs in the store by status (shared by all workers).", ("status",),
+    collect=lambda: {(status,): n for status, n in count_jobs().items()},
+)
+
+
+class JobProgress:
+    """
+    Picklable progress callback, so functions running in the process pool
+    can report progress straight into the job store.
+    """
+    def __init__(self, job_id: str, interval: float = 0.5):
+        self.job_id = job_id
+        self.interval = interval
+        self._last = 0.0
+
+    def __call__(self, done: int, total: int):
+        now = time.monotonic()
+        if done < total and now - self._last < self.interval:
+            return
+        self._last = now
+        try:
+            set_progress(self.job_id, done, total)
+        except sqlite3.Error as e:
+            logger.warning("Error updating job progress", extra={"job_id": self.job_id, "error": str(e)})
+
+
+# Operations
+#
+# Runners execute in the worker pools, they take the stored input paths and
+# write their result (and any intermediate files) into `output_dir`.
+def _keep(path: str, output_dir: str) -> str:
+    dest = os.path.join(output_dir, "result" + os.path.splitext(path)[1])
+    shutil.move(path, dest)
+    return dest
+
+
+def _keep_zip(paths: List[str], source_path: str, output_dir: str) -> str:
+    from zipfile import ZipFile
+    dest = os.path.join(output_dir, "result.zip")
+    with ZipFile(dest, 'w') as zipf:
+        for path in paths:
+            zipf.write(path, utils.member_name(path, source_path))
+    utils.cleanup_files(paths)
+    return dest
+
+
+def run_convert(inputs, params, output_dir, progress):
+    return _keep(utils.convert_to_pdf_libreoffice(inputs[0], output_dir), output_dir)
+
+
+def run_excel_to_pdf(inputs, params, output_dir, progress):
+    options = utils.excel_preflight_options()
+    if options is None:
+        return run_convert(inputs, params, output_dir, progress)
+    path = utils.prepare_workbook(inputs[0], output_dir, **options)
+    try:
+        return _keep(utils.convert_to_pdf_libreoffice(path, output_dir), output_dir)
+    finally:
+        if path != inputs[0]:
+            utils.cleanup_files([path])
+
+
+def run_text_to_pdf(inputs, params, output_dir, progress):
+    return _keep(utils.text_to_pdf(inputs[0], output_dir, **params), output_dir)
+
+
+def run_merge(inputs, params, output_dir, progress):
+    return _keep(utils.merge_pdfs(inputs, params["pages"], output_dir=output_dir), output_dir)
+
+
+def run_split(inputs, params, output_dir, progress):
+    parts_dir = os.path.join(output_dir, "parts")
+    os.makedirs(parts_dir, exist_ok=True)
+    parts = utils.split_pdf(inputs[0], output_dir=parts_dir, progress=progress, **params)
+    result = _keep_zip(parts, inputs[0], output_dir)
+    shutil.rmtree(parts_dir, ignore_errors=True)
+    return result
+
+
+def run_compress(inputs, params, output_dir, progress):
+    return _keep(utils.compress_pdf(inputs[0], params["preset"], output_dir=output_dir), output_dir)
+
+
+def run_remove_pages(inputs, params, output_dir, progress):
+    return _keep(utils.remove_pdf_pages(inputs[0], params["pages"], output_dir=output_dir), output_dir)
+
+
+def run_organize(inputs, params, output_dir, progress):
+    return _keep(utils.organize_pdf(inputs[0], output_dir=output_dir, **params), output_dir)
+
+
+def run_image_to_pdf(inputs, params, output_dir, progress):
+    return _keep(utils.image_to_pdf(inputs, params["preset"], progress=progress, output_dir=output_dir), output_dir)
+
+
+def run_image_convert(inputs, params, output_dir, progress):
+    return _keep(utils.convert_image_format(inputs[0], output_dir=output_dir, **params), output_dir)
+
+
+def run_pdf_to_images(inputs, params, output_dir, progress):
+    return _keep(utils.pdf_to_images_zip(inputs[0], progress=progress, output_dir=output_dir, **params), output_dir)
+
+
+def _no_params(params: dict) -> dict:
+    return {}
+
+
+def _pages_params(params: dict) -> dict:
+    return {"pages": utils.validate_page_numbers(params.get("pages"))}
+
+
+def _organize_params(params: dict) -> dict:
+    return utils.validate_organize_options(params.get("pages", ""), params.get("remove", ""), params.get("rotate", 0))
+
+
+def _format_params(params: dict) -> dict:
+    return utils.validate_image_convert_options(
+        params.get("format", "PNG"), params.get("width", 0), params.get("height", 0),
+        params.get("quality"), params.get("encoder", utils.DEFAULT_ENCODER_PRESET)
+    )
+
+
+def _merge_params(params: dict) -> dict:
+    return {"pages": utils.validate_merge_pages(params.get("pages"))}
+
+
+def _split_params(params: dict) -> dict:
+    return utils.validate_split_options(
+        params.get("ranges", ""), params.get("every", 0), params.get("bookmarks", False),
+        params.get("minimal_resources", False)
+    )
+
+
+def _text_pdf_params(params: dict) -> dict:
+    return utils.validate_text_pdf_options(
+        params.get("font", "courier"), params.get("font_size", 10), params.get("page_size", "A4"),
+        params.get("landscape", False), params.get("margin", 15), params.get("wrap", True),
+        params.get("encoding", "")
+    )
+
+
+def _compress_params(params: dict) -> dict:
+    return {"preset": utils.validate_compression_preset(params.get("preset", utils.DEFAULT_COMPRESSION_PRESET))}
+
+
+def _image_pdf_params(params: dict) -> dict:
+    return {"preset": utils.validate_image_pdf_preset(params.get("preset", utils.DEFAULT_IMAGE_PDF_PRESET))}
+
+
+def _render_params(params: dict) -> dict:
+    options = utils.validate_render_options(
+        params.get("dpi", 200), params.get("format", "JPEG"), params.get("quality", 75)
+    )
+    pages = params.get("pages", "")
+    if not isinstance(pages, str):
+        raise HTTPException(status_code=400, detail="Pages must be a page range string like \"1-5,8\".")
+    options["pages"] = pages
+    return options
+
+
+class JobOperation:
+    def __init__(self, runner, accept, suffix: str, media_type: str, slot: str,
+                 multiple: bool = False, cpu_bound: bool = True, validate=_no_params):
+        self.runner = runner
+        # tuple of extensions, or "image" to check the content type
+        self.accept = accept
+        if accept == "image":
+            self.kinds = utils.KINDS_IMAGE
+        elif accept == ('.pdf',):
+            self.kinds = utils.KINDS_PDF
+        elif accept == ('.txt',):
+            self.kinds = utils.KINDS_TEXT
+        else:
+            self.kinds = utils.KINDS_OFFICE
+        self.suffix = suffix
+        self.media_type = media_type
+        self.slot = slot
+        self.multiple = multiple
+        self.cpu_bound = cpu_bound
+        self.validate = validate
+
+    def accepts(self, filename: str, content_type: Optional[str]) -> bool:
+        if self.accept == "image":
+            return bool(content_type) and content_type.startswith("image/")
+        return filename.endswith(self.accept)
+
+    def _fields(self, params: dict) -> dict:
+        fields = dict(params)
+        fields.update({f"{k}_lower": str(v).lower() for k, v in params.items()})
+        return fields
+
+    def result_filename(self, filename: str, params: dict) -> str:
+        return f"{utils.clean_filename_base(filename)}{self.suffix.format(**self._fields(params))}"
+
+    def result_media_type(self, params: dict) -> str:
+        return self.media_type.format(**self._fields(params))
+
+
+JOB_OPERATIONS = {
+    "word-to-pdf": JobOperation(run_convert, ('.doc', '.docx'), "-topdf.pdf", "application/pdf", "convert", cpu_bound=False),
+    "excel-to-pdf": JobOperation(run_excel_to_pdf, ('.xls', '.xlsx'), "-topdf.pdf", "application/pdf", "convert", cpu_bound=False),
+    "ppt-to-pdf": JobOperation(run_convert, ('.ppt', '.pptx'), "-topdf.pdf", "application/pdf", "convert", cpu_bound=False),
+    "text-to-pdf": JobOperation(run_text_to_pdf, ('.txt',), "-topdf.pdf", "application/pdf", "text-to-pdf",
+                                validate=_text_pdf_params),
+    "merge": JobOperation(run_merge, ('.pdf',), "-merged.pdf", "application/pdf", "merge", multiple=True,
+                          validate=_merge_params),
+    "split": JobOperation(run_split, ('.pdf',), "-split.zip", "application/zip", "split",
+                          validate=_split_params),
+    "compress": JobOperation(run_compress, ('.pdf',), "-compressed.pdf", "application/pdf", "compress",
+                             validate=_compress_params),
+    "remove-pages": JobOperation(run_remove_pages, ('.pdf',), "-pages-removed.pdf", "application/pdf", "remove-pages",
+                                 validate=_pages_params),
+    "organize": JobOperation(run_organize, ('.pdf',), "-organized.pdf", "application/pdf", "organize",
+                             validate=_organize_params),
+    "image-to-pdf": JobOperation(run_image_to_pdf, "image", "-imagestopdf.pdf", "application/pdf", "image-to-pdf",
+                                 multiple=True, cpu_bound=False, validate=_image_pdf_params),
+    "image-convert": JobOperation(run_image_convert, "image", "-converted.{format_lower}", "image/{format_lower}",
+                                  "image-convert", validate=_format_params),
+    "pdf-to-images": JobOperation(run_pdf_to_images, ('.pdf',), "-toimages.zip", "application/zip", "pdf-to-images",
+                                  cpu_bound=False, validate=_render_params),
+}
+
+
+# Worker
+class JobWorker:
+    """
+    Background task (one per uvicorn worker) that claims queued jobs from
+    the store and runs them on the shared execution pools.
+    """
+    def __init__(self):
+        self.worker_id = f"{socket.gethostname()}-{os.getpid()}"
+        self.wake = asyncio.Event()
+        self.running = {}
+        self.task: Optional[asyncio.Task] = None
+
+    def start(self):
+        self.task = asyncio.create_task(self._loop())
+
+    async def stop(self):
+        if self.task is not None:
+            self.task.cancel()
+            try:
+                await self.task
+            except asyncio.CancelledError:
+                pass
+        for task in list(self.running.values()):
+            task.cancel()
+        if self.running:
+            await asyncio.gather(*self.running.values(), return_exceptions=True)
+
+    async def _loop(self):
+        maintenance_interval = max(1.0, JOB_STALE_SECONDS / 4)
+        last_maintenance = 0.0
+        while True:
+            try:
+                if time.monotonic() - last_maintenance > maintenance_interval:
+                    last_maintenance = time.monotonic()
+                    await asyncio.to_thread(heartbeat, list(self.running))
+                    await asyncio.to_thread(requeue_stale_jobs)
+                    await asyncio.to_thread(purge_expired_jobs)
+
+                while len(self.running) < JOB_CONCURRENCY:
+                    job = await asyncio.to_thread(claim_next_job, self.worker_id)
+                    if job is None:
+                        break
+                    task = asyncio.create_task(self._execute(job))
+                    self.running[job["id"]] = task
+                    task.add_done_callback(lambda t, job_id=job["id"]: self.running.pop(job_id, None))
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.exception("Error in job worker")
+
+            try:
+                await asyncio.wait_for(self.wake.wait(), JOB_POLL_INTERVAL)
+            except asyncio.TimeoutError:
+                pass
+            self.wake.clear()
+
+    async def _execute(self, job: dict):
+        job_id = job["id"]
+        operation = JOB_OPERATIONS.get(job["operation"])
+        if operation is None:
+            await asyncio.to_thread(fail_job, job_id, f"Unknown operation {job['operation']}")
+            return
+
+        inputs = json.loads(job["inputs"])
+        params = json.loads(job["params"])
+        output_dir = os.path.join(job_dir(job_id), "output")
+        os.makedirs(output_dir, exist_ok=True)
+        run = utils.run_cpu_bound if operation.cpu_bound else utils.run_io_bound
+        scheduler.current_work.set(scheduler.Work(JOBS_CLIENT, inputs))
+        try:
+            result_path = await run(operation.slot, operation.runner, inputs, params, output_dir, JobProgress(job_id))
+        except asyncio.CancelledError:
+            # Shutting down, let another worker pick it up
+            requeue_job(job_id)
+            raise
+        except HTTPException as e:
+            if e.status_code in (429, 503):
+                # Server is busy with interactive requests, try again later
+                await asyncio.sleep(RETRY_AFTER_SECONDS)
+                await asyncio.to_thread(requeue_job, job_id)
+                return
+            await asyncio.to_thread(fail_job, job_id, str(e.detail))
+        except Exception as e:
+            logger.error("Job failed", extra={"job_id": job_id, "operation": job["operation"], "error": str(e)})
+            await asyncio.to_thread(fail_job, job_id, str(e))
+        else:
+            await asyncio.to_thread(finish_job, job_id, result_path)
+        utils.cleanup_files(inputs)
+
+    def notify(self):
+        self.wake.set()
+
+
+_worker: Optional[JobWorker] = None
+
+
+def start_worker():
+    global _worker
+    _worker = JobWorker()
+    _worker.start()
+
+
+async def stop_worker():
+    global _worker
+    if _worker is not None:
+        await _worker.stop()
+        _worker = None
+
+
+def notify_worker():
+    if _worker is not None:
+        _worker.notify()
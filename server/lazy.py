@@ -0,0 +1,48 @@
+import importlib
+import logging
+import time
+from typing import Iterable
+
+logger = logging.getLogger(__name__)
+
+# Deferred imports.
+#
+# PyPDF2, Pillow, pikepdf, pdf2image, openpyxl and the toolkit modules built on them
+# are imported on first use instead of when the server starts, so a worker
+# process (or a process pool worker unpickling its first task) is up
+# sooner and only pays for the operations it serves. import_modules()
+# loads them ahead of time for the prewarm hook (TOOLKIT_PREWARM).
+
+# Heavy imports in the order the operations need them
+HEAVY_MODULES = ("PyPDF2", "PIL.Image", "pdf2image", "compression", "merging", "imaging", "pdfinfo", "pikepdf",
+                 "xlsxprep")
+
+
+class LazyModule:
+    """
+    Stands in for a module until one of its attributes is used. Every
+    lookup goes through importlib, which imports the module once and makes
+    other threads wait while that import is running.
+    """
+    def __init__(self, name: str):
+        self.__dict__["_name"] = name
+
+    def __getattr__(self, attr):
+        return getattr(importlib.import_module(self._name), attr)
+
+    def __repr__(self):
+        return f"<lazy module {self._name!r}>"
+
+
+def import_modules(names: Iterable[str] = HEAVY_MODULES) -> float:
+    """
+    Imports `names` (optional ones that aren't installed are skipped) and
+    returns the seconds it took.
+    """
+    started = time.perf_counter()
+    for name in names:
+        try:
+            importlib.import_module(name)
+        except ImportError as e:
+            logger.info("Not prewarming missing module", extra={"module": name, "error": str(e)})
+    return time.perf_counter() - started
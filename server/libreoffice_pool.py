@@ -0,0 +1,403 @@
+import logging
+import os
+import queue
+import shutil
+import subprocess
+import tempfile
+import threading
+import time
+from contextlib import contextmanager
+from typing import Optional
+
+from config import (
+    LIBREOFFICE_POOL_SIZE,
+    LIBREOFFICE_MAX_CONVERSIONS,
+    LIBREOFFICE_TIMEOUT,
+    LIBREOFFICE_STARTUP_TIMEOUT,
+    LIBREOFFICE_HEALTH_INTERVAL,
+    LIBREOFFICE_PROFILE_DIR,
+)
+import metrics
+
+logger = logging.getLogger(__name__)
+
+# Pool of long-lived headless LibreOffice instances.
+#
+# Every instance runs with its own user profile and its own UNO pipe
+# listener, so concurrent conversions never fight over the shared default
+# profile, and documents are converted through the UNO API. The pool needs
+# the `uno` Python bindings (they ship with LibreOffice); without them every
+# conversion is a one-off `soffice --convert-to` process with a profile of
+# its own (see one_shot_profile).
+
+try:
+    import uno  # noqa: F401
+    HAS_UNO = True
+except ImportError:
+    HAS_UNO = False
+
+# storeToURL export filter per document service
+PDF_EXPORT_FILTERS = [
+    ("com.sun.star.sheet.SpreadsheetDocument", "calc_pdf_Export"),
+    ("com.sun.star.presentation.PresentationDocument", "impress_pdf_Export"),
+    ("com.sun.star.drawing.DrawingDocument", "draw_pdf_Export"),
+    ("com.sun.star.text.TextDocument", "writer_pdf_Export"),
+]
+
+
+class LibreOfficeError(Exception):
+    pass
+
+
+class LibreOfficeTimeout(LibreOfficeError):
+    pass
+
+
+def _path_to_url(path: str) -> str:
+    if HAS_UNO:
+        import uno
+        return uno.systemPathToFileUrl(os.path.abspath(path))
+    from pathlib import Path
+    return Path(os.path.abspath(path)).as_uri()
+
+
+def _property(name, value):
+    from com.sun.star.beans import PropertyValue
+    prop = PropertyValue()
+    prop.Name = name
+    prop.Value = value
+    return prop
+
+
+class LibreOfficeWorker:
+    def __init__(self, command: str, index: int):
+        self.command = command
+        self.index = index
+        self.name = f"toolkit_{os.getpid()}_{index}"
+        self.profile_dir = os.path.join(LIBREOFFICE_PROFILE_DIR, self.name)
+        self.process: Optional[subprocess.Popen] = None
+        self.conversions = 0
+
+    @property
+    def connection(self) -> str:
+        return f"pipe,name={self.name};urp;StarOffice.ComponentContext"
+
+    def _base_command(self):
+        return [
+            self.command,
+            f"-env:UserInstallation={_path_to_url(self.profile_dir)}",
+            "--headless",
+            "--invisible",
+            "--nocrashreport",
+            "--nodefault",
+            "--nologo",
+            "--nofirststartwizard",
+            "--norestore",
+        ]
+
+    def start(self, timeout: float = LIBREOFFICE_STARTUP_TIMEOUT):
+        os.makedirs(self.profile_dir, exist_ok=True)
+        cmd = self._base_command() + [f"--accept={self.connection}"]
+        self.process = subprocess.Popen(cmd, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        self.conversions = 0
+
+        deadline = time.monotonic() + timeout
+        while time.monotonic() < deadline:
+            if self.healthy():
+                return
+            if not self.is_alive():
+                break
+            time.sleep(0.25)
+        timed_out = self.is_alive()
+        self.stop()
+        if timed_out:
+            raise LibreOfficeTimeout(f"LibreOffice worker {self.name} did not start within {timeout:.0f}s")
+        raise LibreOfficeError(f"LibreOffice worker {self.name} failed to start")
+
+    def stop(self, timeout: float = 10):
+        if self.process is not None and self.process.poll() is None:
+            self.process.terminate()
+            try:
+                self.process.wait(timeout=timeout)
+            except subprocess.TimeoutExpired:
+                self.process.kill()
+                self.process.wait()
+        self.process = None
+
+    def restart(self, timeout: float = LIBREOFFICE_STARTUP_TIMEOUT):
+        # Stopping and starting share one budget
+        deadline = time.monotonic() + timeout
+        self.stop(min(10, timeout))
+        self.start(max(0, deadline - time.monotonic()))
+
+    def close(self):
+        self.stop()
+        shutil.rmtree(self.profile_dir, ignore_errors=True)
+
+    def is_alive(self) -> bool:
+        return self.process is not None and self.process.poll() is None
+
+    def healthy(self) -> bool:
+        if not self.is_alive():
+            return False
+        try:
+            self._desktop()
+            return True
+        except Exception:
+            return False
+
+    def _desktop(self):
+        import uno
+        local = uno.getComponentContext()
+        resolver = local.ServiceManager.createInstanceWithContext("com.sun.star.bridge.UnoUrlResolver", local)
+        ctx = resolver.resolve(f"uno:{self.connection}")
+        return ctx.ServiceManager.createInstanceWithContext("com.sun.star.frame.Desktop", ctx)
+
+    def _convert_uno(self, input_path: str, output_path: str):
+        desktop = self._desktop()
+        doc = desktop.loadComponentFromURL(
+            _path_to_url(input_path), "_blank", 0, (_property("Hidden", True), _property("ReadOnly", True))
+        )
+        if doc is None:
+            raise LibreOfficeError(f"LibreOffice could not open {os.path.basename(input_path)}")
+        try:
+            export_filter = "writer_pdf_Export"
+            for service, name in PDF_EXPORT_FILTERS:
+                if doc.supportsService(service):
+                    export_filter = name
+                    break
+            doc.storeToURL(_path_to_url(output_path), (_property("FilterName", export_filter),))
+        finally:
+            doc.close(True)
+
+    def _run_uno(self, func, timeout: float):
+        errors = []
+
+        def target():
+            try:
+                func()
+            except Exception as e:
+                errors.append(e)
+
+        thread = threading.Thread(target=target, daemon=True)
+        thread.start()
+        thread.join(timeout)
+        if thread.is_alive():
+            # Killing the office process unblocks the UNO call
+            self.stop()
+            raise LibreOfficeTimeout(f"Conversion timed out after {timeout:.0f}s")
+        if errors:
+            raise LibreOfficeError(f"LibreOffice conversion failed with error: {errors[0]}")
+
+    def convert(self, input_path: str, output_dir: str, timeout: float) -> str:
+        filename_no_ext = os.path.splitext(os.path.basename(input_path))[0]
+        output_path = os.path.join(output_dir, f"{filename_no_ext}.pdf")
+
+        self._run_uno(lambda: self._convert_uno(input_path, output_path), timeout)
+        self.conversions += 1
+        if not os.path.exists(output_path):
+            raise LibreOfficeError(f"Output PDF not found at {output_path} after conversion.")
+        return output_path
+
+    def convert_many(self, input_paths, output_dir: str, timeout: float) -> dict:
+        """
+        Converts a group of documents in one go. Returns {input_path: error}
+        for the documents that failed; the PDFs of the others are in
+        output_dir under the input's base name.
+        """
+        failed = {}
+
+        def convert_all():
+            for path in input_paths:
+                name = os.path.splitext(os.path.basename(path))[0]
+                try:
+                    self._convert_uno(path, os.path.join(output_dir, f"{name}.pdf"))
+                except Exception as e:
+                    failed[path] = str(e)
+
+        self._run_uno(convert_all, timeout)
+        self.conversions += len(input_paths)
+        return failed
+
+
+class LibreOfficePool:
+    def __init__(self, command: str, size: int = LIBREOFFICE_POOL_SIZE,
+                 max_conversions: int = LIBREOFFICE_MAX_CONVERSIONS,
+                 timeout: float = LIBREOFFICE_TIMEOUT):
+        self.command = command
+        self.size = size
+        self.max_conversions = max_conversions
+        self.timeout = timeout
+        self.workers = [LibreOfficeWorker(command, i) for i in range(size)]
+        self._idle: "queue.Queue[LibreOfficeWorker]" = queue.Queue()
+        self._closed = threading.Event()
+        self._monitor: Optional[threading.Thread] = None
+
+    def start(self):
+        # Start all instances in parallel, cold start is the slow part
+        threads = [threading.Thread(target=self._start_worker, args=(w,), daemon=True) for w in self.workers]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        self._monitor = threading.Thread(target=self._monitor_loop, daemon=True)
+        self._monitor.start()
+
+    def _start_worker(self, worker: LibreOfficeWorker):
+        try:
+            worker.start()
+        except Exception as e:
+            logger.error("Error starting LibreOffice worker", extra={"worker": worker.name, "error": str(e)})
+        # Put it in the queue either way, an unhealthy worker is restarted
+        # on checkout.
+        self._idle.put(worker)
+
+    def _recycle(self, worker: LibreOfficeWorker):
+        if self._closed.is_set():
+            # close() may already have stopped it, don't start it again
+            worker.close()
+            return
+        metrics.LIBREOFFICE_RESTARTS.inc()
+        try:
+            worker.restart()
+        except Exception as e:
+            logger.error("Error restarting LibreOffice worker", extra={"worker": worker.name, "error": str(e)})
+        finally:
+            if self._closed.is_set():
+                worker.close()
+            else:
+                self._idle.put(worker)
+
+    def _monitor_loop(self):
+        while not self._closed.wait(LIBREOFFICE_HEALTH_INTERVAL):
+            # Only idle workers are checked, busy ones are checked on return
+            checked = []
+            while True:
+                try:
+                    checked.append(self._idle.get_nowait())
+                except queue.Empty:
+                    break
+            for worker in checked:
+                if worker.healthy():
+                    self._idle.put(worker)
+                else:
+                    logger.warning("LibreOffice worker failed health check, restarting", extra={"worker": worker.name})
+                    threading.Thread(target=self._recycle, args=(worker,), daemon=True).start()
+
+    def _run(self, job, timeout: Optional[float]):
+        if self._closed.is_set():
+            raise LibreOfficeError("LibreOffice pool is shut down")
+        timeout = timeout or self.timeout
+        # Waiting for a worker, restarting it and converting all come out of
+        # the same budget, a conversion never takes longer than `timeout`.
+        deadline = time.monotonic() + timeout
+
+        def remaining() -> float:
+            left = deadline - time.monotonic()
+            if left <= 0:
+                raise LibreOfficeTimeout(f"Conversion timed out after {timeout:.0f}s")
+            return left
+
+        try:
+            worker = self._idle.get(timeout=timeout)
+        except queue.Empty:
+            raise LibreOfficeTimeout("No LibreOffice worker became available in time")
+
+        recycle = False
+        try:
+            if not worker.healthy():
+                metrics.LIBREOFFICE_RESTARTS.inc()
+                worker.restart(remaining())
+            result = job(worker, remaining())
+            recycle = worker.conversions >= self.max_conversions
+            return result
+        except Exception:
+            # Crashed or hung instances are replaced, plain conversion
+            # errors (bad document) keep the worker.
+            recycle = not worker.healthy()
+            raise
+        finally:
+            if recycle:
+                threading.Thread(target=self._recycle, args=(worker,), daemon=True).start()
+            else:
+                self._idle.put(worker)
+
+    def convert(self, input_path: str, output_dir: str, timeout: Optional[float] = None) -> str:
+        return self._run(lambda worker, t: worker.convert(input_path, output_dir, t), timeout)
+
+    def convert_many(self, input_paths, output_dir: str, timeout: Optional[float] = None) -> dict:
+        # Same as convert() for a group of documents on one instance
+        return self._run(lambda worker, t: worker.convert_many(input_paths, output_dir, t), timeout)
+
+    def close(self):
+        self._closed.set()
+        for worker in self.workers:
+            worker.close()
+
+
+_pool: Optional[LibreOfficePool] = None
+_pool_lock = threading.Lock()
+_warned_no_uno = False
+# Profiles of finished one-off conversions, reused by later ones
+_idle_profiles: "queue.SimpleQueue[str]" = queue.SimpleQueue()
+
+
+def get_pool(command: str) -> Optional[LibreOfficePool]:
+    """
+    Returns the process-wide pool, starting it on first use.
+    Returns None when the pool is disabled, LibreOffice is not installed or
+    the uno bindings are missing, in which case callers fall back to a
+    one-off process per call.
+    """
+    global _pool, _warned_no_uno
+    if LIBREOFFICE_POOL_SIZE <= 0:
+        return None
+    if not HAS_UNO:
+        if not _warned_no_uno:
+            _warned_no_uno = True
+            logger.warning("Python uno bindings not found, LibreOffice pool disabled")
+        return None
+    if _pool is not None:
+        return _pool
+    with _pool_lock:
+        if _pool is None:
+            if not (os.path.exists(command) or shutil.which(command)):
+                return None
+            pool = LibreOfficePool(command)
+            pool.start()
+            _pool = pool
+    return _pool
+
+
+@contextmanager
+def one_shot_profile():
+    """
+    -env:UserInstallation argument for a one-off soffice process. Two
+    processes never share a profile (the second one would hand its job to
+    the first or fail); profiles are reused once their process is done,
+    and dropped if it failed, as it may have left a lock behind.
+    """
+    try:
+        path = _idle_profiles.get_nowait()
+    except queue.Empty:
+        os.makedirs(LIBREOFFICE_PROFILE_DIR, exist_ok=True)
+        path = tempfile.mkdtemp(prefix=f"oneshot_{os.getpid()}_", dir=LIBREOFFICE_PROFILE_DIR)
+    try:
+        yield f"-env:UserInstallation={_path_to_url(path)}"
+    except BaseException:
+        shutil.rmtree(path, ignore_errors=True)
+        raise
+    _idle_profiles.put(path)
+
+
+def shutdown_pool():
+    global _pool
+    with _pool_lock:
+        if _pool is not None:
+            _pool.close()
+            _pool = None
+    while True:
+        try:
+            shutil.rmtree(_idle_profiles.get_nowait(), ignore_errors=True)
+        except queue.Empty:
+            break
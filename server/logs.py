@@ -0,0 +1,66 @@
+import contextvars
+import json
+import logging
+import sys
+import time
+from typing import Optional
+
+from config import LOG_FORMAT, LOG_LEVEL
+
+# Structured logging. Every record is one JSON object per line (or a
+# plain text line with TOOLKIT_LOG_FORMAT=text), carrying the id of the
+# request it belongs to and any fields passed with `extra=`.
+
+request_id: contextvars.ContextVar[Optional[str]] = contextvars.ContextVar("request_id", default=None)
+
+# Attributes every LogRecord has, everything else came in through extra=
+_RECORD_FIELDS = set(vars(logging.LogRecord("", 0, "", 0, "", (), None))) | {"message", "asctime"}
+
+
+def _extra_fields(record: logging.LogRecord) -> dict:
+    return {k: v for k, v in vars(record).items() if k not in _RECORD_FIELDS and not k.startswith("_")}
+
+
+class JsonFormatter(logging.Formatter):
+    def format(self, record: logging.LogRecord) -> str:
+        entry = {
+            "time": time.strftime("%Y-%m-%dT%H:%M:%S", time.gmtime(record.created)) + f".{int(record.msecs):03d}Z",
+            "level": record.levelname.lower(),
+            "logger": record.name,
+            "message": record.getMessage(),
+        }
+        rid = request_id.get()
+        if rid:
+            entry["request_id"] = rid
+        entry.update(_extra_fields(record))
+        if record.exc_info:
+            entry["exception"] = self.formatException(record.exc_info)
+        return json.dumps(entry, default=str)
+
+
+class TextFormatter(logging.Formatter):
+    def __init__(self):
+        super().__init__("%(asctime)s %(levelname)s %(name)s: %(message)s")
+
+    def format(self, record: logging.LogRecord) -> str:
+        line = super().format(record)
+        fields = _extra_fields(record)
+        rid = request_id.get()
+        if rid:
+            fields = {"request_id": rid, **fields}
+        if fields:
+            line += " " + " ".join(f"{k}={v}" for k, v in fields.items())
+        return line
+
+
+def configure_logging():
+    handler = logging.StreamHandler(sys.stdout)
+    handler.setFormatter(TextFormatter() if LOG_FORMAT == "text" else JsonFormatter())
+    root = logging.getLogger()
+    # Calling this again (e.g. tests, reload) replaces our handler
+    for existing in list(root.handlers):
+        if getattr(existing, "_toolkit", False):
+            root.removeHandler(existing)
+    handler._toolkit = True
+    root.addHandler(handler)
+    root.setLevel(LOG_LEVEL)
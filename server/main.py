@@ -1,10 +1,21 @@
 from fastapi import FastAPI
 from fastapi.middleware.cors import CORSMiddleware
-from routers import convert, pdf_ops, images
+from routers import convert, pdf_ops, images, documents, jobs as jobs_router
+from utils import get_libreoffice_pool, prewarm_process_pool, shutdown_executors
+from lazy import import_modules
+from libreoffice_pool import shutdown_pool
+import jobs
+import storage
+from middleware import RequestSizeLimitMiddleware, MetricsMiddleware, SchedulingMiddleware
+from config import MAX_REQUEST_BYTES, METRICS_ENABLED, ACCESS_LOG, PREWARM
+from logs import configure_logging
+import metrics
 
-import os
 import asyncio
-import tempfile
+import logging
+
+configure_logging()
+logger = logging.getLogger(__name__)
 
 app = FastAPI(title="Document Toolkit API", description="API for document conversions and manipulations.")
 
@@ -21,21 +32,38 @@ app.add_middleware(
     allow_credentials=True,
     allow_methods=["*"],
     allow_headers=["*"],
-    expose_headers=["Content-Disposition"]
+    expose_headers=[
+        "Content-Disposition", "X-Cache", "X-Compression-Preset", "X-Original-Size",
+        "X-Compressed-Size", "X-Compression-Ratio", "X-Processing-Time", "X-Image-Preset",
+        "X-Batch-Files", "X-Cache-Hits", "Server-Timing", "X-Request-ID", "X-Document-Id", "ETag",
+        "Accept-Ranges", "Content-Range"
+    ]
 )
 
+# Reject oversized request bodies before they are spooled to disk; per file
+# limits and type checks run later, in ingest_upload or iter_multipart
+app.add_middleware(RequestSizeLimitMiddleware, max_bytes=MAX_REQUEST_BYTES)
+
+# Client and inputs of every request, for the scheduler's lanes and fairness
+app.add_middleware(SchedulingMiddleware)
+
+# Outermost, so rejected and failed requests are measured too
+app.add_middleware(MetricsMiddleware, access_log=ACCESS_LOG)
+
 # Include Routers
 app.include_router(convert.router)
 app.include_router(pdf_ops.router)
 app.include_router(images.router)
+app.include_router(documents.router)
+app.include_router(jobs_router.router)
 
 from fastapi.exceptions import RequestValidationError
-from fastapi.responses import JSONResponse
-from fastapi import Request
+from fastapi.responses import JSONResponse, PlainTextResponse
+from fastapi import Request, HTTPException
 
 @app.exception_handler(RequestValidationError)
 async def validation_exception_handler(request: Request, exc: RequestValidationError):
-    print(f"Validation Error: {exc.errors()}")
+    logger.info("Validation error", extra={"path": request.url.path, "errors": exc.errors()})
     return JSONResponse(
         status_code=422,
         content={"detail": exc.errors()},
@@ -45,25 +73,34 @@ async def validation_exception_handler(request: Request, exc: RequestValidationE
 def read_root():
     return {"message": "Welcome to Document Toolkit API. Docs at /docs"}
 
-# Periodic cleanup (fallback)
-async def cleanup_tmp_folder():
-    base_tmp = tempfile.gettempdir()
-    folders = [os.path.join(base_tmp, "uploads"), os.path.join(base_tmp, "outputs")]
-    for folder in folders:
-        if os.path.exists(folder):
-            for filename in os.listdir(folder):
-                file_path = os.path.join(folder, filename)
-                try:
-                    # Remove files older than 1 hour as fallback
-                    if os.path.isfile(file_path):
-                        # check time... implementation skipped for brevity, just defining the idea
-                        pass
-                except Exception as e:
-                    print(f"Error deleting file {file_path}: {e}")
+@app.get("/metrics", include_in_schema=False)
+def read_metrics():
+    if not METRICS_ENABLED:
+        raise HTTPException(status_code=404, detail="Not Found")
+    return PlainTextResponse(metrics.render(), media_type="text/plain; version=0.0.4; charset=utf-8")
 
 @app.on_event("startup")
 async def startup_event():
-    # Setup directories
-    base_tmp = tempfile.gettempdir()
-    os.makedirs(os.path.join(base_tmp, "uploads"), exist_ok=True)
-    os.makedirs(os.path.join(base_tmp, "outputs"), exist_ok=True)
+    # Creates the temp dirs, then removes whatever earlier runs left behind
+    # and keeps enforcing the age limit and disk quota
+    storage.start_sweeper()
+
+    # Prewarm in the background (TOOLKIT_PREWARM), so the worker starts
+    # serving right away and the first conversions don't pay the cold start
+    loop = asyncio.get_running_loop()
+    if "libreoffice" in PREWARM:
+        loop.run_in_executor(None, get_libreoffice_pool)
+    if "imports" in PREWARM:
+        loop.run_in_executor(None, import_modules)
+    if "pool" in PREWARM:
+        loop.run_in_executor(None, prewarm_process_pool)
+
+    # Pick up queued async jobs, including ones left over from a restart
+    jobs.start_worker()
+
+@app.on_event("shutdown")
+async def shutdown_event():
+    await jobs.stop_worker()
+    await storage.stop_sweeper()
+    shutdown_pool()
+    shutdown_executors()
@@ -0,0 +1,339 @@
+import logging
+import os
+from typing import Callable, Dict, List, Optional, Tuple, Union
+
+import PyPDF2
+from PyPDF2.generic import (
+    ArrayObject,
+    DictionaryObject,
+    IndirectObject,
+    NameObject,
+    NullObject,
+    NumberObject,
+    StreamObject,
+    TextStringObject,
+)
+
+from compression import StreamDeduplicator
+
+logger = logging.getLogger(__name__)
+
+# Incremental PDF merge behind /pdf/merge.
+#
+# PdfMerger keeps every object of every input in memory until the result is
+# written. Here each input is copied page by page straight into the output
+# file: objects are renumbered and written as soon as they are read, and the
+# reader's object cache is dropped after every page. What stays in memory
+# between pages is bookkeeping only: the byte offset of every written object,
+# content hashes of written streams (identical images and font programs from
+# different inputs are written once) and the page/outline entries needed for
+# the page tree, which is written last together with the xref table.
+
+HEADER = b"%PDF-1.7\n%\xe2\xe3\xcf\xd3\n"
+# Page keys that only make sense in the source document
+EXCLUDED_PAGE_KEYS = ("/Parent", "/StructParents")
+
+
+class _InputCopy:
+    """Copies the objects of one input, translating its object numbers."""
+
+    def __init__(self, merger: "IncrementalMerger", reader: PyPDF2.PdfReader, out):
+        self.merger = merger
+        self.reader = reader
+        self.out = out
+        # Source objects are keyed by (number, generation), output
+        # objects are all generation 0
+        self.numbers: Dict[Tuple[int, int], int] = {}
+        self.pending: List[Tuple[Tuple[int, int], int]] = []
+        self.dedup = StreamDeduplicator()
+        # Pages of this input: output number of their first copy, None if
+        # not selected (references to them, e.g. from links, become null)
+        self.pages: Dict[Tuple[int, int], Optional[int]] = {}
+
+    def reference(self, ref: IndirectObject):
+        source = (ref.idnum, ref.generation)
+        if source in self.pages:
+            number = self.pages[source]
+            return NullObject() if number is None else IndirectObject(number, 0, None)
+        number = self.numbers.get(source)
+        if number is None:
+            target = ref.get_object()
+            key = None
+            if isinstance(target, StreamObject):
+                key = self.dedup.key(ref)
+                number = self.merger.streams.get(key)
+            if number is None:
+                number = self.merger.allocate()
+                self.pending.append((source, number))
+                if key is not None:
+                    self.merger.streams[key] = number
+            self.numbers[source] = number
+        return IndirectObject(number, 0, None)
+
+    def translate(self, obj, exclude=()):
+        if isinstance(obj, IndirectObject):
+            return self.reference(obj)
+        if isinstance(obj, DictionaryObject):
+            return DictionaryObject(
+                (NameObject(k), self.translate(v)) for k, v in obj.items() if k not in exclude
+            )
+        if isinstance(obj, ArrayObject):
+            return ArrayObject(self.translate(v) for v in obj)
+        return obj
+
+    def write_pending(self):
+        while self.pending:
+            (idnum, generation), number = self.pending.pop()
+            obj = self.reader.get_object(IndirectObject(idnum, generation, self.reader))
+            self.merger.write_object(self.out, number, obj, self)
+
+
+class PdfFileWriter:
+    """
+    Writes a PDF object by object straight to output_path. Subclasses add
+    pages with write_object() and append their numbers to `kids`; finish()
+    writes the page tree and the cross-reference table. Only object
+    offsets are kept in memory.
+    """
+
+    def __init__(self, output_path: str):
+        self.output_path = output_path
+        # offsets[n] is the byte offset of object n, index 0 is unused
+        self.offsets: List[Optional[int]] = [None]
+        self.kids: List[int] = []
+        self.pages_number = self.allocate()
+        self.started = False
+
+    @property
+    def page_count(self) -> int:
+        return len(self.kids)
+
+    def allocate(self) -> int:
+        self.offsets.append(None)
+        return len(self.offsets) - 1
+
+    def open(self):
+        # The file is reopened for every batch of objects, so the writer
+        # can be pickled between batches
+        out = open(self.output_path, "ab" if self.started else "wb")
+        if not self.started:
+            out.write(HEADER)
+            self.started = True
+        return out
+
+    def write_object(self, out, number: int, obj, copy: Optional[_InputCopy] = None, exclude=()):
+        self.offsets[number] = out.tell()
+        out.write(f"{number} 0 obj\n".encode())
+        if isinstance(obj, StreamObject):
+            data = obj._data
+            header = copy.translate(DictionaryObject(obj), exclude=("/Length",)) if copy else DictionaryObject(obj)
+            header[NameObject("/Length")] = NumberObject(len(data))
+            header.write_to_stream(out, None)
+            out.write(b"\nstream\n")
+            out.write(data)
+            out.write(b"\nendstream")
+        else:
+            if copy is not None:
+                obj = copy.translate(obj, exclude=exclude)
+            obj.write_to_stream(out, None)
+        out.write(b"\nendobj\n")
+
+    def write_stream_file(self, out, number: int, header: DictionaryObject, path: str,
+                          chunk_size: int = 1024 * 1024):
+        # Stream whose data is copied from a file in chunks
+        self.offsets[number] = out.tell()
+        out.write(f"{number} 0 obj\n".encode())
+        header = DictionaryObject(header)
+        header[NameObject("/Length")] = NumberObject(os.path.getsize(path))
+        header.write_to_stream(out, None)
+        out.write(b"\nstream\n")
+        with open(path, "rb") as src:
+            while True:
+                chunk = src.read(chunk_size)
+                if not chunk:
+                    break
+                out.write(chunk)
+        out.write(b"\nendstream\nendobj\n")
+
+    def _write_outline(self, out) -> Optional[int]:
+        return None
+
+    def finish(self) -> str:
+        if not self.kids:
+            raise ValueError("No pages to write.")
+        with self.open() as out:
+            pages = DictionaryObject({
+                NameObject("/Type"): NameObject("/Pages"),
+                NameObject("/Kids"): ArrayObject(IndirectObject(n, 0, None) for n in self.kids),
+                NameObject("/Count"): NumberObject(len(self.kids)),
+            })
+            self.write_object(out, self.pages_number, pages)
+
+            catalog = DictionaryObject({
+                NameObject("/Type"): NameObject("/Catalog"),
+                NameObject("/Pages"): IndirectObject(self.pages_number, 0, None),
+            })
+            outlines = self._write_outline(out)
+            if outlines is not None:
+                catalog[NameObject("/Outlines")] = IndirectObject(outlines, 0, None)
+            root = self.allocate()
+            self.write_object(out, root, catalog)
+
+            xref = out.tell()
+            out.write(f"xref\n0 {len(self.offsets)}\n0000000000 65535 f \n".encode())
+            for offset in self.offsets[1:]:
+                if offset is None:
+                    out.write(b"0000000000 00000 f \n")
+                else:
+                    out.write(f"{offset:010d} 00000 n \n".encode())
+            out.write(f"trailer\n<< /Size {len(self.offsets)} /Root {root} 0 R >>\n".encode())
+            out.write(f"startxref\n{xref}\n%%EOF\n".encode())
+        return self.output_path
+
+
+class IncrementalMerger(PdfFileWriter):
+    """
+    Merges PDFs into output_path one input at a time with add(), finish()
+    writes the page tree and the cross-reference table. The state kept
+    between inputs is small and picklable, so every add() can run as its
+    own process pool task while the next input is still uploading.
+    """
+
+    def __init__(self, output_path: str):
+        super().__init__(output_path)
+        self.streams: Dict[str, int] = {}
+        # (level, title, page object number)
+        self.outline: List[Tuple[int, str, int]] = []
+
+    def add(self, path: str, pages: Union[str, List[int], Callable, None] = None,
+            rotations: Optional[List[int]] = None) -> int:
+        """
+        Appends the pages of path, all of them or a selection like "1-3,7"
+        or an already checked list of page numbers. `rotations` (degrees,
+        one per selected page) turn the copies. `pages` can also be a
+        function of the page count returning (pages, rotations), so a page
+        plan is compiled without opening the file twice. Returns the number
+        of pages added. Raises ValueError for bad selections and password
+        protected files.
+        """
+        from utils import parse_page_ranges
+
+        with open(path, "rb") as source:
+            # Passing a file object keeps PyPDF2 from reading it into memory
+            reader = PyPDF2.PdfReader(source)
+            if reader.is_encrypted and not reader.decrypt(""):
+                raise ValueError(f"{os.path.basename(path)} is password protected.")
+            if callable(pages):
+                numbers, rotations = pages(len(reader.pages))
+            elif isinstance(pages, list):
+                numbers = pages
+            else:
+                numbers = parse_page_ranges(pages, len(reader.pages))
+
+            with self.open() as out:
+                copy = _InputCopy(self, reader, out)
+                page_refs = [(page.indirect_reference.idnum, page.indirect_reference.generation)
+                             for page in reader.pages]
+                copy.pages = dict.fromkeys(page_refs)
+                first_copies = {}
+
+                targets = []
+                for n in numbers:
+                    number = self.allocate()
+                    targets.append((n, number))
+                    first_copies.setdefault(n, number)
+                for n, number in first_copies.items():
+                    copy.pages[page_refs[n - 1]] = number
+
+                for i, (n, number) in enumerate(targets):
+                    page = reader.pages[n - 1]
+                    if rotations and rotations[i]:
+                        rotation = (page.rotation + rotations[i]) % 360
+                        page = DictionaryObject(page)
+                        page[NameObject("/Rotate")] = NumberObject(rotation)
+                    self.write_object(out, number, page, copy, exclude=EXCLUDED_PAGE_KEYS)
+                    copy.write_pending()
+                    self.kids.append(number)
+                    # Everything this page needed is on disk now
+                    reader.resolved_objects.clear()
+
+                self._add_outline(reader, page_refs, copy.pages)
+        return len(numbers)
+
+    def _add_outline(self, reader: PyPDF2.PdfReader, page_refs: List[Tuple[int, int]],
+                     pages: Dict[Tuple[int, int], Optional[int]]):
+        def walk(items, level):
+            for item in items:
+                if isinstance(item, list):
+                    walk(item, level + 1)
+                    continue
+                try:
+                    index = reader.get_destination_page_number(item)
+                except Exception:
+                    continue
+                if index is None or not 0 <= index < len(page_refs):
+                    continue
+                number = pages.get(page_refs[index])
+                if number is not None:
+                    self.outline.append((level, str(item.title or ""), number))
+
+        try:
+            walk(reader.outline, 0)
+        except Exception as e:
+            logger.warning("Skipping outline of merged input", extra={"error": str(e)})
+
+    def _write_outline(self, out) -> Optional[int]:
+        if not self.outline:
+            return None
+        root = {"number": self.allocate(), "children": []}
+        stack = [(-1, root)]
+        for level, title, page in self.outline:
+            node = {"number": self.allocate(), "title": title, "page": page, "children": []}
+            while stack[-1][0] >= level:
+                stack.pop()
+            stack[-1][1]["children"].append(node)
+            stack.append((level, node))
+
+        def count(node):
+            return sum(1 + count(child) for child in node["children"])
+
+        def write(node, parent):
+            children = node["children"]
+            entry = DictionaryObject()
+            if parent is None:
+                entry[NameObject("/Type")] = NameObject("/Outlines")
+            else:
+                entry[NameObject("/Title")] = TextStringObject(node["title"])
+                entry[NameObject("/Parent")] = IndirectObject(parent["number"], 0, None)
+                entry[NameObject("/Dest")] = ArrayObject([IndirectObject(node["page"], 0, None), NameObject("/Fit")])
+                siblings = parent["children"]
+                i = siblings.index(node)
+                if i > 0:
+                    entry[NameObject("/Prev")] = IndirectObject(siblings[i - 1]["number"], 0, None)
+                if i + 1 < len(siblings):
+                    entry[NameObject("/Next")] = IndirectObject(siblings[i + 1]["number"], 0, None)
+            if children:
+                entry[NameObject("/First")] = IndirectObject(children[0]["number"], 0, None)
+                entry[NameObject("/Last")] = IndirectObject(children[-1]["number"], 0, None)
+                entry[NameObject("/Count")] = NumberObject(count(node))
+            self.write_object(out, node["number"], entry)
+            for child in children:
+                write(child, node)
+
+        write(root, None)
+        return root["number"]
+
+    def finish(self) -> str:
+        if not self.kids:
+            raise ValueError("No pages to merge.")
+        return super().finish()
+
+
+def merge_add(merger: IncrementalMerger, path: str, pages: Optional[str] = None) -> IncrementalMerger:
+    # Process pool entry point: the merger travels to the worker and back
+    merger.add(path, pages)
+    return merger
+
+
+def merge_finish(merger: IncrementalMerger) -> str:
+    return merger.finish()
@@ -0,0 +1,250 @@
+import bisect
+import contextvars
+import logging
+import os
+import threading
+import time
+from contextlib import contextmanager
+from typing import Callable, Dict, List, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+# In-process metrics in the Prometheus text format, served at /metrics.
+#
+# Every uvicorn worker keeps its own values; scrape each worker (or run
+# one worker per container) and aggregate in Prometheus. Values recorded
+# inside process pool tasks are lost, so timings are taken around the
+# await in the server process instead.
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0, 300.0)
+
+
+def _escape(value: str) -> str:
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _labels(names: Tuple[str, ...], values: Tuple[str, ...], extra: str = "") -> str:
+    parts = [f'{n}="{_escape(v)}"' for n, v in zip(names, values)]
+    if extra:
+        parts.append(extra)
+    return "{" + ",".join(parts) + "}" if parts else ""
+
+
+def _number(value: float) -> str:
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if not float(value).is_integer() else str(int(value))
+
+
+class _Metric:
+    kind = ""
+
+    def __init__(self, name: str, help: str, labels: Tuple[str, ...] = ()):
+        self.name = name
+        self.help = help
+        self.label_names = tuple(labels)
+        self._lock = threading.Lock()
+        REGISTRY.append(self)
+
+    def _key(self, labels: dict) -> Tuple[str, ...]:
+        return tuple(str(labels.get(name, "")) for name in self.label_names)
+
+    def samples(self) -> List[str]:
+        raise NotImplementedError
+
+    def render(self) -> str:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.kind}"]
+        lines.extend(self.samples())
+        return "\n".join(lines)
+
+
+class Counter(_Metric):
+    kind = "counter"
+
+    def __init__(self, name: str, help: str, labels: Tuple[str, ...] = ()):
+        super().__init__(name, help, labels)
+        self._values: Dict[Tuple[str, ...], float] = {}
+
+    def inc(self, amount: float = 1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def samples(self) -> List[str]:
+        with self._lock:
+            items = sorted(self._values.items())
+        return [f"{self.name}{_labels(self.label_names, k)} {_number(v)}" for k, v in items]
+
+
+class Gauge(_Metric):
+    """
+    Either set() directly or computed at scrape time by `collect`, a
+    function returning {label values tuple: value}.
+    """
+    kind = "gauge"
+
+    def __init__(self, name: str, help: str, labels: Tuple[str, ...] = (),
+                 collect: Optional[Callable[[], Dict[Tuple[str, ...], float]]] = None):
+        super().__init__(name, help, labels)
+        self._values: Dict[Tuple[str, ...], float] = {}
+        self.collect = collect
+
+    def set(self, value: float, **labels):
+        with self._lock:
+            self._values[self._key(labels)] = value
+
+    def samples(self) -> List[str]:
+        if self.collect is not None:
+            try:
+                values = self.collect()
+            except Exception as e:
+                logger.warning("Error collecting metric", extra={"metric": self.name, "error": str(e)})
+                values = {}
+        else:
+            with self._lock:
+                values = dict(self._values)
+        return [f"{self.name}{_labels(self.label_names, k)} {_number(v)}" for k, v in sorted(values.items())]
+
+
+class Histogram(_Metric):
+    kind = "histogram"
+
+    def __init__(self, name: str, help: str, labels: Tuple[str, ...] = (), buckets=LATENCY_BUCKETS):
+        super().__init__(name, help, labels)
+        self.buckets = tuple(sorted(buckets))
+        # key -> [bucket counts..., sum, count]
+        self._values: Dict[Tuple[str, ...], List[float]] = {}
+
+    def observe(self, value: float, **labels):
+        key = self._key(labels)
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            series = self._values.get(key)
+            if series is None:
+                series = self._values[key] = [0] * (len(self.buckets) + 2)
+            if index < len(self.buckets):
+                series[index] += 1
+            series[-2] += value
+            series[-1] += 1
+
+    def samples(self) -> List[str]:
+        with self._lock:
+            items = sorted((k, list(v)) for k, v in self._values.items())
+        lines = []
+        for key, series in items:
+            cumulative = 0
+            for bound, count in zip(self.buckets, series):
+                cumulative += count
+                le = 'le="%s"' % _number(bound)
+                lines.append(f"{self.name}_bucket{_labels(self.label_names, key, le)} {cumulative}")
+            le = 'le="+Inf"'
+            lines.append(f"{self.name}_bucket{_labels(self.label_names, key, le)} {_number(series[-1])}")
+            lines.append(f"{self.name}_sum{_labels(self.label_names, key)} {_number(series[-2])}")
+            lines.append(f"{self.name}_count{_labels(self.label_names, key)} {_number(series[-1])}")
+        return lines
+
+
+REGISTRY: List[_Metric] = []
+
+
+def render() -> str:
+    return "\n".join(metric.render() for metric in REGISTRY) + "\n"
+
+
+# Instruments
+REQUESTS = Counter("toolkit_requests_total", "HTTP requests by route and status.", ("method", "route", "status"))
+REQUEST_DURATION = Histogram("toolkit_request_duration_seconds", "Time from request start to the last response byte.",
+                             ("route",))
+STAGE_DURATION = Histogram("toolkit_stage_duration_seconds",
+                           "Time spent per operation and stage (upload, queue, processing, zip, response).",
+                           ("operation", "stage"))
+INPUT_BYTES = Counter("toolkit_input_bytes_total", "Request body bytes received.", ("operation",))
+OUTPUT_BYTES = Counter("toolkit_output_bytes_total", "Response body bytes sent.", ("operation",))
+PAGES = Counter("toolkit_pages_total", "Pages processed.", ("operation",))
+LIBREOFFICE_DURATION = Histogram("toolkit_libreoffice_duration_seconds",
+                                 "Duration of one LibreOffice conversion call.", ("mode",))
+LIBREOFFICE_FAILURES = Counter("toolkit_libreoffice_failures_total", "Failed LibreOffice conversions.", ("reason",))
+LIBREOFFICE_RESTARTS = Counter("toolkit_libreoffice_restarts_total", "LibreOffice pool instances restarted.")
+
+
+# Per-request stage timings
+class RequestTimings:
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.operation: Optional[str] = None
+        self.stages: Dict[str, float] = {}
+
+    def add(self, stage: str, seconds: float):
+        self.stages[stage] = self.stages.get(stage, 0.0) + seconds
+
+    def server_timing(self) -> str:
+        # Server-Timing wants milliseconds
+        parts = [f"{stage};dur={seconds * 1000:.1f}" for stage, seconds in self.stages.items()]
+        parts.append(f"total;dur={(time.perf_counter() - self.started) * 1000:.1f}")
+        return ", ".join(parts)
+
+
+current_timings: contextvars.ContextVar[Optional[RequestTimings]] = contextvars.ContextVar(
+    "current_timings", default=None
+)
+
+
+def set_operation(operation: str):
+    timings = current_timings.get()
+    if timings is not None and timings.operation is None:
+        timings.operation = operation
+
+
+def record_stage(operation: str, stage: str, seconds: float):
+    STAGE_DURATION.observe(seconds, operation=operation, stage=stage)
+    timings = current_timings.get()
+    if timings is not None:
+        timings.add(stage, seconds)
+
+
+@contextmanager
+def stage(operation: str, name: str):
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        record_stage(operation, name, time.perf_counter() - started)
+
+
+def count_pages(operation: str, pages: int):
+    if pages:
+        PAGES.inc(pages, operation=operation)
+
+
+# Disk usage of the temp directories, walked at most every DISK_USAGE_TTL
+DISK_USAGE_TTL = 15.0
+_disk_usage_cache: Tuple[float, Dict[Tuple[str, ...], float]] = (0.0, {})
+
+
+def directory_bytes(path: str) -> int:
+    total = 0
+    try:
+        with os.scandir(path) as entries:
+            for entry in entries:
+                try:
+                    if entry.is_dir(follow_symlinks=False):
+                        total += directory_bytes(entry.path)
+                    elif entry.is_file(follow_symlinks=False):
+                        total += entry.stat(follow_symlinks=False).st_size
+                except OSError:
+                    # Deleted while walking
+                    continue
+    except OSError:
+        pass
+    return total
+
+
+def disk_usage_collector(directories: Dict[str, str]):
+    def collect():
+        global _disk_usage_cache
+        checked, values = _disk_usage_cache
+        if time.monotonic() - checked > DISK_USAGE_TTL:
+            values = {(name,): directory_bytes(path) for name, path in directories.items()}
+            _disk_usage_cache = (time.monotonic(), values)
+        return values
+    return collect
@@ -0,0 +1,154 @@
+import logging
+import time
+import uuid
+
+from starlette.datastructures import MutableHeaders
+from starlette.exceptions import HTTPException
+from starlette.responses import JSONResponse
+
+import logs
+import metrics
+import scheduler
+
+access_logger = logging.getLogger("access")
+
+# Pure ASGI middlewares (no BaseHTTPMiddleware, so request bodies stay
+# streamed and contextvars propagate to the endpoint).
+
+
+class RequestSizeLimitMiddleware:
+    """
+    Rejects requests whose body is larger than `max_bytes`: up front when
+    Content-Length is too large, otherwise as soon as the streamed body
+    crosses the limit (chunked uploads).
+    """
+    def __init__(self, app, max_bytes: int):
+        self.app = app
+        self.max_bytes = max_bytes
+
+    def _too_large(self):
+        return HTTPException(status_code=413, detail=f"Request body exceeds the limit of {self.max_bytes} bytes.")
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or self.max_bytes <= 0:
+            await self.app(scope, receive, send)
+            return
+
+        for name, value in scope["headers"]:
+            if name == b"content-length":
+                try:
+                    too_large = int(value) > self.max_bytes
+                except ValueError:
+                    too_large = False
+                if too_large:
+                    error = self._too_large()
+                    response = JSONResponse({"detail": error.detail}, status_code=error.status_code)
+                    await response(scope, receive, send)
+                    return
+                break
+
+        received = 0
+
+        async def limited_receive():
+            nonlocal received
+            message = await receive()
+            if message["type"] == "http.request":
+                received += len(message.get("body", b""))
+                if received > self.max_bytes:
+                    # FastAPI re-raises HTTPExceptions from body parsing
+                    raise self._too_large()
+            return message
+
+        await self.app(scope, limited_receive, send)
+
+
+class SchedulingMiddleware:
+    """
+    Tells the scheduler which client a request comes from, for per-client
+    fairness; the request's inputs are added as they are ingested.
+    """
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        token = scheduler.current_work.set(scheduler.Work(scheduler.client_id(scope)))
+        try:
+            await self.app(scope, receive, send)
+        finally:
+            scheduler.current_work.reset(token)
+
+
+class MetricsMiddleware:
+    """
+    Times every request and records it in `metrics`: request counts and
+    latency per route, bytes in and out per operation, and the per-stage
+    timings collected while the request ran, which also go out in a
+    Server-Timing header. Logs one structured access line per request.
+    """
+    def __init__(self, app, access_log: bool = True):
+        self.app = app
+        self.access_log = access_log
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        rid = None
+        for name, value in scope["headers"]:
+            if name == b"x-request-id":
+                rid = value.decode("latin-1")[:64]
+                break
+        rid = rid or uuid.uuid4().hex[:16]
+        request_token = logs.request_id.set(rid)
+        timings = metrics.RequestTimings()
+        timings_token = metrics.current_timings.set(timings)
+        state = {"status": 500, "in": 0, "out": 0, "headers_sent": None}
+
+        async def counting_receive():
+            message = await receive()
+            if message["type"] == "http.request":
+                state["in"] += len(message.get("body", b""))
+            return message
+
+        async def timing_send(message):
+            if message["type"] == "http.response.start":
+                state["status"] = message["status"]
+                state["headers_sent"] = time.perf_counter()
+                headers = MutableHeaders(scope=message)
+                headers.append("Server-Timing", timings.server_timing())
+                headers.append("X-Request-ID", rid)
+            elif message["type"] == "http.response.body":
+                state["out"] += len(message.get("body", b""))
+            await send(message)
+
+        try:
+            await self.app(scope, counting_receive, timing_send)
+        finally:
+            finished = time.perf_counter()
+            route = scope.get("route")
+            route = getattr(route, "path", None) or "unmatched"
+            operation = timings.operation or route
+            if state["headers_sent"] is not None:
+                metrics.record_stage(operation, "response", finished - state["headers_sent"])
+            metrics.REQUESTS.inc(method=scope["method"], route=route, status=state["status"])
+            metrics.REQUEST_DURATION.observe(finished - timings.started, route=route)
+            metrics.INPUT_BYTES.inc(state["in"], operation=operation)
+            metrics.OUTPUT_BYTES.inc(state["out"], operation=operation)
+            if self.access_log:
+                access_logger.info("request", extra={
+                    "method": scope["method"],
+                    "path": scope["path"],
+                    "route": route,
+                    "operation": operation,
+                    "status": state["status"],
+                    "duration_ms": round((finished - timings.started) * 1000, 1),
+                    "stages_ms": {k: round(v * 1000, 1) for k, v in timings.stages.items()},
+                    "bytes_in": state["in"],
+                    "bytes_out": state["out"],
+                })
+            metrics.current_timings.reset(timings_token)
+            logs.request_id.reset(request_token)
@@ -0,0 +1,110 @@
+import re
+from typing import Iterable, List, NamedTuple, Union
+
+from fastapi import HTTPException
+
+# Page plans behind /pdf/organize.
+#
+# A plan lists, in output order, which source page every output page is
+# and how far it is turned. It is compiled once from compact expressions:
+#
+#     pages   "1-3,10-8@90,5,5"   ranges in output order, "a-b" with a > b
+#                                 runs backwards, "end" is the last page,
+#                                 "@angle" rotates that item, repeating a
+#                                 page duplicates it; empty means all pages
+#     remove  "4,7-,end"          source pages dropped wherever they occur
+#     rotate  90                  added to every output page
+#
+# Compiling costs one step per output page (removals are a set lookup) and
+# the result is applied in a single read/write pass by IncrementalMerger.
+
+ROTATION_STEP = 90
+# Duplicating pages can make the output much longer than the input
+MAX_PLAN_PAGES = 100000
+
+_ITEM_RE = re.compile(r"^(?:\d+|end)?(?:-(?:\d+|end)?)?$")
+
+
+class PagePlan(NamedTuple):
+    # 1-based source page of every output page
+    pages: List[int]
+    # Degrees added to each output page's /Rotate
+    rotations: List[int]
+
+
+def _rotation(value) -> int:
+    try:
+        angle = int(value)
+    except (TypeError, ValueError):
+        angle = None
+    if angle is None or isinstance(value, bool) or angle % ROTATION_STEP:
+        raise HTTPException(status_code=400, detail=f"Rotation must be a multiple of 90 degrees, not {value!r}.")
+    return angle % 360
+
+
+def _items(pages: str):
+    for item in pages.split(","):
+        item = item.replace(" ", "").lower()
+        if not item:
+            continue
+        spec, _, angle = item.partition("@")
+        if not spec or not _ITEM_RE.match(spec) or spec == "-":
+            raise HTTPException(status_code=400, detail=f"Invalid page range: {item!r}")
+        yield spec, _rotation(angle) if angle else 0
+
+
+def _pages_of(spec: str, page_count: int) -> List[int]:
+    from utils import parse_page_ranges
+
+    return parse_page_ranges(spec.replace("end", str(page_count)), page_count)
+
+
+def validate_page_numbers(pages) -> List[int]:
+    """1-based page numbers, e.g. the JSON list sent to /pdf/remove-pages."""
+    if not isinstance(pages, list) or not all(
+            isinstance(p, int) and not isinstance(p, bool) and p >= 1 for p in pages):
+        raise HTTPException(status_code=400, detail="Pages must be a JSON list of positive integers.")
+    return pages
+
+
+def validate_organize_options(pages: str = "", remove: Union[str, List[int]] = "", rotate=0) -> dict:
+    """Checks the syntax, page numbers are checked against the document later."""
+    pages = (pages or "").strip()
+    if pages.lower() != "all":
+        list(_items(pages))
+    if isinstance(remove, list):
+        remove = validate_page_numbers(remove)
+    else:
+        remove = (remove or "").strip()
+        if any(angle for _, angle in _items(remove)):
+            raise HTTPException(status_code=400, detail="Removed pages can't be rotated.")
+    return {"pages": pages, "remove": remove, "rotate": _rotation(rotate)}
+
+
+def compile_page_plan(page_count: int, pages: str = "", remove: Union[str, Iterable[int]] = "",
+                      rotate: int = 0) -> PagePlan:
+    """
+    Raises ValueError for pages outside the document and for plans that
+    keep nothing.
+    """
+    if isinstance(remove, str):
+        drop = {n for spec, _ in _items(remove) for n in _pages_of(spec, page_count)}
+    else:
+        drop = set(remove)
+        outside = [p for p in drop if not 1 <= p <= page_count]
+        if outside:
+            raise ValueError(f"Page {min(outside)} is outside 1-{page_count}")
+
+    plan = PagePlan([], [])
+    items = [("1-end", 0)] if pages.strip().lower() in ("", "all") else _items(pages)
+    for spec, angle in items:
+        angle = (angle + rotate) % 360
+        for n in _pages_of(spec, page_count):
+            if n not in drop:
+                plan.pages.append(n)
+                plan.rotations.append(angle)
+        if len(plan.pages) > MAX_PLAN_PAGES:
+            raise ValueError(f"The plan has more than {MAX_PLAN_PAGES} pages.")
+    if not plan.pages:
+        raise ValueError("The plan keeps no pages.")
+    return plan
@@ -0,0 +1,142 @@
+import base64
+import os
+import shutil
+import tempfile
+from typing import List
+
+import pdf2image
+import PyPDF2
+
+# Document structure behind /pdf/info and /pdf/thumbnails.
+#
+# read_pdf_info only touches the cross-reference table, the page tree and
+# the outline; content streams are never decoded, so even large documents
+# are described in milliseconds. The result is plain JSON and is cached by
+# the file's digest, other operations on the same upload (split, render)
+# take the page count and bookmarks from it instead of parsing again.
+
+METADATA_FIELDS = {"/Title": "title", "/Author": "author", "/Subject": "subject", "/Creator": "creator",
+                   "/Producer": "producer"}
+
+
+def _page_size(page: PyPDF2.PageObject) -> dict:
+    box = page.cropbox
+    width, height = float(box.width), float(box.height)
+    rotation = int(page.get("/Rotate", 0) or 0) % 360
+    if rotation in (90, 270):
+        width, height = height, width
+    # As displayed, in points
+    return {"width": round(width, 2), "height": round(height, 2), "rotation": rotation}
+
+
+def _outline(reader: PyPDF2.PdfReader, items) -> List[dict]:
+    # A nested list holds the children of the entry before it
+    entries = []
+    for item in items:
+        if isinstance(item, list):
+            if entries:
+                entries[-1]["children"] = _outline(reader, item)
+            continue
+        try:
+            page = reader.get_destination_page_number(item)
+        except Exception:
+            page = None
+        entries.append({
+            "title": str(item.title or ""),
+            "page": page + 1 if page is not None and page >= 0 else None,
+            "children": [],
+        })
+    return entries
+
+
+def read_pdf_info(file_path: str) -> dict:
+    reader = PyPDF2.PdfReader(file_path)
+    encrypted = reader.is_encrypted
+    if encrypted and not reader.decrypt(""):
+        # Needs a user password, nothing past the trailer is readable
+        return {"page_count": None, "encrypted": True, "password_required": True,
+                "pages": [], "outline": [], "metadata": {}}
+
+    metadata = {}
+    try:
+        for key, name in METADATA_FIELDS.items():
+            value = (reader.metadata or {}).get(key)
+            if value:
+                metadata[name] = str(value)
+    except Exception:
+        pass
+    try:
+        outline = _outline(reader, reader.outline)
+    except Exception:
+        # Broken outlines are common and shouldn't fail the request
+        outline = []
+    return {
+        "page_count": len(reader.pages),
+        "encrypted": encrypted,
+        "password_required": False,
+        "pages": [_page_size(page) for page in reader.pages],
+        "outline": outline,
+        "metadata": metadata,
+    }
+
+
+def outline_starts(info: dict):
+    # Same as splitting by bookmarks needs: top level (title, page), by page
+    starts = [(entry["title"], entry["page"]) for entry in info["outline"] if entry["page"]]
+    starts.sort(key=lambda start: start[1])
+    return starts
+
+
+def _runs(pages: List[int]):
+    # Consecutive page numbers, one pdftoppm call each
+    run = []
+    for page in pages:
+        if run and page != run[-1] + 1:
+            yield run
+            run = []
+        run.append(page)
+    if run:
+        yield run
+
+
+def render_thumbnails(file_path: str, pages: List[int], width: int, output_dir: str,
+                      quality: int = 60) -> List[str]:
+    """
+    Renders only the given pages as JPEGs `width` pixels wide (height
+    follows the page) and returns their paths in the order of `pages`.
+    """
+    work_dir = tempfile.mkdtemp(prefix="thumbs_", dir=output_dir)
+    paths = {}
+    try:
+        for run in _runs(sorted(set(pages))):
+            run_dir = tempfile.mkdtemp(dir=work_dir)
+            rendered = pdf2image.convert_from_path(
+                file_path,
+                dpi=72,
+                size=(width, None),
+                first_page=run[0],
+                last_page=run[-1],
+                fmt="jpeg",
+                jpegopt={"quality": quality, "progressive": False, "optimize": False},
+                output_folder=run_dir,
+                output_file="page",
+                paths_only=True,
+            )
+            for page, path in zip(run, sorted(rendered)):
+                dest = os.path.join(output_dir, f"thumb_{page}.jpg")
+                os.replace(path, dest)
+                paths[page] = dest
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+    return [paths[page] for page in pages]
+
+
+def thumbnail_entry(page: int, path: str) -> dict:
+    """A rendered thumbnail as returned by /pdf/thumbnails, inlined as a data URI."""
+    from PIL import Image
+
+    with Image.open(path) as img:
+        width, height = img.size
+    with open(path, "rb") as f:
+        data = base64.b64encode(f.read()).decode("ascii")
+    return {"page": page, "width": width, "height": height, "data": f"data:image/jpeg;base64,{data}"}
@@ -0,0 +1,209 @@
+import json
+import os
+import shutil
+import tempfile
+from typing import List, NamedTuple, Optional
+
+from fastapi import HTTPException
+
+import jobs
+import utils
+from config import MAX_PIPELINE_STEPS
+
+# Chained operations (/pipeline).
+#
+# A pipeline is a list of the operations the async job API knows (same
+# names and params), each working on the result of the one before.
+# Consecutive CPU bound steps run as one process pool task, and page
+# selections are never written out between steps: remove-pages after merge
+# (or after another remove-pages) only narrows the list of pages the merge
+# will copy, and a selection followed by compress is applied while
+# compressing. Only steps that need a file of their own (LibreOffice,
+# rendering, split, ...) see an intermediate file.
+
+
+class PipelineStep(NamedTuple):
+    operation: str
+    params: dict
+
+
+def validate_pipeline(steps, inputs: list) -> List[PipelineStep]:
+    """
+    steps is a list (or its JSON text) of {"op": name, ...params} or bare
+    operation names, inputs the resolved uploads and documents. Checks that
+    every step accepts what the previous one produces.
+    """
+    if isinstance(steps, str):
+        try:
+            steps = json.loads(steps)
+        except ValueError:
+            steps = None
+    if not isinstance(steps, list) or not steps:
+        raise HTTPException(status_code=400,
+                            detail="Steps must be a JSON list like [{\"op\": \"merge\"}, {\"op\": \"compress\"}].")
+    if len(steps) > MAX_PIPELINE_STEPS:
+        raise HTTPException(status_code=400, detail=f"A pipeline has at most {MAX_PIPELINE_STEPS} steps.")
+
+    validated = []
+    files = [(f.filename or "", f.content_type) for f in inputs]
+    for number, step in enumerate(steps, 1):
+        if isinstance(step, str):
+            step = {"op": step}
+        if not isinstance(step, dict) or step.get("op") not in jobs.JOB_OPERATIONS:
+            raise HTTPException(status_code=400,
+                                detail=f"Step {number}: op must be one of {list(jobs.JOB_OPERATIONS)}")
+        name = step["op"]
+        op = jobs.JOB_OPERATIONS[name]
+        if len(files) > 1 and not op.multiple:
+            raise HTTPException(status_code=400, detail=f"Step {number}: {name} takes exactly one file.")
+        for filename, content_type in files:
+            if not op.accepts(filename, content_type):
+                raise HTTPException(status_code=400, detail=f"Step {number}: {name} can't take {filename}.")
+        params = op.validate({k: v for k, v in step.items() if k != "op"})
+        result = op.result_filename(files[0][0], params)
+        if result.endswith(".zip") and number < len(steps):
+            raise HTTPException(status_code=400, detail=f"Step {number}: {name} returns a ZIP and must come last.")
+        validated.append(PipelineStep(name, params))
+        files = [(result, op.result_media_type(params))]
+    return validated
+
+
+def result_filename(steps: List[PipelineStep], first_filename: str) -> str:
+    return jobs.JOB_OPERATIONS[steps[-1].operation].result_filename(first_filename, steps[-1].params)
+
+
+def result_media_type(steps: List[PipelineStep]) -> str:
+    return jobs.JOB_OPERATIONS[steps[-1].operation].result_media_type(steps[-1].params)
+
+
+# Page selections
+def _spec(pages: List[int]) -> str:
+    # [1, 2, 3, 7] -> "1-3,7", what parse_page_ranges reads back
+    runs = []
+    for page in pages:
+        if runs and page == runs[-1][1] + 1:
+            runs[-1][1] = page
+        else:
+            runs.append([page, page])
+    return ",".join(str(a) if a == b else f"{a}-{b}" for a, b in runs)
+
+
+class PageSelection:
+    """
+    The pages a chain of merge and remove-pages steps keeps, per input and
+    in order, before anything is written.
+    """
+    def __init__(self, paths: List[str], specs: Optional[List[str]] = None):
+        specs = specs or []
+        if len(specs) > len(paths):
+            raise ValueError("More page selections than files.")
+        self.paths = paths
+        self.pages = [
+            utils.parse_page_ranges(specs[i] if i < len(specs) else None, utils.get_pdf_page_count(path))
+            for i, path in enumerate(paths)
+        ]
+        self.unchanged = not any(specs)
+
+    def remove(self, numbers: List[int]):
+        # Numbers refer to the pages of the document built so far
+        drop = set(numbers)
+        total = sum(len(pages) for pages in self.pages)
+        outside = [n for n in drop if n > total]
+        if outside:
+            raise ValueError(f"Page {min(outside)} is outside 1-{total}")
+        position = 0
+        for i, pages in enumerate(self.pages):
+            kept = []
+            for page in pages:
+                position += 1
+                if position not in drop:
+                    kept.append(page)
+            if len(kept) != len(pages):
+                self.unchanged = False
+            self.pages[i] = kept
+
+    def write(self, output_dir: str) -> str:
+        if len(self.paths) == 1 and self.unchanged:
+            return self.paths[0]
+        selected = [(path, pages) for path, pages in zip(self.paths, self.pages) if pages]
+        if not selected:
+            raise ValueError("No pages left in the document.")
+        return utils.merge_pdfs([path for path, _ in selected], [_spec(pages) for _, pages in selected],
+                                output_dir=output_dir)
+
+
+def run_steps(inputs: List[str], steps: List[PipelineStep], output_dir: str) -> str:
+    """
+    Runs CPU bound steps one after the other in the calling process and
+    returns the path of the last result.
+    """
+    current = inputs
+    selection = None
+    for step in steps:
+        op = jobs.JOB_OPERATIONS[step.operation]
+        if step.operation == "merge":
+            if selection is not None:
+                current = [selection.write(output_dir)]
+            selection = PageSelection(current, step.params["pages"])
+            continue
+        if step.operation == "remove-pages":
+            if selection is None:
+                selection = PageSelection(current)
+            selection.remove(step.params["pages"])
+            continue
+        if step.operation == "compress" and selection is not None and len(selection.paths) == 1:
+            pages = None if selection.unchanged else selection.pages[0]
+            if pages == []:
+                raise ValueError("No pages left in the document.")
+            current = [utils.compress_pdf(selection.paths[0], step.params["preset"], output_dir, pages)]
+            selection = None
+            continue
+        if selection is not None:
+            current = [selection.write(output_dir)]
+            selection = None
+        current = [op.runner(current, step.params, tempfile.mkdtemp(prefix="step_", dir=output_dir), None)]
+    if selection is not None:
+        current = [selection.write(output_dir)]
+    if current[0] in inputs:
+        # Nothing was changed, hand out a copy the caller may delete
+        dest = os.path.join(output_dir, "result" + os.path.splitext(inputs[0])[1])
+        shutil.copyfile(inputs[0], dest)
+        return dest
+    return current[0]
+
+
+def _groups(steps: List[PipelineStep]):
+    # Consecutive CPU bound steps share a pool task, the others (which use
+    # the pools themselves) run alone
+    group = []
+    for step in steps:
+        if jobs.JOB_OPERATIONS[step.operation].cpu_bound:
+            group.append(step)
+            continue
+        if group:
+            yield group
+            group = []
+        yield [step]
+    if group:
+        yield group
+
+
+async def run_pipeline(inputs: List[str], steps: List[PipelineStep], work_dir: str) -> str:
+    """
+    Executes validated steps on the input paths. Intermediate results are
+    removed as soon as the next group of steps has finished with them.
+    Raises ValueError for bad page selections and protected PDFs.
+    """
+    current = inputs
+    previous_dir = None
+    for group in _groups(steps):
+        group_dir = tempfile.mkdtemp(prefix="pipeline_", dir=work_dir)
+        op = jobs.JOB_OPERATIONS[group[0].operation]
+        if op.cpu_bound:
+            result = await utils.run_cpu_bound("pipeline", run_steps, current, group, group_dir)
+        else:
+            result = await utils.run_io_bound(op.slot, op.runner, current, group[0].params, group_dir, None)
+        if previous_dir is not None:
+            shutil.rmtree(previous_dir, ignore_errors=True)
+        current, previous_dir = [result], group_dir
+    return current[0]
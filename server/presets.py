@@ -0,0 +1,59 @@
+from typing import NamedTuple, Optional
+
+# Option tables of the processing modules (compression.py, imaging.py).
+# They live apart from the code using them so routes can validate options
+# and show defaults without importing PyPDF2 and Pillow.
+
+
+# /pdf/compress
+class CompressionPreset(NamedTuple):
+    # None keeps images untouched
+    dpi: Optional[int]
+    quality: Optional[int]
+
+
+COMPRESSION_PRESETS = {
+    "screen": CompressionPreset(dpi=72, quality=50),
+    "ebook": CompressionPreset(dpi=150, quality=70),
+    "print": CompressionPreset(dpi=300, quality=85),
+    "lossless": CompressionPreset(dpi=None, quality=None),
+}
+DEFAULT_COMPRESSION_PRESET = "ebook"
+
+
+# /image/to-pdf
+class ImagePreset(NamedTuple):
+    # None keeps the image as it is
+    max_pixels: Optional[int]
+    quality: Optional[int]
+    grayscale: bool = False
+
+
+IMAGE_PDF_PRESETS = {
+    "original": ImagePreset(None, None),
+    "photo": ImagePreset(12_000_000, 85),
+    "compact": ImagePreset(4_000_000, 70),
+    "scan": ImagePreset(8_000_000, 75, grayscale=True),
+}
+DEFAULT_IMAGE_PDF_PRESET = "original"
+
+
+# /image/convert: encoder settings per speed-vs-size preset
+ENCODER_PRESETS = {
+    "fast": {
+        "JPEG": {"optimize": False, "progressive": False},
+        "PNG": {"compress_level": 1},
+        "WEBP": {"method": 0},
+    },
+    "balanced": {
+        "JPEG": {"optimize": True, "progressive": False},
+        "PNG": {"compress_level": 6},
+        "WEBP": {"method": 4},
+    },
+    "small": {
+        "JPEG": {"optimize": True, "progressive": True},
+        "PNG": {"compress_level": 9, "optimize": True},
+        "WEBP": {"method": 6},
+    },
+}
+DEFAULT_ENCODER_PRESET = "balanced"
@@ -1,94 +1,218 @@
-from fastapi import APIRouter, UploadFile, File, HTTPException, BackgroundTasks
-from fastapi.responses import FileResponse
-from utils import save_upload_file, convert_to_pdf_libreoffice, cleanup_files, clean_filename_base
+from fastapi import APIRouter, UploadFile, File, Form, HTTPException, BackgroundTasks
+from fastapi.responses import JSONResponse
+from typing import List
+from utils import (
+    ingest_upload,
+    resolve_input,
+    resolve_inputs,
+    convert_to_pdf_libreoffice,
+    excel_preflight_options,
+    prepare_workbook,
+    xlsxprep,
+    text_to_pdf,
+    validate_text_pdf_engine,
+    validate_text_pdf_options,
+    iter_convert_batch,
+    iter_zip,
+    zip_streaming_response,
+    clean_filename_base,
+    request_scratch,
+    upload_size,
+    run_io_bound,
+    run_cpu_bound,
+    BatchItem,
+    BatchManifest,
+    BatchConversionFailed,
+    UploadBudget,
+    KINDS_OFFICE,
+    KINDS_TEXT
+)
+from cache import cached_call, cache_lookup, result_key, get_cache
+from downloads import DownloadResponse
+import logging
 import os
 
 router = APIRouter()
+logger = logging.getLogger(__name__)
+
+async def _convert_to_pdf(background_tasks: BackgroundTasks, file: UploadFile, kinds, route_name: str,
+                          preflight: dict = None):
+    # preflight: options of the XLSX preflight, run before LibreOffice
+    async with request_scratch(background_tasks, upload_size([file])) as scratch:
+        saved = await ingest_upload(file, kinds=kinds, operation="convert", directory=scratch.path)
+        try:
+            async def produce():
+                path = saved.path
+                if preflight is not None:
+                    path = await run_cpu_bound("xlsx-preflight", prepare_workbook, path, scratch.path, **preflight)
+                return await run_io_bound("convert", convert_to_pdf_libreoffice, path, scratch.path)
+
+            output_path, hit = await cached_call("libreoffice-pdf", saved.sha256, preflight, produce, scratch.path)
+
+            final_filename = f"{clean_filename_base(file.filename)}-topdf.pdf"
+            return DownloadResponse(
+                output_path,
+                filename=final_filename,
+                media_type='application/pdf',
+                digest=result_key("libreoffice-pdf", saved.sha256, preflight),
+                headers={"X-Cache": "HIT" if hit else "MISS"}
+            )
+        except HTTPException:
+            raise
+        except xlsxprep.WorkbookTooLarge as e:
+            raise HTTPException(status_code=413, detail=str(e))
+        except Exception as e:
+            logger.error("Conversion failed", extra={"route": route_name, "error": str(e)})
+            raise HTTPException(status_code=500, detail=str(e))
 
 @router.post("/convert/word-to-pdf")
-async def word_to_pdf(background_tasks: BackgroundTasks, file: UploadFile = File(...)):
+async def word_to_pdf(background_tasks: BackgroundTasks, file: UploadFile = File(None),
+                      document: str = Form(None)):
+    file = await resolve_input(file, document)
     if not file.filename.endswith(('.doc', '.docx')):
         raise HTTPException(status_code=400, detail="Invalid file type. Please upload a Word document.")
-    
-    file_path = await save_upload_file(file)
-    try:
-        output_path = convert_to_pdf_libreoffice(file_path)
-        background_tasks.add_task(cleanup_files, [file_path, output_path])
-        
-        final_filename = f"{clean_filename_base(file.filename)}-topdf.pdf"
-        return FileResponse(
-            output_path, 
-            filename=final_filename, 
-            media_type='application/pdf',
-            headers={"Content-Disposition": f"attachment; filename=\"{final_filename}\""}
-        )
-    except Exception as e:
-        print(f"Error in word_to_pdf: {e}")
-        cleanup_files([file_path])
-        raise HTTPException(status_code=500, detail=str(e))
+    return await _convert_to_pdf(background_tasks, file, KINDS_OFFICE, "word_to_pdf")
 
 @router.post("/convert/excel-to-pdf")
-async def excel_to_pdf(background_tasks: BackgroundTasks, file: UploadFile = File(...)):
+async def excel_to_pdf(background_tasks: BackgroundTasks, file: UploadFile = File(None),
+                       document: str = Form(None)):
+    file = await resolve_input(file, document)
     if not file.filename.endswith(('.xls', '.xlsx')):
         raise HTTPException(status_code=400, detail="Invalid file type. Please upload an Excel document.")
-    
-    file_path = await save_upload_file(file)
-    try:
-        output_path = convert_to_pdf_libreoffice(file_path)
-        background_tasks.add_task(cleanup_files, [file_path, output_path])
-        
-        final_filename = f"{clean_filename_base(file.filename)}-topdf.pdf"
-        return FileResponse(
-            output_path, 
-            filename=final_filename, 
-            media_type='application/pdf',
-            headers={"Content-Disposition": f"attachment; filename=\"{final_filename}\""}
-        )
-    except Exception as e:
-        print(f"Error in excel_to_pdf: {e}")
-        cleanup_files([file_path])
-        raise HTTPException(status_code=500, detail=str(e))
+    return await _convert_to_pdf(background_tasks, file, KINDS_OFFICE, "excel_to_pdf",
+                                 preflight=excel_preflight_options())
 
 @router.post("/convert/ppt-to-pdf")
-async def ppt_to_pdf(background_tasks: BackgroundTasks, file: UploadFile = File(...)):
+async def ppt_to_pdf(background_tasks: BackgroundTasks, file: UploadFile = File(None),
+                     document: str = Form(None)):
+    file = await resolve_input(file, document)
     if not file.filename.endswith(('.ppt', '.pptx')):
         raise HTTPException(status_code=400, detail="Invalid file type. Please upload a PowerPoint document.")
-    
-    file_path = await save_upload_file(file)
-    try:
-        output_path = convert_to_pdf_libreoffice(file_path)
-        background_tasks.add_task(cleanup_files, [file_path, output_path])
-        
-        final_filename = f"{clean_filename_base(file.filename)}-topdf.pdf"
-        return FileResponse(
-            output_path, 
-            filename=final_filename, 
-            media_type='application/pdf',
-            headers={"Content-Disposition": f"attachment; filename=\"{final_filename}\""}
-        )
-    except Exception as e:
-        print(f"Error in ppt_to_pdf: {e}")
-        cleanup_files([file_path])
-        raise HTTPException(status_code=500, detail=str(e))
+    return await _convert_to_pdf(background_tasks, file, KINDS_OFFICE, "ppt_to_pdf")
 
 @router.post("/text/to-pdf")
-async def text_to_pdf(background_tasks: BackgroundTasks, file: UploadFile = File(...)):
+async def text_to_pdf_conversion(
+    background_tasks: BackgroundTasks,
+    file: UploadFile = File(None),
+    document: str = Form(None),
+    engine: str = Form(None),
+    font: str = Form("courier"),
+    font_size: float = Form(10),
+    page_size: str = Form("A4"),
+    landscape: bool = Form(False),
+    margin: float = Form(15),
+    wrap: bool = Form(True),
+    encoding: str = Form("")
+):
+    """
+    Lays out a plain text file. The native engine streams the file page by
+    page with a standard PDF font (courier, helvetica or times), margin is
+    in mm and the encoding is detected unless given; engine=libreoffice
+    converts with LibreOffice instead and ignores the layout options.
+    """
+    file = await resolve_input(file, document)
     if not file.filename.endswith('.txt'):
         raise HTTPException(status_code=400, detail="Invalid file type. Please upload a Text file.")
-        
-    file_path = await save_upload_file(file)
-    try:
-        output_path = convert_to_pdf_libreoffice(file_path)
-        background_tasks.add_task(cleanup_files, [file_path, output_path])
-        
-        final_filename = f"{clean_filename_base(file.filename)}-topdf.pdf"
-        return FileResponse(
-            output_path, 
-            filename=final_filename, 
-            media_type='application/pdf',
-            headers={"Content-Disposition": f"attachment; filename=\"{final_filename}\""}
-        )
-    except Exception as e:
-        print(f"Error in text_to_pdf: {e}")
-        cleanup_files([file_path])
-        raise HTTPException(status_code=500, detail=str(e))
+    if validate_text_pdf_engine(engine) == "libreoffice":
+        return await _convert_to_pdf(background_tasks, file, KINDS_TEXT, "text_to_pdf")
+    options = validate_text_pdf_options(font, font_size, page_size, landscape, margin, wrap, encoding)
+
+    async with request_scratch(background_tasks, upload_size([file])) as scratch:
+        saved = await ingest_upload(file, kinds=KINDS_TEXT, operation="text-to-pdf", directory=scratch.path)
+        try:
+            async def produce():
+                return await run_cpu_bound("text-to-pdf", text_to_pdf, saved.path, scratch.path, **options)
+
+            output_path, hit = await cached_call("text-pdf", saved.sha256, options, produce, scratch.path)
+
+            final_filename = f"{clean_filename_base(file.filename)}-topdf.pdf"
+            return DownloadResponse(
+                output_path,
+                filename=final_filename,
+                media_type='application/pdf',
+                digest=result_key("text-pdf", saved.sha256, options),
+                headers={"X-Cache": "HIT" if hit else "MISS"}
+            )
+        except HTTPException:
+            raise
+        except Exception as e:
+            logger.error("Conversion failed", extra={"route": "text_to_pdf", "error": str(e)})
+            raise HTTPException(status_code=500, detail=str(e))
+
+BATCH_KINDS = {
+    ".doc": KINDS_OFFICE, ".docx": KINDS_OFFICE,
+    ".xls": KINDS_OFFICE, ".xlsx": KINDS_OFFICE,
+    ".ppt": KINDS_OFFICE, ".pptx": KINDS_OFFICE,
+    ".txt": KINDS_TEXT,
+}
+
+@router.post("/convert/batch-to-pdf")
+async def batch_to_pdf(background_tasks: BackgroundTasks, file: List[UploadFile] = File(None),
+                       document: List[str] = Form(None)):
+    """
+    Converts many Word/Excel/PowerPoint/text files in one request. The
+    response is a ZIP with one PDF per converted file and a manifest.json
+    listing every file with its status and error. A file that can't be
+    converted doesn't fail the others; if none converts the manifest is
+    returned as JSON with status 422.
+    """
+    file = await resolve_inputs(file, document)
+    manifest = BatchManifest(".pdf")
+    items = []
+    cached = {}
+    keys = {}
+    budget = UploadBudget()
+    preflight = excel_preflight_options()
+
+    async with request_scratch(background_tasks, upload_size(file)) as scratch:
+        try:
+            for index, f in enumerate(file):
+                kinds = BATCH_KINDS.get(os.path.splitext(f.filename or "")[1].lower())
+                if kinds is None:
+                    manifest.add(index, f.filename, error="Invalid file type. Please upload Word, Excel, PowerPoint or text files.")
+                    continue
+                try:
+                    saved = await ingest_upload(f, kinds=kinds, operation="convert", budget=budget,
+                                                directory=scratch.path)
+                except HTTPException as e:
+                    # Oversized requests stay fatal, a single bad file doesn't
+                    if e.status_code == 413:
+                        raise
+                    manifest.add(index, f.filename, error=e.detail)
+                    continue
+                options = preflight if f.filename.lower().endswith(".xlsx") else None
+                key, cached_path = await cache_lookup("libreoffice-pdf", saved.sha256, options, scratch.path)
+                path = saved.path
+                if options is not None and not cached_path:
+                    try:
+                        path = await run_cpu_bound("xlsx-preflight", prepare_workbook, path, scratch.path, **options)
+                    except xlsxprep.WorkbookTooLarge as e:
+                        manifest.add(index, f.filename, error=str(e))
+                        continue
+                items.append(BatchItem(index, f.filename, path))
+                keys[path] = key
+                if cached_path:
+                    cached[path] = cached_path
+
+            def store(input_path: str, pdf_path: str):
+                if keys.get(input_path) is not None:
+                    get_cache().put(keys[input_path], pdf_path)
+
+            if not items:
+                raise BatchConversionFailed(manifest.entries)
+            hits = len(cached)
+            chunks = iter_zip(iter_convert_batch(items, scratch.path, manifest, cached, store))
+            return await zip_streaming_response(
+                chunks, "converted-pdfs.zip", "convert",
+                headers={"X-Batch-Files": str(len(file)), "X-Cache-Hits": str(hits)}
+            )
+        except BatchConversionFailed as e:
+            return JSONResponse(
+                status_code=422,
+                content={"detail": "None of the files could be converted.", "files": e.manifest}
+            )
+        except HTTPException:
+            raise
+        except Exception as e:
+            logger.error("Conversion failed", extra={"route": "batch_to_pdf", "error": str(e)})
+            raise HTTPException(status_code=500, detail=str(e))
@@ -0,0 +1,112 @@
+from fastapi import APIRouter, UploadFile, File, Form, HTTPException, BackgroundTasks, Response
+from typing import List
+from utils import (
+    ingest_upload,
+    resolve_inputs,
+    keep_document,
+    request_scratch,
+    upload_size,
+    UploadBudget,
+    KINDS_PDF,
+    KINDS_IMAGE,
+    KINDS_OFFICE,
+    KINDS_TEXT
+)
+from documents import create_document, require_document, delete_document
+from pipeline import validate_pipeline, run_pipeline, result_filename, result_media_type
+from downloads import DownloadResponse
+from cache import result_key
+import jobs
+import asyncio
+import logging
+
+router = APIRouter()
+logger = logging.getLogger(__name__)
+
+DOCUMENT_KINDS = KINDS_PDF + KINDS_IMAGE + KINDS_OFFICE + KINDS_TEXT
+
+@router.post("/documents", status_code=201)
+async def upload_documents(background_tasks: BackgroundTasks, file: List[UploadFile] = File(...)):
+    """
+    Stores the uploads and returns an id for each, which any operation
+    accepts as `document` instead of a `file`.
+    """
+    budget = UploadBudget()
+    stored = []
+    async with request_scratch(background_tasks, upload_size(file)) as scratch:
+        for f in file:
+            saved = await ingest_upload(f, kinds=DOCUMENT_KINDS, operation="documents", budget=budget,
+                                        directory=scratch.path)
+            doc = await asyncio.to_thread(create_document, saved.path, f.filename, f.content_type,
+                                          saved.size, saved.sha256, saved.kind)
+            stored.append(doc)
+    return {"documents": [doc.describe() for doc in stored]}
+
+@router.get("/documents/{doc_id}")
+async def get_document_info(doc_id: str):
+    doc = await asyncio.to_thread(require_document, doc_id)
+    return doc.describe()
+
+@router.get("/documents/{doc_id}/content")
+async def get_document_content(doc_id: str):
+    doc = await asyncio.to_thread(require_document, doc_id)
+    return DownloadResponse(
+        doc.path,
+        filename=doc.filename,
+        media_type=doc.content_type or "application/octet-stream",
+        digest=doc.sha256
+    )
+
+@router.delete("/documents/{doc_id}", status_code=204)
+async def remove_document(doc_id: str):
+    if not await asyncio.to_thread(delete_document, doc_id):
+        raise HTTPException(status_code=404, detail=f"Document {doc_id} not found or expired.")
+    return Response(status_code=204)
+
+@router.post("/pipeline")
+async def run_pipeline_request(
+    background_tasks: BackgroundTasks,
+    steps: str = Form(...),
+    file: List[UploadFile] = File(None),
+    document: List[str] = Form(None),
+    keep: bool = Form(False)
+):
+    """
+    Runs several operations in one request, each on the result of the one
+    before, e.g. steps=[{"op": "merge"}, {"op": "remove-pages", "pages": [2]},
+    {"op": "compress", "preset": "ebook"}]. Operation names and params are
+    those of /jobs. With keep=true the result is also stored as a document,
+    its id is in the X-Document-Id header.
+    """
+    sources = await resolve_inputs(file, document)
+    plan = validate_pipeline(steps, sources)
+    first = jobs.JOB_OPERATIONS[plan[0].operation]
+
+    budget = UploadBudget()
+    async with request_scratch(background_tasks, upload_size(sources)) as scratch:
+        inputs = [
+            await ingest_upload(s, kinds=first.kinds, operation="pipeline", budget=budget, directory=scratch.path)
+            for s in sources
+        ]
+        try:
+            output_path = await run_pipeline([saved.path for saved in inputs], plan, scratch.path)
+
+            final_filename = result_filename(plan, sources[0].filename)
+            media_type = result_media_type(plan)
+            headers = {}
+            if keep:
+                doc = await keep_document(output_path, final_filename, media_type)
+                headers["X-Document-Id"] = doc.id
+
+            digest = result_key("pipeline", [saved.sha256 for saved in inputs],
+                                {"steps": [[step.operation, step.params] for step in plan]})
+            return DownloadResponse(output_path, filename=final_filename, media_type=media_type, digest=digest,
+                                    headers=headers)
+        except HTTPException:
+            raise
+        except ValueError as e:
+            # Bad page selection or protected PDF
+            raise HTTPException(status_code=400, detail=str(e))
+        except Exception as e:
+            logger.error("Pipeline failed", extra={"steps": [step.operation for step in plan], "error": str(e)})
+            raise HTTPException(status_code=500, detail=str(e))
@@ -1,92 +1,215 @@
-from fastapi import APIRouter, UploadFile, File, Form, HTTPException, BackgroundTasks
-from fastapi.responses import FileResponse
+from fastapi import APIRouter, UploadFile, File, Form, HTTPException, BackgroundTasks, Request
+from fastapi.responses import JSONResponse
 from typing import List
 from utils import (
-    save_upload_file, 
+    ingest_upload,
+    resolve_input,
+    resolve_inputs,
+    request_scratch,
+    upload_size,
     image_to_pdf, 
     convert_image_format, 
-    pdf_to_images,
-    create_zip_from_files,
-    cleanup_files,
-    clean_filename_base
+    iter_convert_images,
+    iter_pdf_to_images,
+    get_pdf_info,
+    iter_zip,
+    member_name,
+    zip_streaming_response,
+    validate_render_options,
+    validate_image_pdf_preset,
+    validate_image_convert_options,
+    clean_filename_base,
+    run_cpu_bound,
+    run_io_bound,
+    IMAGE_EXTENSIONS,
+    DEFAULT_IMAGE_PDF_PRESET,
+    DEFAULT_ENCODER_PRESET,
+    BatchItem,
+    BatchManifest,
+    BatchConversionFailed,
+    UploadBudget,
+    KINDS_IMAGE,
+    KINDS_PDF
 )
+from cache import cached_call, cache_lookup, result_key, tee_to_cache, get_cache
+from downloads import DownloadResponse
 import os
 
 router = APIRouter()
 
 @router.post("/image/to-pdf")
-async def images_to_pdf_conversion(background_tasks: BackgroundTasks, file: List[UploadFile] = File(...)):
-    saved_paths = []
+async def images_to_pdf_conversion(background_tasks: BackgroundTasks, file: List[UploadFile] = File(None),
+                                   document: List[str] = Form(None),
+                                   preset: str = Form(DEFAULT_IMAGE_PDF_PRESET)):
+    file = await resolve_inputs(file, document)
     for f in file:
-        if not f.content_type.startswith('image/'):
+        if not (f.content_type or "").startswith('image/'):
              raise HTTPException(status_code=400, detail=f"File {f.filename} is not an image.")
-        saved_paths.append(await save_upload_file(f))
-        
-    try:
-        output_path = image_to_pdf(saved_paths)
-        background_tasks.add_task(cleanup_files, saved_paths + [output_path])
-        
-        # Use first image name as base
-        base_name = clean_filename_base(file[0].filename)
-        final_filename = f"{base_name}-imagestopdf.pdf"
-        
-        return FileResponse(
-            output_path, 
-            filename=final_filename, 
-            media_type='application/pdf',
-            headers={"Content-Disposition": f"attachment; filename=\"{final_filename}\""}
-        )
-    except Exception as e:
-        cleanup_files(saved_paths)
-        raise HTTPException(status_code=500, detail=str(e))
+    preset = validate_image_pdf_preset(preset)
+
+    saved = []
+    budget = UploadBudget()
+    async with request_scratch(background_tasks, upload_size(file)) as scratch:
+        try:
+            for f in file:
+                saved.append(await ingest_upload(f, kinds=KINDS_IMAGE, operation="image-to-pdf", budget=budget,
+                                                 directory=scratch.path))
+
+            # image_to_pdf fans the images out to the process pool itself
+            output_path = await run_io_bound("image-to-pdf", image_to_pdf, [s.path for s in saved], preset,
+                                             output_dir=scratch.path)
+
+            # Use first image name as base
+            base_name = clean_filename_base(file[0].filename)
+            final_filename = f"{base_name}-imagestopdf.pdf"
+
+            return DownloadResponse(
+                output_path, 
+                filename=final_filename, 
+                media_type='application/pdf',
+                digest=result_key("image-to-pdf", [s.sha256 for s in saved], {"preset": preset}),
+                headers={"X-Image-Preset": preset}
+            )
+        except HTTPException:
+            raise
+        except Exception as e:
+            raise HTTPException(status_code=500, detail=str(e))
 
 @router.post("/image/convert")
-async def convert_image(background_tasks: BackgroundTasks, file: UploadFile = File(...), format: str = Form("PNG")):
-    if not file.content_type.startswith('image/'):
-        raise HTTPException(status_code=400, detail="Invalid file type.")
-        
-    valid_formats = ['JPEG', 'PNG', 'WEBP', 'BMP', 'GIF']
-    if format.upper() not in valid_formats:
-        raise HTTPException(status_code=400, detail=f"Format must be one of {valid_formats}")
-        
-    file_path = await save_upload_file(file)
-    try:
-        output_path = convert_image_format(file_path, format)
-        background_tasks.add_task(cleanup_files, [file_path, output_path])
-        
-        final_filename = f"{clean_filename_base(file.filename)}-converted.{format.lower()}"
-        
-        return FileResponse(
-            output_path, 
-            filename=final_filename, 
-            media_type=f'image/{format.lower()}',
-            headers={"Content-Disposition": f"attachment; filename=\"{final_filename}\""}
-        )
-    except Exception as e:
-        cleanup_files([file_path])
-        raise HTTPException(status_code=500, detail=str(e))
+async def convert_image(
+    background_tasks: BackgroundTasks,
+    file: List[UploadFile] = File(None),
+    document: List[str] = Form(None),
+    format: str = Form("PNG"),
+    width: int = Form(0),
+    height: int = Form(0),
+    quality: int = Form(None),
+    encoder: str = Form(DEFAULT_ENCODER_PRESET)
+):
+    file = await resolve_inputs(file, document)
+    for f in file:
+        if not (f.content_type or "").startswith('image/'):
+            raise HTTPException(status_code=400, detail="Invalid file type.")
+    options = validate_image_convert_options(format, width, height, quality, encoder)
+    if len(file) > 1:
+        return await _convert_image_batch(background_tasks, file, options)
+    file = file[0]
+
+    async with request_scratch(background_tasks, upload_size([file])) as scratch:
+        saved = await ingest_upload(file, kinds=KINDS_IMAGE, operation="image-convert", directory=scratch.path)
+        try:
+            async def produce():
+                return await run_cpu_bound("image-convert", convert_image_format, saved.path,
+                                           output_dir=scratch.path, **options)
+
+            output_path, hit = await cached_call("image-convert", saved.sha256, options, produce, scratch.path)
+
+            final_filename = f"{clean_filename_base(file.filename)}-converted.{options['format'].lower()}"
+
+            return DownloadResponse(
+                output_path, 
+                filename=final_filename, 
+                media_type=f"image/{options['format'].lower()}",
+                digest=result_key("image-convert", saved.sha256, options),
+                headers={"X-Cache": "HIT" if hit else "MISS"}
+            )
+        except HTTPException:
+            raise
+        except Exception as e:
+            raise HTTPException(status_code=500, detail=str(e))
+
+async def _convert_image_batch(background_tasks: BackgroundTasks, file: List[UploadFile], options: dict):
+    # Several files: a ZIP with one converted image per upload plus a
+    # manifest.json, images that fail are listed there
+    manifest = BatchManifest("." + IMAGE_EXTENSIONS[options["format"]])
+    items = []
+    cached = {}
+    keys = {}
+    budget = UploadBudget()
+    async with request_scratch(background_tasks, upload_size(file)) as scratch:
+        try:
+            for index, f in enumerate(file):
+                try:
+                    saved = await ingest_upload(f, kinds=KINDS_IMAGE, operation="image-convert", budget=budget,
+                                                directory=scratch.path)
+                except HTTPException as e:
+                    if e.status_code == 413:
+                        raise
+                    manifest.add(index, f.filename, error=e.detail)
+                    continue
+                items.append(BatchItem(index, f.filename, saved.path))
+                keys[saved.path], cached_path = await cache_lookup("image-convert", saved.sha256, options, scratch.path)
+                if cached_path:
+                    cached[saved.path] = cached_path
+
+            def store(input_path: str, output_path: str):
+                if keys.get(input_path) is not None:
+                    get_cache().put(keys[input_path], output_path)
+
+            if not items:
+                raise BatchConversionFailed(manifest.entries)
+            chunks = iter_zip(iter_convert_images(items, scratch.path, options, manifest, cached, store))
+            return await zip_streaming_response(
+                chunks, "converted-images.zip", "image-convert",
+                headers={"X-Batch-Files": str(len(file)), "X-Cache-Hits": str(len(cached))}
+            )
+        except BatchConversionFailed as e:
+            return JSONResponse(
+                status_code=422,
+                content={"detail": "None of the files could be converted.", "files": e.manifest}
+            )
+        except HTTPException:
+            raise
+        except Exception as e:
+            raise HTTPException(status_code=500, detail=str(e))
 
 @router.post("/pdf/to-images")
-async def pdf_to_imgs(background_tasks: BackgroundTasks, file: UploadFile = File(...)):
+async def pdf_to_imgs(
+    request: Request,
+    background_tasks: BackgroundTasks,
+    file: UploadFile = File(None),
+    document: str = Form(None),
+    dpi: int = Form(200),
+    format: str = Form("JPEG"),
+    quality: int = Form(75),
+    pages: str = Form("")
+):
+    file = await resolve_input(file, document)
     if not file.filename.endswith('.pdf'):
         raise HTTPException(status_code=400, detail="Invalid file type.")
-        
-    file_path = await save_upload_file(file)
-    try:
-        image_paths = pdf_to_images(file_path)
-        
-        base_name = clean_filename_base(file.filename)
-        zip_name = f"{base_name}-toimages.zip"
-        
-        zip_path = create_zip_from_files(image_paths, zip_name)
-        background_tasks.add_task(cleanup_files, [file_path, zip_path] + image_paths)
-        
-        return FileResponse(
-            zip_path, 
-            filename=zip_name, 
-            media_type='application/zip',
-            headers={"Content-Disposition": f"attachment; filename=\"{zip_name}\""}
-        )
-    except Exception as e:
-        cleanup_files([file_path])
-        raise HTTPException(status_code=500, detail=str(e))
+    options = validate_render_options(dpi, format, quality)
+    options["pages"] = pages.strip()
+
+    async with request_scratch(background_tasks, upload_size([file])) as scratch:
+        saved = await ingest_upload(file, kinds=KINDS_PDF, operation="pdf-to-images", directory=scratch.path)
+        try:
+            base_name = clean_filename_base(file.filename)
+            zip_name = f"{base_name}-toimages.zip"
+
+            cache_key, cached_path = await cache_lookup("pdf-to-images", saved.sha256, options, scratch.path)
+            etag = result_key("pdf-to-images", saved.sha256, options)
+            if cached_path:
+                return DownloadResponse(
+                    cached_path,
+                    filename=zip_name,
+                    media_type='application/zip',
+                    digest=etag,
+                    headers={"X-Cache": "HIT"}
+                )
+
+            # Pages go into the streamed ZIP as soon as they are rendered
+            info, _ = await get_pdf_info(saved, scratch.path)
+            render_dir = scratch.subdir("render_")
+            pages_iter = iter_pdf_to_images(saved.path, output_dir=render_dir, page_count=info["page_count"], **options)
+            chunks = tee_to_cache(iter_zip((member_name(p, saved.path), p) for p in pages_iter), cache_key)
+            # A client resuming an interrupted download asks for a byte range
+            resume_to = scratch.file(zip_name) if "range" in request.headers else None
+            return await zip_streaming_response(chunks, zip_name, "pdf-to-images", headers={"X-Cache": "MISS"},
+                                                etag=etag, resume_to=resume_to)
+        except HTTPException:
+            raise
+        except ValueError as e:
+            # Bad page selection
+            raise HTTPException(status_code=400, detail=str(e))
+        except Exception as e:
+            raise HTTPException(status_code=500, detail=str(e))
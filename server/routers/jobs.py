@@ -0,0 +1,97 @@
+from fastapi import APIRouter, UploadFile, File, Form, HTTPException
+from typing import List
+from utils import ingest_upload, check_capacity, UploadBudget
+from cache import result_key
+from downloads import DownloadResponse
+import jobs
+import asyncio
+import json
+import os
+import shutil
+
+router = APIRouter()
+
+@router.post("/jobs/{operation}", status_code=202)
+async def submit_job(operation: str, file: List[UploadFile] = File(...), params: str = Form("{}")):
+    op = jobs.JOB_OPERATIONS.get(operation)
+    if op is None:
+        raise HTTPException(status_code=404, detail=f"Unknown operation. Must be one of {list(jobs.JOB_OPERATIONS)}")
+    if not op.multiple and len(file) != 1:
+        raise HTTPException(status_code=400, detail="This operation takes exactly one file.")
+    for f in file:
+        if not op.accepts(f.filename, f.content_type):
+            raise HTTPException(status_code=400, detail=f"Invalid file type: {f.filename}")
+
+    try:
+        params_dict = json.loads(params)
+        if not isinstance(params_dict, dict):
+            raise ValueError
+    except ValueError:
+        raise HTTPException(status_code=400, detail="Params must be a JSON object.")
+    params_dict = op.validate(params_dict)
+    check_capacity()
+
+    job_id = jobs.new_job_id()
+    input_dir = os.path.join(jobs.job_dir(job_id), "input")
+    os.makedirs(input_dir, exist_ok=True)
+    try:
+        budget = UploadBudget()
+        inputs = [
+            await ingest_upload(f, kinds=op.kinds, operation=op.slot, budget=budget, directory=input_dir)
+            for f in file
+        ]
+        await asyncio.to_thread(
+            jobs.create_job, job_id, operation, params_dict, [saved.path for saved in inputs],
+            op.result_filename(file[0].filename, params_dict), op.result_media_type(params_dict),
+            result_key(operation, [saved.sha256 for saved in inputs], params_dict)
+        )
+    except HTTPException:
+        shutil.rmtree(jobs.job_dir(job_id), ignore_errors=True)
+        raise
+    except Exception as e:
+        shutil.rmtree(jobs.job_dir(job_id), ignore_errors=True)
+        raise HTTPException(status_code=500, detail=str(e))
+
+    jobs.notify_worker()
+    return {
+        "id": job_id,
+        "status": jobs.STATUS_QUEUED,
+        "status_url": f"/jobs/{job_id}",
+        "result_url": f"/jobs/{job_id}/result",
+    }
+
+@router.get("/jobs/{job_id}")
+async def get_job_status(job_id: str):
+    job = await asyncio.to_thread(jobs.get_job, job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="Job not found.")
+    return {
+        "id": job["id"],
+        "operation": job["operation"],
+        "status": job["status"],
+        "progress": {"done": job["progress_done"], "total": job["progress_total"]},
+        "error": job["error"],
+        "created_at": job["created_at"],
+        "updated_at": job["updated_at"],
+        "result_url": f"/jobs/{job_id}/result" if job["status"] == jobs.STATUS_DONE else None,
+    }
+
+@router.get("/jobs/{job_id}/result")
+async def get_job_result(job_id: str):
+    job = await asyncio.to_thread(jobs.get_job, job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="Job not found.")
+    if job["status"] == jobs.STATUS_FAILED:
+        raise HTTPException(status_code=409, detail=f"Job failed: {job['error']}")
+    if job["status"] != jobs.STATUS_DONE:
+        raise HTTPException(status_code=409, detail=f"Job is {job['status']}.")
+    if not job["result_path"] or not os.path.exists(job["result_path"]):
+        raise HTTPException(status_code=410, detail="Job result has expired.")
+
+    final_filename = job["result_filename"]
+    return DownloadResponse(
+        job["result_path"],
+        filename=final_filename,
+        media_type=job["media_type"],
+        digest=job["result_key"]
+    )
@@ -1,120 +1,427 @@
-from fastapi import APIRouter, UploadFile, File, Form, HTTPException, BackgroundTasks
-from fastapi.responses import FileResponse
-from typing import List
+from fastapi import APIRouter, UploadFile, File, Form, HTTPException, BackgroundTasks, Request
+from fastapi.responses import JSONResponse
 from utils import (
-    save_upload_file, 
-    merge_pdfs, 
-    split_pdf, 
+    ingest_upload,
+    resolve_input,
+    request_scratch,
+    upload_size,
+    check_capacity,
+    Scratch,
+    iter_multipart,
+    MultipartField,
+    validate_merge_pages,
+    new_merge_output,
+    merging,
+    iter_split_pdf,
+    get_pdf_info,
+    validate_thumbnail_options,
+    pdfinfo,
+    plan_split,
+    validate_split_options,
+    iter_zip,
+    member_name,
+    zip_streaming_response,
     compress_pdf, 
+    validate_compression_preset,
+    DEFAULT_COMPRESSION_PRESET,
     remove_pdf_pages,
-    create_zip_from_files,
-    cleanup_files,
-    clean_filename_base
+    organize_pdf,
+    validate_organize_options,
+    validate_page_numbers,
+    clean_filename_base,
+    run_cpu_bound,
+    run_io_bound,
+    UploadBudget,
+    KINDS_PDF
 )
+from cache import cached_call, cache_lookup, result_key, tee_to_cache, get_cache
+from downloads import DownloadResponse
+import asyncio
+import logging
+import metrics
 import os
 import json
+import time
 
 router = APIRouter()
+logger = logging.getLogger(__name__)
 
-@router.post("/pdf/merge")
-async def merge_pdf_files(background_tasks: BackgroundTasks, file: List[UploadFile] = File(...)):
-    saved_paths = []
-    for f in file:
-        if not f.filename.endswith('.pdf'):
-            raise HTTPException(status_code=400, detail=f"File {f.filename} is not a PDF.")
-        saved_paths.append(await save_upload_file(f))
-        
+MERGE_FORM_SCHEMA = {
+    "requestBody": {
+        "required": True,
+        "content": {
+            "multipart/form-data": {
+                "schema": {
+                    "type": "object",
+                    "properties": {
+                        "pages": {
+                            "type": "string",
+                            "description": "JSON list with one page range per file, e.g. [\"1-3\", \"\"]. "
+                                           "Must be sent before the files.",
+                        },
+                        "file": {"type": "array", "items": {"type": "string", "format": "binary"}},
+                        "document": {
+                            "type": "array",
+                            "items": {"type": "string"},
+                            "description": "Ids of stored documents (see /documents), merged where they appear "
+                                           "among the files.",
+                        },
+                    },
+                }
+            }
+        },
+    }
+}
+
+def _discard_merge(task: asyncio.Task, scratch: Scratch):
+    if not task.cancelled() and task.exception() is not None:
+        logger.warning("Error in abandoned merge", extra={"error": str(task.exception())})
+    scratch.release()
+
+@router.post("/pdf/merge", openapi_extra=MERGE_FORM_SCHEMA)
+async def merge_pdf_files(request: Request, background_tasks: BackgroundTasks):
+    # The body is parsed as it arrives: every PDF is appended to the output
+    # on the process pool as soon as it has been received, while the next
+    # one is still uploading.
+    check_capacity()
+    scratch = Scratch(int(request.headers.get("content-length") or 0))
+    merger = merging.IncrementalMerger(new_merge_output(scratch.path))
+    filenames = []
+    digests = []
+    pages = None
+    queue: asyncio.Queue = asyncio.Queue()
+
+    async def append_inputs():
+        state = merger
+        while True:
+            item = await queue.get()
+            if item is None:
+                return state
+            state = await run_cpu_bound("merge", merging.merge_add, state, *item)
+
+    appender = asyncio.create_task(append_inputs())
+    succeeded = False
     try:
-        output_path = merge_pdfs(saved_paths)
-        background_tasks.add_task(cleanup_files, saved_paths + [output_path])
+        async for part in iter_multipart(request, kinds=KINDS_PDF, operation="merge", budget=UploadBudget(),
+                                         directory=scratch.path):
+            if isinstance(part, MultipartField):
+                if part.field == "pages":
+                    if filenames:
+                        raise HTTPException(status_code=400, detail="The pages field must be sent before the files.")
+                    pages = validate_merge_pages(part.value)
+                    continue
+                if part.field != "document":
+                    continue
+                # A stored document, in the order it appears among the files
+                doc = await resolve_input(None, part.value.strip())
+                if not doc.filename.endswith('.pdf'):
+                    raise HTTPException(status_code=400, detail=f"File {doc.filename} is not a PDF.")
+                filename = doc.filename
+                saved = await ingest_upload(doc, kinds=KINDS_PDF, operation="merge", directory=scratch.path)
+            elif part.field == "file":
+                if not part.filename.endswith('.pdf'):
+                    raise HTTPException(status_code=400, detail=f"File {part.filename} is not a PDF.")
+                filename, saved = part.filename, part.saved
+            else:
+                continue
+            if appender.done():
+                # Appending failed already, surface the error now
+                break
+            index = len(filenames)
+            filenames.append(filename)
+            digests.append(saved.sha256)
+            await queue.put((saved.path, pages[index] if pages and index < len(pages) else None))
+
+        if not filenames and not appender.done():
+            raise HTTPException(status_code=400, detail="No files were uploaded.")
+        if pages and len(pages) > len(filenames):
+            raise HTTPException(status_code=400, detail="More page selections than files.")
+        await queue.put(None)
+        try:
+            state = await appender
+            output_path = await run_cpu_bound("merge", merging.merge_finish, state)
+        except ValueError as e:
+            raise HTTPException(status_code=400, detail=str(e))
+        metrics.count_pages("merge", state.page_count)
+        background_tasks.add_task(scratch.release)
+        succeeded = True
         
         # Use first file name as base for proper naming
-        base_name = clean_filename_base(file[0].filename)
+        base_name = clean_filename_base(filenames[0])
         final_filename = f"{base_name}-merged.pdf"
         
-        return FileResponse(
+        return DownloadResponse(
             output_path, 
             filename=final_filename, 
             media_type='application/pdf',
-            headers={"Content-Disposition": f"attachment; filename=\"{final_filename}\""}
+            digest=result_key("merge", digests, {"pages": pages})
         )
+    except HTTPException:
+        raise
     except Exception as e:
-        cleanup_files(saved_paths)
         raise HTTPException(status_code=500, detail=str(e))
+    finally:
+        if not succeeded:
+            if appender.done():
+                if not appender.cancelled():
+                    appender.exception()
+                scratch.release()
+            else:
+                # An input may still be being appended; skip the rest and
+                # clean up once it has finished
+                while not queue.empty():
+                    queue.get_nowait()
+                queue.put_nowait(None)
+                appender.add_done_callback(lambda task: _discard_merge(task, scratch))
 
 @router.post("/pdf/split")
-async def split_pdf_file(background_tasks: BackgroundTasks, file: UploadFile = File(...)):
+async def split_pdf_file(
+    request: Request,
+    background_tasks: BackgroundTasks,
+    file: UploadFile = File(None),
+    document: str = Form(None),
+    ranges: str = Form(""),
+    every: int = Form(0),
+    bookmarks: bool = Form(False),
+    minimal_resources: bool = Form(False)
+):
+    file = await resolve_input(file, document)
     if not file.filename.endswith('.pdf'):
         raise HTTPException(status_code=400, detail="Invalid file type.")
-        
-    file_path = await save_upload_file(file)
-    try:
-        split_files = split_pdf(file_path)
-        
-        base_name = clean_filename_base(file.filename)
-        zip_name = f"{base_name}-split.zip"
-        
-        zip_path = create_zip_from_files(split_files, zip_name)
-        # Cleanup original, split parts, and zip
-        background_tasks.add_task(cleanup_files, [file_path, zip_path] + split_files)
-        
-        return FileResponse(
-            zip_path, 
-            filename=zip_name, 
-            media_type='application/zip',
-            headers={"Content-Disposition": f"attachment; filename=\"{zip_name}\""}
-        )
-    except Exception as e:
-        cleanup_files([file_path])
-        raise HTTPException(status_code=500, detail=str(e))
+    options = validate_split_options(ranges, every, bookmarks, minimal_resources)
+
+    async with request_scratch(background_tasks, upload_size([file])) as scratch:
+        saved = await ingest_upload(file, kinds=KINDS_PDF, operation="split", directory=scratch.path)
+        try:
+            base_name = clean_filename_base(file.filename)
+            zip_name = f"{base_name}-split.zip"
+
+            cache_key, cached_path = await cache_lookup("split", saved.sha256, options, scratch.path)
+            etag = result_key("split", saved.sha256, options)
+            if cached_path:
+                return DownloadResponse(
+                    cached_path,
+                    filename=zip_name,
+                    media_type='application/zip',
+                    digest=etag,
+                    headers={"X-Cache": "HIT"}
+                )
+
+            info, _ = await get_pdf_info(saved, scratch.path)
+            try:
+                plan = await run_cpu_bound(
+                    "split", plan_split, saved.path, options["ranges"], options["every"], options["bookmarks"], info
+                )
+            except ValueError as e:
+                raise HTTPException(status_code=400, detail=str(e))
+            metrics.count_pages("split", sum(len(part.pages) for part in plan))
+
+            # Parts are zipped and deleted as they are produced, the archive is
+            # streamed to the client and never written out in full.
+            parts_dir = scratch.subdir("split_")
+            parts = iter_split_pdf(saved.path, parts_dir, plan, options["minimal_resources"])
+            chunks = tee_to_cache(iter_zip((member_name(p, saved.path), p) for p in parts), cache_key)
+            # A client resuming an interrupted download asks for a byte range
+            resume_to = scratch.file(zip_name) if "range" in request.headers else None
+            return await zip_streaming_response(chunks, zip_name, "split", headers={"X-Cache": "MISS"},
+                                                etag=etag, resume_to=resume_to)
+        except HTTPException:
+            raise
+        except Exception as e:
+            raise HTTPException(status_code=500, detail=str(e))
 
 @router.post("/pdf/compress")
-async def compress_pdf_file(background_tasks: BackgroundTasks, file: UploadFile = File(...)):
+async def compress_pdf_file(background_tasks: BackgroundTasks, file: UploadFile = File(None),
+                            document: str = Form(None),
+                            preset: str = Form(DEFAULT_COMPRESSION_PRESET)):
+    file = await resolve_input(file, document)
     if not file.filename.endswith('.pdf'):
         raise HTTPException(status_code=400, detail="Invalid file type.")
-        
-    file_path = await save_upload_file(file)
-    try:
-        output_path = compress_pdf(file_path)
-        background_tasks.add_task(cleanup_files, [file_path, output_path])
-        
-        final_filename = f"{clean_filename_base(file.filename)}-compressed.pdf"
-        
-        return FileResponse(
-            output_path, 
-            filename=final_filename, 
-            media_type='application/pdf',
-            headers={"Content-Disposition": f"attachment; filename=\"{final_filename}\""}
-        )
-    except Exception as e:
-        cleanup_files([file_path])
-        raise HTTPException(status_code=500, detail=str(e))
+    preset = validate_compression_preset(preset)
+
+    async with request_scratch(background_tasks, upload_size([file])) as scratch:
+        saved = await ingest_upload(file, kinds=KINDS_PDF, operation="compress", directory=scratch.path)
+        try:
+            started = time.perf_counter()
+
+            async def produce():
+                return await run_cpu_bound("compress", compress_pdf, saved.path, preset, scratch.path)
+
+            params = {"preset": preset}
+            output_path, hit = await cached_call("compress", saved.sha256, params, produce, scratch.path)
+            elapsed = time.perf_counter() - started
+
+            final_filename = f"{clean_filename_base(file.filename)}-compressed.pdf"
+            compressed_size = os.path.getsize(output_path)
+
+            return DownloadResponse(
+                output_path, 
+                filename=final_filename, 
+                media_type='application/pdf',
+                digest=result_key("compress", saved.sha256, params),
+                headers={
+                    "X-Cache": "HIT" if hit else "MISS",
+                    "X-Compression-Preset": preset,
+                    "X-Original-Size": str(saved.size),
+                    "X-Compressed-Size": str(compressed_size),
+                    "X-Compression-Ratio": f"{compressed_size / saved.size:.4f}" if saved.size else "1.0000",
+                    "X-Processing-Time": f"{elapsed:.3f}"
+                }
+            )
+        except HTTPException:
+            raise
+        except Exception as e:
+            raise HTTPException(status_code=500, detail=str(e))
 
 @router.post("/pdf/remove-pages")
-async def remove_pages(background_tasks: BackgroundTasks, file: UploadFile = File(...), pages: str = Form("[]")):
+async def remove_pages(background_tasks: BackgroundTasks, file: UploadFile = File(None),
+                       document: str = Form(None), pages: str = Form("[]")):
+    file = await resolve_input(file, document)
     if not file.filename.endswith('.pdf'):
         raise HTTPException(status_code=400, detail="Invalid file type.")
         
     try:
         pages_list = json.loads(pages)
-        if not isinstance(pages_list, list):
-            raise ValueError
-    except:
-        raise HTTPException(status_code=400, detail="Pages must be a JSON list of integers.")
-        
-    file_path = await save_upload_file(file)
-    try:
-        output_path = remove_pdf_pages(file_path, pages_list)
-        background_tasks.add_task(cleanup_files, [file_path, output_path])
-        
-        final_filename = f"{clean_filename_base(file.filename)}-pages-removed.pdf"
-        
-        return FileResponse(
-            output_path, 
-            filename=final_filename, 
-            media_type='application/pdf',
-            headers={"Content-Disposition": f"attachment; filename=\"{final_filename}\""}
-        )
-    except Exception as e:
-        cleanup_files([file_path])
-        raise HTTPException(status_code=500, detail=str(e))
+    except ValueError:
+        pages_list = None
+    pages_list = validate_page_numbers(pages_list)
+
+    async with request_scratch(background_tasks, upload_size([file])) as scratch:
+        saved = await ingest_upload(file, kinds=KINDS_PDF, operation="remove-pages", directory=scratch.path)
+        try:
+            try:
+                output_path = await run_cpu_bound("remove-pages", remove_pdf_pages, saved.path, pages_list, scratch.path)
+            except ValueError as e:
+                # Page outside the document, nothing left or protected PDF
+                raise HTTPException(status_code=400, detail=str(e))
+
+            final_filename = f"{clean_filename_base(file.filename)}-pages-removed.pdf"
+
+            return DownloadResponse(
+                output_path, 
+                filename=final_filename, 
+                media_type='application/pdf',
+                digest=result_key("remove-pages", saved.sha256, {"pages": pages_list})
+            )
+        except HTTPException:
+            raise
+        except Exception as e:
+            raise HTTPException(status_code=500, detail=str(e))
+
+@router.post("/pdf/organize")
+async def organize_pages(
+    background_tasks: BackgroundTasks,
+    file: UploadFile = File(None),
+    document: str = Form(None),
+    pages: str = Form(""),
+    remove: str = Form(""),
+    rotate: int = Form(0)
+):
+    """
+    Extracts, reorders, duplicates, rotates and removes pages in a single
+    pass. `pages` lists the output in order, e.g. "3-1,5@90,end" (default
+    all pages), `remove` drops source pages wherever they occur and `rotate`
+    turns every output page (multiples of 90 degrees).
+    """
+    file = await resolve_input(file, document)
+    if not file.filename.endswith('.pdf'):
+        raise HTTPException(status_code=400, detail="Invalid file type.")
+    options = validate_organize_options(pages, remove, rotate)
+
+    async with request_scratch(background_tasks, upload_size([file])) as scratch:
+        saved = await ingest_upload(file, kinds=KINDS_PDF, operation="organize", directory=scratch.path)
+        try:
+            async def produce():
+                try:
+                    # Pages outside the document, empty result or protected PDF
+                    return await run_cpu_bound("organize", organize_pdf, saved.path, output_dir=scratch.path, **options)
+                except ValueError as e:
+                    raise HTTPException(status_code=400, detail=str(e))
+
+            output_path, hit = await cached_call("organize", saved.sha256, options, produce, scratch.path)
+
+            final_filename = f"{clean_filename_base(file.filename)}-organized.pdf"
+            return DownloadResponse(
+                output_path,
+                filename=final_filename,
+                media_type='application/pdf',
+                digest=result_key("organize", saved.sha256, options),
+                headers={"X-Cache": "HIT" if hit else "MISS"}
+            )
+        except HTTPException:
+            raise
+        except Exception as e:
+            raise HTTPException(status_code=500, detail=str(e))
+
+@router.post("/pdf/info")
+async def pdf_info(background_tasks: BackgroundTasks, file: UploadFile = File(None),
+                   document: str = Form(None)):
+    """
+    Page count, page sizes (points, as displayed), outline, metadata and
+    whether the PDF is encrypted. Content streams are not decoded.
+    """
+    file = await resolve_input(file, document)
+    if not file.filename.endswith('.pdf'):
+        raise HTTPException(status_code=400, detail="Invalid file type.")
+
+    async with request_scratch(background_tasks, upload_size([file])) as scratch:
+        saved = await ingest_upload(file, kinds=KINDS_PDF, operation="pdf-info", directory=scratch.path)
+        try:
+            info, hit = await get_pdf_info(saved, scratch.path)
+            return JSONResponse({"sha256": saved.sha256, "size": saved.size, **info},
+                                headers={"X-Cache": "HIT" if hit else "MISS"})
+        except HTTPException:
+            raise
+        except Exception as e:
+            raise HTTPException(status_code=500, detail=str(e))
+
+@router.post("/pdf/thumbnails")
+async def pdf_thumbnails(
+    background_tasks: BackgroundTasks,
+    file: UploadFile = File(None),
+    document: str = Form(None),
+    pages: str = Form(""),
+    width: int = Form(200)
+):
+    """
+    Small JPEG previews of the selected pages (the first 12 by default, at
+    most 50) as data URIs. Only pages not rendered before at this width are
+    rendered.
+    """
+    file = await resolve_input(file, document)
+    if not file.filename.endswith('.pdf'):
+        raise HTTPException(status_code=400, detail="Invalid file type.")
+
+    async with request_scratch(background_tasks, upload_size([file])) as scratch:
+        saved = await ingest_upload(file, kinds=KINDS_PDF, operation="thumbnails", directory=scratch.path)
+        try:
+            info, _ = await get_pdf_info(saved, scratch.path)
+            if info["password_required"]:
+                raise HTTPException(status_code=400, detail="The PDF is password protected.")
+            selected = validate_thumbnail_options(pages, width, info["page_count"])
+
+            found, keys, missing = {}, {}, []
+            for page in selected:
+                keys[page], found[page] = await cache_lookup(
+                    "thumbnail", saved.sha256, {"page": page, "width": width}, scratch.path
+                )
+                if found[page] is None:
+                    missing.append(page)
+            if missing:
+                rendered = await run_io_bound("thumbnails", pdfinfo.render_thumbnails, saved.path, missing, width, scratch.path)
+                for page, path in zip(missing, rendered):
+                    found[page] = path
+                    if keys[page] is not None:
+                        await asyncio.to_thread(get_cache().put, keys[page], path)
+
+            thumbnails = await asyncio.to_thread(
+                lambda: [pdfinfo.thumbnail_entry(page, found[page]) for page in selected]
+            )
+            return JSONResponse(
+                {"sha256": saved.sha256, "page_count": info["page_count"], "thumbnails": thumbnails},
+                headers={"X-Cache-Hits": str(len(selected) - len(missing))}
+            )
+        except HTTPException:
+            raise
+        except Exception as e:
+            raise HTTPException(status_code=500, detail=str(e))
@@ -0,0 +1,356 @@
+import asyncio
+import contextvars
+import heapq
+import itertools
+import os
+import re
+import time
+from contextlib import asynccontextmanager
+from typing import Dict, List, NamedTuple, Optional, Tuple
+
+from fastapi import HTTPException
+
+import metrics
+from config import (
+    CPU_WORKERS,
+    LIBREOFFICE_POOL_SIZE,
+    OPERATION_CONCURRENCY,
+    OPERATION_QUEUE_SIZE,
+    MAX_PENDING_JOBS,
+    RETRY_AFTER_SECONDS,
+    HEAVY_COST,
+    LIGHT_LANE_CONCURRENCY,
+    HEAVY_LANE_CONCURRENCY,
+    OFFICE_LANE_CONCURRENCY,
+    CLIENT_QUEUE_SIZE,
+    CLIENT_HEADER,
+    operation_concurrency,
+)
+from metrics import record_stage, set_operation
+
+# Scheduling.
+#
+# Work that leaves the event loop (run_cpu_bound, run_io_bound, streamed
+# ZIPs) first waits for a slot here. The slot comes from one of two lanes,
+# picked by the request's estimated cost: roughly seconds of work, from the
+# operation and the inputs' size, page count (read from the ends of a PDF,
+# without parsing it) and image dimensions (from the header). Each lane has
+# its own concurrency budget and process pool (utils.get_process_pool), so
+# a 2,000 page rasterization can only take heavy lane slots and workers and
+# quick operations keep running next to it. LibreOffice conversions run on
+# the thread pool and wait in a lane of their own. Within a lane, waiting work is served in the order of
+# virtual finish times (fair queueing): every slot a client takes pushes
+# its next one back by the cost it was charged, so a client with many
+# queued requests delays its own work rather than everybody else's. The
+# per-operation limits and queue sizes still apply on top.
+
+LIGHT = "light"
+HEAVY = "heavy"
+OFFICE = "office"
+# Operations that take their slot in the office lane
+OFFICE_OPERATIONS = frozenset({"convert"})
+# Work started outside a request (e.g. the job worker sets its own)
+BACKGROUND_CLIENT = "background"
+
+# Defaults for operations that shouldn't get the generic limit
+DEFAULT_OPERATION_LIMITS = {
+    "convert": max(1, LIBREOFFICE_POOL_SIZE),
+    "pdf-to-images": max(1, CPU_WORKERS // 2),
+}
+
+# Estimated seconds of work: (per slot, per MB, per page, per megapixel)
+OPERATION_COSTS = {
+    "convert": (1.0, 0.5, 0.0, 0.0),
+    "xlsx-preflight": (0.02, 0.8, 0.0, 0.0),
+    "text-to-pdf": (0.05, 0.2, 0.0, 0.0),
+    "merge": (0.02, 0.01, 0.002, 0.0),
+    "split": (0.02, 0.01, 0.005, 0.0),
+    "compress": (0.05, 0.05, 0.005, 0.0),
+    "remove-pages": (0.02, 0.005, 0.001, 0.0),
+    "organize": (0.02, 0.005, 0.001, 0.0),
+    "pdf-info": (0.01, 0.002, 0.0005, 0.0),
+    "thumbnails": (0.05, 0.005, 0.01, 0.0),
+    "pdf-to-images": (0.1, 0.01, 0.1, 0.0),
+    "image-to-pdf": (0.02, 0.02, 0.0, 0.02),
+    "image-convert": (0.01, 0.01, 0.0, 0.03),
+    "pipeline": (0.1, 0.05, 0.005, 0.02),
+}
+DEFAULT_COST = (0.05, 0.02, 0.002, 0.02)
+
+# Bytes read from each end of a PDF looking for the page tree's /Count
+PDF_SNIFF_BYTES = 256 * 1024
+# Pages assumed per byte when the page tree is in an object stream
+BYTES_PER_PAGE = 64 * 1024
+_PAGE_COUNT = re.compile(rb"/Count\s+(\d+)")
+# Virtual finish times kept per lane before old ones are dropped
+_MAX_CLIENTS = 4096
+_CLIENT_HEADER = CLIENT_HEADER.encode("latin-1")
+
+
+class InputSize(NamedTuple):
+    size: int
+    pages: int
+    megapixels: float
+
+
+def measure_input(path: str) -> InputSize:
+    """
+    Size, page count and megapixels of an input, read from its first and
+    last bytes. Unknown values are 0; this is an estimate, never an error.
+    """
+    size = 0
+    try:
+        size = os.path.getsize(path)
+        with open(path, "rb") as f:
+            head = f.read(PDF_SNIFF_BYTES)
+            if b"%PDF-" in head[:1024]:
+                counts = [int(n) for n in _PAGE_COUNT.findall(head)]
+                if size > len(head):
+                    f.seek(max(len(head), size - PDF_SNIFF_BYTES))
+                    counts += [int(n) for n in _PAGE_COUNT.findall(f.read())]
+                # The root of the page tree has the largest count
+                return InputSize(size, max(counts) if counts else max(1, size // BYTES_PER_PAGE), 0.0)
+        from PIL import Image
+        with Image.open(path) as image:
+            width, height = image.size
+        return InputSize(size, 0, width * height / 1e6)
+    except Exception:
+        return InputSize(size, 0, 0.0)
+
+
+class Work:
+    """
+    What the scheduler knows about the current request: the client it is
+    for and the inputs it has brought so far (see note_input).
+    """
+    def __init__(self, client: str, inputs: Optional[List[str]] = None):
+        self.client = client
+        self.inputs = list(inputs or [])
+        self.sizes: List[InputSize] = []
+        # Inputs already charged to the client
+        self.charged = 0
+
+
+current_work: contextvars.ContextVar[Optional[Work]] = contextvars.ContextVar("current_work", default=None)
+# Lane of the last slot taken, picks the process pool
+current_lane: contextvars.ContextVar[str] = contextvars.ContextVar("current_lane", default=LIGHT)
+
+
+def client_id(scope) -> str:
+    # CLIENT_HEADER is only trusted when set, i.e. a proxy in front sets it
+    if _CLIENT_HEADER:
+        for name, value in scope["headers"]:
+            if name == _CLIENT_HEADER:
+                value = value.decode("latin-1").split(",")[0].strip()
+                if value:
+                    return value[:128]
+                break
+    client = scope.get("client")
+    return client[0] if client else "unknown"
+
+
+def note_input(path: str):
+    work = current_work.get()
+    if work is not None:
+        work.inputs.append(path)
+
+
+async def estimate_cost(work: Work, operation: str) -> Tuple[float, float]:
+    """
+    (cost of the whole request, cost to charge for this slot): inputs are
+    charged to the client by the first slot taken after they arrived.
+    """
+    new = work.inputs[len(work.sizes):]
+    if new:
+        work.sizes += await asyncio.to_thread(lambda: [measure_input(path) for path in new])
+    base, per_mb, per_page, per_megapixel = OPERATION_COSTS.get(operation, DEFAULT_COST)
+
+    def cost(sizes):
+        return sum(s.size / 2**20 * per_mb + s.pages * per_page + s.megapixels * per_megapixel for s in sizes)
+
+    charge = base + cost(work.sizes[work.charged:])
+    work.charged = len(work.sizes)
+    return base + cost(work.sizes), charge
+
+
+class OperationLimiter:
+    def __init__(self, operation: str):
+        default = DEFAULT_OPERATION_LIMITS.get(operation, OPERATION_CONCURRENCY)
+        self.operation = operation
+        self.concurrency = operation_concurrency(operation, default)
+        self.waiting = 0
+        self.running = 0
+
+
+class _Waiter:
+    __slots__ = ("future", "limiter", "client")
+
+    def __init__(self, future: asyncio.Future, limiter: OperationLimiter, client: str):
+        self.future = future
+        self.limiter = limiter
+        self.client = client
+
+
+class Lane:
+    def __init__(self, name: str, concurrency: int):
+        self.name = name
+        self.concurrency = max(1, concurrency)
+        self.running = 0
+        # (virtual finish, arrival, waiter)
+        self.queue: List[Tuple[float, int, _Waiter]] = []
+        self.virtual = 0.0
+        self.finish: Dict[str, float] = {}
+        self.waiting: Dict[str, int] = {}
+
+    def enqueue(self, waiter: _Waiter, charge: float):
+        finish = max(self.virtual, self.finish.get(waiter.client, 0.0)) + charge
+        self.finish[waiter.client] = finish
+        if len(self.finish) > _MAX_CLIENTS:
+            # Clients at or behind the virtual time would start from it anyway
+            self.finish = {c: f for c, f in self.finish.items() if f > self.virtual}
+        heapq.heappush(self.queue, (finish, next(_arrivals), waiter))
+
+    def dispatch(self):
+        blocked = []
+        while self.running < self.concurrency and self.queue:
+            entry = heapq.heappop(self.queue)
+            finish, _, waiter = entry
+            if waiter.future.done():
+                # Cancelled while waiting
+                continue
+            if waiter.limiter.running >= waiter.limiter.concurrency:
+                blocked.append(entry)
+                continue
+            self.virtual = max(self.virtual, finish)
+            self.running += 1
+            waiter.limiter.running += 1
+            waiter.future.set_result(None)
+        for entry in blocked:
+            heapq.heappush(self.queue, entry)
+
+
+_arrivals = itertools.count()
+_lanes = {
+    LIGHT: Lane(LIGHT, LIGHT_LANE_CONCURRENCY),
+    HEAVY: Lane(HEAVY, HEAVY_LANE_CONCURRENCY),
+    OFFICE: Lane(OFFICE, OFFICE_LANE_CONCURRENCY),
+}
+_limiters: Dict[str, OperationLimiter] = {}
+_pending = 0
+
+LANE_REQUESTS = metrics.Counter("toolkit_lane_slots_total", "Slots granted by lane and operation.",
+                                ("lane", "operation"))
+metrics.Gauge(
+    "toolkit_operation_queue_depth", "Requests waiting for an operation slot.", ("operation",),
+    collect=lambda: {(op,): limiter.waiting for op, limiter in list(_limiters.items())},
+)
+metrics.Gauge(
+    "toolkit_operation_in_flight", "Requests holding an operation slot.", ("operation",),
+    collect=lambda: {(op,): limiter.running for op, limiter in list(_limiters.items())},
+)
+metrics.Gauge(
+    "toolkit_lane_queue_depth", "Requests waiting for a slot in each lane.", ("lane",),
+    collect=lambda: {(name,): sum(lane.waiting.values()) for name, lane in _lanes.items()},
+)
+metrics.Gauge(
+    "toolkit_lane_in_flight", "Slots taken in each lane.", ("lane",),
+    collect=lambda: {(name,): lane.running for name, lane in _lanes.items()},
+)
+metrics.Gauge(
+    "toolkit_pending_jobs", "Queued plus running requests across all operations.",
+    collect=lambda: {(): _pending},
+)
+
+
+def _get_limiter(operation: str) -> OperationLimiter:
+    limiter = _limiters.get(operation)
+    if limiter is None:
+        limiter = _limiters[operation] = OperationLimiter(operation)
+    return limiter
+
+
+def _dispatch():
+    # A released slot may unblock waiters of its operation in either lane
+    for lane in _lanes.values():
+        lane.dispatch()
+
+
+def _busy(status_code: int, detail: str) -> HTTPException:
+    return HTTPException(status_code=status_code, detail=detail, headers={"Retry-After": str(RETRY_AFTER_SECONDS)})
+
+
+async def acquire_operation_slot(operation: str):
+    """
+    Waits for a slot for `operation` in the lane the current request's
+    estimated cost puts it in (LibreOffice conversions: the office lane)
+    and returns a function that releases it. Sets current_lane, so the
+    work that follows runs on that lane's process pool.
+    Raises 503 when the server as a whole is saturated and 429 when this
+    operation's wait queue, or the client's share of the lane's, is full.
+    """
+    global _pending
+    limiter = _get_limiter(operation)
+    work = current_work.get() or Work(BACKGROUND_CLIENT)
+    cost, charge = await estimate_cost(work, operation)
+    if operation in OFFICE_OPERATIONS:
+        lane = _lanes[OFFICE]
+    else:
+        lane = _lanes[HEAVY if cost > HEAVY_COST else LIGHT]
+    free = lane.running < lane.concurrency and limiter.running < limiter.concurrency
+    if _pending >= MAX_PENDING_JOBS:
+        raise _busy(503, "Server is busy, please retry later.")
+    if not free and limiter.waiting >= OPERATION_QUEUE_SIZE:
+        raise _busy(429, f"Too many pending '{operation}' requests, please retry later.")
+    if not free and lane.waiting.get(work.client, 0) >= CLIENT_QUEUE_SIZE:
+        raise _busy(429, "Too many pending requests from this client, please retry later.")
+
+    set_operation(operation)
+    waiter = _Waiter(asyncio.get_running_loop().create_future(), limiter, work.client)
+    _pending += 1
+    limiter.waiting += 1
+    lane.waiting[work.client] = lane.waiting.get(work.client, 0) + 1
+    lane.enqueue(waiter, charge)
+    lane.dispatch()
+    started = time.perf_counter()
+    try:
+        await waiter.future
+    except BaseException:
+        if waiter.future.done() and not waiter.future.cancelled():
+            # Granted just as the wait was cancelled
+            lane.running -= 1
+            limiter.running -= 1
+            _dispatch()
+        _pending -= 1
+        raise
+    finally:
+        limiter.waiting -= 1
+        lane.waiting[work.client] -= 1
+        if not lane.waiting[work.client]:
+            del lane.waiting[work.client]
+    record_stage(operation, "queue", time.perf_counter() - started)
+    LANE_REQUESTS.inc(lane=lane.name, operation=operation)
+    current_lane.set(lane.name)
+
+    released = False
+
+    def release():
+        global _pending
+        nonlocal released
+        if released:
+            return
+        released = True
+        lane.running -= 1
+        limiter.running -= 1
+        _pending -= 1
+        _dispatch()
+
+    return release
+
+
+@asynccontextmanager
+async def operation_slot(operation: str):
+    release = await acquire_operation_slot(operation)
+    try:
+        yield
+    finally:
+        release()
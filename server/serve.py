@@ -0,0 +1,44 @@
+"""
+Production entry point: uvicorn with several server processes.
+
+    cd server
+    TOOLKIT_WORKERS=4 python serve.py
+    python serve.py --workers 4 --port 8080
+
+Every worker imports main on its own (heavy libraries load on first use,
+see lazy.py, or at startup with TOOLKIT_PREWARM) and gets its own process
+pool, LibreOffice pool and scheduler. They share the temp, cache, document
+and job directories, which are safe to use from several processes: scratch
+directories and LibreOffice profiles are named after the owning process,
+cache entries are written under a temporary name and renamed, and jobs are
+claimed through SQLite.
+"""
+import argparse
+import os
+
+import uvicorn
+
+from config import HOST, PORT, WORKERS
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--host", default=HOST, help="TOOLKIT_HOST")
+    parser.add_argument("--port", type=int, default=PORT, help="TOOLKIT_PORT")
+    parser.add_argument("--workers", type=int, default=WORKERS, help="TOOLKIT_WORKERS")
+    args = parser.parse_args()
+    workers = max(1, args.workers)
+
+    if not os.environ.get("TOOLKIT_CPU_WORKERS", "").strip():
+        # Read by every worker's config; the process pools together get
+        # one process per CPU
+        os.environ["TOOLKIT_CPU_WORKERS"] = str(max(1, (os.cpu_count() or 2) // workers))
+
+    # The toolkit logs requests itself (TOOLKIT_ACCESS_LOG) and configures
+    # the log handlers in main
+    uvicorn.run("main:app", host=args.host, port=args.port, workers=workers,
+                access_log=False, log_config=None)
+
+
+if __name__ == "__main__":
+    main()
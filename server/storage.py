@@ -0,0 +1,331 @@
+import asyncio
+import logging
+import os
+import shutil
+import tempfile
+import threading
+import time
+import uuid
+from contextlib import asynccontextmanager
+from typing import Dict, Optional
+
+from fastapi import BackgroundTasks, HTTPException
+
+import metrics
+from documents import CONTENT_NAME
+from config import (
+    UPLOAD_DIR,
+    OUTPUT_DIR,
+    SCRATCH_DIR,
+    DOCUMENTS_DIR,
+    DOCUMENT_TTL_SECONDS,
+    TEMP_MAX_AGE_SECONDS,
+    TEMP_SWEEP_INTERVAL,
+    TEMP_MAX_BYTES,
+    TEMP_MIN_FREE_BYTES,
+    TMPFS_DIR,
+    TMPFS_MAX_BYTES,
+    TMPFS_MAX_REQUEST_BYTES,
+    RETRY_AFTER_SECONDS,
+)
+
+logger = logging.getLogger(__name__)
+
+# Temporary file lifecycle.
+#
+# Each request gets a scratch directory (uploads, intermediates and the
+# result) that is removed as a whole once the response has been sent, or
+# straight away if the request fails. Directories are named after the
+# owning process, so the sweeper can tell a live request from one a
+# crashed worker left behind. Scratch directories of live requests are
+# never swept; responses release theirs even when the client drops the
+# connection (see downloads.py). The sweeper removes other entries older
+# than TEMP_MAX_AGE_SECONDS, document handles unused for
+# DOCUMENT_TTL_SECONDS and, above the quota, the oldest entries nothing is
+# using. While the temp dirs stay over quota or the disk is nearly full,
+# new requests are shed with 503.
+
+# Unowned entries younger than this are left alone by the quota sweep,
+# another worker may be writing them
+SWEEP_GRACE_SECONDS = 300.0
+# tmpfs scratch space reserved per request byte: input, result and
+# intermediates
+TMPFS_HEADROOM = 3
+
+SWEPT = metrics.Counter("toolkit_temp_swept_total", "Temporary entries removed by the sweeper.", ("reason",))
+SHED = metrics.Counter("toolkit_temp_shed_total", "Requests rejected because temporary storage was full.")
+
+_lock = threading.Lock()
+# Scratch directories of this process's live requests by path
+_active: Dict[str, "Scratch"] = {}
+_tmpfs_reserved = 0
+_usage: Dict[str, int] = {}
+_sweeper: Optional[asyncio.Task] = None
+
+
+def temp_roots() -> Dict[str, str]:
+    roots = {"uploads": UPLOAD_DIR, "outputs": OUTPUT_DIR, "scratch": SCRATCH_DIR, "documents": DOCUMENTS_DIR}
+    if TMPFS_DIR:
+        roots["tmpfs"] = TMPFS_DIR
+    return roots
+
+
+def _max_age(root_name: str) -> float:
+    # Document handles are kept while they are being used
+    return DOCUMENT_TTL_SECONDS if root_name == "documents" else TEMP_MAX_AGE_SECONDS
+
+
+def ensure_dirs():
+    for path in temp_roots().values():
+        os.makedirs(path, exist_ok=True)
+
+
+class Scratch:
+    """
+    A private directory for one request. release() removes it with
+    everything in it and may be called more than once.
+    """
+    def __init__(self, expected_bytes: int = 0):
+        self.created = time.time()
+        self.tmpfs_bytes = _reserve_tmpfs(expected_bytes)
+        root = TMPFS_DIR if self.tmpfs_bytes else SCRATCH_DIR
+        self.path = os.path.join(root, f"req_{os.getpid()}_{uuid.uuid4().hex}")
+        try:
+            os.makedirs(self.path)
+        except BaseException:
+            _release_tmpfs(self.tmpfs_bytes)
+            raise
+        with _lock:
+            _active[self.path] = self
+
+    def file(self, name: str) -> str:
+        return os.path.join(self.path, name)
+
+    def subdir(self, prefix: str) -> str:
+        return tempfile.mkdtemp(prefix=prefix, dir=self.path)
+
+    def release(self):
+        with _lock:
+            owned = _active.pop(self.path, None) is not None
+        if owned:
+            shutil.rmtree(self.path, ignore_errors=True)
+            self._forget()
+
+    def _forget(self):
+        _release_tmpfs(self.tmpfs_bytes)
+        self.tmpfs_bytes = 0
+
+
+def _reserve_tmpfs(expected_bytes: int) -> int:
+    global _tmpfs_reserved
+    if not TMPFS_DIR or not 0 < expected_bytes <= TMPFS_MAX_REQUEST_BYTES:
+        return 0
+    wanted = expected_bytes * TMPFS_HEADROOM
+    with _lock:
+        if _tmpfs_reserved + wanted > TMPFS_MAX_BYTES:
+            return 0
+        _tmpfs_reserved += wanted
+    return wanted
+
+
+def _release_tmpfs(reserved: int):
+    global _tmpfs_reserved
+    if reserved:
+        with _lock:
+            _tmpfs_reserved -= reserved
+
+
+def storage_full() -> Optional[str]:
+    """Why new work should be refused right now, or None."""
+    if TEMP_MAX_BYTES and sum(_usage.values()) > TEMP_MAX_BYTES:
+        return "Temporary storage quota exceeded"
+    if TEMP_MIN_FREE_BYTES:
+        try:
+            free = shutil.disk_usage(SCRATCH_DIR).free
+        except OSError:
+            return None
+        if free < TEMP_MIN_FREE_BYTES:
+            return "Disk almost full"
+    return None
+
+
+def check_capacity():
+    reason = storage_full()
+    if reason:
+        SHED.inc()
+        logger.warning("Shedding request", extra={"reason": reason})
+        raise HTTPException(status_code=503, detail="Server is low on disk space, please retry later.",
+                            headers={"Retry-After": str(RETRY_AFTER_SECONDS)})
+
+
+def upload_size(files) -> int:
+    # UploadFiles have been spooled by the time the route runs
+    return sum(f.size or 0 for f in files)
+
+
+@asynccontextmanager
+async def request_scratch(background_tasks: BackgroundTasks, expected_bytes: int = 0):
+    """
+    Scratch directory for a route. Removed after the response has been sent
+    (including streamed ones), or right away if the route raises.
+    """
+    check_capacity()
+    scratch = Scratch(expected_bytes)
+    try:
+        yield scratch
+    except BaseException:
+        scratch.release()
+        raise
+    background_tasks.add_task(scratch.release)
+
+
+# Sweeper
+def _owned_elsewhere(name: str) -> bool:
+    # Scratch directory (req_<pid>_<id>) of a live request in another process
+    parts = name.split("_")
+    if len(parts) != 3 or parts[0] != "req" or not parts[1].isdigit():
+        return False
+    pid = int(parts[1])
+    if pid == os.getpid():
+        # Ours but not active: left behind
+        return False
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+def _document_in_use(entry: os.DirEntry) -> bool:
+    # Requests hard link a handle's content into their scratch directory
+    try:
+        return os.stat(os.path.join(entry.path, CONTENT_NAME)).st_nlink > 1
+    except OSError:
+        return False
+
+
+def _entry_size(entry: os.DirEntry) -> int:
+    try:
+        if entry.is_dir(follow_symlinks=False):
+            return metrics.directory_bytes(entry.path)
+        return entry.stat(follow_symlinks=False).st_size
+    except OSError:
+        return 0
+
+
+def _remove(path: str, reason: str):
+    with _lock:
+        scratch = _active.pop(path, None)
+    if scratch is not None:
+        scratch._forget()
+    try:
+        if os.path.isdir(path) and not os.path.islink(path):
+            shutil.rmtree(path)
+        else:
+            os.remove(path)
+    except FileNotFoundError:
+        return
+    except OSError as e:
+        logger.warning("Error removing temporary file", extra={"path": path, "error": str(e)})
+        return
+    SWEPT.inc(reason=reason)
+
+
+def sweep(now: float = None) -> dict:
+    """
+    One pass over the temp dirs. Scratch directories of live requests (in
+    this process or another) are left alone. Removes entries older than the
+    max age or left by a dead process, then, while over quota, the oldest
+    entries nothing is using. Returns the number of entries removed per
+    reason.
+    """
+    now = now or time.time()
+    removed = {"age": 0, "orphaned": 0, "quota": 0}
+    candidates = []
+    usage = {}
+    for root_name, root in temp_roots().items():
+        max_age = _max_age(root_name)
+        total = 0
+        try:
+            entries = list(os.scandir(root))
+        except OSError:
+            usage[root_name] = 0
+            continue
+        for entry in entries:
+            try:
+                modified = entry.stat(follow_symlinks=False).st_mtime
+            except OSError:
+                continue
+            with _lock:
+                active = entry.path in _active
+            if active or _owned_elsewhere(entry.name):
+                total += _entry_size(entry)
+                continue
+            if entry.name.startswith("req_"):
+                _remove(entry.path, "orphaned")
+                removed["orphaned"] += 1
+                continue
+            age = now - modified
+            if age > max_age:
+                _remove(entry.path, "age")
+                removed["age"] += 1
+                continue
+            size = _entry_size(entry)
+            total += size
+            in_use = root_name == "documents" and _document_in_use(entry)
+            if not in_use and age > SWEEP_GRACE_SECONDS:
+                candidates.append((modified, entry.path, root_name, size))
+        usage[root_name] = total
+
+    if TEMP_MAX_BYTES and sum(usage.values()) > TEMP_MAX_BYTES:
+        for _, path, root_name, size in sorted(candidates):
+            if sum(usage.values()) <= TEMP_MAX_BYTES:
+                break
+            _remove(path, "quota")
+            removed["quota"] += 1
+            usage[root_name] -= size
+
+    _usage.clear()
+    _usage.update(usage)
+    if any(removed.values()):
+        logger.info("Swept temporary files", extra={"removed": removed, "bytes": sum(usage.values())})
+    return removed
+
+
+def usage() -> Dict[str, int]:
+    """Bytes per temp dir as of the last sweep."""
+    return dict(_usage)
+
+
+async def _sweep_forever():
+    while True:
+        try:
+            await asyncio.to_thread(sweep)
+        except Exception as e:
+            logger.error("Temporary file sweep failed", extra={"error": str(e)})
+        await asyncio.sleep(TEMP_SWEEP_INTERVAL)
+
+
+def start_sweeper():
+    global _sweeper
+    ensure_dirs()
+    _sweeper = asyncio.get_running_loop().create_task(_sweep_forever())
+
+
+async def stop_sweeper():
+    global _sweeper
+    if _sweeper is not None:
+        _sweeper.cancel()
+        try:
+            await _sweeper
+        except asyncio.CancelledError:
+            pass
+        _sweeper = None
+
+
+metrics.Gauge(
+    "toolkit_temp_active_scratch", "Scratch directories of requests in progress.",
+    collect=lambda: {(): len(_active)},
+)
@@ -0,0 +1,57 @@
+"""Small hand written PDFs for the tests."""
+from typing import Dict, Tuple
+
+
+def write_pdf(path: str, objects: Dict[int, Tuple[int, bytes]], root: int = 1):
+    """
+    Writes objects {number: (generation, body)} with a classic
+    cross-reference table. Bodies refer to each other with the right
+    generation themselves, e.g. b"4 1 R".
+    """
+    size = max(objects) + 1
+    with open(path, "wb") as f:
+        f.write(b"%PDF-1.4\n")
+        offsets = {}
+        for n in sorted(objects):
+            generation, body = objects[n]
+            offsets[n] = f.tell()
+            f.write(b"%d %d obj\n" % (n, generation) + body + b"\nendobj\n")
+        xref = f.tell()
+        f.write(b"xref\n0 %d\n0000000000 65535 f \n" % size)
+        for n in range(1, size):
+            if n in offsets:
+                f.write(b"%010d %05d n \n" % (offsets[n], objects[n][0]))
+            else:
+                f.write(b"0000000000 00001 f \n")
+        f.write(b"trailer\n<< /Size %d /Root %d %d R >>\nstartxref\n%d\n%%%%EOF\n"
+                % (size, root, objects[root][0], xref))
+
+
+def write_generation_pdf(path: str, text: str = "Hello", generation: int = 1):
+    """One page whose page, font and content stream objects are not generation 0."""
+    content = b"BT /F1 12 Tf 50 750 Td (%s) Tj ET" % text.encode("latin-1")
+    g = generation
+    write_pdf(path, {
+        1: (0, b"<< /Type /Catalog /Pages 2 0 R >>"),
+        2: (0, b"<< /Type /Pages /Count 1 /Kids [3 %d R] >>" % g),
+        3: (g, b"<< /Type /Page /Parent 2 0 R /MediaBox [0 0 595 842] "
+               b"/Resources << /Font << /F1 4 %d R >> >> /Contents 5 %d R >>" % (g, g)),
+        4: (g, b"<< /Type /Font /Subtype /Type1 /BaseFont /Helvetica >>"),
+        5: (g, b"<< /Length %d >>\nstream\n" % len(content) + content + b"\nendstream"),
+    })
+
+
+def write_pages_pdf(path: str, pages: int):
+    """Pages showing their own number."""
+    objects = {1: (0, b"<< /Type /Catalog /Pages 2 0 R >>"),
+               3: (0, b"<< /Type /Font /Subtype /Type1 /BaseFont /Helvetica >>")}
+    kids = []
+    for n in range(pages):
+        page, content = 4 + 2 * n, 5 + 2 * n
+        text = b"BT /F1 24 Tf 100 700 Td (Page %d) Tj ET" % (n + 1)
+        objects[page] = (0, b"<< /Type /Page /Parent 2 0 R /MediaBox [0 0 595 842] "
+                            b"/Resources << /Font << /F1 3 0 R >> >> /Contents %d 0 R >>" % content)
+        objects[content] = (0, b"<< /Length %d >>\nstream\n" % len(text) + text + b"\nendstream")
+        kids.append(b"%d 0 R" % page)
+    objects[2] = (0, b"<< /Type /Pages /Count %d /Kids [%s] >>" % (pages, b" ".join(kids)))
+    write_pdf(path, objects)
@@ -0,0 +1,49 @@
+import zlib
+
+import PyPDF2
+
+from compression import compress_document
+from pdfs import write_pdf
+
+
+def image(size: int = 600) -> bytes:
+    data = zlib.compress(bytes((x * y) % 251 for y in range(size) for x in range(size)))
+    return (b"<< /Type /XObject /Subtype /Image /Width %d /Height %d /ColorSpace /DeviceGray "
+            b"/BitsPerComponent 8 /Filter /FlateDecode /Length %d >>\nstream\n" % (size, size, len(data))
+            + data + b"\nendstream")
+
+
+def stream(content: bytes, entries: bytes = b"") -> bytes:
+    return b"<< %s /Length %d >>\nstream\n" % (entries, len(content)) + content + b"\nendstream"
+
+
+def write_form_pdf(path):
+    """The only image drawn is drawn from a form without /Resources, and has generation 1."""
+    write_pdf(path, {
+        1: (0, b"<< /Type /Catalog /Pages 2 0 R >>"),
+        2: (0, b"<< /Type /Pages /Count 1 /Kids [3 0 R] >>"),
+        3: (0, b"<< /Type /Page /Parent 2 0 R /MediaBox [0 0 595 842] "
+               b"/Resources << /XObject << /Fm1 4 0 R /Im1 5 1 R /Im2 6 0 R >> >> /Contents 7 0 R >>"),
+        4: (0, stream(b"q 100 0 0 100 0 0 cm /Im1 Do Q", b"/Type /XObject /Subtype /Form /BBox [0 0 595 842]")),
+        5: (1, image()),
+        6: (0, image(50)),
+        7: (0, stream(b"q /Fm1 Do Q")),
+    })
+
+
+def test_form_without_resources_uses_page_resources(tmp_path):
+    source, output = str(tmp_path / "in.pdf"), str(tmp_path / "out.pdf")
+    write_form_pdf(source)
+    stats = compress_document(source, output, "screen")
+    assert stats["unused_removed"] == 1
+    xobjects = PyPDF2.PdfReader(output).pages[0]["/Resources"]["/XObject"]
+    assert set(xobjects) == {"/Fm1", "/Im1"}
+
+
+def test_recompresses_images_of_any_generation(tmp_path):
+    source, output = str(tmp_path / "in.pdf"), str(tmp_path / "out.pdf")
+    write_form_pdf(source)
+    stats = compress_document(source, output, "screen")
+    assert stats["images_recompressed"] == 1
+    im1 = PyPDF2.PdfReader(output).pages[0]["/Resources"]["/XObject"]["/Im1"].get_object()
+    assert im1["/Filter"] == "/DCTDecode" and im1["/Width"] < 600
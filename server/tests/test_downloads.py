@@ -0,0 +1,113 @@
+import asyncio
+import os
+
+import pytest
+from fastapi.testclient import TestClient
+from starlette.background import BackgroundTask
+from starlette.requests import ClientDisconnect
+
+import cache
+import main
+from downloads import DownloadResponse
+from pdfs import write_pages_pdf
+
+
+def test_background_runs_when_client_disconnects(tmp_path):
+    path = tmp_path / "result.pdf"
+    path.write_bytes(b"%PDF-1.4 data")
+    released = []
+    response = DownloadResponse(str(path), "result.pdf", "application/pdf", digest="abc",
+                                background=BackgroundTask(released.append, True))
+    scope = {"type": "http", "method": "GET", "path": "/", "headers": [], "asgi": {"spec_version": "2.4"}}
+
+    async def receive():
+        return {"type": "http.disconnect"}
+
+    async def send(message):
+        raise OSError("connection reset")
+
+    with pytest.raises((OSError, ClientDisconnect)):
+        asyncio.run(response(scope, receive, send))
+    assert released == [True]
+
+
+def get(response, headers=()):
+    scope = {"type": "http", "method": "GET", "path": "/", "asgi": {"spec_version": "2.4"},
+             "headers": [(k.lower().encode(), v.encode()) for k, v in headers]}
+    messages = []
+
+    async def receive():
+        return {"type": "http.request", "body": b"", "more_body": False}
+
+    async def send(message):
+        messages.append(message)
+
+    asyncio.run(response(scope, receive, send))
+    start = messages[0]
+    body = b"".join(m.get("body", b"") for m in messages[1:])
+    return start["status"], dict((k.decode(), v.decode()) for k, v in start["headers"]), body
+
+
+@pytest.fixture
+def result(tmp_path):
+    path = tmp_path / "result.pdf"
+    path.write_bytes(b"0123456789")
+    return str(path)
+
+
+def test_range_with_matching_if_range(result):
+    status, headers, body = get(DownloadResponse(result, "result.pdf", digest="abc"),
+                                [("Range", "bytes=4-"), ("If-Range", '"abc"')])
+    assert (status, body) == (206, b"456789")
+    assert headers["etag"] == '"abc"'
+
+
+def test_stale_if_range_gets_whole_file(result):
+    status, _, body = get(DownloadResponse(result, "result.pdf", digest="abc"),
+                          [("Range", "bytes=4-"), ("If-Range", '"stale"')])
+    assert (status, body) == (200, b"0123456789")
+
+
+def test_if_none_match(result):
+    status, headers, body = get(DownloadResponse(result, "result.pdf", digest="abc"),
+                                [("If-None-Match", 'W/"abc"')])
+    assert (status, body) == (304, b"")
+    assert headers["etag"] == '"abc"'
+
+
+def test_weak_etag_never_satisfies_if_range(result):
+    etag = get(DownloadResponse(result, "result.pdf"))[1]["etag"]
+    assert etag.startswith('W/"')
+    status, _, body = get(DownloadResponse(result, "result.pdf"), [("Range", "bytes=4-"), ("If-Range", etag)])
+    assert (status, body) == (200, b"0123456789")
+    assert get(DownloadResponse(result, "result.pdf"), [("If-None-Match", etag)])[0] == 304
+
+
+def test_repeated_request_resumes(tmp_path, monkeypatch):
+    # Not cached: the second request produces the result again
+    monkeypatch.setattr(cache, "get_cache", lambda: None)
+    source = tmp_path / "in.pdf"
+    write_pages_pdf(str(source), 3)
+    files = {"file": ("in.pdf", source.read_bytes(), "application/pdf")}
+    with TestClient(main.app) as client:
+        first = client.post("/pdf/remove-pages", files=files, data={"pages": "[2]"})
+        etag = first.headers["etag"]
+        assert not etag.startswith("W/")
+        resumed = client.post("/pdf/remove-pages", files=files, data={"pages": "[2]"},
+                              headers={"Range": "bytes=10-", "If-Range": etag})
+        other = client.post("/pdf/remove-pages", files=files, data={"pages": "[3]"})
+    assert resumed.status_code == 206 and resumed.headers["etag"] == etag
+    assert first.content[10:] == resumed.content
+    assert other.headers["etag"] != etag
+
+
+def test_cached_and_produced_results_share_their_etag(tmp_path, monkeypatch):
+    result_cache = cache.ResultCache(str(tmp_path / "cache"), 1 << 20, 3600)
+    monkeypatch.setattr(cache, "get_cache", lambda: result_cache)
+    source = tmp_path / "in.pdf"
+    write_pages_pdf(str(source), 2)
+    files = {"file": ("in.pdf", source.read_bytes(), "application/pdf")}
+    with TestClient(main.app) as client:
+        responses = [client.post("/pdf/organize", files=files, data={"pages": "2,1"}) for _ in range(2)]
+    assert [r.headers["x-cache"] for r in responses] == ["MISS", "HIT"]
+    assert responses[0].headers["etag"] == responses[1].headers["etag"]
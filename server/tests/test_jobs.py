@@ -0,0 +1,84 @@
+import asyncio
+import os
+import time
+
+import pytest
+
+import jobs
+
+
+@pytest.fixture
+def store(tmp_path, monkeypatch):
+    monkeypatch.setattr(jobs, "JOBS_DIR", str(tmp_path / "jobs"))
+    monkeypatch.setattr(jobs, "JOB_POLL_INTERVAL", 0.01)
+    return tmp_path / "jobs"
+
+
+def write_result(inputs, params, output_dir, progress):
+    path = os.path.join(output_dir, "result.txt")
+    with open(path, "w") as f:
+        f.write(params["text"])
+    return path
+
+
+def submit(params=None) -> str:
+    job_id = jobs.new_job_id()
+    jobs.create_job(job_id, "write", params or {"text": "done"}, [], "result.txt", "text/plain")
+    return job_id
+
+
+def test_stale_running_job_is_requeued_on_restart(store, monkeypatch):
+    monkeypatch.setitem(jobs.JOB_OPERATIONS, "write",
+                        jobs.JobOperation(write_result, (".txt",), ".txt", "text/plain", "write", cpu_bound=False))
+    job_id = submit()
+    assert jobs.claim_next_job("dead-worker")["id"] == job_id
+    jobs._update(job_id, heartbeat_at=time.time() - jobs.JOB_STALE_SECONDS - 1)
+
+    async def restart():
+        worker = jobs.JobWorker()
+        worker.start()
+        try:
+            for _ in range(500):
+                if jobs.get_job(job_id)["status"] == jobs.STATUS_DONE:
+                    break
+                await asyncio.sleep(0.01)
+        finally:
+            await worker.stop()
+
+    asyncio.run(restart())
+    job = jobs.get_job(job_id)
+    assert (job["status"], job["attempts"]) == (jobs.STATUS_DONE, 2)
+    assert job["worker"] != "dead-worker"
+    with open(job["result_path"]) as f:
+        assert f.read() == "done"
+
+
+def test_requeue_leaves_live_jobs_and_fails_exhausted_ones(store):
+    live, exhausted = submit(), submit()
+    jobs.claim_next_job("worker")
+    jobs.claim_next_job("worker")
+    jobs._update(exhausted, attempts=jobs.MAX_ATTEMPTS, heartbeat_at=time.time() - jobs.JOB_STALE_SECONDS - 1)
+    jobs.requeue_stale_jobs()
+    assert jobs.get_job(live)["status"] == jobs.STATUS_RUNNING
+    assert jobs.get_job(exhausted)["status"] == jobs.STATUS_FAILED
+
+
+def test_expired_jobs_are_purged_with_their_results(store):
+    expired, recent, queued = submit(), submit(), submit()
+    for job_id in (expired, recent, queued):
+        output_dir = os.path.join(jobs.job_dir(job_id), "output")
+        os.makedirs(output_dir)
+        open(os.path.join(output_dir, "result.txt"), "w").close()
+    jobs.finish_job(expired, os.path.join(jobs.job_dir(expired), "output", "result.txt"))
+    jobs.finish_job(recent, os.path.join(jobs.job_dir(recent), "output", "result.txt"))
+    conn = jobs._connect()
+    conn.execute("UPDATE jobs SET updated_at = ? WHERE id IN (?, ?)",
+                 (time.time() - jobs.JOB_TTL_SECONDS - 1, expired, queued))
+    conn.close()
+    jobs.purge_expired_jobs()
+
+    assert jobs.get_job(expired) is None
+    assert not os.path.exists(jobs.job_dir(expired))
+    for job_id in (recent, queued):
+        assert jobs.get_job(job_id) is not None
+        assert os.path.exists(jobs.job_dir(job_id))
@@ -0,0 +1,89 @@
+import os
+import time
+
+import pytest
+
+import libreoffice_pool
+
+
+@pytest.fixture
+def profiles(tmp_path, monkeypatch):
+    monkeypatch.setattr(libreoffice_pool, "LIBREOFFICE_PROFILE_DIR", str(tmp_path))
+    yield tmp_path
+    libreoffice_pool.shutdown_pool()
+
+
+def test_one_shot_profiles_are_never_shared(profiles):
+    with libreoffice_pool.one_shot_profile() as first:
+        with libreoffice_pool.one_shot_profile() as second:
+            assert first != second
+    # Both are free again and reused
+    with libreoffice_pool.one_shot_profile() as again:
+        assert again in (first, second)
+    assert len(os.listdir(profiles)) == 2
+
+
+def test_failed_one_shot_profile_is_dropped(profiles):
+    with pytest.raises(RuntimeError):
+        with libreoffice_pool.one_shot_profile():
+            raise RuntimeError("soffice crashed")
+    assert os.listdir(profiles) == []
+
+
+def test_no_pool_without_uno(monkeypatch):
+    monkeypatch.setattr(libreoffice_pool, "HAS_UNO", False)
+    assert libreoffice_pool.get_pool("soffice") is None
+
+
+def test_recycle_after_close_does_not_restart(profiles):
+    pool = libreoffice_pool.LibreOfficePool("soffice", size=1)
+    worker = pool.workers[0]
+    restarts = []
+    worker.restart = lambda: restarts.append(worker)
+    pool.close()
+    pool._recycle(worker)
+    assert restarts == []
+    assert pool._idle.empty()
+
+
+class SlowWorker:
+    """Stands in for an unhealthy instance whose restart takes `delay`."""
+
+    def __init__(self, delay):
+        self.delay = delay
+        self.conversions = 0
+        self.budgets = []
+
+    def healthy(self):
+        return False
+
+    def restart(self, timeout):
+        self.budgets.append(timeout)
+        time.sleep(min(self.delay, timeout))
+        if self.delay >= timeout:
+            raise libreoffice_pool.LibreOfficeTimeout("did not start")
+
+
+def checked_out_pool(worker):
+    pool = libreoffice_pool.LibreOfficePool("soffice", size=1)
+    pool._recycle = lambda w: None
+    pool._idle.put(worker)
+    return pool
+
+
+def test_restart_and_conversion_share_one_deadline(profiles):
+    worker = SlowWorker(delay=0.3)
+    pool = checked_out_pool(worker)
+    budgets = []
+    pool._run(lambda w, t: budgets.append(t), timeout=1)
+    assert worker.budgets[0] <= 1
+    assert budgets[0] <= 1 - 0.3
+
+
+def test_restart_is_bounded_by_the_timeout(profiles):
+    worker = SlowWorker(delay=5)
+    pool = checked_out_pool(worker)
+    started = time.monotonic()
+    with pytest.raises(libreoffice_pool.LibreOfficeTimeout):
+        pool._run(lambda w, t: pytest.fail("converted after a failed restart"), timeout=0.2)
+    assert time.monotonic() - started < 1
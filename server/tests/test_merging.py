@@ -0,0 +1,82 @@
+import pickle
+
+import PyPDF2
+import pytest
+
+import merging
+from fixtures import write_text_pdf
+from pdfs import write_generation_pdf
+
+
+def page_texts(path):
+    return [page.extract_text().strip() for page in PyPDF2.PdfReader(path).pages]
+
+
+def test_merge_copies_all_pages(tmp_path):
+    first, second = tmp_path / "a.pdf", tmp_path / "b.pdf"
+    write_text_pdf(str(first), 3)
+    write_text_pdf(str(second), 2, seed=1)
+    merger = merging.IncrementalMerger(str(tmp_path / "out.pdf"))
+    assert merger.add(str(first)) == 3
+    assert merger.add(str(second), "2") == 1
+    out = merger.finish()
+
+    texts = page_texts(out)
+    assert len(texts) == 4
+    assert [t.split("\n")[0] for t in texts] == ["Page 1", "Page 2", "Page 3", "Page 2"]
+
+
+def test_merge_generation_one_objects(tmp_path):
+    first, second = tmp_path / "a.pdf", tmp_path / "b.pdf"
+    write_generation_pdf(str(first), "First")
+    write_generation_pdf(str(second), "Second", generation=3)
+    merger = merging.IncrementalMerger(str(tmp_path / "out.pdf"))
+    merger.add(str(first))
+    merger.add(str(second))
+    assert page_texts(merger.finish()) == ["First", "Second"]
+
+
+def test_merge_repeated_pages_and_rotation(tmp_path):
+    source = tmp_path / "a.pdf"
+    write_generation_pdf(str(source), "Again")
+    merger = merging.IncrementalMerger(str(tmp_path / "out.pdf"))
+    merger.add(str(source), [1, 1], rotations=[0, 90])
+    reader = PyPDF2.PdfReader(merger.finish())
+    assert [page.extract_text() for page in reader.pages] == ["Again", "Again"]
+    assert [page.rotation for page in reader.pages] == [0, 90]
+
+
+def test_merge_shares_identical_streams(tmp_path):
+    source = tmp_path / "a.pdf"
+    write_text_pdf(str(source), 1)
+    once = merging.IncrementalMerger(str(tmp_path / "once.pdf"))
+    once.add(str(source))
+    once.finish()
+    twice = merging.IncrementalMerger(str(tmp_path / "twice.pdf"))
+    twice.add(str(source))
+    twice.add(str(source))
+    twice.finish()
+    # The second copy adds a page and its font dictionary, the content
+    # stream is shared
+    assert len(twice.streams) == len(once.streams) == 1
+    assert len(twice.offsets) == len(once.offsets) + 2
+
+
+def test_merger_survives_pickling_between_inputs(tmp_path):
+    source = tmp_path / "a.pdf"
+    write_generation_pdf(str(source), "Pickled")
+    merger = merging.IncrementalMerger(str(tmp_path / "out.pdf"))
+    merger.add(str(source))
+    merger = pickle.loads(pickle.dumps(merger))
+    merger.add(str(source))
+    assert page_texts(merger.finish()) == ["Pickled", "Pickled"]
+
+
+def test_merge_rejects_bad_selection_and_empty_output(tmp_path):
+    source = tmp_path / "a.pdf"
+    write_generation_pdf(str(source))
+    merger = merging.IncrementalMerger(str(tmp_path / "out.pdf"))
+    with pytest.raises(ValueError):
+        merger.add(str(source), "5")
+    with pytest.raises(ValueError):
+        merger.finish()
@@ -0,0 +1,64 @@
+import pytest
+from fastapi import HTTPException
+
+from pageplan import compile_page_plan, validate_organize_options
+
+
+def test_all_pages_by_default():
+    assert compile_page_plan(3) == ([1, 2, 3], [0, 0, 0])
+    assert compile_page_plan(3, "all") == ([1, 2, 3], [0, 0, 0])
+
+
+def test_order_backwards_duplicates_and_rotation():
+    plan = compile_page_plan(10, "3-1,5@90,end,5", rotate=180)
+    assert plan.pages == [3, 2, 1, 5, 10, 5]
+    assert plan.rotations == [180, 180, 180, 270, 180, 180]
+
+
+def test_open_ranges_and_end():
+    assert compile_page_plan(5, "4-").pages == [4, 5]
+    assert compile_page_plan(5, "-2").pages == [1, 2]
+    assert compile_page_plan(5, "end-3").pages == [5, 4, 3]
+
+
+@pytest.mark.parametrize("remove, kept", [
+    ("end", [1, 2, 3, 4]),
+    ("3-end", [1, 2]),
+    ("end-4", [1, 2, 3]),
+    (" 2 , end", [1, 3, 4]),
+    ("4-", [1, 2, 3]),
+    ([1, 5], [2, 3, 4]),
+])
+def test_remove(remove, kept):
+    validate_organize_options("", remove)
+    assert compile_page_plan(5, "", remove).pages == kept
+
+
+def test_removed_pages_are_dropped_wherever_they_occur():
+    assert compile_page_plan(4, "1,2,1,3", "1").pages == [2, 3]
+
+
+@pytest.mark.parametrize("pages, remove", [
+    ("7", ""),
+    ("", "7"),
+    ("", [0]),
+    ("", [6]),
+    ("1-2", "1-2"),
+])
+def test_rejected_plans(pages, remove):
+    with pytest.raises(ValueError):
+        compile_page_plan(5, pages, remove)
+
+
+@pytest.mark.parametrize("options", [
+    {"pages": "1-x"},
+    {"pages": "-"},
+    {"pages": "1@45"},
+    {"remove": "2@90"},
+    {"remove": [0]},
+    {"rotate": "sideways"},
+])
+def test_invalid_syntax(options):
+    with pytest.raises(HTTPException) as e:
+        validate_organize_options(**options)
+    assert e.value.status_code == 400
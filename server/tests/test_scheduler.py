@@ -0,0 +1,43 @@
+import asyncio
+
+import scheduler
+import utils
+
+
+def take_slot(operation, work):
+    async def run():
+        token = scheduler.current_work.set(work)
+        try:
+            release = await scheduler.acquire_operation_slot(operation)
+            lane = scheduler.current_lane.get()
+            pool = utils.get_process_pool()
+            release()
+            return lane, pool
+        finally:
+            scheduler.current_work.reset(token)
+
+    return asyncio.run(run())
+
+
+def test_heavy_work_gets_its_own_pool(tmp_path):
+    big = tmp_path / "big.pdf"
+    # The page count alone puts pdf-to-images over the heavy cost
+    big.write_bytes(b"%PDF-1.4\n1 0 obj << /Type /Pages /Count 2000 >> endobj\n%%EOF\n")
+    small = tmp_path / "small.pdf"
+    small.write_bytes(b"%PDF-1.4\n1 0 obj << /Type /Pages /Count 1 >> endobj\n%%EOF\n")
+    try:
+        heavy_lane, heavy_pool = take_slot("pdf-to-images", scheduler.Work("a", [str(big)]))
+        light_lane, light_pool = take_slot("pdf-to-images", scheduler.Work("b", [str(small)]))
+        assert (heavy_lane, light_lane) == (scheduler.HEAVY, scheduler.LIGHT)
+        assert heavy_pool is not light_pool
+        assert heavy_pool._max_workers == scheduler.HEAVY_LANE_CONCURRENCY
+        assert light_pool._max_workers == scheduler.LIGHT_LANE_CONCURRENCY
+    finally:
+        utils.shutdown_executors()
+
+
+def test_libreoffice_waits_in_its_own_lane():
+    lane, _ = take_slot("convert", scheduler.Work("a"))
+    assert lane == scheduler.OFFICE
+    assert scheduler._lanes[scheduler.OFFICE].running == 0
+    assert scheduler._lanes[scheduler.LIGHT].running == 0
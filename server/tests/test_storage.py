@@ -0,0 +1,89 @@
+import os
+import time
+
+import pytest
+
+import storage
+
+
+@pytest.fixture
+def roots(tmp_path, monkeypatch):
+    paths = {}
+    for name, setting in (("uploads", "UPLOAD_DIR"), ("outputs", "OUTPUT_DIR"), ("scratch", "SCRATCH_DIR"),
+                          ("documents", "DOCUMENTS_DIR")):
+        paths[name] = str(tmp_path / name)
+        os.makedirs(paths[name])
+        monkeypatch.setattr(storage, setting, paths[name])
+    monkeypatch.setattr(storage, "TMPFS_DIR", "")
+    monkeypatch.setattr(storage, "TEMP_MAX_BYTES", 0)
+    return paths
+
+
+def make_old(path, seconds):
+    then = time.time() - seconds
+    os.utime(path, (then, then))
+
+
+def write(path, size=10):
+    with open(path, "wb") as f:
+        f.write(b"x" * size)
+    return path
+
+
+def test_active_scratch_survives_age(roots):
+    scratch = storage.Scratch()
+    try:
+        write(scratch.file("input.pdf"))
+        scratch.created -= storage.TEMP_MAX_AGE_SECONDS * 2
+        make_old(scratch.path, storage.TEMP_MAX_AGE_SECONDS * 2)
+        removed = storage.sweep()
+        assert removed == {"age": 0, "orphaned": 0, "quota": 0}
+        assert os.path.exists(scratch.file("input.pdf"))
+    finally:
+        scratch.release()
+    assert not os.path.exists(scratch.path)
+
+
+def test_orphaned_scratch_and_old_files_are_removed(roots):
+    # Named like one of ours but not active: a request that leaked it
+    orphan = os.path.join(roots["scratch"], f"req_{os.getpid()}_0123456789abcdef")
+    os.makedirs(orphan)
+    old = write(os.path.join(roots["outputs"], "old.pdf"))
+    make_old(old, storage.TEMP_MAX_AGE_SECONDS + 10)
+    fresh = write(os.path.join(roots["outputs"], "fresh.pdf"))
+
+    removed = storage.sweep()
+    assert removed == {"age": 1, "orphaned": 1, "quota": 0}
+    assert not os.path.exists(orphan)
+    assert not os.path.exists(old)
+    assert os.path.exists(fresh)
+
+
+def test_quota_skips_active_scratch_and_documents_in_use(roots, monkeypatch):
+    monkeypatch.setattr(storage, "TEMP_MAX_BYTES", 100)
+    age = storage.SWEEP_GRACE_SECONDS + 10
+
+    scratch = storage.Scratch()
+    try:
+        write(scratch.file("input.pdf"), 100)
+        scratch.created -= age
+        make_old(scratch.path, age)
+
+        used = os.path.join(roots["documents"], "a" * 32)
+        os.makedirs(used)
+        content = write(os.path.join(used, "content"), 100)
+        os.link(content, scratch.file("doc.pdf"))
+        make_old(used, age)
+
+        unused = os.path.join(roots["documents"], "b" * 32)
+        os.makedirs(unused)
+        write(os.path.join(unused, "content"), 100)
+        make_old(unused, age)
+
+        removed = storage.sweep()
+        assert removed["quota"] == 1
+        assert os.path.exists(used)
+        assert not os.path.exists(unused)
+        assert os.path.exists(scratch.file("input.pdf"))
+    finally:
+        scratch.release()
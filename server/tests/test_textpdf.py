@@ -0,0 +1,65 @@
+import codecs
+import re
+
+import PyPDF2
+import pytest
+
+import textpdf
+from textpdf import detect_encoding, render_text_pdf
+
+
+def render(tmp_path, data: bytes, **options):
+    """Text lines of each page of the rendered PDF."""
+    source, output = tmp_path / "in.txt", str(tmp_path / "out.pdf")
+    source.write_bytes(data)
+    render_text_pdf(str(source), output, **options)
+    return [[re.sub(rb"\\(.)", rb"\1", line).decode("cp1252")
+             for line in re.findall(rb"\(((?:[^\\)]|\\.)*)\)'", page.get_contents().get_data())]
+            for page in PyPDF2.PdfReader(output).pages]
+
+
+def test_wraps_at_spaces(tmp_path):
+    # 50 mm of 10 pt Courier hold 23 characters
+    pages = render(tmp_path, b"the quick brown fox jumps over the lazy dog\n", page_size="A5", margin=(148 - 50) / 2)
+    assert pages == [["the quick brown fox", "jumps over the lazy dog"]]
+
+
+def test_long_word_is_broken_and_without_wrap_cut(tmp_path):
+    options = {"page_size": "A5", "margin": (148 - 50) / 2}
+    assert render(tmp_path, b"x" * 50 + b"\n", **options) == [["x" * 23, "x" * 23, "x" * 4]]
+    assert render(tmp_path, b"x" * 50 + b"\nnext\n", wrap=False, **options) == [["x" * 23, "next"]]
+
+
+@pytest.mark.parametrize("wrap", [True, False])
+def test_lines_longer_than_a_read(tmp_path, monkeypatch, wrap):
+    options = {"wrap": wrap, "page_size": "A5", "margin": (148 - 50) / 2}
+    text = b"word\tword " * 30 + b"\n\n" + b"y" * 50 + b"\fz"
+    expected = render(tmp_path, text, **options)
+    monkeypatch.setattr(textpdf, "READ_CHARS", 7)
+    assert render(tmp_path, text, **options) == expected
+    if wrap:
+        assert expected[0][:2] == ["word    word word      ", "word word       word"]
+        assert expected[0][-3:] == ["y" * 23, "y" * 23, "y" * 4]
+    else:
+        assert expected == [["word    word word       word"[:23], "", "y" * 23], ["z"]]
+
+
+def test_form_feeds_start_pages(tmp_path):
+    assert render(tmp_path, b"\fone\ntwo\fthree\n\f\n\ffour") == [["one", "two"], ["three"], ["four"]]
+
+
+def test_tabs_and_blank_lines(tmp_path):
+    assert render(tmp_path, b"a\tb\n\n\tc\r\n") == [["a       b", "", "        c"]]
+
+
+@pytest.mark.parametrize("data, encoding", [
+    ("café\n".encode("utf-8"), "utf-8"),
+    (codecs.BOM_UTF8 + "café\n".encode("utf-8"), "utf-8-sig"),
+    ("café\n".encode("utf-16"), "utf-16"),
+    ("café\n".encode("cp1252"), "cp1252"),
+])
+def test_encoding_detection(tmp_path, data, encoding):
+    path = tmp_path / "in.txt"
+    path.write_bytes(data)
+    assert detect_encoding(str(path)) == encoding
+    assert render(tmp_path, data) == [["café"]]
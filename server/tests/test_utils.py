@@ -0,0 +1,29 @@
+import os
+import shutil
+
+import pytest
+from fastapi import HTTPException
+
+from pdfs import write_pages_pdf
+from utils import iter_pdf_to_images, validate_image_convert_options
+
+
+@pytest.mark.parametrize("quality", [0, 101, -1])
+def test_image_quality_out_of_range(quality):
+    with pytest.raises(HTTPException) as error:
+        validate_image_convert_options("JPEG", quality=quality)
+    assert error.value.detail == "Quality must be between 1 and 100."
+
+
+@pytest.mark.parametrize("quality, expected", [(None, 0), ("", 0), (1, 1), ("100", 100)])
+def test_image_quality(quality, expected):
+    assert validate_image_convert_options("jpg", quality=quality)["quality"] == expected
+
+
+@pytest.mark.skipif(shutil.which("pdftoppm") is None, reason="needs pdftoppm")
+def test_pdf_to_images_renders_repeated_pages_once(tmp_path):
+    source = tmp_path / "in.pdf"
+    write_pages_pdf(str(source), 3)
+    paths = list(iter_pdf_to_images(str(source), str(tmp_path), dpi=72, pages="1,1,1-3,2"))
+    assert [os.path.basename(p) for p in paths] == ["in_page_1.jpg", "in_page_2.jpg", "in_page_3.jpg"]
+    assert all(os.path.exists(p) for p in paths)
@@ -0,0 +1,87 @@
+import openpyxl
+import pytest
+from openpyxl.styles import PatternFill
+
+from xlsxprep import WorkbookTooLarge, plan_workbook, write_workbook
+
+
+def table(sheet, rows: int, columns: int = 4):
+    for row in range(rows):
+        sheet.append([f"{row}-{column}" for column in range(columns)])
+
+
+def save(workbook, tmp_path) -> str:
+    path = str(tmp_path / "input.xlsx")
+    workbook.save(path)
+    return path
+
+
+def prepare(path: str, tmp_path, **options):
+    plans = plan_workbook(path, **options)
+    output = str(tmp_path / "prepared.xlsx")
+    write_workbook(path, output, plans)
+    return plans, openpyxl.load_workbook(output)
+
+
+def test_formatted_last_row_is_not_printed(tmp_path):
+    workbook = openpyxl.Workbook()
+    table(workbook.active, 50)
+    workbook.active.cell(row=1048576, column=1).fill = PatternFill("solid", fgColor="FFFF00")
+    plans, prepared = prepare(save(workbook, tmp_path), tmp_path)
+    assert [(plan.rows, plan.columns, plan.truncated, plan.hidden) for plan in plans] == [(50, 4, False, False)]
+    sheet = prepared.active
+    assert sheet.print_area == "'Sheet'!$A$1:$D$50"
+    assert sheet.sheet_properties.pageSetUpPr.fitToPage
+    assert (sheet.page_setup.fitToWidth, sheet.page_setup.fitToHeight) == (1, 0)
+
+
+def test_empty_sheets_are_hidden(tmp_path):
+    workbook = openpyxl.Workbook()
+    table(workbook.active, 3)
+    workbook.create_sheet("Empty")
+    plans, prepared = prepare(save(workbook, tmp_path), tmp_path)
+    assert [plan.hidden for plan in plans] == [False, True]
+    assert prepared["Empty"].sheet_state == "hidden"
+    assert prepared["Sheet"].sheet_state == "visible"
+
+
+def test_empty_workbook_prints_one_page(tmp_path):
+    workbook = openpyxl.Workbook()
+    plans, prepared = prepare(save(workbook, tmp_path), tmp_path)
+    assert [(plan.rows, plan.columns, plan.pages, plan.hidden) for plan in plans] == [(1, 1, 1, False)]
+    assert prepared.active.sheet_state == "visible"
+
+
+def test_print_area_of_its_own_is_kept(tmp_path):
+    workbook = openpyxl.Workbook()
+    table(workbook.active, 20)
+    workbook.active.print_area = "A1:B5"
+    plans, prepared = prepare(save(workbook, tmp_path), tmp_path)
+    assert plans[0].keep_print_area
+    sheet = prepared.active
+    assert sheet.print_area == "'Sheet'!$A$1:$B$5"
+    assert not (sheet.sheet_properties.pageSetUpPr and sheet.sheet_properties.pageSetUpPr.fitToPage)
+
+
+@pytest.mark.parametrize("budget, message", [
+    ({"max_cells": 100}, "more than 100 cells"),
+    ({"max_pages": 1}, "more than 1 pages"),
+])
+def test_over_budget(tmp_path, budget, message):
+    workbook = openpyxl.Workbook()
+    table(workbook.active, 200)
+    with pytest.raises(WorkbookTooLarge, match=message):
+        plan_workbook(save(workbook, tmp_path), **budget)
+
+
+def test_truncate_cuts_down_and_hides(tmp_path):
+    workbook = openpyxl.Workbook()
+    table(workbook.active, 200)
+    workbook.active.print_area = "A1:D200"
+    table(workbook.create_sheet("More"), 10)
+    plans, prepared = prepare(save(workbook, tmp_path), tmp_path, max_cells=100, truncate=True)
+    assert [(plan.rows, plan.columns, plan.truncated, plan.hidden) for plan in plans] == [
+        (25, 4, True, False), (0, 0, True, True)]
+    # The print area of its own no longer fits and is replaced
+    assert prepared["Sheet"].print_area == "'Sheet'!$A$1:$D$25"
+    assert prepared["More"].sheet_state == "hidden"
@@ -0,0 +1,57 @@
+import io
+import zipfile
+
+from fastapi import FastAPI
+from fastapi.testclient import TestClient
+
+import cache
+from utils import iter_zip, member_name, zip_streaming_response
+
+
+def outputs(directory, names):
+    paths = []
+    for name in names:
+        path = directory / name
+        path.write_bytes(name.encode() * 1000)
+        paths.append(str(path))
+    return paths
+
+
+def test_iter_zip_streams_and_removes_members(tmp_path):
+    paths = outputs(tmp_path, ["abc_page_1.pdf", "abc_page_2.txt"])
+    data = b"".join(iter_zip((member_name(p, "abc.pdf"), p) for p in paths))
+    with zipfile.ZipFile(io.BytesIO(data)) as archive:
+        assert archive.namelist() == ["page_1.pdf", "page_2.txt"]
+        assert [i.compress_type for i in archive.infolist()] == [zipfile.ZIP_STORED, zipfile.ZIP_DEFLATED]
+        assert archive.read("page_2.txt") == b"abc_page_2.txt" * 1000
+    assert not any((tmp_path / name).exists() for name in ["abc_page_1.pdf", "abc_page_2.txt"])
+
+
+def test_iter_zip_is_deterministic(tmp_path):
+    archives = []
+    for run in ("a", "b"):
+        (tmp_path / run).mkdir()
+        paths = outputs(tmp_path / run, ["one.png", "two.png"])
+        archives.append(b"".join(iter_zip((member_name(p, "x"), p) for p in paths)))
+    assert archives[0] == archives[1]
+
+
+def test_zip_streaming_response_is_cached(tmp_path, monkeypatch):
+    result_cache = cache.ResultCache(str(tmp_path / "cache"), 1 << 20, 3600)
+    monkeypatch.setattr(cache, "get_cache", lambda: result_cache)
+    key = cache.ResultCache.key("digest", "split", {})
+    app = FastAPI()
+
+    @app.get("/zip")
+    async def endpoint():
+        paths = outputs(tmp_path, ["page_1.pdf", "page_2.pdf"])
+        chunks = cache.tee_to_cache(iter_zip((member_name(p, "x"), p) for p in paths), key)
+        return await zip_streaming_response(chunks, "pages.zip", "split", etag=key)
+
+    with TestClient(app) as client:
+        response = client.get("/zip")
+    assert response.status_code == 200
+    assert response.headers["etag"] == f'"{key}"'
+    assert zipfile.ZipFile(io.BytesIO(response.content)).namelist() == ["page_1.pdf", "page_2.pdf"]
+    with open(result_cache.get(key, str(tmp_path)), "rb") as f:
+        assert f.read() == response.content
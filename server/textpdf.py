@@ -0,0 +1,337 @@
+import codecs
+import unicodedata
+import zlib
+from array import array
+from bisect import bisect_right
+from itertools import accumulate
+from typing import Iterator, List, Optional, Tuple
+
+from fastapi import HTTPException
+
+# Plain text to PDF without LibreOffice (/text/to-pdf).
+#
+# The text is read a line at a time and set in one of the PDF standard
+# fonts, which viewers bring along, so nothing is embedded. Every page is
+# written out as soon as it is full: memory use doesn't grow with the file,
+# only the xref offsets (8 bytes per object) do. Pages hang off /Pages
+# nodes of PAGES_PER_NODE pages each, whose object numbers are reserved up
+# front so a page can name its parent before the node is written.
+#
+# The standard fonts cover Windows-1252, other characters come out as "?";
+# engine=libreoffice lays out any script LibreOffice has fonts for.
+
+MM = 72 / 25.4
+PAGE_SIZES = {  # points, portrait
+    "A3": (842, 1191),
+    "A4": (595, 842),
+    "A5": (420, 595),
+    "LETTER": (612, 792),
+    "LEGAL": (612, 1008),
+}
+FONTS = {"courier": "Courier", "helvetica": "Helvetica", "times": "Times-Roman"}
+LINE_SPACING = 1.2
+TAB_SIZE = 8
+PAGES_PER_NODE = 256
+# Lines are read in pieces of at most this many characters, so a file
+# without line breaks doesn't end up in memory as a whole; only _fit
+# decides where the line breaks
+READ_CHARS = 64 * 1024
+SNIFF_BYTES = 64 * 1024
+
+# Advance widths (1/1000 em) of the printable ASCII characters, from the
+# Adobe font metrics of the standard fonts
+_ASCII_WIDTHS = {
+    "helvetica": [
+        278, 278, 355, 556, 556, 889, 667, 191, 333, 333, 389, 584, 278, 333, 278, 278,
+        556, 556, 556, 556, 556, 556, 556, 556, 556, 556, 278, 278, 584, 584, 584, 556,
+        1015, 667, 667, 722, 722, 667, 611, 778, 722, 278, 500, 667, 556, 833, 722, 778,
+        667, 778, 722, 667, 611, 722, 667, 944, 667, 667, 611, 278, 278, 278, 469, 556,
+        333, 556, 556, 500, 556, 556, 278, 556, 556, 222, 222, 500, 222, 833, 556, 556,
+        556, 556, 333, 500, 278, 556, 500, 722, 500, 500, 500, 334, 260, 334, 584,
+    ],
+    "times": [
+        250, 333, 408, 500, 500, 833, 778, 180, 333, 333, 500, 564, 250, 333, 250, 278,
+        500, 500, 500, 500, 500, 500, 500, 500, 500, 500, 278, 278, 564, 564, 564, 444,
+        921, 722, 667, 667, 722, 611, 556, 722, 722, 333, 389, 722, 611, 889, 722, 722,
+        556, 722, 667, 556, 611, 722, 722, 944, 722, 722, 611, 333, 278, 333, 469, 500,
+        333, 444, 500, 444, 500, 444, 333, 500, 500, 278, 278, 500, 278, 778, 500, 500,
+        500, 500, 333, 389, 278, 500, 500, 722, 500, 500, 444, 480, 200, 480, 541,
+    ],
+}
+COURIER_WIDTH = 600
+
+# C0 controls and DEL are dropped (tabs are expanded and form feeds start
+# a new page before this applies)
+_CONTROL = bytes(range(32)) + b"\x7f"
+_PAGE_BREAK = None
+
+
+def _width_table(font: str) -> List[int]:
+    """Widths of the 256 Windows-1252 codes."""
+    if font == "courier":
+        return [COURIER_WIDTH] * 256
+    ascii_widths = _ASCII_WIDTHS[font]
+    widths = [max(ascii_widths)] * 256
+    widths[32:127] = ascii_widths
+    for code in range(128, 256):
+        try:
+            char = bytes([code]).decode("cp1252")
+        except UnicodeDecodeError:
+            continue
+        # Accented letters are as wide as their base letter; the rest is
+        # an upper bound, wrapping a little early is harmless
+        base = unicodedata.normalize("NFKD", char)[:1]
+        if base and 32 <= ord(base) < 127:
+            widths[code] = widths[ord(base)]
+    return widths
+
+
+def detect_encoding(path: str) -> str:
+    """Byte order mark, else UTF-8 if the start of the file is valid UTF-8, else Windows-1252."""
+    with open(path, "rb") as f:
+        head = f.read(SNIFF_BYTES)
+    for bom, encoding in ((codecs.BOM_UTF32_LE, "utf-32"), (codecs.BOM_UTF32_BE, "utf-32"),
+                          (codecs.BOM_UTF8, "utf-8-sig"), (codecs.BOM_UTF16_LE, "utf-16"),
+                          (codecs.BOM_UTF16_BE, "utf-16")):
+        if head.startswith(bom):
+            return encoding
+    try:
+        # Not final, the sample may end in the middle of a character
+        codecs.getincrementaldecoder("utf-8")().decode(head, final=False)
+    except UnicodeDecodeError:
+        return "cp1252"
+    return "utf-8"
+
+
+def validate_text_pdf_options(font: str = "courier", font_size: float = 10, page_size: str = "A4",
+                              landscape: bool = False, margin: float = 15, wrap: bool = True,
+                              encoding: str = "") -> dict:
+    font = str(font).strip().lower()
+    if font not in FONTS:
+        raise HTTPException(status_code=400, detail=f"Font must be one of {list(FONTS)}")
+    page_size = str(page_size).strip().upper()
+    if page_size not in PAGE_SIZES:
+        raise HTTPException(status_code=400, detail=f"Page size must be one of {list(PAGE_SIZES)}")
+    try:
+        font_size, margin = float(font_size), float(margin)
+    except (TypeError, ValueError):
+        raise HTTPException(status_code=400, detail="Font size and margin must be numbers.")
+    if not 4 <= font_size <= 72:
+        raise HTTPException(status_code=400, detail="Font size must be between 4 and 72 points.")
+    if not 0 <= margin <= 50:
+        raise HTTPException(status_code=400, detail="Margin must be between 0 and 50 mm.")
+    width, height = PAGE_SIZES[page_size]
+    if min(width, height) - 2 * margin * MM < 4 * font_size:
+        raise HTTPException(status_code=400, detail="The margins leave no room for text.")
+    encoding = (encoding or "").strip().lower()
+    if encoding:
+        try:
+            encoding = codecs.lookup(encoding).name
+        except LookupError:
+            raise HTTPException(status_code=400, detail=f"Unknown encoding: {encoding!r}")
+    return {"font": font, "font_size": font_size, "page_size": page_size, "landscape": bool(landscape),
+            "margin": margin, "wrap": bool(wrap), "encoding": encoding}
+
+
+def _lines(path: str, encoding: str) -> Iterator[Tuple[Optional[bytes], bool]]:
+    """
+    Windows-1252 encoded lines as (piece, whether it ends the line): longer
+    lines come in several pieces. (_PAGE_BREAK, True) for form feeds, which
+    end the line before them.
+    """
+    column = 0
+    started = False
+
+    def encode(part: str) -> bytes:
+        nonlocal column
+        # Tab stops count from the start of the line, not of the piece
+        pad = column % TAB_SIZE
+        part = (" " * pad + part).expandtabs(TAB_SIZE)[pad:]
+        column += len(part)
+        return part.encode("cp1252", "replace").translate(None, _CONTROL)
+
+    with open(path, encoding=encoding, errors="replace", newline=None) as f:
+        while True:
+            piece = f.readline(READ_CHARS)
+            if not piece:
+                if started:
+                    yield b"", True
+                return
+            complete = piece.endswith("\n")
+            parts = (piece[:-1] if complete else piece).split("\f")
+            for i, part in enumerate(parts):
+                if i:
+                    yield _PAGE_BREAK, True
+                ends = complete or i < len(parts) - 1
+                if not ends:
+                    if part:
+                        yield encode(part), False
+                        started = True
+                elif part or started or len(parts) == 1:
+                    yield encode(part), True
+                if ends:
+                    column, started = 0, False
+
+
+def _fit(data: bytes, widths: List[int], widest: int, limit: float, wrap: bool,
+         final: bool = True) -> Iterator[bytes]:
+    """
+    Splits a line into pieces no wider than limit (1/1000 em), at spaces
+    where possible. Unless final, more of the line follows and the last
+    piece is what is left to continue (possibly nothing).
+    """
+    if len(data) * widest <= limit:
+        # Fits whatever the characters are, the common case
+        yield data
+        return
+    ends = list(accumulate(map(widths.__getitem__, data)))
+    if ends[-1] <= limit:
+        yield data
+        return
+    start, offset = 0, 0
+    while start < len(data):
+        end = bisect_right(ends, offset + limit)
+        if end >= len(data):
+            yield data[start:]
+            return
+        if not wrap:
+            yield data[start:end]
+            return
+        cut = data.rfind(b" ", start, end + 1)
+        if cut <= start:
+            # A word longer than the line is broken anywhere
+            cut = max(end, start + 1)
+            next_start = cut
+        else:
+            next_start = cut + 1
+        yield data[start:cut]
+        start = next_start
+        offset = ends[start - 1]
+    if not final:
+        yield b""
+
+
+class _PdfFile:
+    """Objects written in order as they are produced, the xref at the end."""
+    def __init__(self, f):
+        self.f = f
+        self.offsets = array("Q", [0])
+        f.write(b"%PDF-1.4\n%\xe2\xe3\xcf\xd3\n")
+
+    def reserve(self) -> int:
+        self.offsets.append(0)
+        return len(self.offsets) - 1
+
+    def write(self, number: int, body: bytes):
+        self.offsets[number] = self.f.tell()
+        self.f.write(b"%d 0 obj\n" % number + body + b"\nendobj\n")
+
+    def write_stream(self, number: int, data: bytes):
+        data = zlib.compress(data, 6)
+        self.write(number, b"<< /Length %d /Filter /FlateDecode >>\nstream\n" % len(data) + data + b"\nendstream")
+
+    def finish(self, root: int):
+        xref = self.f.tell()
+        self.f.write(b"xref\n0 %d\n0000000000 65535 f \n" % len(self.offsets))
+        for offset in self.offsets[1:]:
+            self.f.write(b"%010d 00000 n \n" % offset)
+        self.f.write(b"trailer\n<< /Size %d /Root %d 0 R >>\nstartxref\n%d\n%%%%EOF\n"
+                     % (len(self.offsets), root, xref))
+
+
+class _PageTree:
+    def __init__(self, pdf: _PdfFile, root: int):
+        self.pdf = pdf
+        self.root = root
+        self.nodes = array("Q")
+        self.kids: List[int] = []
+        self.count = 0
+
+    def add(self, content: bytes):
+        if not self.nodes or len(self.kids) == PAGES_PER_NODE:
+            self._close_node()
+            self.nodes.append(self.pdf.reserve())
+        contents, page = self.pdf.reserve(), self.pdf.reserve()
+        self.pdf.write_stream(contents, content)
+        self.pdf.write(page, b"<< /Type /Page /Parent %d 0 R /Contents %d 0 R >>" % (self.nodes[-1], contents))
+        self.kids.append(page)
+        self.count += 1
+
+    def _close_node(self):
+        if self.kids:
+            self.pdf.write(self.nodes[-1], b"<< /Type /Pages /Parent %d 0 R /Kids [%s] /Count %d >>" % (
+                self.root, b" ".join(b"%d 0 R" % kid for kid in self.kids), len(self.kids)))
+            self.kids = []
+
+    def finish(self, inherited: bytes):
+        self._close_node()
+        self.pdf.write(self.root, b"<< /Type /Pages /Kids [%s] /Count %d %s >>" % (
+            b" ".join(b"%d 0 R" % node for node in self.nodes), self.count, inherited))
+
+
+def _escape(data: bytes) -> bytes:
+    return data.replace(b"\\", b"\\\\").replace(b"(", b"\\(").replace(b")", b"\\)")
+
+
+def render_text_pdf(input_path: str, output_path: str, font: str = "courier", font_size: float = 10,
+                    page_size: str = "A4", landscape: bool = False, margin: float = 15, wrap: bool = True,
+                    encoding: str = "") -> int:
+    """
+    Lays out the text file at input_path (options as validated by
+    validate_text_pdf_options, margin in mm) and writes the PDF to
+    output_path. Returns the number of pages.
+    """
+    width, height = PAGE_SIZES[page_size]
+    if landscape:
+        width, height = height, width
+    margin_pt = margin * MM
+    leading = font_size * LINE_SPACING
+    lines_per_page = max(1, int((height - 2 * margin_pt) // leading))
+    widths = _width_table(font)
+    widest = max(widths)
+    limit = (width - 2 * margin_pt) * 1000 / font_size
+    # First baseline one leading below the top margin, each ' moves down
+    start = b"BT /F1 %.2f Tf %.2f TL %.2f %.2f Td\n" % (font_size, leading, margin_pt, height - margin_pt)
+
+    with open(output_path, "wb") as f:
+        pdf = _PdfFile(f)
+        catalog, pages_root, font_ref = pdf.reserve(), pdf.reserve(), pdf.reserve()
+        tree = _PageTree(pdf, pages_root)
+        page: List[bytes] = []
+
+        def flush():
+            tree.add(start + b"".join(b"(%s)'\n" % _escape(line) for line in page) + b"ET")
+            page.clear()
+
+        line = b""
+        # The rest of a line that was cut off (without wrap)
+        skip = False
+        for data, complete in _lines(input_path, encoding or detect_encoding(input_path)):
+            if data is _PAGE_BREAK:
+                if page:
+                    flush()
+                continue
+            if skip:
+                skip = not complete
+                continue
+            data, line = line + data, b""
+            pieces = list(_fit(data, widths, widest, limit, wrap, complete))
+            if not complete:
+                # More of the line follows, its last piece may still grow
+                if wrap or len(pieces[0]) == len(data):
+                    line = pieces.pop()
+                else:
+                    skip = True
+            for piece in pieces:
+                if len(page) == lines_per_page:
+                    flush()
+                page.append(piece)
+        if page or not tree.count:
+            flush()
+
+        pdf.write(font_ref, b"<< /Type /Font /Subtype /Type1 /BaseFont /%s /Encoding /WinAnsiEncoding >>"
+                  % FONTS[font].encode())
+        tree.finish(b"/MediaBox [0 0 %d %d] /Resources << /Font << /F1 %d 0 R >> >>" % (width, height, font_ref))
+        pdf.write(catalog, b"<< /Type /Catalog /Pages %d 0 R >>" % pages_root)
+        pdf.finish(catalog)
+    return tree.count
@@ -1,23 +1,83 @@
 import os
+import re
 import subprocess
 import uuid
 import shutil
-from typing import List
-from fastapi import UploadFile
-import PyPDF2
-from PIL import Image
-import img2pdf
-import pdf2image
+import asyncio
+import contextvars
+import functools
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+import hashlib
+import json
+import logging
+import time
+from collections import OrderedDict
+from typing import List, NamedTuple, Optional
+from fastapi import UploadFile, HTTPException, Request
+import aiofiles
+from python_multipart.multipart import MultipartParser, parse_options_header
 
 # Configuration
 import tempfile
-import os
+from config import (
+    CPU_WORKERS,
+    IO_WORKERS,
+    LIBREOFFICE_TIMEOUT,
+    LIBREOFFICE_BATCH_SIZE,
+    LIBREOFFICE_BATCH_TIMEOUT,
+    UPLOAD_CHUNK_SIZE,
+    MAX_REQUEST_BYTES,
+    PDF_RENDER_THREADS,
+    PDF_RENDER_CHUNK_PAGES,
+    CACHE_DIR,
+    JOBS_DIR,
+    UPLOAD_DIR,
+    OUTPUT_DIR,
+    TEXT_PDF_ENGINE,
+    XLSX_PREFLIGHT,
+    XLSX_FIT_TO_WIDTH,
+    XLSX_MAX_CELLS,
+    XLSX_MAX_PAGES,
+    XLSX_OVER_BUDGET,
+    LIGHT_LANE_CONCURRENCY,
+    HEAVY_LANE_CONCURRENCY,
+    max_upload_bytes,
+)
+import metrics
+from metrics import record_stage, set_operation
+from downloads import DownloadResponse, ZipStreamingResponse, content_disposition, strong_etag
+from scheduler import HEAVY, LIGHT, acquire_operation_slot, current_lane, operation_slot, note_input
+from storage import Scratch, request_scratch, upload_size, check_capacity, temp_roots
+from lazy import LazyModule, HEAVY_MODULES, import_modules
+from presets import (
+    COMPRESSION_PRESETS,
+    DEFAULT_COMPRESSION_PRESET,
+    IMAGE_PDF_PRESETS,
+    DEFAULT_IMAGE_PDF_PRESET,
+    ENCODER_PRESETS,
+    DEFAULT_ENCODER_PRESET,
+)
+from pageplan import compile_page_plan, validate_organize_options, validate_page_numbers
+from textpdf import render_text_pdf, validate_text_pdf_options
+from cache import cached_call, cache_lookup, get_cache, link_or_copy
+from documents import StoredDocument, require_document, link_document, create_document
+
+# Imported on first use (see lazy.py)
+PyPDF2 = LazyModule("PyPDF2")
+Image = LazyModule("PIL.Image")
+pdf2image = LazyModule("pdf2image")
+merging = LazyModule("merging")
+imaging = LazyModule("imaging")
+pdfinfo = LazyModule("pdfinfo")
+compression = LazyModule("compression")
+xlsxprep = LazyModule("xlsxprep")
+
+logger = logging.getLogger(__name__)
 
-UPLOAD_DIR = os.path.join(tempfile.gettempdir(), "uploads")
-OUTPUT_DIR = os.path.join(tempfile.gettempdir(), "outputs")
 def get_libreoffice_command():
-    import platform
-    if platform.system() == "Windows":
+    if os.name == "nt":
         # Common installation paths for LibreOffice on Windows
         possible_paths = [
             r"C:\Program Files\LibreOffice\program\soffice.exe",
@@ -33,8 +93,11 @@ def get_libreoffice_command():
 
 LIBREOFFICE_CMD = get_libreoffice_command()
 
-os.makedirs(UPLOAD_DIR, exist_ok=True)
-os.makedirs(OUTPUT_DIR, exist_ok=True)
+IMAGE_FORMATS = ['JPEG', 'PNG', 'WEBP', 'BMP', 'GIF']
+
+def get_libreoffice_pool():
+    import libreoffice_pool
+    return libreoffice_pool.get_pool(LIBREOFFICE_CMD)
 
 def generate_unique_filename(original_filename: str) -> str:
     ext = os.path.splitext(original_filename)[1]
@@ -47,196 +110,1523 @@ def clean_filename_base(filename: str) -> str:
     base = os.path.splitext(filename)[0]
     return base.lower().strip().replace(" ", "-")
 
-async def save_upload_file(upload_file: UploadFile) -> str:
-    filename = generate_unique_filename(upload_file.filename)
-    file_path = os.path.join(UPLOAD_DIR, filename)
-    with open(file_path, "wb") as buffer:
-        shutil.copyfileobj(upload_file.file, buffer)
-    return file_path
+# Upload kinds, checked against the first chunk of the upload
+KINDS_PDF = ("pdf",)
+KINDS_IMAGE = ("image",)
+KINDS_OFFICE = ("ooxml", "ole")
+KINDS_TEXT = ("text",)
 
-def convert_to_pdf_libreoffice(input_path: str) -> str:
+IMAGE_SIGNATURES = [
+    b"\xff\xd8\xff",                 # JPEG
+    b"\x89PNG\r\n\x1a\n",            # PNG
+    b"GIF87a", b"GIF89a",
+    b"BM",
+    b"II*\x00", b"MM\x00*",            # TIFF
+]
+
+def sniff_kind(head: bytes) -> Optional[str]:
     """
-    Converts docx, xlsx, pptx to PDF using LibreOffice.
-    Returns the path to the generated PDF.
+    Returns the kind of file from its first bytes, or None if unknown.
+    """
+    # The spec allows junk before the header, readers look at the first 1KB
+    if b"%PDF-" in head[:1024]:
+        return "pdf"
+    if any(head.startswith(sig) for sig in IMAGE_SIGNATURES):
+        return "image"
+    if head.startswith(b"RIFF") and head[8:12] == b"WEBP":
+        return "image"
+    if head.startswith(b"PK\x03\x04"):
+        return "ooxml"
+    if head.startswith(b"\xd0\xcf\x11\xe0\xa1\xb1\x1a\xe1"):
+        return "ole"
+    if head.startswith((b"\xef\xbb\xbf", b"\xff\xfe", b"\xfe\xff")) or b"\x00" not in head:
+        return "text"
+    return None
+
+class UploadBudget:
+    """
+    Byte budget shared by all files of one request.
+    """
+    def __init__(self, max_bytes: int = MAX_REQUEST_BYTES):
+        self.max_bytes = max_bytes
+        self.used = 0
+
+    def consume(self, n: int):
+        self.used += n
+        if self.used > self.max_bytes:
+            raise HTTPException(status_code=413, detail=f"Request exceeds the upload limit of {self.max_bytes} bytes.")
+
+class SavedUpload(NamedTuple):
+    path: str
+    size: int
+    sha256: str
+    kind: Optional[str]
+
+class _UploadWriter:
+    """
+    Writes one upload to disk chunk by chunk: the start of the file is
+    sniffed against `kinds` before anything is written, size limits abort
+    mid-stream, and the SHA-256 of the content is computed along the way.
+    """
+    SNIFF_BYTES = 1024
+
+    def __init__(self, filename: str, kinds=None, operation: str = None,
+                 budget: UploadBudget = None, directory: str = UPLOAD_DIR, content_type: str = None):
+        self.filename = filename
+        self.content_type = content_type
+        self.kinds = kinds
+        self.budget = budget
+        self.max_bytes = max_upload_bytes(operation)
+        self.path = os.path.join(directory, generate_unique_filename(filename or ""))
+        self.digest = hashlib.sha256()
+        self.size = 0
+        self.kind = None
+        self._head = b""
+        self._file = None
+
+    async def open(self):
+        self._file = await aiofiles.open(self.path, "wb")
+
+    def _sniff(self, head: bytes):
+        self.kind = sniff_kind(head)
+        if self.kinds and self.kind not in self.kinds:
+            raise HTTPException(
+                status_code=415,
+                detail=f"File {self.filename} content does not match the expected type."
+            )
+
+    async def write(self, chunk: bytes):
+        if not chunk:
+            return
+        self.size += len(chunk)
+        if self.size > self.max_bytes:
+            raise HTTPException(
+                status_code=413,
+                detail=f"File {self.filename} exceeds the upload limit of {self.max_bytes} bytes."
+            )
+        if self.budget is not None:
+            self.budget.consume(len(chunk))
+        self.digest.update(chunk)
+        if self._head is not None:
+            # Hold back the start of the file until there is enough to sniff
+            self._head += chunk
+            if len(self._head) < self.SNIFF_BYTES:
+                return
+            self._sniff(self._head)
+            chunk, self._head = self._head, None
+        await self._file.write(chunk)
+
+    async def close(self) -> SavedUpload:
+        if self._head is not None:
+            if self._head:
+                self._sniff(self._head)
+                await self._file.write(self._head)
+            self._head = None
+        await self._file.close()
+        if self.size == 0 and self.kinds:
+            raise HTTPException(status_code=400, detail=f"File {self.filename} is empty.")
+        note_input(self.path)
+        return SavedUpload(self.path, self.size, self.digest.hexdigest(), self.kind)
+
+    async def abort(self):
+        if self._file is not None:
+            await self._file.close()
+        cleanup_files([self.path])
+
+async def ingest_upload(upload_file: UploadFile, kinds=None, operation: str = None,
+                        budget: UploadBudget = None, directory: str = UPLOAD_DIR) -> SavedUpload:
+    """
+    Copies an upload into `directory` in chunks without blocking the event
+    loop, checking its type, the size limits and computing its SHA-256 on
+    the way. Starlette has already spooled an UploadFile in full by the
+    time the route runs (bounded only by RequestSizeLimitMiddleware), so a
+    file failing the checks was received, just not processed; only
+    iter_multipart checks files while they arrive.
+    """
+    if isinstance(upload_file, StoredDocument):
+        return await _ingest_document(upload_file, kinds, operation, directory)
+    writer = _UploadWriter(upload_file.filename, kinds, operation, budget, directory)
+    started = time.perf_counter()
+    try:
+        await writer.open()
+        while True:
+            chunk = await upload_file.read(UPLOAD_CHUNK_SIZE)
+            if not chunk:
+                break
+            await writer.write(chunk)
+        return await writer.close()
+    except BaseException:
+        await writer.abort()
+        raise
+    finally:
+        set_operation(operation or "upload")
+        record_stage(operation or "upload", "upload", time.perf_counter() - started)
+
+async def _ingest_document(doc: StoredDocument, kinds=None, operation: str = None,
+                           directory: str = UPLOAD_DIR) -> SavedUpload:
+    # Checked like an upload, then linked instead of copied
+    set_operation(operation or "upload")
+    if kinds and doc.kind not in kinds:
+        raise HTTPException(status_code=415, detail=f"File {doc.filename} content does not match the expected type.")
+    max_bytes = max_upload_bytes(operation)
+    if doc.size > max_bytes:
+        raise HTTPException(status_code=413, detail=f"File {doc.filename} exceeds the upload limit of {max_bytes} bytes.")
+    path = await asyncio.to_thread(link_document, doc, directory)
+    note_input(path)
+    return SavedUpload(path, doc.size, doc.sha256, doc.kind)
+
+def _describe_file(path: str):
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        head = f.read(_UploadWriter.SNIFF_BYTES)
+        digest.update(head)
+        for chunk in iter(lambda: f.read(UPLOAD_CHUNK_SIZE), b""):
+            digest.update(chunk)
+    return os.path.getsize(path), digest.hexdigest(), sniff_kind(head)
+
+async def keep_document(path: str, filename: str, content_type: str) -> StoredDocument:
+    """Stores a copy of a result (e.g. a response still to be sent) as a document."""
+    copy = os.path.join(os.path.dirname(path), f"keep_{uuid.uuid4().hex}")
+    await asyncio.to_thread(link_or_copy, path, copy)
+    try:
+        size, sha256, kind = await asyncio.to_thread(_describe_file, copy)
+        return await asyncio.to_thread(create_document, copy, filename, content_type, size, sha256, kind)
+    except BaseException:
+        cleanup_files([copy])
+        raise
+
+async def resolve_inputs(files: Optional[List[UploadFile]], document_ids: Optional[List[str]]) -> list:
     """
+    The uploaded files followed by the documents referenced by id. Both
+    kinds have filename, content_type and size and go through ingest_upload.
+    """
+    sources = [f for f in files or [] if f is not None]
+    for doc_id in document_ids or []:
+        sources.append(await asyncio.to_thread(require_document, doc_id))
+    if not sources:
+        raise HTTPException(status_code=400, detail="Upload a file or pass a document id.")
+    return sources
+
+async def resolve_input(file: Optional[UploadFile], document: Optional[str]):
+    if file is not None and document:
+        raise HTTPException(status_code=400, detail="Send either a file or a document id, not both.")
+    sources = await resolve_inputs([file], [document] if document else None)
+    return sources[0]
+
+async def save_upload_file(upload_file: UploadFile, directory: str = UPLOAD_DIR, kinds=None,
+                           operation: str = None, budget: UploadBudget = None) -> str:
+    saved = await ingest_upload(upload_file, kinds=kinds, operation=operation, budget=budget, directory=directory)
+    return saved.path
+
+class MultipartFile(NamedTuple):
+    field: str
+    filename: str
+    content_type: Optional[str]
+    saved: SavedUpload
+
+class MultipartField(NamedTuple):
+    field: str
+    value: str
+
+MAX_FORM_FIELD_BYTES = 64 * 1024
+
+async def iter_multipart(request: Request, kinds=None, operation: str = None,
+                         budget: UploadBudget = None, directory: str = UPLOAD_DIR):
+    """
+    Parses a multipart/form-data body while it is being received and yields
+    a MultipartField or MultipartFile as soon as each part is complete, so
+    work on the first file can start while later ones are still uploading.
+    Files get the same checks as ingest_upload. Files already yielded belong
+    to the caller; a partially written one is removed on errors.
+    """
+    content_type, options = parse_options_header(request.headers.get("content-type", ""))
+    boundary = options.get(b"boundary")
+    if content_type != b"multipart/form-data" or not boundary:
+        raise HTTPException(status_code=400, detail="Expected a multipart/form-data request.")
+
+    events = []
+    header = {"field": b"", "value": b""}
+    headers = {}
+
+    def on_header_field(data, start, end):
+        header["field"] += data[start:end]
+
+    def on_header_value(data, start, end):
+        header["value"] += data[start:end]
+
+    def on_header_end():
+        headers[header["field"].lower()] = header["value"]
+        header["field"] = header["value"] = b""
+
+    def on_headers_finished():
+        events.append(("headers", dict(headers)))
+        headers.clear()
+
+    def on_part_data(data, start, end):
+        events.append(("data", bytes(data[start:end])))
+
+    def on_part_end():
+        events.append(("end", None))
+
+    parser = MultipartParser(boundary, {
+        "on_header_field": on_header_field,
+        "on_header_value": on_header_value,
+        "on_header_end": on_header_end,
+        "on_headers_finished": on_headers_finished,
+        "on_part_data": on_part_data,
+        "on_part_end": on_part_end,
+    })
+
+    writer = None
+    name = None
+    value = b""
+    started = time.perf_counter()
+    set_operation(operation or "upload")
+    try:
+        async for chunk in request.stream():
+            try:
+                parser.write(chunk)
+            except Exception as e:
+                raise HTTPException(status_code=400, detail=f"Malformed multipart body: {e}")
+            pending, events = events, []
+            for event, data in pending:
+                if event == "headers":
+                    _, disposition = parse_options_header(data.get(b"content-disposition", b""))
+                    name = disposition.get(b"name", b"").decode("utf-8", "replace")
+                    filename = disposition.get(b"filename")
+                    value = b""
+                    if filename is not None:
+                        filename = filename.decode("utf-8", "replace")
+                        part_type = data.get(b"content-type")
+                        writer = _UploadWriter(filename, kinds, operation, budget, directory,
+                                               part_type.decode("latin-1") if part_type else None)
+                        await writer.open()
+                elif event == "data":
+                    if writer is not None:
+                        await writer.write(data)
+                    else:
+                        value += data
+                        if len(value) > MAX_FORM_FIELD_BYTES:
+                            raise HTTPException(status_code=413, detail=f"Form field {name} is too large.")
+                elif writer is not None:
+                    saved = await writer.close()
+                    part = MultipartFile(name, writer.filename, writer.content_type, saved)
+                    writer = None
+                    yield part
+                else:
+                    yield MultipartField(name, value.decode("utf-8", "replace"))
+        parser.finalize()
+        # Overlaps with the processing of earlier files
+        record_stage(operation or "upload", "upload", time.perf_counter() - started)
+    except BaseException:
+        if writer is not None:
+            await writer.abort()
+        raise
+
+class ConversionResult(NamedTuple):
+    input_path: str
+    output_path: Optional[str]
+    error: Optional[str]
+
+def _expected_pdf_path(input_path: str, output_dir: str) -> str:
+    # LibreOffice saves the file with the same basename in output dir
+    filename_no_ext = os.path.splitext(os.path.basename(input_path))[0]
+    return os.path.join(output_dir, f"{filename_no_ext}.pdf")
+
+def convert_many_to_pdf_libreoffice(input_paths: List[str], output_dir: str = OUTPUT_DIR,
+                                    timeout: float = None) -> List[ConversionResult]:
+    """
+    Converts a group of documents with a single LibreOffice invocation
+    (`--convert-to pdf` takes any number of inputs, the pool converts them
+    back to back on one instance). Returns one result per input, in order;
+    a document that fails has its error set instead of raising. If the
+    invocation as a whole fails (crash, timeout) the documents without
+    output are retried one by one, so one bad file can't fail the group.
+    """
+    from libreoffice_pool import LibreOfficeTimeout, one_shot_profile
+
     # Ensure absolute paths
-    input_path = os.path.abspath(input_path)
-    output_temp_dir = os.path.abspath(OUTPUT_DIR)
+    input_paths = [os.path.abspath(path) for path in input_paths]
+    output_dir = os.path.abspath(output_dir)
+    timeout = timeout or (LIBREOFFICE_TIMEOUT if len(input_paths) == 1 else LIBREOFFICE_BATCH_TIMEOUT)
+
+    failed = {}
+    group_error = None
+    missing = [path for path in input_paths if not os.path.exists(path)]
+    for path in missing:
+        failed[path] = f"Input file not found: {path}"
+    todo = [path for path in input_paths if path not in failed]
+
+    # Prefer a warm instance from the pool; the one-off process below is the
+    # fallback when the pool is disabled or LibreOffice is missing.
+    pool = get_libreoffice_pool()
+    started = time.perf_counter()
+    failure = None
+    try:
+        if not todo:
+            pass
+        elif pool is not None:
+            failed.update(pool.convert_many(todo, output_dir, timeout))
+        else:
+            # Check if LibreOffice executable exists before running
+            # (This avoids a confusing FileNotFoundError from subprocess if the binary is missing)
+            if os.path.isabs(LIBREOFFICE_CMD) and not os.path.exists(LIBREOFFICE_CMD):
+                raise Exception(f"LibreOffice executable not found at: {LIBREOFFICE_CMD}")
+            with one_shot_profile() as profile:
+                cmd = [LIBREOFFICE_CMD, profile, "--headless", "--convert-to", "pdf", "--outdir", output_dir] + todo
+                result = subprocess.run(cmd, check=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+                                        timeout=timeout)
+            details = f"stdout: {result.stdout.decode(errors='replace')}\nstderr: {result.stderr.decode(errors='replace')}"
+            for path in todo:
+                if not os.path.exists(_expected_pdf_path(path, output_dir)):
+                    failed.setdefault(path, f"Output PDF not found after conversion.\n{details}")
+    except subprocess.CalledProcessError as e:
+        error_msg = e.stderr.decode(errors="replace") if e.stderr else "Unknown error"
+        group_error = f"LibreOffice conversion failed with error: {error_msg}"
+        failure = "error"
+    except (subprocess.TimeoutExpired, LibreOfficeTimeout):
+        group_error = f"Conversion timed out after {timeout:.0f}s"
+        failure = "timeout"
+    except FileNotFoundError as e:
+        # No LibreOffice at all, retrying one by one won't help
+        group_error = f"LibreOffice executable not found: {e}"
+        todo = todo[:1]
+        failure = "missing"
+    except Exception as e:
+        group_error = str(e)
+        failure = "error"
+    if todo:
+        metrics.LIBREOFFICE_DURATION.observe(
+            time.perf_counter() - started, mode="pool" if pool is not None else "subprocess"
+        )
+    if failure:
+        metrics.LIBREOFFICE_FAILURES.inc(reason=failure)
 
+    results = []
+    for path in input_paths:
+        output_path = _expected_pdf_path(path, output_dir)
+        if path not in failed and os.path.exists(output_path):
+            results.append(ConversionResult(path, output_path, None))
+        elif path not in failed and group_error and len(todo) > 1:
+            results.extend(convert_many_to_pdf_libreoffice([path], output_dir))
+        else:
+            error = failed.get(path) or group_error or "LibreOffice could not convert this document."
+            logger.warning("LibreOffice conversion failed", extra={"file": os.path.basename(path), "error": error})
+            if not group_error:
+                metrics.LIBREOFFICE_FAILURES.inc(reason="document")
+            results.append(ConversionResult(path, None, error))
+    return results
+
+def convert_to_pdf_libreoffice(input_path: str, output_dir: str = OUTPUT_DIR) -> str:
+    """
+    Converts docx, xlsx, pptx to PDF using LibreOffice.
+    Returns the path to the generated PDF.
+    """
     if not os.path.exists(input_path):
         raise FileNotFoundError(f"Input file not found: {input_path}")
+    result = convert_many_to_pdf_libreoffice([input_path], output_dir)[0]
+    if result.error:
+        raise Exception(result.error)
+    return result.output_path
 
-    cmd = [
-        LIBREOFFICE_CMD,
-        "--headless",
-        "--convert-to",
-        "pdf",
-        "--outdir",
-        output_temp_dir,
-        input_path
-    ]
-    
-    # print(f"Executing command: {' '.join(cmd)}")  # Debug logging
-
-    try:
-        # Check if LibreOffice executable exists before running
-        # (This avoids a confusing FileNotFoundError from subprocess if the binary is missing)
-        # Note: If LIBREOFFICE_CMD is just 'soffice', shutil.which can check it.
-        if os.path.isabs(LIBREOFFICE_CMD) and not os.path.exists(LIBREOFFICE_CMD):
-             raise Exception(f"LibreOffice executable not found at: {LIBREOFFICE_CMD}")
-
-        result = subprocess.run(cmd, check=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-        
-        # LibreOffice saves the file with the same basename in output dir
-        basename = os.path.basename(input_path)
-        filename_no_ext = os.path.splitext(basename)[0]
-        output_path = os.path.join(output_temp_dir, f"{filename_no_ext}.pdf")
-        
-        if not os.path.exists(output_path):
-            # Sometimes LibreOffice might output with a different name or fail silently.
-            # Check for any PDF created recently? No, let's trust the name.
-            raise Exception(f"Output PDF not found at {output_path} after conversion.\nscostdout: {result.stdout.decode()}\nstderr: {result.stderr.decode()}")
-            
-        return output_path
-    except subprocess.CalledProcessError as e:
-        error_msg = e.stderr.decode() if e.stderr else "Unknown error"
-        print(f"LibreOffice conversion failed: {error_msg}")
-        raise Exception(f"LibreOffice conversion failed with error: {error_msg}")
+def excel_preflight_options() -> Optional[dict]:
+    """Options of prepare_workbook, None when the preflight is disabled."""
+    if not XLSX_PREFLIGHT:
+        return None
+    return {"max_cells": XLSX_MAX_CELLS, "max_pages": XLSX_MAX_PAGES,
+            "truncate": XLSX_OVER_BUDGET == "truncate", "fit_to_width": XLSX_FIT_TO_WIDTH}
+
+def prepare_workbook(input_path: str, output_dir: str = OUTPUT_DIR, **options) -> str:
+    """
+    XLSX preflight (see xlsxprep.py) with options from
+    excel_preflight_options. Returns the workbook to convert: a copy that
+    prints only the used ranges, or the input itself when it isn't an XLSX
+    file or can't be read. Raises WorkbookTooLarge above the budget.
+    """
+    import zipfile
+
+    if not zipfile.is_zipfile(input_path):
+        # .xls, or an encrypted workbook
+        return input_path
+    output_path = os.path.join(output_dir, f"workbook_{uuid.uuid4()}.xlsx")
+    try:
+        plans = xlsxprep.plan_workbook(input_path, **options)
+        xlsxprep.write_workbook(input_path, output_path, plans, options.get("fit_to_width", True))
+    except xlsxprep.WorkbookTooLarge:
+        raise
     except Exception as e:
-        print(f"Conversion error: {str(e)}")
-        raise e
+        # LibreOffice may still make sense of it
+        logger.warning("XLSX preflight failed, converting the workbook as it is", extra={"error": str(e)})
+        cleanup_files([output_path])
+        return input_path
+    logger.info("XLSX preflight", extra={
+        "sheets": len(plans),
+        "cells": sum(plan.rows * plan.columns for plan in plans),
+        "pages": sum(plan.pages for plan in plans),
+        "truncated": any(plan.truncated for plan in plans),
+    })
+    return output_path
 
-def merge_pdfs(file_paths: List[str]) -> str:
-    merger = PyPDF2.PdfMerger()
-    for path in file_paths:
-        merger.append(path)
-    
-    output_filename = f"merged_{uuid.uuid4()}.pdf"
-    output_path = os.path.join(OUTPUT_DIR, output_filename)
-    merger.write(output_path)
-    merger.close()
+TEXT_PDF_ENGINES = ("native", "libreoffice")
+
+def validate_text_pdf_engine(engine: Optional[str]) -> str:
+    engine = (engine or TEXT_PDF_ENGINE).strip().lower()
+    if engine not in TEXT_PDF_ENGINES:
+        raise HTTPException(status_code=400, detail=f"Engine must be one of {list(TEXT_PDF_ENGINES)}")
+    return engine
+
+def text_to_pdf(input_path: str, output_dir: str = OUTPUT_DIR, **options) -> str:
+    """
+    Lays out a plain text file without LibreOffice (see textpdf.py), with
+    options from validate_text_pdf_options. Returns the path to the PDF.
+    """
+    output_path = os.path.join(output_dir, f"text_{uuid.uuid4()}.pdf")
+    try:
+        render_text_pdf(input_path, output_path, **options)
+    except BaseException:
+        cleanup_files([output_path])
+        raise
     return output_path
 
-def split_pdf(file_path: str, output_dir: str = OUTPUT_DIR) -> List[str]:
-    # Returns a list of paths to the split files (or a zip? For now let's say we return a zip path ideally,
-    # but the requirement says "Split PDF". Usually this returns a ZIP of PDFs. 
-    # For simplicity in this function, let's just return the list of created files.)
-    # Actually, for the API, we probably want to return a ZIP file containing all pages.
-    
+class BatchItem(NamedTuple):
+    index: int         # position in the request
+    name: str          # original filename
+    input_path: str
+
+class BatchConversionFailed(Exception):
+    """Raised when no file of a batch could be converted."""
+    def __init__(self, manifest: List[dict]):
+        super().__init__("None of the files could be converted.")
+        self.manifest = manifest
+
+class BatchManifest:
+    """
+    Per-file results of a batch request, written as manifest.json at the
+    end of its ZIP. Outputs are named after the uploads with `extension`.
+    """
+    def __init__(self, extension: str):
+        self.extension = extension
+        self.entries: List[dict] = []
+        self.taken = set()
+        self.converted = 0
+
+    def add(self, index: int, name: str, output_path: Optional[str] = None, error: Optional[str] = None,
+            cached: bool = False) -> Optional[str]:
+        # Returns the name of the output in the ZIP
+        arcname = None
+        if output_path:
+            arcname = _unique_name(f"{clean_filename_base(name)}{self.extension}", self.taken)
+            self.converted += 1
+        self.entries.append({
+            "index": index,
+            "filename": name,
+            "status": "converted" if output_path else "failed",
+            "output": arcname,
+            "error": error,
+            "cached": cached,
+        })
+        return arcname
+
+    def write(self, output_dir: str) -> str:
+        self.entries.sort(key=lambda entry: entry["index"])
+        if not self.converted:
+            raise BatchConversionFailed(self.entries)
+        path = os.path.join(output_dir, "manifest.json")
+        with open(path, "w") as f:
+            json.dump({
+                "converted": self.converted,
+                "failed": len(self.entries) - self.converted,
+                "files": self.entries,
+            }, f, indent=2)
+        return path
+
+def _conversion_groups(items: list, workers: int, group_size: int):
+    # Small batches are spread over all instances, large ones go in groups
+    # of group_size
+    size = max(1, min(group_size, -(-len(items) // max(1, workers))))
+    return [items[i:i + size] for i in range(0, len(items), size)]
+
+def iter_convert_batch(items: List[BatchItem], output_dir: str, manifest: BatchManifest = None,
+                       cached: dict = None, store=None):
+    """
+    Converts documents to PDF in groups of LIBREOFFICE_BATCH_SIZE, one
+    LibreOffice invocation per group and one group per pool instance at a
+    time. Yields (arcname, pdf_path) for every converted document as its
+    group finishes and finally ("manifest.json", path) describing every
+    document, including the error for each one that failed.
+    `manifest` may already hold entries for files rejected before
+    conversion, `cached` maps input paths to PDFs from the result cache and
+    `store(input_path, pdf_path)` is called for every fresh conversion.
+    Raises BatchConversionFailed before yielding anything if nothing could
+    be converted.
+    """
+    manifest = manifest or BatchManifest(".pdf")
+    cached = cached or {}
+    pool = get_libreoffice_pool()
+    workers = pool.size if pool is not None else 1
+    todo = [item for item in items if item.input_path not in cached]
+    by_path = {item.input_path: item for item in todo}
+    groups = iter(_conversion_groups(todo, workers, LIBREOFFICE_BATCH_SIZE))
+    executor = get_thread_pool()
+    futures = []
+
+    def submit_next():
+        group = next(groups, None)
+        if group is not None:
+            # Every group gets its own directory, LibreOffice names outputs
+            # after the inputs
+            group_dir = tempfile.mkdtemp(prefix="batch_", dir=output_dir)
+            futures.append((group_dir, executor.submit(
+                convert_many_to_pdf_libreoffice, [item.input_path for item in group], group_dir
+            )))
+
+    try:
+        for item in items:
+            if item.input_path in cached:
+                path = cached[item.input_path]
+                yield manifest.add(item.index, item.name, path, cached=True), path
+
+        for _ in range(workers):
+            submit_next()
+        while futures:
+            group_dir, future = futures.pop(0)
+            results = future.result()
+            submit_next()
+            for result in results:
+                item = by_path[result.input_path]
+                if result.output_path and store is not None:
+                    store(result.input_path, result.output_path)
+                arcname = manifest.add(item.index, item.name, result.output_path, result.error)
+                if arcname:
+                    yield arcname, result.output_path
+            shutil.rmtree(group_dir, ignore_errors=True)
+        yield "manifest.json", manifest.write(output_dir)
+    finally:
+        for group_dir, future in futures:
+            future.cancel()
+            shutil.rmtree(group_dir, ignore_errors=True)
+
+def validate_merge_pages(pages) -> List[str]:
+    """
+    Per-input page selections for merge: a list (or its JSON text) with one
+    range spec like "1-3,7" per input, "" or null for all pages.
+    """
+    if pages is None or pages == "":
+        return []
+    if isinstance(pages, str):
+        try:
+            pages = json.loads(pages)
+        except ValueError:
+            pages = None
+    if not isinstance(pages, list) or not all(p is None or isinstance(p, str) for p in pages):
+        raise HTTPException(status_code=400, detail="Pages must be a JSON list with one page range per file, e.g. [\"1-3\", \"\"].")
+    return [p or "" for p in pages]
+
+def new_merge_output(output_dir: str = OUTPUT_DIR) -> str:
+    return os.path.join(output_dir, f"merged_{uuid.uuid4()}.pdf")
+
+def merge_pdfs(file_paths: List[str], pages: List[str] = None, output_dir: str = OUTPUT_DIR) -> str:
+    pages = pages or []
+    if len(pages) > len(file_paths):
+        raise ValueError("More page selections than files.")
+    merger = merging.IncrementalMerger(new_merge_output(output_dir))
+    try:
+        for i, path in enumerate(file_paths):
+            merger.add(path, pages[i] if i < len(pages) else None)
+        return merger.finish()
+    except BaseException:
+        cleanup_files([merger.output_path])
+        raise
+
+class SplitPart(NamedTuple):
+    name: str
+    pages: List[int]  # 1-based, in output order
+
+# Resource categories that content streams refer to by name
+RESOURCE_CATEGORIES = ("/Font", "/XObject", "/ExtGState", "/Pattern", "/Shading", "/ColorSpace", "/Properties")
+
+def validate_split_options(ranges: str = "", every: int = 0, bookmarks: bool = False,
+                           minimal_resources: bool = False) -> dict:
+    if not isinstance(ranges or "", str):
+        raise HTTPException(status_code=400, detail="Ranges must be a string like \"1-10,11-20\".")
+    ranges = (ranges or "").strip()
+    try:
+        every = int(every or 0)
+    except (TypeError, ValueError):
+        raise HTTPException(status_code=400, detail="Every must be an integer.")
+    if every < 0:
+        raise HTTPException(status_code=400, detail="Every must be a positive number of pages.")
+    if sum([bool(ranges), every > 0, bool(bookmarks)]) > 1:
+        raise HTTPException(status_code=400, detail="Use only one of ranges, every or bookmarks.")
+    return {"ranges": ranges, "every": every, "bookmarks": bool(bookmarks),
+            "minimal_resources": bool(minimal_resources)}
+
+def _unique_name(name: str, taken: set) -> str:
+    base, ext = os.path.splitext(name)
+    candidate, n = name, 1
+    while candidate in taken:
+        n += 1
+        candidate = f"{base}_{n}{ext}"
+    taken.add(candidate)
+    return candidate
+
+def _range_part_name(base_name: str, pages: List[int]) -> str:
+    if len(pages) == 1:
+        return f"{base_name}_page_{pages[0]}.pdf"
+    return f"{base_name}_pages_{pages[0]}-{pages[-1]}.pdf"
+
+def _outline_starts(reader: "PyPDF2.PdfReader"):
+    # Top level bookmarks only, nested lists are the children of an entry
+    starts = []
+    for item in reader.outline:
+        if isinstance(item, list):
+            continue
+        try:
+            page = reader.get_destination_page_number(item)
+        except Exception:
+            continue
+        if page is not None and page >= 0:
+            starts.append((str(item.title or ""), page + 1))
+    starts.sort(key=lambda start: start[1])
+    return starts
+
+def plan_split(file_path: str, ranges: str = "", every: int = 0, bookmarks: bool = False,
+               info: dict = None) -> List[SplitPart]:
+    """
+    Works out which pages go into which output file:
+    - ranges: one part per comma separated range, e.g. "1-10,11-20"
+    - every: consecutive parts of N pages
+    - bookmarks: one part per top level bookmark, up to the next one
+    - otherwise one part per page
+    Raises ValueError for ranges outside the document or a PDF without bookmarks.
+    With `info` (from get_pdf_info) the PDF isn't parsed again.
+    """
+    if info is not None and info["page_count"] is None:
+        # Password protected, let PyPDF2 report it
+        info = None
+    reader = None if info else PyPDF2.PdfReader(file_path)
+    total = info["page_count"] if info else len(reader.pages)
+    base_name = os.path.splitext(os.path.basename(file_path))[0]
+    taken = set()
+    parts = []
+
+    if ranges:
+        for item in ranges.split(","):
+            if item.strip():
+                pages = parse_page_ranges(item, total)
+                parts.append(SplitPart(_unique_name(_range_part_name(base_name, pages), taken), pages))
+        if not parts:
+            raise ValueError("Page selection is empty")
+    elif every:
+        for start in range(1, total + 1, every):
+            pages = list(range(start, min(start + every - 1, total) + 1))
+            parts.append(SplitPart(_range_part_name(base_name, pages), pages))
+    elif bookmarks:
+        starts = pdfinfo.outline_starts(info) if info else _outline_starts(reader)
+        if not starts:
+            raise ValueError("The PDF has no bookmarks to split by.")
+        if starts[0][1] > 1:
+            starts.insert(0, ("", 1))
+        for i, (title, start) in enumerate(starts):
+            end = starts[i + 1][1] - 1 if i + 1 < len(starts) else total
+            if end < start:
+                # Several bookmarks on one page, the last one gets the page
+                continue
+            label = re.sub(r"[^\w\-]+", "-", title.strip().lower()).strip("-")[:60] or "untitled"
+            name = _unique_name(f"{base_name}_{len(parts) + 1:02d}_{label}.pdf", taken)
+            parts.append(SplitPart(name, list(range(start, end + 1))))
+    else:
+        parts = [SplitPart(f"{base_name}_page_{n}.pdf", [n]) for n in range(1, total + 1)]
+    return parts
+
+def _used_resource_names(page: "PyPDF2.PageObject", pdf) -> Optional[set]:
+    content = page.get_contents()
+    if content is None:
+        return set()
+    try:
+        operations = PyPDF2.generic.ContentStream(content, pdf).operations
+    except Exception:
+        return None
+    names = set()
+    for operands, operator in operations:
+        if isinstance(operands, list):
+            names.update(o for o in operands if isinstance(o, PyPDF2.generic.NameObject))
+    return names
+
+def _minimal_page(reader: "PyPDF2.PdfReader", page: "PyPDF2.PageObject") -> "PyPDF2.PageObject":
+    """
+    Copy of page whose /Resources only lists what its content stream uses.
+    Office exports often attach one resource dictionary with every font and
+    image of the document to all pages, which a plain copy would carry into
+    every part.
+    """
+    used = _used_resource_names(page, reader)
+    if used is None or "/Resources" not in page:
+        return page
+    resources = page["/Resources"].get_object()
+    minimal = PyPDF2.generic.DictionaryObject()
+    for key, value in resources.items():
+        if key in RESOURCE_CATEGORIES:
+            category = value.get_object()
+            value = PyPDF2.generic.DictionaryObject(
+                (name, ref) for name, ref in category.items() if name in used
+            )
+        minimal[PyPDF2.generic.NameObject(key)] = value
+
+    copy = PyPDF2.PageObject(reader)
+    for key, value in page.items():
+        copy[PyPDF2.generic.NameObject(key)] = value
+    copy[PyPDF2.generic.NameObject("/Resources")] = minimal
+    return copy
+
+def write_split_parts(file_path: str, output_dir: str, parts: List[SplitPart], minimal_resources: bool = False,
+                      progress=None, done: int = 0, total: int = None) -> List[str]:
+    # The source is parsed lazily, only the objects of the requested pages are read
     reader = PyPDF2.PdfReader(file_path)
     created_files = []
-    base_name = os.path.splitext(os.path.basename(file_path))[0]
-    
-    for i, page in enumerate(reader.pages):
+    for part in parts:
         writer = PyPDF2.PdfWriter()
-        writer.add_page(page)
-        
-        out_filename = f"{base_name}_page_{i+1}.pdf"
-        out_path = os.path.join(output_dir, out_filename)
-        
+        for number in part.pages:
+            page = reader.pages[number - 1]
+            writer.add_page(_minimal_page(reader, page) if minimal_resources else page)
+
+        out_path = os.path.join(output_dir, part.name)
         with open(out_path, "wb") as f:
             writer.write(f)
         created_files.append(out_path)
-        
+        done += len(part.pages)
+        if progress:
+            progress(done, total)
     return created_files
 
-def compress_pdf(file_path: str) -> str:
-    reader = PyPDF2.PdfReader(file_path)
-    writer = PyPDF2.PdfWriter()
-    
-    for page in reader.pages:
-        page.compress_content_streams() # Basic compression
-        writer.add_page(page)
-    
-    # Enable compression in writer
-    for page in writer.pages:
-        page.compress_content_streams()
-        
+def split_pdf(file_path: str, output_dir: str = OUTPUT_DIR, progress=None, ranges: str = "", every: int = 0,
+              bookmarks: bool = False, minimal_resources: bool = False) -> List[str]:
+    # Returns a list of paths to the split files, one per page by default
+    parts = plan_split(file_path, ranges=ranges, every=every, bookmarks=bookmarks)
+    total = sum(len(part.pages) for part in parts)
+    return write_split_parts(file_path, output_dir, parts, minimal_resources, progress=progress, total=total)
+
+def _part_batches(parts: List[SplitPart], chunk_pages: int):
+    batch, pages = [], 0
+    for part in parts:
+        batch.append(part)
+        pages += len(part.pages)
+        if pages >= chunk_pages:
+            yield batch
+            batch, pages = [], 0
+    if batch:
+        yield batch
+
+def iter_split_pdf(file_path: str, output_dir: str, parts: List[SplitPart] = None,
+                   minimal_resources: bool = False, chunk_pages: int = 32):
+    """
+    Writes the parts in batches of about chunk_pages pages on the process
+    pool and yields the part paths in order as batches finish. Only a few
+    batches are in flight at a time, so parts don't pile up on disk ahead
+    of the consumer.
+    """
+    if parts is None:
+        parts = plan_split(file_path)
+    pool = get_process_pool()
+    window = max(2, CPU_WORKERS)
+    batches = _part_batches(parts, chunk_pages)
+    futures = []
+
+    def submit_next():
+        batch = next(batches, None)
+        if batch is not None:
+            futures.append(pool.submit(write_split_parts, file_path, output_dir, batch, minimal_resources))
+
+    try:
+        for _ in range(window):
+            submit_next()
+        while futures:
+            created = futures.pop(0).result()
+            submit_next()
+            for path in created:
+                yield path
+    finally:
+        for future in futures:
+            future.cancel()
+
+def validate_compression_preset(preset: str) -> str:
+    preset = str(preset).lower()
+    if preset not in COMPRESSION_PRESETS:
+        raise HTTPException(status_code=400, detail=f"Preset must be one of {list(COMPRESSION_PRESETS)}")
+    return preset
+
+def compress_pdf(file_path: str, preset: str = DEFAULT_COMPRESSION_PRESET, output_dir: str = OUTPUT_DIR,
+                 pages: List[int] = None) -> str:
     output_filename = f"compressed_{uuid.uuid4()}.pdf"
-    output_path = os.path.join(OUTPUT_DIR, output_filename)
-    
-    with open(output_path, "wb") as f:
-        writer.write(f)
-        
+    output_path = os.path.join(output_dir, output_filename)
+    compression.compress_document(file_path, output_path, preset, pages)
     return output_path
 
-def remove_pdf_pages(file_path: str, pages_to_remove: List[int]) -> str:
+def organize_pdf(file_path: str, pages: str = "", remove=(), rotate: int = 0, output_dir: str = OUTPUT_DIR,
+                 prefix: str = "organized") -> str:
+    """
+    Keeps, reorders, duplicates and rotates pages in one pass, see
+    pageplan.py for the expressions. Raises ValueError for pages outside
+    the document, empty results and password protected files.
+    """
+    plan = functools.partial(compile_page_plan, pages=pages, remove=remove, rotate=rotate)
+    merger = merging.IncrementalMerger(os.path.join(output_dir, f"{prefix}_{uuid.uuid4()}.pdf"))
+    try:
+        merger.add(file_path, plan)
+        return merger.finish()
+    except BaseException:
+        cleanup_files([merger.output_path])
+        raise
+
+def remove_pdf_pages(file_path: str, pages_to_remove: List[int], output_dir: str = OUTPUT_DIR) -> str:
     # pages_to_remove is 1-based index list
-    reader = PyPDF2.PdfReader(file_path)
-    writer = PyPDF2.PdfWriter()
-    
-    for i, page in enumerate(reader.pages):
-        if (i + 1) not in pages_to_remove:
-            writer.add_page(page)
-            
-    output_filename = f"edited_{uuid.uuid4()}.pdf"
-    output_path = os.path.join(OUTPUT_DIR, output_filename)
-    
-    with open(output_path, "wb") as f:
-        writer.write(f)
-        
-    return output_path
+    return organize_pdf(file_path, remove=pages_to_remove, output_dir=output_dir, prefix="edited")
+
+def validate_image_pdf_preset(preset: str) -> str:
+    preset = str(preset).lower()
+    if preset not in IMAGE_PDF_PRESETS:
+        raise HTTPException(status_code=400, detail=f"Preset must be one of {list(IMAGE_PDF_PRESETS)}")
+    return preset
 
-def image_to_pdf(image_paths: List[str]) -> str:
-    # Use img2pdf for better quality or PIL
-    # img2pdf is good for exact embedding suitable for photos/scans
-    # If images have different sizes, img2pdf handles it well.
-    
+def image_to_pdf(image_paths: List[str], preset: str = DEFAULT_IMAGE_PDF_PRESET, progress=None,
+                 output_dir: str = OUTPUT_DIR) -> str:
+    """
+    Writes one page per image (per frame for GIF/TIFF) straight to the
+    output file. Images are prepared (decoded, downscaled, re-encoded as
+    the preset says) on the process pool, a few ahead of the writer, and
+    written in upload order. Must not itself run on the process pool.
+    """
     output_filename = f"images_{uuid.uuid4()}.pdf"
-    output_path = os.path.join(OUTPUT_DIR, output_filename)
-    
-    with open(output_path, "wb") as f:
-        # img2pdf.convert wants bytes or filenames
-        f.write(img2pdf.convert(image_paths))
-        
-    return output_path
+    output_path = os.path.join(output_dir, output_filename)
+    work_dir = tempfile.mkdtemp(prefix="images_", dir=output_dir)
+    writer = imaging.ImagePdfWriter(output_path)
+    pool = get_process_pool()
+    window = max(2, CPU_WORKERS)
+    pending = iter(image_paths)
+    futures = []
+
+    def submit_next():
+        path = next(pending, None)
+        if path is not None:
+            futures.append(pool.submit(imaging.prepare_image, path, preset, work_dir))
+
+    try:
+        for _ in range(window):
+            submit_next()
+        done = 0
+        while futures:
+            pages = futures.pop(0).result()
+            submit_next()
+            for page in pages:
+                writer.add(page)
+                if page.temporary:
+                    cleanup_files([page.data_path])
+            done += 1
+            if progress:
+                progress(done, len(image_paths))
+        metrics.count_pages("image-to-pdf", writer.page_count)
+        return writer.finish()
+    except BaseException:
+        for future in futures:
+            future.cancel()
+        cleanup_files([output_path])
+        raise
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
 
-def convert_image_format(input_path: str, format: str) -> str:
+IMAGE_EXTENSIONS = {"JPEG": "jpg", "PNG": "png", "WEBP": "webp", "BMP": "bmp", "GIF": "gif"}
+MAX_IMAGE_SIDE = 20000
+
+def validate_image_convert_options(format: str, width: int = 0, height: int = 0, quality: Optional[int] = None,
+                                   encoder: str = DEFAULT_ENCODER_PRESET) -> dict:
+    """
+    Options for /image/convert. width/height bound the output size (0
+    keeps it), without a quality the format's default is used (quality 0
+    in the result).
+    """
+    format = str(format).upper()
+    if format == "JPG":
+        format = "JPEG"
+    if format not in IMAGE_FORMATS:
+        raise HTTPException(status_code=400, detail=f"Format must be one of {IMAGE_FORMATS}")
+    try:
+        width, height = int(width or 0), int(height or 0)
+        quality = None if quality in (None, "") else int(quality)
+    except (TypeError, ValueError):
+        raise HTTPException(status_code=400, detail="Width, height and quality must be integers.")
+    if not (0 <= width <= MAX_IMAGE_SIDE and 0 <= height <= MAX_IMAGE_SIDE):
+        raise HTTPException(status_code=400, detail=f"Width and height must be between 0 and {MAX_IMAGE_SIDE}.")
+    if quality is None:
+        quality = 0
+    elif not 1 <= quality <= 100:
+        raise HTTPException(status_code=400, detail="Quality must be between 1 and 100.")
+    encoder = str(encoder).lower()
+    if encoder not in ENCODER_PRESETS:
+        raise HTTPException(status_code=400, detail=f"Encoder must be one of {list(ENCODER_PRESETS)}")
+    return {"format": format, "width": width, "height": height, "quality": quality, "encoder": encoder}
+
+def convert_image_format(input_path: str, format: str, width: int = 0, height: int = 0, quality: int = 0,
+                         encoder: str = DEFAULT_ENCODER_PRESET, output_dir: str = OUTPUT_DIR) -> str:
     # format: 'PNG', 'JPEG', etc.
-    img = Image.open(input_path)
-    # Convert to RGB if saving as JPEG
-    if format.upper() == 'JPEG' and img.mode != 'RGB':
-        img = img.convert('RGB')
-        
+    format = format.upper()
     output_filename = f"{os.path.splitext(os.path.basename(input_path))[0]}.{format.lower()}"
-    output_path = os.path.join(OUTPUT_DIR, output_filename)
-    img.save(output_path, format=format.upper())
-    return output_path
+    output_path = os.path.join(output_dir, output_filename)
+    return imaging.convert_image(input_path, output_path, format, width or None, height or None, quality or None, encoder)
+
+def _image_batches(items: list, workers: int, max_batch: int = 16):
+    # A few images per task amortizes the round trip to the worker, but
+    # small batches still use every worker
+    size = max(1, min(max_batch, -(-len(items) // (2 * max(1, workers)))))
+    return [items[i:i + size] for i in range(0, len(items), size)]
+
+def iter_convert_images(items: List[BatchItem], output_dir: str, options: dict, manifest: BatchManifest = None,
+                        cached: dict = None, store=None):
+    """
+    Converts a batch of images on the process pool, a few per task, and
+    yields (arcname, path) in upload order as tasks finish, then
+    ("manifest.json", path). Same contract as iter_convert_batch.
+    """
+    format = options["format"]
+    extension = "." + IMAGE_EXTENSIONS[format]
+    manifest = manifest or BatchManifest(extension)
+    cached = cached or {}
+    todo = [item for item in items if item.input_path not in cached]
+    batches = iter(_image_batches(todo, CPU_WORKERS))
+    pool = get_process_pool()
+    window = max(2, CPU_WORKERS)
+    futures = []
+
+    def submit_next():
+        batch = next(batches, None)
+        if batch is not None:
+            jobs = [imaging.ImageJob(item.input_path, os.path.join(output_dir, f"{uuid.uuid4()}{extension}")) for item in batch]
+            futures.append((batch, jobs, pool.submit(
+                imaging.convert_images, jobs, format, options["width"] or None, options["height"] or None,
+                options["quality"] or None, options["encoder"]
+            )))
+
+    try:
+        for item in items:
+            if item.input_path in cached:
+                path = cached[item.input_path]
+                yield manifest.add(item.index, item.name, path, cached=True), path
+
+        for _ in range(window):
+            submit_next()
+        while futures:
+            batch, jobs, future = futures.pop(0)
+            errors = future.result()
+            submit_next()
+            for item, job, error in zip(batch, jobs, errors):
+                if error:
+                    cleanup_files([job.output_path])
+                    manifest.add(item.index, item.name, error=error)
+                    continue
+                if store is not None:
+                    store(item.input_path, job.output_path)
+                yield manifest.add(item.index, item.name, job.output_path), job.output_path
+        yield "manifest.json", manifest.write(output_dir)
+    finally:
+        for batch, jobs, future in futures:
+            future.cancel()
+
+RENDER_FORMATS = {
+    # format: (pdftoppm format, extension)
+    "JPEG": ("jpeg", "jpg"),
+    "PNG": ("png", "png"),
+    # pdftoppm can't write WEBP, pages are rendered as PNG and re-encoded
+    "WEBP": ("png", "webp"),
+}
+
+def validate_render_options(dpi: int, format: str, quality: int) -> dict:
+    try:
+        dpi, quality = int(dpi), int(quality)
+    except (TypeError, ValueError):
+        raise HTTPException(status_code=400, detail="DPI and quality must be integers.")
+    format = str(format).upper()
+    if format == "JPG":
+        format = "JPEG"
+    if format not in RENDER_FORMATS:
+        raise HTTPException(status_code=400, detail=f"Format must be one of {list(RENDER_FORMATS)}")
+    if not 36 <= dpi <= 600:
+        raise HTTPException(status_code=400, detail="DPI must be between 36 and 600.")
+    if not 1 <= quality <= 100:
+        raise HTTPException(status_code=400, detail="Quality must be between 1 and 100.")
+    return {"dpi": dpi, "format": format, "quality": quality}
+
+def parse_page_ranges(spec: Optional[str], page_count: int) -> List[int]:
+    """
+    Parses a page selection like "1-5,8,10-" (1-based, "-3" means up to 3,
+    "10-" means 10 to the end) into a list of page numbers in the given
+    order. An empty spec or "all" selects every page.
+    """
+    if spec is None or spec.strip().lower() in ("", "all"):
+        return list(range(1, page_count + 1))
+
+    pages = []
+    for part in spec.split(","):
+        part = part.strip()
+        if not part:
+            continue
+        try:
+            if "-" in part:
+                start, end = part.split("-", 1)
+                start = int(start) if start.strip() else 1
+                end = int(end) if end.strip() else page_count
+            else:
+                start = end = int(part)
+        except ValueError:
+            raise ValueError(f"Invalid page range: {part!r}")
+        if not (1 <= start <= page_count and 1 <= end <= page_count):
+            raise ValueError(f"Page range {part!r} is outside 1-{page_count}")
+        step = 1 if end >= start else -1
+        pages.extend(range(start, end + step, step))
+    if not pages:
+        raise ValueError("Page selection is empty")
+    return pages
+
+def _page_chunks(pages: List[int], size: int):
+    # Contiguous runs of pages, cut into chunks of at most `size` pages
+    chunk = []
+    for page in pages:
+        if chunk and (page != chunk[-1] + 1 or len(chunk) >= size):
+            yield chunk
+            chunk = []
+        chunk.append(page)
+    if chunk:
+        yield chunk
+
+def get_pdf_page_count(file_path: str) -> int:
+    with open(file_path, "rb") as f:
+        reader = PyPDF2.PdfReader(f)
+        if reader.is_encrypted and not reader.decrypt(""):
+            raise ValueError(f"{os.path.basename(file_path)} is password protected.")
+        return len(reader.pages)
+
+# Parsed structure of recently seen PDFs by digest, in front of the result cache
+PDF_INFO_MEMO_SIZE = 256
+_pdf_info_memo: "OrderedDict[str, dict]" = OrderedDict()
+
+def _write_json(path: str, data):
+    with open(path, "w") as f:
+        json.dump(data, f)
+
+def _take_json(path: str):
+    # Reads and removes a JSON file
+    with open(path) as f:
+        data = json.load(f)
+    os.remove(path)
+    return data
+
+async def get_pdf_info(saved: SavedUpload, scratch_dir: str):
+    """
+    Page count, page sizes, outline and encryption of an uploaded PDF as
+    (info, hit). Parsed once per digest, then served from memory or the
+    result cache.
+    """
+    info = _pdf_info_memo.get(saved.sha256)
+    if info is not None:
+        _pdf_info_memo.move_to_end(saved.sha256)
+        return info, True
+
+    async def produce():
+        result = await run_cpu_bound("pdf-info", pdfinfo.read_pdf_info, saved.path)
+        path = os.path.join(scratch_dir, f"info_{uuid.uuid4()}.json")
+        await asyncio.to_thread(_write_json, path, result)
+        return path
+
+    try:
+        path, hit = await cached_call("pdf-info", saved.sha256, None, produce, scratch_dir)
+    except PyPDF2.errors.PdfReadError as e:
+        raise HTTPException(status_code=400, detail=f"Could not read the PDF: {e}")
+    info = await asyncio.to_thread(_take_json, path)
+    _pdf_info_memo[saved.sha256] = info
+    while len(_pdf_info_memo) > PDF_INFO_MEMO_SIZE:
+        _pdf_info_memo.popitem(last=False)
+    return info, hit
+
+THUMBNAIL_WIDTH = 200
+MAX_THUMBNAIL_WIDTH = 800
+MAX_THUMBNAIL_PAGES = 50
+
+def validate_thumbnail_options(pages: str, width: int, page_count: int) -> List[int]:
+    """Pages to render: the selection, or the first few pages if there is none."""
+    if not 32 <= width <= MAX_THUMBNAIL_WIDTH:
+        raise HTTPException(status_code=400, detail=f"Width must be between 32 and {MAX_THUMBNAIL_WIDTH}.")
+    try:
+        selected = parse_page_ranges(pages or f"1-{min(page_count, 12)}", page_count)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    selected = list(dict.fromkeys(selected))
+    if len(selected) > MAX_THUMBNAIL_PAGES:
+        raise HTTPException(status_code=400, detail=f"At most {MAX_THUMBNAIL_PAGES} pages per request.")
+    return selected
+
+def iter_pdf_to_images(file_path: str, output_dir: str = OUTPUT_DIR, dpi: int = 200, format: str = "JPEG",
+                       quality: int = 75, pages: Optional[str] = None, progress=None,
+                       page_count: Optional[int] = None):
+    """
+    Rasterizes the selected pages with pdftoppm and yields the image paths
+    in page order as each chunk finishes. pdftoppm writes straight to files
+    and every chunk is rendered by several pdftoppm processes in parallel,
+    so memory use doesn't grow with the page count. A page selected more
+    than once is rendered once.
+    """
+    format = format.upper()
+    ppm_format, ext = RENDER_FORMATS[format]
+    # Repeats would render to the same file and repeat a ZIP member name
+    page_list = list(dict.fromkeys(parse_page_ranges(pages, page_count or get_pdf_page_count(file_path))))
+    base_name = os.path.splitext(os.path.basename(file_path))[0]
+    done = 0
+
+    for chunk in _page_chunks(page_list, PDF_RENDER_CHUNK_PAGES):
+        # Private folder per chunk, pdf2image lists the folder to find pages
+        chunk_dir = tempfile.mkdtemp(prefix="render_", dir=output_dir)
+        kwargs = {}
+        if ppm_format == "jpeg":
+            kwargs["jpegopt"] = {"quality": quality, "progressive": False, "optimize": False}
+        try:
+            rendered = pdf2image.convert_from_path(
+                file_path,
+                dpi=dpi,
+                first_page=chunk[0],
+                last_page=chunk[-1],
+                fmt=ppm_format,
+                output_folder=chunk_dir,
+                output_file="page",
+                paths_only=True,
+                thread_count=min(PDF_RENDER_THREADS, len(chunk)),
+                **kwargs
+            )
+        except Exception:
+            shutil.rmtree(chunk_dir, ignore_errors=True)
+            raise
+        # pdftoppm names pages <prefix>-<n>, sorted order is page order
+        rendered = sorted(rendered)
+        try:
+            for page, path in zip(chunk, rendered):
+                out_path = os.path.join(output_dir, f"{base_name}_page_{page}.{ext}")
+                if format == "WEBP":
+                    with Image.open(path) as img:
+                        img.save(out_path, "WEBP", quality=quality)
+                    os.remove(path)
+                else:
+                    os.replace(path, out_path)
+                done += 1
+                metrics.count_pages("pdf-to-images", 1)
+                if progress:
+                    progress(done, len(page_list))
+                yield out_path
+        finally:
+            shutil.rmtree(chunk_dir, ignore_errors=True)
 
-def pdf_to_images(file_path: str) -> List[str]:
+def pdf_to_images(file_path: str, progress=None, dpi: int = 200, format: str = "JPEG",
+                  quality: int = 75, pages: Optional[str] = None) -> List[str]:
     # Returns list of image paths.
     # Requires poppler installed for pdf2image.
-    # User didn't specify poppler, but pdf2image needs it. I will assume it's there or give instructions.
-    
-    try:
-        images = pdf2image.convert_from_path(file_path)
-        output_paths = []
-        base_name = os.path.splitext(os.path.basename(file_path))[0]
-        
-        for i, img in enumerate(images):
-            out_name = f"{base_name}_page_{i+1}.jpg"
-            out_path = os.path.join(OUTPUT_DIR, out_name)
-            img.save(out_path, 'JPEG')
-            output_paths.append(out_path)
-            
-        return output_paths
+    try:
+        return list(iter_pdf_to_images(file_path, dpi=dpi, format=format, quality=quality,
+                                       pages=pages, progress=progress))
     except Exception as e:
-        print(f"Error converting PDF to images: {e}")
+        logger.error("Error converting PDF to images", extra={"error": str(e)})
         raise e
 
-
-def create_zip_from_files(file_paths: List[str], zip_name: str) -> str:
-    zip_path = os.path.join(OUTPUT_DIR, zip_name)
-    from zipfile import ZipFile
-    with ZipFile(zip_path, 'w') as zipf:
-        for file in file_paths:
-            zipf.write(file, os.path.basename(file))
+def pdf_to_images_zip(file_path: str, progress=None, dpi: int = 200, format: str = "JPEG",
+                      quality: int = 75, pages: Optional[str] = None, output_dir: str = OUTPUT_DIR) -> str:
+    """
+    Like pdf_to_images, but adds every page to a ZIP as soon as it is
+    rendered and deletes the page file, so at most one chunk of pages is on
+    disk besides the archive.
+    """
+    zip_path = os.path.join(output_dir, f"images_{uuid.uuid4()}.zip")
+    try:
+        pages_iter = iter_pdf_to_images(file_path, output_dir=output_dir, dpi=dpi, format=format, quality=quality,
+                                        pages=pages, progress=progress)
+        with open(zip_path, "wb") as out:
+            for chunk in iter_zip((member_name(p, file_path), p) for p in pages_iter):
+                out.write(chunk)
+    except Exception as e:
+        logger.error("Error converting PDF to images", extra={"error": str(e)})
+        cleanup_files([zip_path])
+        raise e
     return zip_path
 
+
+# Entries that are already compressed are STORED, deflating them again only
+# costs CPU
+STORED_EXTENSIONS = {".jpg", ".jpeg", ".png", ".webp", ".gif", ".pdf", ".zip", ".docx", ".xlsx", ".pptx"}
+# Members get a fixed timestamp, so the same inputs always give the same
+# archive bytes and its ETag (the cache key) can be a strong one
+ZIP_DATE_TIME = (1980, 1, 1, 0, 0, 0)
+
+class _ZipSink:
+    """
+    Write-only, non-seekable target for ZipFile. zipfile then writes data
+    descriptors instead of seeking back, so the archive can be sent while
+    it is being written.
+    """
+    def __init__(self):
+        self._chunks = []
+
+    def write(self, data) -> int:
+        self._chunks.append(bytes(data))
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def take(self) -> bytes:
+        data = b"".join(self._chunks)
+        self._chunks.clear()
+        return data
+
+def member_name(path: str, source_path: str) -> str:
+    """
+    Name in a ZIP for an output named after its source file, without the
+    source's random upload name: <id>_page_3.pdf -> page_3.pdf.
+    """
+    name = os.path.basename(path)
+    stem = os.path.splitext(os.path.basename(source_path))[0]
+    if not name.startswith(stem):
+        return name
+    return name[len(stem):].lstrip("_") or name
+
+def iter_zip(entries, chunk_size: int = 1024 * 1024):
+    """
+    Yields the bytes of a ZIP archive built from `entries`, an iterable of
+    (arcname, path). Each file is deleted once it is in the archive, and
+    the archive itself never touches the disk. ZIP64 is used automatically
+    for large members and archives.
+    """
+    from zipfile import ZipFile, ZipInfo, ZIP_STORED, ZIP_DEFLATED
+    sink = _ZipSink()
+    with ZipFile(sink, 'w', allowZip64=True) as zipf:
+        for arcname, path in entries:
+            info = ZipInfo.from_file(path, arcname)
+            info.date_time = ZIP_DATE_TIME
+            ext = os.path.splitext(arcname)[1].lower()
+            info.compress_type = ZIP_STORED if ext in STORED_EXTENSIONS else ZIP_DEFLATED
+            try:
+                # from_file sets file_size, which makes zipfile pick ZIP64
+                # for members over 4GB
+                with open(path, "rb") as src, zipf.open(info, 'w') as dest:
+                    while True:
+                        chunk = src.read(chunk_size)
+                        if not chunk:
+                            break
+                        dest.write(chunk)
+                        data = sink.take()
+                        if data:
+                            yield data
+            finally:
+                cleanup_files([path])
+            data = sink.take()
+            if data:
+                yield data
+    # Central directory
+    data = sink.take()
+    if data:
+        yield data
+
 def cleanup_files(file_paths: List[str]):
     for path in file_paths:
         try:
             if os.path.exists(path):
                 os.remove(path)
         except Exception as e:
-            print(f"Error cleaning up {path}: {e}")
+            logger.warning("Error cleaning up file", extra={"path": path, "error": str(e)})
+
+
+# Execution layer
+#
+# Routes are async, so anything heavy has to leave the event loop. CPU-bound
+# PyPDF2/Pillow/pdf2image work goes to a process pool, subprocess-bound work
+# (LibreOffice) and file I/O to a thread pool. Slots are handed out by the
+# scheduler (see scheduler.py): per operation limits and bounded wait
+# queues, a light and a heavy lane by estimated cost and per-client
+# fairness; when a queue is full the request is rejected straight away with
+# Retry-After instead of piling up.
+
+# Process pool per scheduling lane: heavy work has workers of its own, so
+# light work never waits behind it for a process
+_process_pools = {}
+_thread_pool = None
+_LANE_WORKERS = {LIGHT: LIGHT_LANE_CONCURRENCY, HEAVY: HEAVY_LANE_CONCURRENCY}
+
+
+def get_process_pool(lane: str = None) -> ProcessPoolExecutor:
+    """The process pool of `lane`, by default of the current slot's lane."""
+    lane = lane or current_lane.get()
+    if lane not in _LANE_WORKERS:
+        lane = LIGHT
+    pool = _process_pools.get(lane)
+    if pool is None:
+        # spawn keeps workers clean of the server's threads and open sockets
+        pool = _process_pools[lane] = ProcessPoolExecutor(
+            max_workers=_LANE_WORKERS[lane], mp_context=multiprocessing.get_context("spawn")
+        )
+    return pool
+
+def get_thread_pool() -> ThreadPoolExecutor:
+    global _thread_pool
+    if _thread_pool is None:
+        _thread_pool = ThreadPoolExecutor(max_workers=IO_WORKERS, thread_name_prefix="toolkit-io")
+    return _thread_pool
+
+def prewarm_process_pool() -> float:
+    """
+    Starts every process pool worker and has it import what its tasks
+    need, returns the seconds that took.
+    """
+    started = time.perf_counter()
+    futures = []
+    for lane, workers in _LANE_WORKERS.items():
+        pool = get_process_pool(lane)
+        # The pool starts another worker for each task submitted while the
+        # others are busy
+        futures += [pool.submit(import_modules, ("utils",) + HEAVY_MODULES) for _ in range(workers)]
+    for future in futures:
+        future.result()
+    return time.perf_counter() - started
+
+
+def shutdown_executors(wait: bool = False):
+    global _thread_pool
+    for lane in list(_process_pools):
+        _process_pools.pop(lane).shutdown(wait=wait, cancel_futures=True)
+    if _thread_pool is not None:
+        _thread_pool.shutdown(wait=wait, cancel_futures=True)
+        _thread_pool = None
+
+metrics.Gauge(
+    "toolkit_temp_dir_bytes", "Disk used by the temporary directories.", ("directory",),
+    collect=metrics.disk_usage_collector({**temp_roots(), "cache": CACHE_DIR, "jobs": JOBS_DIR}),
+)
+
+async def run_cpu_bound(operation: str, func, *args, **kwargs):
+    # func and its arguments must be picklable (module level functions)
+    async with operation_slot(operation):
+        loop = asyncio.get_running_loop()
+        pool = get_process_pool()
+        try:
+            with metrics.stage(operation, "processing"):
+                return await loop.run_in_executor(pool, functools.partial(func, *args, **kwargs))
+        except BrokenProcessPool:
+            # A worker died (e.g. OOM killed), start over with a fresh pool
+            for lane, current in list(_process_pools.items()):
+                if current is pool:
+                    del _process_pools[lane]
+            pool.shutdown(wait=False, cancel_futures=True)
+            raise Exception(f"Worker process crashed while running '{operation}'.")
+
+async def run_io_bound(operation: str, func, *args, **kwargs):
+    async with operation_slot(operation):
+        loop = asyncio.get_running_loop()
+        # In the slot's context, so process pool work it starts stays in its lane
+        context = contextvars.copy_context()
+        with metrics.stage(operation, "processing"):
+            return await loop.run_in_executor(get_thread_pool(), functools.partial(context.run, func, *args, **kwargs))
+
+_END = object()
+
+def _close_quietly(iterator):
+    try:
+        iterator.close()
+    except Exception as e:
+        logger.warning("Error closing stream", extra={"error": str(e)})
+
+async def iterate_in_thread(iterator):
+    """
+    Async wrapper around a blocking generator; every step runs on the
+    thread pool. Closing the wrapper (e.g. client disconnect) closes the
+    generator once its current step is done, so its cleanup still runs.
+    """
+    pending = None
+    context = contextvars.copy_context()
+    try:
+        while True:
+            pending = get_thread_pool().submit(context.run, next, iterator, _END)
+            item = await asyncio.wrap_future(pending)
+            pending = None
+            if item is _END:
+                return
+            yield item
+    finally:
+        if pending is not None and not pending.done():
+            pending.add_done_callback(lambda _f: _close_quietly(iterator))
+        else:
+            _close_quietly(iterator)
+
+def write_chunks(chunks, path: str) -> str:
+    with open(path, "wb") as f:
+        for chunk in chunks:
+            f.write(chunk)
+    return path
+
+async def zip_streaming_response(chunks, zip_name: str, operation: str, headers: dict = None,
+                                 etag: Optional[str] = None, resume_to: Optional[str] = None):
+    """
+    Streams a ZIP produced by the blocking generator `chunks` (see iter_zip)
+    while holding an operation slot. The first chunk is produced before
+    the response starts, so bad input still fails with a proper status.
+
+    etag identifies the archive (the cache key it is stored under). A range
+    can only be cut from the whole archive, so requests resuming a download
+    pass resume_to, where it is written before being served as a file.
+    """
+    headers = dict(headers or {})
+    if resume_to is not None:
+        path = await run_io_bound(operation, write_chunks, chunks, resume_to)
+        return DownloadResponse(path, zip_name, "application/zip", digest=etag, headers=headers)
+    if etag is not None:
+        headers.update({"ETag": strong_etag(etag), "Accept-Ranges": "bytes"})
+
+    release = await acquire_operation_slot(operation)
+    body = iterate_in_thread(chunks)
+    # Producing the chunks (the work itself and zipping it) is the "zip"
+    # stage; only the part before the first chunk makes it into the
+    # Server-Timing header, the metric gets all of it
+    timings = metrics.current_timings.get()
+    started = time.perf_counter()
+    try:
+        first = await body.__anext__()
+    except StopAsyncIteration:
+        first = b""
+    except BaseException:
+        release()
+        await body.aclose()
+        raise
+    producing = time.perf_counter() - started
+    if timings is not None:
+        timings.add("zip", producing)
+
+    async def stream():
+        nonlocal producing
+        try:
+            if first:
+                yield first
+            while True:
+                started = time.perf_counter()
+                try:
+                    chunk = await body.__anext__()
+                except StopAsyncIteration:
+                    break
+                elapsed = time.perf_counter() - started
+                producing += elapsed
+                if timings is not None:
+                    timings.add("zip", elapsed)
+                yield chunk
+        except Exception as e:
+            # Headers are gone already, all we can do is cut the stream
+            logger.error("Error while streaming ZIP", extra={"zip_name": zip_name, "error": str(e)})
+            raise
+        finally:
+            metrics.STAGE_DURATION.observe(producing, operation=operation, stage="zip")
+            await body.aclose()
+            release()
+
+    return ZipStreamingResponse(
+        stream(),
+        media_type='application/zip',
+        headers={"Content-Disposition": content_disposition(zip_name), **headers}
+    )
@@ -0,0 +1,377 @@
+import math
+import re
+import shutil
+import zipfile
+from typing import Dict, List, NamedTuple, Optional
+from xml.parsers import expat
+from xml.sax.saxutils import escape
+
+from openpyxl.packaging.relationship import get_dependents, get_rels_path
+from openpyxl.reader.workbook import WorkbookParser
+from openpyxl.utils import column_index_from_string, get_column_letter
+from openpyxl.xml.constants import ARC_ROOT_RELS, REL_NS
+
+# XLSX preflight before /convert/excel-to-pdf hands a workbook to LibreOffice.
+#
+# LibreOffice prints every visible sheet from A1 to the last cell that has
+# content or formatting, so one formatted cell at row 1,048,576 turns into
+# thousands of blank pages. Each sheet's used range (the last row and
+# column with a value) is found by streaming its XML once, and the sheet
+# then gets that range as its print area and is scaled to the page width,
+# unless it has a print area of its own. Sheets beyond the cell or page
+# budget are either rejected (WorkbookTooLarge) or cut down to the budget
+# (truncate).
+#
+# openpyxl reads the workbook part, relationships and defined names. Its
+# read-only cell reader converts every value (and scans a sheet twice when
+# it has no <dimension>), several times slower than the scan here, which
+# only notes which cells have a value. The edits only touch the workbook
+# part and the start and end of each sheet part; the rows in between are
+# copied through in chunks, so memory use stays flat however large the
+# sheets are.
+
+# Printable area of an A4 page with the default margins, in points
+PAGE_WIDTH = 595 - 2 * 0.7 * 72
+PAGE_HEIGHT = 842 - 2 * 0.75 * 72
+# Default column width (8.43 characters) and row height, in points
+COLUMN_WIDTH = 48
+ROW_HEIGHT = 15
+# Smallest scale a spreadsheet application prints at
+MIN_SCALE = 0.1
+
+COPY_CHUNK = 1024 * 1024
+OFFICE_DOCUMENT = REL_NS + "/officeDocument"
+WORKSHEET = REL_NS + "/worksheet"
+DRAWING = REL_NS + "/drawing"
+
+# Children of <c> that give it a value (a formula is calculated on load)
+_VALUE_TAGS = frozenset(("v", "is", "f"))
+_ANCHOR = re.compile(rb"<(?:\w+:)?(twoCellAnchor|oneCellAnchor|absoluteAnchor)\b.*?</(?:\w+:)?\1>", re.S)
+_ANCHOR_CELL = re.compile(rb"<(?:\w+:)?col>(\d+)</(?:\w+:)?col>.*?<(?:\w+:)?row>(\d+)</", re.S)
+_ANCHOR_POINT = re.compile(rb'<(?:\w+:)?pos\s+x="(\d+)"\s+y="(\d+)"')
+_ANCHOR_EXT = re.compile(rb'<(?:\w+:)?ext\s+cx="(\d+)"\s+cy="(\d+)"')
+EMU_PER_POINT = 12700
+# Children of <worksheet> that follow <pageSetup>
+_AFTER_PAGE_SETUP = ("headerFooter", "rowBreaks", "colBreaks", "customProperties", "cellWatches",
+                     "ignoredErrors", "smartTags", "drawing", "legacyDrawing", "legacyDrawingHF", "drawingHF",
+                     "picture", "oleObjects", "controls", "webPublishItems", "tableParts", "extLst")
+
+
+class WorkbookTooLarge(ValueError):
+    """The workbook's used cells or estimated pages exceed the budget."""
+
+
+class SheetPlan(NamedTuple):
+    name: str
+    index: int          # position in the workbook, localSheetId of its print area
+    path: str           # sheet part in the package
+    rows: int           # used range, 0 when the sheet is empty
+    columns: int
+    pages: int          # estimated
+    truncated: bool
+    keep_print_area: bool
+    hidden: bool        # nothing of it is printed
+
+
+def _scale(columns: int, fit_to_width: bool) -> float:
+    if not fit_to_width:
+        return 1.0
+    return max(MIN_SCALE, min(1.0, PAGE_WIDTH / (columns * COLUMN_WIDTH)))
+
+
+def _layout(columns: int, fit_to_width: bool):
+    # (pages across, rows per page) of a sheet `columns` wide
+    scale = _scale(columns, fit_to_width)
+    return math.ceil(columns * COLUMN_WIDTH * scale / PAGE_WIDTH), max(1, int(PAGE_HEIGHT / (ROW_HEIGHT * scale)))
+
+
+def estimate_pages(rows: int, columns: int, fit_to_width: bool = True) -> int:
+    """Pages a range prints on, assuming default column widths and row heights."""
+    if not rows or not columns:
+        return 0
+    across, per_page = _layout(columns, fit_to_width)
+    return across * math.ceil(rows / per_page)
+
+
+def _rows_within(pages: int, columns: int, fit_to_width: bool) -> int:
+    across, per_page = _layout(columns, fit_to_width)
+    return max(0, pages // across) * per_page
+
+
+def _workbook_part(archive: zipfile.ZipFile) -> str:
+    return next(get_dependents(archive, ARC_ROOT_RELS).find(OFFICE_DOCUMENT)).target
+
+
+def _anchor_end(anchor: bytes):
+    # (row, column) a drawing reaches, 1-based
+    cells = _ANCHOR_CELL.findall(anchor)
+    if len(cells) > 1:
+        # The cell it ends in
+        return int(cells[-1][1]) + 1, int(cells[-1][0]) + 1
+    ext = _ANCHOR_EXT.search(anchor)
+    width, height = (int(ext.group(1)), int(ext.group(2))) if ext else (0, 0)
+    if cells:
+        row, column = int(cells[0][1]), int(cells[0][0])
+    else:
+        point = _ANCHOR_POINT.search(anchor)
+        x, y = (int(point.group(1)), int(point.group(2))) if point else (0, 0)
+        row, column = 0, 0
+        width, height = width + x, height + y
+    return (row + math.ceil(height / EMU_PER_POINT / ROW_HEIGHT) + 1,
+            column + math.ceil(width / EMU_PER_POINT / COLUMN_WIDTH) + 1)
+
+
+def _drawing_extent(archive: zipfile.ZipFile, sheet_part: str):
+    # (rows, columns) covered by the sheet's charts and pictures
+    rels_path = get_rels_path(sheet_part)
+    if rels_path not in archive.NameToInfo:
+        return 0, 0
+    rows = columns = 0
+    for rel in get_dependents(archive, rels_path).find(DRAWING):
+        if rel.target not in archive.NameToInfo:
+            continue
+        for anchor in _ANCHOR.finditer(archive.read(rel.target)):
+            row, column = _anchor_end(anchor.group(0))
+            rows, columns = max(rows, row), max(columns, column)
+    return rows, columns
+
+
+class _OverBudget(Exception):
+    pass
+
+
+class _UsedRange:
+    """
+    expat handlers following <row> and <c> (whose r attributes are
+    optional) and noting the last row and column that have a value.
+    """
+    def __init__(self, max_cells: Optional[int], max_pages: Optional[int], fit_to_width: bool):
+        self.max_cells = max_cells
+        self.max_pages = max_pages
+        self.fit_to_width = fit_to_width
+        self.row = self.column = 0
+        self.rows = self.columns = 0
+
+    def check(self):
+        if self.max_cells is not None and self.rows * self.columns > self.max_cells:
+            raise _OverBudget()
+        if self.max_pages is not None and estimate_pages(self.rows, self.columns, self.fit_to_width) > self.max_pages:
+            raise _OverBudget()
+
+    def start(self, name, attributes):
+        tag = name.rpartition(":")[2]
+        if tag == "c":
+            ref = attributes.get("r")
+            self.column = column_index_from_string(ref.rstrip("0123456789")) if ref else self.column + 1
+        elif tag in _VALUE_TAGS:
+            if self.row > self.rows:
+                self.rows = self.row
+            if self.column > self.columns:
+                self.columns = self.column
+        elif tag == "row":
+            # The rows before are complete
+            self.check()
+            ref = attributes.get("r")
+            self.row = int(ref) if ref else self.row + 1
+            self.column = 0
+
+
+def _used_range(archive: zipfile.ZipFile, part: str, max_cells: Optional[int], max_pages: Optional[int],
+                fit_to_width: bool):
+    """
+    Last row and column with a value. Stops early when the range outgrows
+    the budget and returns (rows, columns, over budget).
+    """
+    used = _UsedRange(max_cells, max_pages, fit_to_width)
+    parser = expat.ParserCreate()
+    parser.StartElementHandler = used.start
+    try:
+        with archive.open(part) as source:
+            while True:
+                chunk = source.read(COPY_CHUNK)
+                parser.Parse(chunk, not chunk)
+                if not chunk:
+                    break
+        used.check()
+    except _OverBudget:
+        return used.rows, used.columns, True
+    return used.rows, used.columns, False
+
+
+def plan_workbook(path: str, max_cells: int = 0, max_pages: int = 0, truncate: bool = False,
+                  fit_to_width: bool = True) -> List[SheetPlan]:
+    """
+    Reads the workbook's used ranges within the budgets (0 for none).
+    Raises WorkbookTooLarge when they are exceeded, unless `truncate`, in
+    which case the sheets that don't fit are cut down or hidden.
+    """
+    plans = []
+    cells = pages = 0
+    with zipfile.ZipFile(path) as archive:
+        workbook = WorkbookParser(archive, _workbook_part(archive), keep_links=False)
+        workbook.parse()
+        print_areas = {index for index, names in workbook.defined_names.by_sheet().items()
+                       if index != "global" and "_xlnm.Print_Area" in names}
+        for index, sheet in enumerate(workbook.sheets):
+            rel = workbook.rels.get(sheet.id)
+            if sheet.state != "visible" or rel is None or rel.Type != WORKSHEET:
+                # Hidden sheets aren't printed, chart sheets are left as they are
+                continue
+            cells_left = max_cells - cells if max_cells else None
+            pages_left = max_pages - pages if max_pages else None
+            if (cells_left is not None and cells_left <= 0) or (pages_left is not None and pages_left <= 0):
+                plans.append(SheetPlan(sheet.name, index, rel.target, 0, 0, 0, True, False, True))
+                continue
+            rows, columns, over = _used_range(archive, rel.target, cells_left, pages_left, fit_to_width)
+            if over and not truncate:
+                if cells_left is not None and rows * columns > cells_left:
+                    raise WorkbookTooLarge(f"The workbook has more than {max_cells} cells in use.")
+                raise WorkbookTooLarge(f"The workbook would print more than {max_pages} pages.")
+            if over:
+                limit = rows
+                if cells_left is not None:
+                    limit = min(limit, cells_left // columns)
+                if pages_left is not None:
+                    limit = min(limit, _rows_within(pages_left, columns, fit_to_width))
+                rows = limit
+            else:
+                # Charts and pictures may reach past the last value
+                drawn_rows, drawn_columns = _drawing_extent(archive, rel.target)
+                rows, columns = max(rows, drawn_rows), max(columns, drawn_columns)
+            sheet_pages = estimate_pages(rows, columns, fit_to_width)
+            cells += rows * columns
+            pages += sheet_pages
+            plans.append(SheetPlan(sheet.name, index, rel.target, rows, columns, sheet_pages, over,
+                                   index in print_areas and not over, not rows))
+
+    if plans and all(plan.hidden for plan in plans):
+        # A workbook needs a visible sheet, print an empty first page
+        plans[0] = plans[0]._replace(rows=1, columns=1, pages=1, hidden=False)
+    return plans
+
+
+def _set_attributes(tag: bytes, values: Dict[str, str]) -> bytes:
+    closing = b"/>" if tag.endswith(b"/>") else b">"
+    body = tag[:-len(closing)]
+    for name, value in values.items():
+        body = re.sub(rb'\s' + name.encode() + rb'="[^"]*"', b"", body)
+        body += f' {name}="{value}"'.encode()
+    return body + closing
+
+
+def _patch_head(head: bytes, prefix: bytes) -> bytes:
+    # Ask for fit to page in <sheetPr><pageSetUpPr/>
+    setup = re.search(rb"<" + prefix + rb"pageSetUpPr\b[^>]*>", head)
+    if setup:
+        return head[:setup.start()] + _set_attributes(setup.group(0), {"fitToPage": "1"}) + head[setup.end():]
+    element = b"<" + prefix + b'pageSetUpPr fitToPage="1"/>'
+    sheet_pr = re.search(rb"<" + prefix + rb"sheetPr\b[^>]*?(/?)>", head)
+    if sheet_pr and sheet_pr.group(1):
+        opened = sheet_pr.group(0)[:-2] + b">" + element + b"</" + prefix + b"sheetPr>"
+        return head[:sheet_pr.start()] + opened + head[sheet_pr.end():]
+    if sheet_pr:
+        end = head.index(b"</" + prefix + b"sheetPr>")
+        return head[:end] + element + head[end:]
+    root = re.search(rb"<" + prefix + rb"worksheet\b[^>]*>", head)
+    return head[:root.end()] + b"<" + prefix + b"sheetPr>" + element + b"</" + prefix + b"sheetPr>" + head[root.end():]
+
+
+def _patch_tail(tail: bytes, prefix: bytes) -> bytes:
+    # One page wide, as many pages tall as needed
+    values = {"fitToWidth": "1", "fitToHeight": "0"}
+    setup = re.search(rb"<" + prefix + rb"pageSetup\b[^>]*>", tail)
+    if setup:
+        return tail[:setup.start()] + _set_attributes(setup.group(0), values) + tail[setup.end():]
+    following = [m.start() for m in (re.search(rb"<" + prefix + name.encode() + rb"\b", tail)
+                                     for name in _AFTER_PAGE_SETUP) if m]
+    at = min(following) if following else tail.rindex(b"</" + prefix + b"worksheet>")
+    return tail[:at] + _set_attributes(b"<" + prefix + b"pageSetup/>", values) + tail[at:]
+
+
+def _copy_sheet(source, target):
+    # Copies a sheet part, patching what comes before and after <sheetData>
+    data = b""
+    while True:
+        chunk = source.read(COPY_CHUNK)
+        data += chunk
+        start = re.search(rb"<(\w+:)?sheetData\b[^>]*?(/?)>", data)
+        if start or not chunk:
+            break
+    prefix = re.search(rb"<(\w+:)?worksheet\b", data).group(1) or b""
+    if not start:
+        target.write(_patch_tail(_patch_head(data, prefix), prefix))
+        return
+    target.write(_patch_head(data[:start.start()], prefix) + start.group(0))
+    if start.group(2):
+        target.write(_patch_tail(data[start.end():] + source.read(), prefix))
+        return
+    end_tag = b"</" + prefix + b"sheetData>"
+    keep = len(end_tag) - 1
+    pending = data[start.end():]
+    while True:
+        end = pending.find(end_tag)
+        if end >= 0:
+            target.write(pending[:end])
+            target.write(_patch_tail(pending[end:] + source.read(), prefix))
+            return
+        chunk = source.read(COPY_CHUNK)
+        if not chunk:
+            # No end tag, LibreOffice gets the rest as it was
+            target.write(pending)
+            return
+        target.write(pending[:-keep])
+        pending = pending[-keep:] + chunk
+
+
+def _quote_sheet(name: str) -> str:
+    return "'" + name.replace("'", "''") + "'"
+
+
+def _patch_workbook(xml: bytes, plans: List[SheetPlan]) -> bytes:
+    root = re.search(rb"<(\w+:)?workbook\b", xml)
+    prefix = root.group(1) or b""
+    hidden = {plan.index for plan in plans if plan.hidden}
+    if hidden:
+        sheets = list(re.finditer(rb"<" + prefix + rb"sheet\b[^>]*>", xml))
+        for index in sorted(hidden, reverse=True):
+            sheet = sheets[index]
+            xml = xml[:sheet.start()] + _set_attributes(sheet.group(0), {"state": "hidden"}) + xml[sheet.end():]
+    names = []
+    for plan in plans:
+        if plan.hidden or plan.keep_print_area:
+            continue
+        # Replaces a print area of its own that was cut down
+        xml = re.sub(rb"<" + prefix + rb"definedName\b(?=[^>]*name=\"_xlnm\.Print_Area\")(?=[^>]*localSheetId=\""
+                     + str(plan.index).encode() + rb"\")[^>]*>.*?</" + prefix + rb"definedName>", b"", xml, flags=re.S)
+        area = f"{_quote_sheet(plan.name)}!$A$1:${get_column_letter(plan.columns)}${plan.rows}"
+        names.append(f'<{prefix.decode()}definedName name="_xlnm.Print_Area" localSheetId="{plan.index}">'
+                     f"{escape(area)}</{prefix.decode()}definedName>".encode())
+    if not names:
+        return xml
+    added = b"".join(names)
+    defined = re.search(rb"<" + prefix + rb"definedNames\b[^>]*?(/?)>", xml)
+    if defined and defined.group(1):
+        return (xml[:defined.start()] + b"<" + prefix + b"definedNames>" + added + b"</" + prefix + b"definedNames>"
+                + xml[defined.end():])
+    if defined:
+        end = xml.index(b"</" + prefix + b"definedNames>")
+        return xml[:end] + added + xml[end:]
+    end = xml.index(b"</" + prefix + b"sheets>") + len(b"</" + prefix + b"sheets>")
+    return xml[:end] + b"<" + prefix + b"definedNames>" + added + b"</" + prefix + b"definedNames>" + xml[end:]
+
+
+def write_workbook(path: str, output_path: str, plans: List[SheetPlan], fit_to_width: bool = True):
+    """Copies the workbook at `path` with the print settings of `plans`."""
+    patched = {plan.path for plan in plans if fit_to_width and not plan.hidden and not plan.keep_print_area}
+    with zipfile.ZipFile(path) as source, zipfile.ZipFile(output_path, "w", zipfile.ZIP_DEFLATED,
+                                                           compresslevel=1) as target:
+        workbook_part = _workbook_part(source)
+        for info in source.infolist():
+            if info.filename == workbook_part:
+                target.writestr(info.filename, _patch_workbook(source.read(info), plans))
+                continue
+            with source.open(info) as src, target.open(info.filename, "w", force_zip64=info.file_size > 2**30) as dst:
+                if info.filename in patched:
+                    _copy_sheet(src, dst)
+                else:
+                    shutil.copyfileobj(src, dst, COPY_CHUNK)